@@ -1,21 +1,85 @@
 import os
+import time
+import datetime
+import threading
 # `google.generativeai` は `genai` としてインポートするのが一般的
 from google import genai 
 # `types` も明示的にインポート
 from google.genai import types 
 from dotenv import load_dotenv
-from typing import List, Generator, Optional # 型ヒントをより明確に
+from typing import List, Generator, AsyncGenerator, Optional, Callable # 型ヒントをより明確に
+from utils.single_flight import SingleFlight, AsyncSingleFlight, request_key
+from utils.request_scheduler import FairScheduler, INTERACTIVE, get_request_scheduler
 
 load_dotenv() # .envファイルから環境変数を読み込む
 
+# 添付ファイルの送り方の設定 (環境変数で上書き可能)
+ATTACHMENT_INLINE_MAX_BYTES = int(os.getenv("ATTACHMENT_INLINE_MAX_BYTES", str(1024 * 1024))) # これ以下はリクエストに直接含め、超える場合は Files API にアップロードする
+GEMINI_FILE_REUSE_MARGIN = datetime.timedelta(minutes=int(os.getenv("GEMINI_FILE_REUSE_MARGIN_MINUTES", "60"))) # 有効期限までこれ以上残っているアップロード済みファイルを再利用する
+GEMINI_FILE_ACTIVE_TIMEOUT = float(os.getenv("GEMINI_FILE_ACTIVE_TIMEOUT", "120")) # アップロードしたファイルが使えるようになるまで待つ最大秒数
+# 同じ (モデル, システムプロンプト, 履歴) のストリーミングが同時に実行された場合に、API の呼び出しを1回にまとめる
+GENERATION_SINGLE_FLIGHT = os.getenv("GENERATION_SINGLE_FLIGHT", "1") != "0"
+
+# プロセス全体で共有する実行中のストリーム (GeminiClient のインスタンスをまたいでまとめる)
+_stream_flights = SingleFlight()
+_async_stream_flights = AsyncSingleFlight()
+
+def messages_to_contents(messages, prompt: Optional[str] = None,
+                         attachment_parts: Optional[dict] = None,
+                         prompt_parts: Optional[List[types.Part]] = None) -> List[types.Content]:
+    """
+    DB のメッセージ (role / content を持つオブジェクト) を API 用の履歴に変換します。
+    prompt を指定した場合は、最後にユーザーの入力として追加します。
+    attachment_parts (メッセージ ID -> 添付ファイルの Part のリスト) と prompt_parts は本文の前に置きます。
+    """
+    attachment_parts = attachment_parts or {}
+    # DBの 'assistant' を API の 'model' に変換
+    contents = [
+        types.Content(role='model' if m.role == 'assistant' else m.role,
+                      parts=[*attachment_parts.get(getattr(m, 'id', None), []), types.Part(text=m.content)])
+        for m in messages
+    ]
+    if prompt is not None:
+        contents.append(types.Content(role="user", parts=[*(prompt_parts or []), types.Part(text=prompt)]))
+    return contents
+
+def _update_usage(usage: Optional[dict], chunk) -> None:
+    """チャンクの usage_metadata を usage に書き込みます (最後のチャンクほど正確なので、届くたびに上書きする)。"""
+    usage_metadata = getattr(chunk, 'usage_metadata', None)
+    if usage is not None and usage_metadata is not None:
+        usage.update(
+            prompt_tokens=usage_metadata.prompt_token_count,
+            output_tokens=usage_metadata.candidates_token_count,
+            total_tokens=usage_metadata.total_token_count,
+        )
+
+def _record_first_token(usage: Optional[dict], chunk, started: float) -> None:
+    """最初にテキストを含むチャンクが届いた時点までの時間 (ミリ秒) を usage に書き込みます。"""
+    if usage is not None and "time_to_first_token_ms" not in usage and getattr(chunk, 'text', None):
+        usage["time_to_first_token_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+def _record_latency(usage: Optional[dict], started: float) -> None:
+    """ストリームの開始から終了 (中断・エラーを含む) までの時間 (ミリ秒) を usage に書き込みます。"""
+    if usage is not None:
+        usage["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
 class GeminiClient:
     """Gemini APIとの通信を行うクライアントクラス (gemini-sample.py ベース)"""
 
-    def __init__(self):
+    def __init__(self, client: Optional[genai.Client] = None, scheduler: Optional[FairScheduler] = None):
         """
         GeminiClientを初期化します。
         APIキーを環境変数から読み込み、クライアントをセットアップします。
+
+        Args:
+            client: 使用する genai.Client (負荷試験で疑似モデルに差し替える場合など)。省略時は API キーから作成します。
+            scheduler: ストリーミングの開始順を決めるスケジューラー。省略時はプロセスで共有のもの。
         """
+        self.scheduler = scheduler or get_request_scheduler()
+        if client is not None:
+            self.client = client
+            return
+
         api_key = os.getenv("GEMINI_API_KEY")
         if not api_key:
             raise ValueError("GEMINI_API_KEYが設定されていません。 .envファイルを確認してください。")
@@ -23,6 +87,67 @@ class GeminiClient:
         # genai.Client を使用してクライアントを初期化
         self.client = genai.Client(api_key=api_key)
 
+    def attachment_part(self, attachment, store) -> tuple[types.Part, Optional[types.File]]:
+        """
+        添付ファイル (models.Attachment) を API に送る Part にします。
+
+        - Files API にアップロード済みで、有効期限まで GEMINI_FILE_REUSE_MARGIN 以上残っていれば、その URI を再利用します。
+        - ATTACHMENT_INLINE_MAX_BYTES 以下の小さいファイルは、リクエストに直接含めます。
+        - それ以外は保存先 (utils.blob_store) からメモリマップで読みながら Files API にアップロードします。
+
+        Args:
+            attachment: 添付ファイル (sha256 / size_bytes / mime_type / filename / gemini_file_* を持つオブジェクト)。
+            store: utils.blob_store.BlobStore。
+
+        Returns:
+            (Part, 新しくアップロードした場合はその File。呼び出し側で crud.record_gemini_file に記録する)。
+        """
+        now = datetime.datetime.utcnow()
+        if (attachment.gemini_file_uri and attachment.gemini_file_expires_at
+                and attachment.gemini_file_expires_at - GEMINI_FILE_REUSE_MARGIN > now):
+            return types.Part.from_uri(file_uri=attachment.gemini_file_uri, mime_type=attachment.mime_type), None
+
+        with store.open(attachment.sha256) as blob:
+            if attachment.size_bytes <= ATTACHMENT_INLINE_MAX_BYTES:
+                return types.Part.from_bytes(data=blob.read(), mime_type=attachment.mime_type), None
+            uploaded = self.client.files.upload(
+                file=blob,
+                config=types.UploadFileConfig(mime_type=attachment.mime_type, display_name=attachment.filename),
+            )
+        # 動画などは処理が終わるまで使えない
+        deadline = time.monotonic() + GEMINI_FILE_ACTIVE_TIMEOUT
+        while uploaded.state == types.FileState.PROCESSING and time.monotonic() < deadline:
+            time.sleep(1.0)
+            uploaded = self.client.files.get(name=uploaded.name)
+        if uploaded.state == types.FileState.FAILED:
+            raise RuntimeError(f"添付ファイル {attachment.filename} の処理に失敗しました: {uploaded.error}")
+        return types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type or attachment.mime_type), uploaded
+
+    def attachment_parts(self, attachments: dict, store, on_upload: Optional[Callable] = None) -> dict:
+        """
+        キーごとの添付ファイルのリストを Part のリストに変換します (同じ添付ファイルは1回だけ読み込み・アップロードする)。
+
+        Args:
+            attachments: キー (メッセージ ID など) -> 添付ファイルのリスト。
+            store: utils.blob_store.BlobStore。
+            on_upload: 新しくアップロードしたときに (attachment, File) で呼ばれる関数 (参照の記録用)。
+
+        Returns:
+            キー -> Part のリスト。
+        """
+        parts_by_id: dict = {}
+        result = {}
+        for key, items in attachments.items():
+            result[key] = []
+            for attachment in items:
+                if attachment.id not in parts_by_id:
+                    part, uploaded = self.attachment_part(attachment, store)
+                    if uploaded is not None and on_upload is not None:
+                        on_upload(attachment, uploaded)
+                    parts_by_id[attachment.id] = part
+                result[key].append(parts_by_id[attachment.id])
+        return result
+
     def generate_content(self, 
                          model_name: str, 
                          history: List[types.Content],
@@ -71,7 +196,12 @@ class GeminiClient:
     def generate_content_stream(self, 
                               model_name: str,
                               history: List[types.Content],
-                              system_prompt: Optional[str] = None) -> Generator[str, None, None]:
+                              system_prompt: Optional[str] = None,
+                              usage: Optional[dict] = None,
+                              project_id: Optional[int] = None,
+                              user: Optional[str] = None,
+                              priority: str = INTERACTIVE,
+                              cancel_event: Optional[threading.Event] = None) -> Generator[str, None, None]:
         """
         指定されたモデル、履歴、システムプロンプトに基づいてコンテンツをストリーミング生成します。
 
@@ -79,13 +209,43 @@ class GeminiClient:
             model_name: 使用するGeminiモデルの名前 (例: "gemini-1.5-flash")。
             history: 会話履歴のリスト (google.generativeai.types.Content のリスト)。
             system_prompt: システムプロンプト (オプション)。
+            usage: 指定した場合、応答のトークン使用量 (prompt_tokens / output_tokens / total_tokens) と
+                   初回トークンまでの時間・全体の時間 (time_to_first_token_ms / latency_ms) を書き込みます。
+            project_id / user / priority: スケジューラー (utils.request_scheduler) で順番を決めるためのリクエスト元と優先度クラス。
+                   API の同時実行数に空きが無い場合は、順番が来るまで待ってから API を呼び出します。
+            cancel_event: 指定した場合、実行枠や共有中の応答を待っている間に set されると待つのをやめます
+                   (実行枠を待っている場合は utils.request_scheduler.SlotCancelled を送出します)。
 
         Yields:
             生成されたコンテンツのチャンク (テキスト)。
         
         Raises:
             Exception: API呼び出し中にエラーが発生した場合。
+
+        同じ内容のストリーミングが実行中の場合は、新しく API を呼び出さずにその応答を共有します
+        (utils.single_flight。トークン数は応答の完了時に購読中の最初のリクエストの usage にだけ書き込みます)。
         """
+        def open_stream(stream_usage, stop_event):
+            return self._generate_content_stream(model_name, history, system_prompt, stream_usage,
+                                                 project_id=project_id, user=user, priority=priority,
+                                                 cancel_event=stop_event)
+        if not GENERATION_SINGLE_FLIGHT:
+            yield from open_stream(usage, cancel_event)
+            return
+        # 共有中の上流は購読者が全員いなくなったときに止まる (実行枠の待ちもそこで中止される)
+        yield from _stream_flights.stream(request_key(model_name, system_prompt, history), open_stream, usage,
+                                          cancel_event=cancel_event)
+
+    def _generate_content_stream(self,
+                                 model_name: str,
+                                 history: List[types.Content],
+                                 system_prompt: Optional[str] = None,
+                                 usage: Optional[dict] = None,
+                                 project_id: Optional[int] = None,
+                                 user: Optional[str] = None,
+                                 priority: str = INTERACTIVE,
+                                 cancel_event: Optional[threading.Event] = None) -> Generator[str, None, None]:
+        """API を呼び出してストリーミングします (generate_content_stream の本体。実行枠を取得してから呼び出す)。"""
         processed_model_name = model_name
 
         system_instruction_part = None
@@ -104,6 +264,12 @@ class GeminiClient:
             system_instruction=[system_instruction_part] if system_instruction_part else None
         )
 
+        with self.scheduler.slot(project_id, user, priority, cancel_event=cancel_event):
+            yield from self._stream_upstream(processed_model_name, history, generation_config, usage)
+
+    def _stream_upstream(self, processed_model_name: str, history: List[types.Content],
+                         generation_config: types.GenerateContentConfig, usage: Optional[dict]) -> Generator[str, None, None]:
+        started = time.perf_counter()
         try:
             # client.models.generate_content_stream を使用
             stream = self.client.models.generate_content_stream(
@@ -113,8 +279,68 @@ class GeminiClient:
                  # system_instruction は config に含める
             )
             for chunk in stream:
+                _update_usage(usage, chunk)
                 if hasattr(chunk, 'text'):
+                    _record_first_token(usage, chunk, started)
                     yield chunk.text
         except Exception as e:
             print(f"Gemini APIストリーミング呼び出し中にエラーが発生しました: {e}")
             raise
+        finally:
+            _record_latency(usage, started)
+
+    async def generate_content_stream_async(self,
+                                            model_name: str,
+                                            history: List[types.Content],
+                                            system_prompt: Optional[str] = None,
+                                            usage: Optional[dict] = None,
+                                            project_id: Optional[int] = None,
+                                            user: Optional[str] = None,
+                                            priority: str = INTERACTIVE) -> AsyncGenerator[str, None]:
+        """
+        generate_content_stream の非同期版 (API サーバー用)。
+        スレッドを使わずにストリーミングするため、1つのクライアントで多数の応答を同時に生成できます。
+        引数・同じ内容のストリーミングの共有・スケジューリングは generate_content_stream と同じです。
+        """
+        def open_stream(stream_usage):
+            return self._generate_content_stream_async(model_name, history, system_prompt, stream_usage,
+                                                       project_id=project_id, user=user, priority=priority)
+        if not GENERATION_SINGLE_FLIGHT:
+            stream = open_stream(usage)
+        else:
+            stream = _async_stream_flights.stream(request_key(model_name, system_prompt, history), open_stream, usage)
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose() # 中断された場合に購読をすぐにやめる
+
+    async def _generate_content_stream_async(self,
+                                             model_name: str,
+                                             history: List[types.Content],
+                                             system_prompt: Optional[str] = None,
+                                             usage: Optional[dict] = None,
+                                             project_id: Optional[int] = None,
+                                             user: Optional[str] = None,
+                                             priority: str = INTERACTIVE) -> AsyncGenerator[str, None]:
+        """API を呼び出してストリーミングします (generate_content_stream_async の本体。実行枠を取得してから呼び出す)。"""
+        system_instruction_part = types.Part(text=system_prompt) if system_prompt else None
+        generation_config = types.GenerateContentConfig(
+            tools=[types.Tool(google_search=types.GoogleSearch())],
+            system_instruction=[system_instruction_part] if system_instruction_part else None
+        )
+        async with self.scheduler.slot_async(project_id, user, priority):
+            started = time.perf_counter()
+            try:
+                stream = await self.client.aio.models.generate_content_stream(
+                    model=model_name,
+                    contents=history,
+                    config=generation_config,
+                )
+                async for chunk in stream:
+                    _update_usage(usage, chunk)
+                    if getattr(chunk, 'text', None):
+                        _record_first_token(usage, chunk, started)
+                        yield chunk.text
+            finally:
+                _record_latency(usage, started)
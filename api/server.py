@@ -0,0 +1,532 @@
+"""
+プロジェクト・スレッド・メッセージを JSON で操作し、チャットの応答を Server-Sent Events で返す
+ヘッドレスの HTTP API サーバー (ASGI / Starlette)。Streamlit の UI とは独立して動きます。
+
+    python main.py serve --port 8000
+
+エンドポイント:
+    GET    /health
+    GET    /projects                      POST /projects {"name", "system_prompt"}
+    GET    /projects/{id}                 PATCH /projects/{id} {"name"?, "system_prompt"?}    DELETE /projects/{id}
+    GET    /projects/{id}/threads         POST /projects/{id}/threads {"name"?}
+    DELETE /projects/{id}/threads         DELETE /projects/{id}/threads/empty
+    GET    /threads/{id}                  PATCH /threads/{id} {"name"}                        DELETE /threads/{id}
+    GET    /threads/{id}/messages?after_id=&limit=   (分岐したスレッドは分岐元から共有するメッセージを含む。
+           アーカイブしたスレッド (archived_at が設定されたもの) は、メッセージ・分岐・チャットのときにアーカイブから戻す)
+    POST   /threads/{id}/fork {"message_id", "name"?}
+    POST   /threads/{id}/chat {"prompt", "model"?, "attachment_ids"?, "priority"?}   -> text/event-stream (message / delta / done / error)
+           (priority は "interactive" (既定) / "batch"。X-User ヘッダーのユーザーごとに API の実行枠を公平に割り当てる)
+    POST   /attachments?filename=&project_id=   (ボディはファイルの内容、Content-Type は MIME タイプ。同じ内容は同じ ID を返す。
+           project_id は分割保存 (DB_SHARDING=1) の場合のみ必須)
+    GET    /attachments/{id}              GET /attachments/{id}/content
+    GET    /search?q=&archived=1          (archived=1 でアーカイブしたスレッドも検索する)
+    GET    /usage?group_by=project,model&start=YYYY-MM-DD&end=YYYY-MM-DD&project_id=
+    GET    /scheduler                     (API 呼び出しの実行待ちの数と待ち時間。このワーカープロセスの分)
+
+分割保存 (DB_SHARDING=1) では、プロジェクト ID またはスレッド・添付ファイルの ID からプロジェクトの DB を選びます
+(database.sharding)。/usage はプロジェクトをまたぐ合計を返せないため、project_id か group_by の project / thread が必要です。
+"""
+import os
+import json
+import datetime
+import logging
+import contextlib
+from typing import Callable
+
+import anyio
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from database import crud
+from database.database import init_db, QueryTracker
+from database.sharding import ShardRouter, get_shard_router
+from database.archive import restore_thread
+from models.models import Project, Thread, Message
+from utils.markdown_export import enqueue_message_to_markdown, enqueue_thread_history_to_markdown
+from utils.thread_sweeper import EmptyThreadSweeper
+from utils.blob_store import BlobStore, get_blob_store
+from utils.request_scheduler import PRIORITY_CLASSES, INTERACTIVE, get_request_scheduler
+
+log = logging.getLogger(__name__)
+
+# モデルを指定しないチャットで使うモデル
+API_DEFAULT_MODEL = os.getenv("API_DEFAULT_MODEL", "gemini-2.0-flash")
+# メッセージ一覧の1ページの最大件数
+API_MAX_PAGE_SIZE = 1000
+# 添付ファイルの最大サイズ (バイト)
+API_MAX_ATTACHMENT_BYTES = int(os.getenv("API_MAX_ATTACHMENT_BYTES", str(50 * 1024 * 1024)))
+
+# --- シリアライズ (セッションを閉じる前にワーカースレッド内で dict にする) ---
+def _isoformat(value) -> str | None:
+    return value.isoformat() if value is not None else None
+
+def project_to_dict(project: Project) -> dict:
+    return {"id": project.id, "name": project.name, "system_prompt": project.system_prompt,
+            "created_at": _isoformat(project.created_at), "updated_at": _isoformat(project.updated_at)}
+
+def thread_to_dict(thread: Thread) -> dict:
+    return {"id": thread.id, "project_id": thread.project_id, "name": thread.name,
+            "created_at": _isoformat(thread.created_at), "updated_at": _isoformat(thread.updated_at),
+            "parent_thread_id": thread.parent_thread_id, "branch_message_id": thread.branch_message_id,
+            "archived_at": _isoformat(thread.archived_at)}
+
+def message_to_dict(message: Message) -> dict:
+    return {"id": message.id, "thread_id": message.thread_id, "role": message.role,
+            "content": message.content, "created_at": _isoformat(message.created_at)}
+
+def attachment_to_dict(attachment) -> dict:
+    return {"id": attachment.id, "sha256": attachment.sha256, "size_bytes": attachment.size_bytes,
+            "mime_type": attachment.mime_type, "filename": attachment.filename}
+
+def _sse(event: str, data: dict) -> str:
+    """Server-Sent Events の1イベント分の文字列"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _default_client_factory():
+    from api.gemini_client import GeminiClient
+    return GeminiClient()
+
+def create_app(engine: Engine | None = None, client_factory: Callable | None = None,
+               blob_store: BlobStore | None = None, shards: ShardRouter | None = None) -> Starlette:
+    """
+    API サーバーのアプリケーションを作成します。
+
+    - DB 操作は同期の SQLAlchemy をスレッドプールで実行し、セッションは Engine のコネクションプールを共有します。
+    - Gemini のクライアントは起動時に1つだけ作成し、全リクエストで共有します (非同期 API でストリーミング)。
+    - 使われなかった空のスレッドは、起動中にバックグラウンドで定期的に削除します (utils.thread_sweeper)。
+
+    Args:
+        engine: 使用する Engine。省略時はアプリの DB。
+        client_factory: Gemini クライアントを作る関数 (テストや負荷試験で差し替える)。
+        blob_store: 添付ファイルの保存先。省略時は ATTACHMENT_DIR。
+        shards: プロジェクトごとの DB への分割保存。省略時は、アプリの DB を使う場合のみ DB_SHARDING の設定に従います。
+            engine はプロジェクトの一覧を置くカタログになります。
+    """
+    if engine is None:
+        from database.database import engine as default_engine
+        engine = default_engine
+        shards = shards or get_shard_router()
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    client_factory = client_factory or _default_client_factory
+    blob_store = blob_store or get_blob_store()
+
+    def open_session(project_id: int | None, record_id: int | None):
+        """分割保存ではプロジェクト (またはスレッド・添付ファイルの ID) の DB、それ以外はカタログのセッションを開く"""
+        if shards is not None and project_id is not None:
+            return shards.session_for_project(project_id)
+        if shards is not None and record_id is not None:
+            return shards.session_for_record(record_id)
+        return session_factory()
+
+    async def run_db(fn, *args, project_id: int | None = None, record_id: int | None = None):
+        """
+        セッションを開いて fn(db, *args) をスレッドプールで実行する (SQL はハンドラーごとに集計する)。
+        project_id / record_id (スレッド・添付ファイルの ID) は分割保存の DB の選択に使う。
+        """
+        # "create_app.<locals>.list_projects.<locals>.query" -> "list_projects.query"
+        operation = ".".join(fn.__qualname__.split(".<locals>.")[-2:])
+        def call():
+            db = open_session(project_id, record_id)
+            try:
+                with QueryTracker(operation):
+                    return fn(db, *args)
+            finally:
+                db.close()
+        return await run_in_threadpool(call)
+
+    async def read_json(request: Request) -> dict:
+        try:
+            body = await request.json()
+        except ValueError:
+            raise HTTPException(400, "リクエストボディが JSON ではありません。")
+        if not isinstance(body, dict):
+            raise HTTPException(400, "リクエストボディは JSON オブジェクトにしてください。")
+        return body
+
+    def not_found(result, detail: str):
+        if result is None:
+            raise HTTPException(404, detail)
+        return result
+
+    def restore_or_fail(db, thread_id: int) -> None:
+        """アーカイブしたスレッドを戻します。戻せない場合は履歴の無いまま続けないよう 500 にする"""
+        if not restore_thread(db, thread_id):
+            raise HTTPException(500, "チャットをアーカイブから戻せませんでした。")
+
+    # --- プロジェクト ---
+    async def list_projects(request: Request):
+        def query(db):
+            return [project_to_dict(p) for p in crud.list_projects(db)]
+        return JSONResponse(await run_db(query))
+
+    async def create_project(request: Request):
+        body = await read_json(request)
+        def create(db):
+            if shards is not None: # カタログとプロジェクトの DB の両方に作成する
+                project = shards.create_project(body.get("name", ""), body.get("system_prompt", ""))
+            else:
+                project = crud.create_project(db, body.get("name", ""), body.get("system_prompt", ""))
+            return project_to_dict(project) if project else None
+        project = await run_db(create)
+        if project is None:
+            raise HTTPException(409, "プロジェクト名が空か、既に使用されています。")
+        return JSONResponse(project, status_code=201)
+
+    async def get_project(request: Request):
+        project_id = request.path_params["project_id"]
+        def query(db):
+            project = db.get(Project, project_id)
+            return project_to_dict(project) if project else None
+        return JSONResponse(not_found(await run_db(query), "プロジェクトが見つかりません。"))
+
+    async def update_project(request: Request):
+        project_id = request.path_params["project_id"]
+        body = await read_json(request)
+        def update(db):
+            project = db.get(Project, project_id)
+            if project is None:
+                return None
+            name, system_prompt = body.get("name", project.name), body.get("system_prompt", project.system_prompt)
+            if shards is not None: # プロジェクトの DB の写しにも反映する
+                updated = shards.update_project(project_id, name, system_prompt)
+                db.expire_all()
+            else:
+                updated = crud.update_project(db, project_id, name, system_prompt)
+            return project_to_dict(db.get(Project, project_id)) if updated else False
+        result = not_found(await run_db(update), "プロジェクトが見つかりません。")
+        if result is False:
+            raise HTTPException(409, "プロジェクト名が空か、既に使用されています。")
+        return JSONResponse(result)
+
+    async def delete_project(request: Request):
+        project_id = request.path_params["project_id"]
+        # 分割保存ではプロジェクトの DB のファイルを消すだけ
+        deleted = await (run_in_threadpool(shards.delete_project, project_id) if shards is not None
+                         else run_db(crud.delete_project, project_id))
+        if not deleted:
+            raise HTTPException(404, "プロジェクトが見つからないか、削除に失敗しました。")
+        return Response(status_code=204)
+
+    # --- スレッド ---
+    async def list_threads(request: Request):
+        project_id = request.path_params["project_id"]
+        limit = min(int(request.query_params.get("limit", 100)), API_MAX_PAGE_SIZE)
+        offset = int(request.query_params.get("offset", 0))
+        def query(db):
+            return [thread_to_dict(t) for t in crud.list_threads(db, project_id, offset=offset, limit=limit)]
+        return JSONResponse(await run_db(query, project_id=project_id))
+
+    async def create_thread(request: Request):
+        project_id = request.path_params["project_id"]
+        body = await read_json(request) if await request.body() else {}
+        def create(db):
+            thread = crud.create_thread(db, project_id, body.get("name") or "新規チャット")
+            return thread_to_dict(thread) if thread else None
+        return JSONResponse(not_found(await run_db(create, project_id=project_id), "プロジェクトが見つかりません。"),
+                            status_code=201)
+
+    async def delete_all_threads(request: Request):
+        project_id = request.path_params["project_id"]
+        if not await run_db(crud.delete_all_threads_in_project, project_id, project_id=project_id):
+            raise HTTPException(404, "プロジェクトが見つからないか、削除に失敗しました。")
+        return Response(status_code=204)
+
+    async def delete_empty_threads(request: Request):
+        project_id = request.path_params["project_id"]
+        deleted = await run_db(crud.delete_empty_threads_in_project, project_id, project_id=project_id)
+        return JSONResponse({"deleted": deleted})
+
+    async def get_thread(request: Request):
+        thread_id = request.path_params["thread_id"]
+        def query(db):
+            thread = db.get(Thread, thread_id)
+            return thread_to_dict(thread) if thread else None
+        return JSONResponse(not_found(await run_db(query, record_id=thread_id), "スレッドが見つかりません。"))
+
+    async def update_thread(request: Request):
+        thread_id = request.path_params["thread_id"]
+        body = await read_json(request)
+        def update(db):
+            if not crud.update_thread_name(db, thread_id, body.get("name", "")):
+                return None
+            return thread_to_dict(db.get(Thread, thread_id))
+        return JSONResponse(not_found(await run_db(update, record_id=thread_id), "スレッドが見つからないか、名前が空です。"))
+
+    async def fork_thread(request: Request):
+        thread_id = request.path_params["thread_id"]
+        body = await read_json(request)
+        message_id = int(body.get("message_id", 0))
+        def fork(db):
+            source = db.get(Thread, thread_id)
+            if source is not None and source.archived_at is not None:
+                restore_or_fail(db, thread_id)
+            thread = crud.fork_thread(db, thread_id, message_id, body.get("name"))
+            if thread is None:
+                return None
+            enqueue_thread_history_to_markdown(thread.project.name, thread.id, thread.name,
+                                               crud.get_thread_history(db, thread.id))
+            return thread_to_dict(thread)
+        return JSONResponse(not_found(await run_db(fork, record_id=thread_id), "スレッドが見つからないか、メッセージがスレッドの履歴に含まれません。"),
+                            status_code=201)
+
+    async def delete_thread(request: Request):
+        thread_id = request.path_params["thread_id"]
+        if not await run_db(crud.delete_thread, thread_id, record_id=thread_id):
+            raise HTTPException(404, "スレッドが見つからないか、削除に失敗しました。")
+        return Response(status_code=204)
+
+    # --- メッセージ ---
+    async def list_messages(request: Request):
+        thread_id = request.path_params["thread_id"]
+        after_id = int(request.query_params.get("after_id", 0))
+        limit = min(int(request.query_params.get("limit", API_MAX_PAGE_SIZE)), API_MAX_PAGE_SIZE)
+        def query(db):
+            thread = db.get(Thread, thread_id)
+            if thread is None:
+                return None
+            if thread.archived_at is not None:
+                restore_or_fail(db, thread_id)
+            messages = crud.get_thread_history(db, thread_id, after_id=after_id, limit=limit)
+            return [message_to_dict(m) for m in messages]
+        return JSONResponse(not_found(await run_db(query, record_id=thread_id), "スレッドが見つかりません。"))
+
+    async def search(request: Request):
+        query_text = request.query_params.get("q", "")
+        include_archived = request.query_params.get("archived", "").lower() in ("1", "true", "yes")
+        if shards is not None: # 全プロジェクトの DB を並列に検索して合わせる
+            hits = await run_in_threadpool(shards.search_messages, query_text, include_archived=include_archived)
+            return JSONResponse([message_to_dict(m) for m in hits])
+        def query(db):
+            return [message_to_dict(m) for m in crud.search_messages(db, query_text, include_archived=include_archived)]
+        return JSONResponse(await run_db(query))
+
+    async def usage(request: Request):
+        params = request.query_params
+        group_by = [name for name in params.get("group_by", "project").split(",") if name]
+        start_day = datetime.date.fromisoformat(params["start"]) if params.get("start") else None
+        end_day = datetime.date.fromisoformat(params["end"]) if params.get("end") else None
+        project_id = int(params["project_id"]) if params.get("project_id") else None
+        def query(db):
+            rows = crud.get_usage_summary(db, group_by, start_day, end_day, project_id)
+            for row in rows:
+                if "day" in row:
+                    row["day"] = str(row["day"])
+            return rows
+        if shards is not None and project_id is None:
+            # プロジェクトごとの集計は DB ごとに重ならないため、各 DB の結果を並べるだけでよい
+            if not {"project", "thread"} & set(group_by):
+                raise HTTPException(400, "分割保存では project_id を指定するか、group_by に project または thread を含めてください。")
+            return JSONResponse([row for rows in await run_in_threadpool(shards.fan_out, query) for row in rows])
+        return JSONResponse(await run_db(query, project_id=project_id))
+
+    # --- チャット (SSE) ---
+    def start_chat_turn(db, thread_id: int, prompt: str, attachment_ids: list[int], client):
+        """履歴を読み込んでユーザーメッセージを (添付ファイルとともに) 保存し、応答の生成に必要な情報を返す"""
+        from api.gemini_client import messages_to_contents
+        from models.models import Attachment
+
+        thread = db.get(Thread, thread_id)
+        if thread is None:
+            return None
+        if thread.archived_at is not None:
+            restore_or_fail(db, thread_id)
+        if attachment_ids:
+            found = {attachment_id for (attachment_id,) in db.query(Attachment.id).filter(Attachment.id.in_(attachment_ids))}
+            if missing := [attachment_id for attachment_id in attachment_ids if attachment_id not in found]:
+                raise HTTPException(400, f"添付ファイルが見つかりません: {missing}")
+        project = db.get(Project, thread.project_id)
+        history = crud.get_thread_history(db, thread_id)
+        user_message = crud.add_message(db, thread, "user", prompt, attachment_ids=attachment_ids)
+        enqueue_message_to_markdown(project.name, thread.id, thread.name, "user", prompt)
+        # 履歴とこのメッセージの添付ファイル (Files API のアップロード済みのファイルは期限内なら再利用する)
+        attachments = crud.get_attachments_by_message(db, [m.id for m in history] + [user_message.id])
+        parts = {}
+        if attachments:
+            parts = client.attachment_parts(attachments, blob_store,
+                                            on_upload=lambda attachment, uploaded: crud.record_gemini_file(db, attachment, uploaded))
+        contents = messages_to_contents(history, prompt, parts, parts.get(user_message.id))
+        return {
+            "contents": contents,
+            "system_prompt": project.system_prompt,
+            "project_name": project.name,
+            "project_id": project.id,
+            "is_first_exchange": not history,
+            "user_message": message_to_dict(user_message),
+        }
+
+    def finish_chat_turn(db, thread_id: int, turn: dict, prompt: str, text: str, model_name: str, usage: dict):
+        """応答を使用量とともに保存し、最初のやり取りならチャット名を設定する"""
+        thread = db.get(Thread, thread_id)
+        if thread is None: # 生成中にスレッドが削除された
+            return None
+        assistant_message = crud.add_message(db, thread, "assistant", text, model_name=model_name, usage=usage)
+        enqueue_message_to_markdown(turn["project_name"], thread.id, thread.name, "assistant", text)
+        if turn["is_first_exchange"] and prompt[:60]:
+            crud.update_thread_name(db, thread_id, prompt[:60])
+        return message_to_dict(assistant_message)
+
+    async def chat(request: Request):
+        thread_id = request.path_params["thread_id"]
+        body = await read_json(request)
+        prompt = body.get("prompt", "")
+        model_name = body.get("model") or API_DEFAULT_MODEL
+        attachment_ids = body.get("attachment_ids") or []
+        priority = body.get("priority") or INTERACTIVE
+        if priority not in PRIORITY_CLASSES:
+            raise HTTPException(400, f"priority は {' / '.join(PRIORITY_CLASSES)} のいずれかにしてください。")
+        user = request.headers.get("x-user") or (request.client.host if request.client else None)
+        if not prompt.strip():
+            raise HTTPException(400, "prompt を指定してください。")
+        if not isinstance(attachment_ids, list) or not all(isinstance(i, int) for i in attachment_ids):
+            raise HTTPException(400, "attachment_ids は添付ファイルの ID のリストにしてください。")
+        client = request.app.state.gemini_client
+        if client is None:
+            raise HTTPException(503, "Gemini クライアントを初期化できません (GEMINI_API_KEY を確認してください)。")
+        turn = not_found(await run_db(start_chat_turn, thread_id, prompt, attachment_ids, client, record_id=thread_id),
+                         "スレッドが見つかりません。")
+
+        async def events():
+            yield _sse("message", turn["user_message"])
+            chunks: list[str] = []
+            usage: dict = {}
+            error = None
+            try:
+                async for chunk in client.generate_content_stream_async(
+                        model_name=model_name, history=turn["contents"],
+                        system_prompt=turn["system_prompt"], usage=usage,
+                        project_id=turn["project_id"], user=user, priority=priority):
+                    chunks.append(chunk)
+                    yield _sse("delta", {"text": chunk})
+            except Exception as e:
+                log.error(f"Gemini API の呼び出し中にエラーが発生しました (thread={thread_id}): {e}", exc_info=True)
+                error = str(e)
+            finally:
+                # クライアントが切断して中断された場合も、それまでの応答は保存する
+                assistant_message = None
+                if chunks:
+                    with anyio.CancelScope(shield=True):
+                        assistant_message = await run_db(finish_chat_turn, thread_id, turn, prompt, "".join(chunks),
+                                                         model_name, usage, record_id=thread_id)
+            if error is not None:
+                yield _sse("error", {"detail": error, "message": assistant_message})
+            else:
+                yield _sse("done", {"message": assistant_message, "model": model_name, "usage": usage})
+
+        return StreamingResponse(events(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    # --- 添付ファイル ---
+    async def upload_attachment(request: Request):
+        filename = request.query_params.get("filename", "").strip()
+        if not filename:
+            raise HTTPException(400, "filename を指定してください。")
+        project_id = int(request.query_params["project_id"]) if request.query_params.get("project_id") else None
+        if shards is not None and project_id is None:
+            raise HTTPException(400, "分割保存では project_id を指定してください (添付ファイルはプロジェクトの DB に保存します)。")
+        mime_type = request.headers.get("content-type", "application/octet-stream").split(";")[0].strip()
+        data = bytearray()
+        async for chunk in request.stream():
+            data.extend(chunk)
+            if len(data) > API_MAX_ATTACHMENT_BYTES:
+                raise HTTPException(413, f"添付ファイルは {API_MAX_ATTACHMENT_BYTES} バイト以下にしてください。")
+        if not data:
+            raise HTTPException(400, "ファイルの内容が空です。")
+        def store(db):
+            return attachment_to_dict(crud.store_attachment(db, blob_store, bytes(data), filename, mime_type))
+        return JSONResponse(await run_db(store, project_id=project_id), status_code=201)
+
+    def _get_attachment(db, attachment_id: int):
+        from models.models import Attachment
+        attachment = db.get(Attachment, attachment_id)
+        return attachment_to_dict(attachment) if attachment else None
+
+    async def get_attachment(request: Request):
+        attachment_id = request.path_params["attachment_id"]
+        return JSONResponse(not_found(await run_db(_get_attachment, attachment_id, record_id=attachment_id),
+                                      "添付ファイルが見つかりません。"))
+
+    async def download_attachment(request: Request):
+        attachment_id = request.path_params["attachment_id"]
+        attachment = not_found(await run_db(_get_attachment, attachment_id, record_id=attachment_id),
+                               "添付ファイルが見つかりません。")
+        if not blob_store.exists(attachment["sha256"]):
+            raise HTTPException(404, "添付ファイルの内容が見つかりません。")
+
+        def chunks():
+            # メモリマップから少しずつ返す (ファイル全体をメモリに読み込まない)
+            with blob_store.open(attachment["sha256"]) as blob:
+                while chunk := blob.read(256 * 1024):
+                    yield chunk
+        return StreamingResponse(chunks(), media_type=attachment["mime_type"],
+                                 headers={"ETag": f'"{attachment["sha256"]}"',
+                                          "Cache-Control": "private, max-age=31536000, immutable"})
+
+    async def scheduler(request: Request):
+        return JSONResponse(get_request_scheduler().metrics())
+
+    async def health(request: Request):
+        return JSONResponse({"status": "ok", "gemini_client": request.app.state.gemini_client is not None})
+
+    async def http_exception(request: Request, exc: HTTPException):
+        return JSONResponse({"detail": exc.detail}, status_code=exc.status_code)
+
+    async def lookup_error(request: Request, exc: LookupError):
+        # 分割保存で、ID の範囲に対応するプロジェクトが無い
+        return JSONResponse({"detail": str(exc)}, status_code=404)
+
+    async def value_error(request: Request, exc: ValueError):
+        # クエリパラメータの数値変換の失敗など
+        return JSONResponse({"detail": str(exc)}, status_code=400)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app: Starlette):
+        await run_in_threadpool(init_db, engine)
+        try:
+            app.state.gemini_client = client_factory()
+        except ValueError as e:
+            # API キーが無くても、チャット以外のエンドポイントは使えるようにする
+            log.warning(f"Gemini クライアントを初期化できませんでした。チャットは 503 を返します: {e}")
+            app.state.gemini_client = None
+        # チャットはユーザーメッセージを保存してから応答を生成するため、生成中のスレッドが空に見えることはない
+        sweeper = EmptyThreadSweeper(session_factory=session_factory, busy_thread_ids=set, blob_store=blob_store,
+                                     shards=shards).start()
+        try:
+            yield
+        finally:
+            await run_in_threadpool(sweeper.close, 5.0)
+
+    routes = [
+        Route("/health", health),
+        Route("/projects", list_projects, methods=["GET"]),
+        Route("/projects", create_project, methods=["POST"]),
+        Route("/projects/{project_id:int}", get_project, methods=["GET"]),
+        Route("/projects/{project_id:int}", update_project, methods=["PATCH"]),
+        Route("/projects/{project_id:int}", delete_project, methods=["DELETE"]),
+        Route("/projects/{project_id:int}/threads", list_threads, methods=["GET"]),
+        Route("/projects/{project_id:int}/threads", create_thread, methods=["POST"]),
+        Route("/projects/{project_id:int}/threads", delete_all_threads, methods=["DELETE"]),
+        Route("/projects/{project_id:int}/threads/empty", delete_empty_threads, methods=["DELETE"]),
+        Route("/threads/{thread_id:int}", get_thread, methods=["GET"]),
+        Route("/threads/{thread_id:int}", update_thread, methods=["PATCH"]),
+        Route("/threads/{thread_id:int}", delete_thread, methods=["DELETE"]),
+        Route("/threads/{thread_id:int}/messages", list_messages, methods=["GET"]),
+        Route("/threads/{thread_id:int}/fork", fork_thread, methods=["POST"]),
+        Route("/threads/{thread_id:int}/chat", chat, methods=["POST"]),
+        Route("/search", search, methods=["GET"]),
+        Route("/usage", usage, methods=["GET"]),
+        Route("/scheduler", scheduler, methods=["GET"]),
+        Route("/attachments", upload_attachment, methods=["POST"]),
+        Route("/attachments/{attachment_id:int}", get_attachment, methods=["GET"]),
+        Route("/attachments/{attachment_id:int}/content", download_attachment, methods=["GET"]),
+    ]
+    return Starlette(routes=routes, lifespan=lifespan,
+                     exception_handlers={HTTPException: http_exception, ValueError: value_error, LookupError: lookup_error})
+
+# uvicorn から "api.server:app" として読み込む
+app = create_app()
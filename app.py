@@ -1,28 +1,44 @@
 import streamlit as st
-from database.database import SessionLocal, init_db
+from database.database import SessionLocal, init_db, QueryTracker
+from database.sharding import get_shard_router, open_session # プロジェクトごとの DB への分割保存 (DB_SHARDING=1)
+from database.archive import restore_thread # 長い間使われていないチャットはアーカイブにあり、開いたときに戻す
 from models.models import Project, Thread, Message
-from api.gemini_client import GeminiClient
 import datetime
-from google.genai import types
 import logging # logging をインポート
-from utils.markdown_export import export_message_to_markdown # <-- インポートを追加
+from utils.logging_setup import setup_logging
+from utils.perf_timing import PhaseTimer, format_phases # 再実行のフェーズごとの計測 (PERF_TIMING=1 で有効)
+from utils.generation_jobs import get_generation_runner # 応答生成はスクリプトの再実行と独立したバックグラウンドジョブで行う
+from utils.render_cache import render_chat_history # チャット履歴の表示 (再実行ごとの描画をキャッシュ)
+from utils.thread_sweeper import get_empty_thread_sweeper # 空チャットはバックグラウンドで定期的に削除する
+from utils.markdown_export import enqueue_thread_history_to_markdown # 分岐したチャットのファイルは引き継いだ履歴で始める
 from database.crud import ( # インポートを整形
     search_messages, 
     delete_thread, 
-    update_thread_name, 
     delete_project, 
     update_project,
     delete_all_threads_in_project, # <-- 新しい関数をインポート
-    delete_empty_threads_in_project # <-- 空チャット削除関数をインポート
+    get_latest_comparison,
+    adopt_comparison_answer,
+    get_thread_history,
+    fork_thread,
+    store_attachment,
+    get_attachments_by_message,
+    list_projects,
+    list_threads,
 )
 from sqlalchemy import func
-from utils.csv_export import get_all_data_as_dataframe, generate_csv_data # <-- CSVエクスポート関数をインポート
 import json # json モジュールをインポート
 import os # os モジュールをインポート
 import re # re モジュールをインポート
+import uuid
+# 注: google.genai (api.gemini_client) と pandas (utils.csv_export) は読み込みが重く、
+#     チャット送信・エクスポート時にしか使わないため、使う場所で遅延インポートする
 
-# logging の基本設定
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+# logging の基本設定 (キュー経由で別スレッドから出力。レベルは環境変数 LOG_LEVEL / LOG_LEVELS で指定)
+setup_logging()
+log = logging.getLogger("app")
+rerun_timer = PhaseTimer("rerun")
+shards = get_shard_router() # 分割保存が無効なら None (プロジェクトもスレッドも従来の DB に保存する)
 
 # --- 状態保存/読み込み設定 ---
 STATE_FILE = ".last_state.json"
@@ -32,6 +48,8 @@ AVAILABLE_MODELS = [
     "gemini-2.0-flash",
     "gemini-2.5-pro-exp-03-25"
 ]
+GENERATION_POLL_INTERVAL = 0.5 # 生成中の応答の表示を更新する間隔 (秒)
+ATTACHMENT_FILE_TYPES = ["pdf", "png", "jpg", "jpeg", "webp", "txt", "md", "csv"] # チャット入力で添付できるファイルの種類
 
 # --- 状態保存ヘルパー関数 ---
 def save_app_state(project_id: int | None, selected_model: str | None = None):
@@ -56,9 +74,9 @@ def save_app_state(project_id: int | None, selected_model: str | None = None):
         # 保存
         with open(STATE_FILE, 'w') as f:
             json.dump(data, f)
-        logging.debug(f"Saved app state: project_id={project_id}, model={selected_model if selected_model else 'unchanged'}")
+        log.debug("Saved app state: project_id=%s, model=%s", project_id, selected_model if selected_model else 'unchanged')
     except Exception as e:
-        logging.error(f"Failed to save app state to {STATE_FILE}: {e}")
+        log.error(f"Failed to save app state to {STATE_FILE}: {e}")
 
 # 既存の関数を新しいものに置き換え (互換性維持)
 def save_last_project_id(project_id: int | None):
@@ -74,10 +92,10 @@ def load_app_state():
             data = json.load(f)
         last_id = data.get("last_project_id")
         last_model = data.get("last_selected_model")
-        logging.debug(f"Loaded app state: project_id={last_id}, model={last_model}")
+        log.debug("Loaded app state: project_id=%s, model=%s", last_id, last_model)
         return last_id, last_model
     except Exception as e:
-        logging.error(f"Failed to load app state from {STATE_FILE}: {e}")
+        log.error(f"Failed to load app state from {STATE_FILE}: {e}")
         return None, None
 
 # 互換性のための関数
@@ -86,23 +104,28 @@ def load_last_project_id() -> int | None:
     return project_id
 
 # --- データベース初期化 ---
-init_db()
+# プロセスごとに1回だけ実行され、スキーマが最新なら DDL はスキップされる (再実行時はほぼコストなし)
+with rerun_timer.phase("init_db"):
+    init_db()
 
 # --- ★★★ 初期状態設定 ★★★ ---
 def set_initial_state():
     """アプリ初回起動時に最後の状態を復元し、新規チャットを開始"""
     # 既に初期化済みであれば何もしない
     if 'initial_state_complete' in st.session_state:
-        logging.debug("Initial state already set. Skipping.")
+        log.debug("Initial state already set. Skipping.")
         return
     
-    logging.info("Performing initial state setup...")
+    log.info("Performing initial state setup...")
     last_project_id, last_model = load_app_state()
     initial_project_id = None
     initial_thread_id = None
 
     if last_project_id is not None:
-        db = SessionLocal()
+        try:
+            db = open_session(project_id=last_project_id) # 分割保存ではプロジェクトの DB (プロジェクトの行の写しを持つ)
+        except LookupError:
+            db = SessionLocal() # 削除済みのプロジェクト (下で状態をクリアする)
         try:
             # 最後に使ったプロジェクトが存在するか確認
             last_project = db.query(Project).filter(Project.id == last_project_id).first()
@@ -115,12 +138,12 @@ def set_initial_state():
                 db.commit()
                 db.refresh(new_thread)
                 initial_thread_id = new_thread.id
-                logging.info(f"Restored project {initial_project_id}, created and selected new thread {initial_thread_id}")
+                log.info(f"Restored project {initial_project_id}, created and selected new thread {initial_thread_id}")
             else:
-                logging.warning(f"Last project ID {last_project_id} not found in DB. Clearing state.")
+                log.warning(f"Last project ID {last_project_id} not found in DB. Clearing state.")
                 save_app_state(None) # 無効なIDはクリア
         except Exception as e:
-            logging.error(f"Error setting initial state: {e}")
+            log.error(f"Error setting initial state: {e}")
             if db.is_active:
                  db.rollback()
         finally:
@@ -140,19 +163,106 @@ def set_initial_state():
     # モデル設定の初期化
     if last_model and last_model in AVAILABLE_MODELS:
         st.session_state.global_selected_model = last_model
-        logging.info(f"Restored last used model: {last_model}")
+        log.info(f"Restored last used model: {last_model}")
     else:
         st.session_state.global_selected_model = AVAILABLE_MODELS[0]
-        logging.info(f"Using default model: {AVAILABLE_MODELS[0]}")
+        log.info(f"Using default model: {AVAILABLE_MODELS[0]}")
     
     # ★★★ 初期化完了フラグを立てる ★★★
     st.session_state.initial_state_complete = True
-    logging.info("Initial state setup complete.")
+    log.info("Initial state setup complete.")
 
 # アプリのメインロジック開始前に初期状態を設定
-set_initial_state()
+with rerun_timer.phase("state_restore"):
+    set_initial_state()
 # ★★★ 初期状態設定ここまで ★★★
 
+# このセッションで表示中のチャットは、空でもバックグラウンドの掃除で削除させない
+if "sweeper_session_key" not in st.session_state:
+    st.session_state.sweeper_session_key = uuid.uuid4().hex
+get_empty_thread_sweeper().protect(st.session_state.sweeper_session_key, st.session_state.current_thread_id)
+
+# --- モデル比較の表示 ---
+def comparison_answer_to_dict(answer) -> dict:
+    """保存済みの比較回答 (ModelComparisonAnswer) を、生成中の回答 (ModelAnswer.to_dict()) と同じ形にする"""
+    return {
+        "id": answer.id,
+        "model_name": answer.model_name,
+        "text": answer.content,
+        "status": "error" if answer.error else "done",
+        "error": answer.error,
+        "time_to_first_token_ms": answer.time_to_first_token_ms,
+        "latency_ms": answer.latency_ms,
+        "usage": {"output_tokens": answer.output_tokens, "total_tokens": answer.total_tokens},
+        "adopted": answer.adopted,
+    }
+
+def format_answer_metrics(answer: dict) -> str:
+    """比較回答の計測値 (初回トークンまでの時間・全体の時間・トークン数) を1行の文字列にする"""
+    parts = []
+    if answer["time_to_first_token_ms"] is not None:
+        parts.append(f"初回トークン {answer['time_to_first_token_ms'] / 1000:.2f} 秒")
+    if answer["latency_ms"] is not None:
+        parts.append(f"合計 {answer['latency_ms'] / 1000:.2f} 秒")
+    usage = answer["usage"] or {}
+    if usage.get("output_tokens") is not None:
+        parts.append(f"出力 {usage['output_tokens']} / 合計 {usage.get('total_tokens')} トークン")
+    return " ・ ".join(parts)
+
+def render_comparison_columns(answers: list[dict], on_adopt=None):
+    """モデルごとの回答を列に並べて表示する。on_adopt を渡すと採用ボタンを表示する"""
+    for column, answer in zip(st.columns(len(answers)), answers):
+        with column:
+            st.markdown(f"**{answer['model_name']}**" + (" ✅" if answer.get("adopted") else ""))
+            if answer["error"]:
+                st.error(answer["error"])
+            elif answer["text"]:
+                st.markdown(answer["text"] + ("▌" if answer["status"] == "running" else ""))
+            else:
+                st.caption("応答を待っています...")
+            st.caption(format_answer_metrics(answer))
+            if on_adopt is not None and answer["text"] and not answer.get("adopted"):
+                if st.button("この回答を採用", key=f"adopt_answer_{answer['id']}"):
+                    on_adopt(answer["id"])
+
+# --- バックグラウンド生成の進捗表示 ---
+def _render_generation_progress(thread_id: int):
+    """スレッドの生成ジョブ (順番待ち・生成中) を表示し、見ていたジョブが終わったらアプリ全体を再実行する"""
+    runner = get_generation_runner()
+    watched = st.session_state.setdefault("watched_generation_jobs", set())
+    shown_errors = st.session_state.setdefault("shown_generation_errors", set())
+    for job in runner.jobs_for_thread(thread_id, active_only=False):
+        state = job.snapshot()
+        if state["status"] in ("queued", "running"):
+            watched.add(job.job_id)
+            if state["user_message_id"] is None: # まだ DB に保存されていないプロンプト
+                with st.chat_message("user"):
+                    st.markdown(state["prompt"])
+            if "answers" in state: # モデル比較: モデルごとの応答を横に並べる
+                render_comparison_columns(state["answers"])
+                if st.button("停止", key=f"cancel_generation_{job.job_id}"):
+                    runner.cancel(job.job_id)
+                continue
+            with st.chat_message("assistant"):
+                if state["text"]:
+                    st.markdown(state["text"] + "▌")
+                else:
+                    st.caption("応答を生成しています..." if state["status"] == "running" else "順番待ちです...")
+                if st.button("停止", key=f"cancel_generation_{job.job_id}"):
+                    runner.cancel(job.job_id)
+        elif job.job_id in watched:
+            # 完了した応答は DB に保存済みなので、履歴として表示し直す
+            watched.discard(job.job_id)
+            st.rerun()
+        elif state["error"] and job.job_id not in shown_errors:
+            shown_errors.add(job.job_id)
+            st.error(state["error"])
+
+def render_generation_progress(thread_id: int):
+    """生成中のジョブがある間だけ、進捗表示を GENERATION_POLL_INTERVAL ごとに部分的に再実行する"""
+    active = bool(get_generation_runner().jobs_for_thread(thread_id))
+    st.fragment(_render_generation_progress, run_every=GENERATION_POLL_INTERVAL if active else None)(thread_id)
+
 
 
 # --- サイドバー --- 
@@ -192,9 +302,13 @@ js_focus_script = """
 # --- プロジェクト管理 --- 
 st.sidebar.header("プロジェクト")
 
+# サイドバーの SQL を1つの操作として集計する (st.rerun() で中断されても finally で終える)
+sidebar_queries = QueryTracker("sidebar").start()
 db = SessionLocal()
+thread_db = db # スレッドの読み書き (分割保存では選択中のプロジェクトの DB)
 try:
-    projects = db.query(Project).order_by(Project.name).all()
+    with rerun_timer.phase("sidebar_queries"):
+        projects = list_projects(db) # 読み取り専用の軽いレコード (ORM のオブジェクトを作らない)
     project_names = [p.name for p in projects]
     project_map = {p.name: p.id for p in projects}
 
@@ -256,7 +370,9 @@ try:
             st.sidebar.warning(f"プロジェクト '{current_project_name}' を削除すると、関連する全てのチャットとメッセージも削除されます。本当に削除しますか？")
             col1_confirm, col2_confirm = st.sidebar.columns(2)
             if col1_confirm.button("はい、削除します", key="confirm_delete_yes"):
-                delete_success = delete_project(db, current_project_id_for_ops)
+                # 分割保存ではプロジェクトの DB のファイルを消すだけ
+                delete_success = (shards.delete_project(current_project_id_for_ops) if shards is not None
+                                  else delete_project(db, current_project_id_for_ops))
                 if delete_success:
                     st.sidebar.success(f"プロジェクト '{current_project_name}' を削除しました。")
                     st.session_state.current_project_id = None
@@ -275,27 +391,23 @@ try:
     # --- チャット管理 --- (プロジェクトが選択されている場合のみ表示)
     if st.session_state.current_project_id:
         current_project_id = st.session_state.current_project_id
-        threads = db.query(Thread).filter(Thread.project_id == current_project_id).order_by(Thread.updated_at.desc()).all()
+        with rerun_timer.phase("sidebar_queries"):
+            if shards is not None:
+                thread_db = shards.session_for_project(current_project_id)
+            threads = list_threads(thread_db, current_project_id)
         # logging.info(f"[Sidebar Render] Fetched {len(threads)} threads for project {current_project_id}. Displaying up to {st.session_state.visible_thread_count}") # <-- ログ削除
 
         # 新規チャット作成ボタン
         if st.sidebar.button("新規チャット", use_container_width=True):
+            # INSERT 1回だけで作成する (使われなかった空チャットは utils.thread_sweeper がバックグラウンドで削除する)
             new_thread = Thread(project_id=current_project_id, name=f"新規チャット") # 仮の名前
-            db.add(new_thread)
-            db.commit()
-            db.refresh(new_thread)
-            
-            # --- ★★★ 空チャットの自動削除 (今作成したチャットは除く) ★★★ ---
-            deleted_count = delete_empty_threads_in_project(
-                db, 
-                current_project_id, 
-                exclude_thread_id=new_thread.id # ★ 除外IDを指定
-            )
-            if deleted_count > 0:
-                logging.info(f"{deleted_count} 件の空チャットを自動削除しました。")
-            # --- ★★★ 自動削除ここまで ★★★ ---
+            thread_db.add(new_thread)
+            thread_db.flush()
+            new_thread_id = new_thread.id # コミット後に読むと再取得の SELECT が走るため先に取っておく
+            thread_db.commit()
+            get_empty_thread_sweeper().protect(st.session_state.sweeper_session_key, new_thread_id)
 
-            st.session_state.current_thread_id = new_thread.id
+            st.session_state.current_thread_id = new_thread_id
             st.session_state.show_search_results = False # 検索結果表示中なら解除
             st.session_state.creating_project = False # 他のモードも解除
             st.session_state.editing_project = False
@@ -310,32 +422,30 @@ try:
             search_query = st.text_input("メッセージを検索", key="search_input", label_visibility="collapsed") # ラベルを非表示に
         with col_search2:
             search_button_pressed = st.button("検索", key="search_button", use_container_width=True)
+        include_archived = st.sidebar.checkbox("アーカイブしたチャットも検索", key="search_include_archived",
+                                               help="アーカイブを展開して検索するため、時間がかかります")
 
         if search_button_pressed:
             if search_query:
                 db_session = SessionLocal()
                 try:
-                    results = search_messages(db_session, search_query)
-                    # 結果を保存（プロジェクト名とチャット名も取得して付加する）
-                    detailed_results = []
-                    for msg in results:
-                        # 関連するチャットとプロジェクトを取得
-                        # N+1 問題を避けるため、本来は JOIN で取得する方が効率的
-                        thread = db_session.query(Thread).filter(Thread.id == msg.thread_id).first()
-                        project = db_session.query(Project).filter(Project.id == thread.project_id).first() if thread else None
-                        detailed_results.append({
-                            "message": msg,
-                            "thread_name": thread.name if thread else "不明なチャット",
-                            "project_name": project.name if project else "不明なプロジェクト",
-                            "project_id": thread.project_id if thread else None,
-                            "thread_id": msg.thread_id
-                        })
+                    # スレッド名とプロジェクト名は検索と同じクエリで JOIN して取得する
+                    # (分割保存では全プロジェクトの DB を並列に検索して新しい順に合わせる)
+                    results = (shards.search_messages(search_query, include_archived=include_archived) if shards is not None
+                               else search_messages(db_session, search_query, include_archived=include_archived))
+                    detailed_results = [{
+                        "message": hit,
+                        "thread_name": hit.thread_name,
+                        "project_name": hit.project_name,
+                        "project_id": hit.project_id,
+                        "thread_id": hit.thread_id
+                    } for hit in results]
                     st.session_state.search_results = detailed_results
                     st.session_state.show_search_results = True 
                     st.session_state.current_thread_id = None 
                     st.session_state.editing_project = False # 他モード解除
                     st.session_state.creating_project = False
-                    logging.debug(f"検索を実行しました: Query='{search_query}', Results={len(results)}")
+                    log.debug("検索を実行しました: Query='%s', Results=%d", search_query, len(results))
                     st.rerun() 
                 finally:
                     db_session.close()
@@ -361,6 +471,7 @@ try:
              st.sidebar.caption("まだチャットがありません。")
         else:
             # チャット名と削除ボタンを1行に表示
+            generating_thread_ids = get_generation_runner().active_thread_ids()
             for thread in threads: # 全ての threads をループ
                 col1, col2 = st.sidebar.columns([0.8, 0.2])
                 with col1:
@@ -375,6 +486,10 @@ try:
                     # チャット名が長い場合は短縮して表示（20文字まで）
                     max_text_length = 13 
                     display_label = thread.name[:max_text_length] + "..." if len(thread.name) > max_text_length else thread.name
+                    if thread.id in generating_thread_ids:
+                        display_label = f"⏳ {display_label}" # バックグラウンドで応答を生成中
+                    elif thread.archived_at is not None:
+                        display_label = f"🗄️ {display_label}" # アーカイブ済み (開くとアーカイブから戻す)
                     
                     # チャット選択ボタン
                     if st.button(display_label, key=f"select_thread_{thread.id}", use_container_width=True,
@@ -388,17 +503,17 @@ try:
                     if st.button("🗑️", key=f"delete_thread_{thread.id}", help="このチャットを削除します"):
                         thread_id_to_delete = thread.id 
                         thread_name_to_delete = thread.name 
-                        logging.info(f"[Delete Button Clicked] Attempting to delete thread ID: {thread_id_to_delete}, Name: {thread_name_to_delete}") 
-                        delete_success = delete_thread(db, thread_id_to_delete)
-                        logging.info(f"[Delete Action] Deletion result for thread {thread_id_to_delete}: {delete_success}") 
+                        log.info(f"[Delete Button Clicked] Attempting to delete thread ID: {thread_id_to_delete}, Name: {thread_name_to_delete}") 
+                        delete_success = delete_thread(thread_db, thread_id_to_delete)
+                        log.info(f"[Delete Action] Deletion result for thread {thread_id_to_delete}: {delete_success}") 
                         if delete_success:
                             st.sidebar.success(f"チャット '{thread_name_to_delete}' を削除しました。") 
                             current_selection = st.session_state.current_thread_id
                             if current_selection == thread_id_to_delete:
                                 st.session_state.current_thread_id = None
-                                logging.info(f"[Delete Action] Current thread selection {current_selection} was deleted, setting to None.") 
+                                log.info(f"[Delete Action] Current thread selection {current_selection} was deleted, setting to None.") 
                             else:
-                                logging.info(f"[Delete Action] Deleted thread {thread_id_to_delete}, current selection {current_selection} remains.") 
+                                log.info(f"[Delete Action] Deleted thread {thread_id_to_delete}, current selection {current_selection} remains.") 
                             st.rerun()
                         else:
                             st.sidebar.error(f"チャット '{thread_name_to_delete}' の削除に失敗しました。") 
@@ -412,11 +527,11 @@ try:
 
             # 確認メッセージと最終削除処理
             if st.session_state.get("confirm_delete_all_threads", False):
-                current_project = db.query(Project).filter(Project.id == current_project_id).first() # プロジェクト名表示用
+                current_project = thread_db.query(Project).filter(Project.id == current_project_id).first() # プロジェクト名表示用
                 st.sidebar.warning(f"プロジェクト '{current_project.name if current_project else ''}' の全てのチャット履歴 ({len(threads)}件) を削除します。本当によろしいですか？")
                 col1_confirm_all, col2_confirm_all = st.sidebar.columns(2)
                 if col1_confirm_all.button("はい、全て削除します", key="confirm_delete_all_yes"):
-                    delete_success = delete_all_threads_in_project(db, current_project_id)
+                    delete_success = delete_all_threads_in_project(thread_db, current_project_id)
                     if delete_success:
                         st.sidebar.success("全ての関連チャット履歴を削除しました。")
                         st.session_state.current_thread_id = None # チャット選択解除
@@ -437,23 +552,36 @@ try:
     st.sidebar.divider()
     st.sidebar.header("エクスポート")
 
-    # ダウンロードボタン表示前にデータを準備
-    df_export = get_all_data_as_dataframe(db) 
-    csv_data = generate_csv_data(df_export)
-
-    if csv_data:
-        st.sidebar.download_button(
-            label="全データをCSVでダウンロード",
-            data=csv_data,
-            file_name="gemini_search_chat_export.csv",
-            mime="text/csv",
-            key="download_csv_button"
-        )
-    else:
-        st.sidebar.warning("エクスポートするデータがありません。")
+    # 全データの取得と pandas の読み込みは重いため、ボタンが押されたときだけ準備する
+    if st.sidebar.button("CSVエクスポートを準備", key="prepare_csv_button", use_container_width=True):
+        from utils.csv_export import get_all_data_as_dataframe, generate_csv_data # 初回使用時に読み込む
+        frames = shards.fan_out(get_all_data_as_dataframe) if shards is not None else []
+        if frames: # 分割保存では全プロジェクトの DB から読み込んで結合する
+            import pandas as pd
+            df_export = pd.concat(frames, ignore_index=True)
+        else:
+            df_export = get_all_data_as_dataframe(db)
+        st.session_state.csv_export_data = generate_csv_data(df_export)
+        st.session_state.csv_export_prepared = True
+
+    if st.session_state.get("csv_export_prepared", False):
+        csv_data = st.session_state.get("csv_export_data")
+        if csv_data:
+            st.sidebar.download_button(
+                label="全データをCSVでダウンロード",
+                data=csv_data,
+                file_name="gemini_search_chat_export.csv",
+                mime="text/csv",
+                key="download_csv_button"
+            )
+        else:
+            st.sidebar.warning("エクスポートするデータがありません。")
 
 finally:
+    if thread_db is not db:
+        thread_db.close()
     db.close()
+    sidebar_queries.stop()
 
 # --- メインコンテンツエリア --- 
 
@@ -511,7 +639,10 @@ elif st.session_state.editing_project and st.session_state.project_to_edit_id:
                 
                 submitted = st.form_submit_button("保存")
                 if submitted:
-                    update_success = update_project(db, project_to_edit.id, edited_name, edited_system_prompt)
+                    # 分割保存ではプロジェクトの DB の写しにも反映する
+                    update_success = (shards.update_project(project_to_edit.id, edited_name, edited_system_prompt)
+                                      if shards is not None else
+                                      update_project(db, project_to_edit.id, edited_name, edited_system_prompt))
                     if update_success:
                         st.success("プロジェクトを更新しました！")
                         st.session_state.editing_project = False
@@ -581,7 +712,8 @@ else:
     st.title("Chat")
 
     if st.session_state.current_project_id:
-        db = SessionLocal()
+        chat_queries = QueryTracker("chat_view").start()
+        db = open_session(project_id=st.session_state.current_project_id) # 分割保存ではプロジェクトの DB
         try:
             current_project = db.query(Project).filter(Project.id == st.session_state.current_project_id).first()
             if current_project:
@@ -591,6 +723,12 @@ else:
                     current_thread = db.query(Thread).filter(Thread.id == st.session_state.current_thread_id).first()
                     if current_thread:
                         st.write(f"チャット: {current_thread.name}")
+                        if current_thread.archived_at is not None:
+                            with st.spinner("アーカイブからチャットを読み込んでいます..."):
+                                restored = restore_thread(db, current_thread.id)
+                            if not restored: # 履歴の無いまま表示・生成しない
+                                st.error("チャットをアーカイブから戻せませんでした。")
+                                st.stop()
 
                         # --- モデル選択 (チャットエリア上部) ---
                         # グローバルなアプリ設定として選択モデルを保存（チャット間で共有）
@@ -619,129 +757,76 @@ else:
                         # APIリクエスト用のモデル名変数
                         selected_model_for_api = st.session_state.global_selected_model
 
+                        # --- モデル比較モード: 同じプロンプトを複数のモデルに同時に送る ---
+                        compare_mode = st.toggle("モデル比較モード", key="compare_mode")
+                        compare_models = []
+                        if compare_mode:
+                            compare_models = st.multiselect("比較するモデル", AVAILABLE_MODELS, default=AVAILABLE_MODELS, key="compare_models")
+                            # 選択中のモデルを先頭にする (先頭のモデルの回答がチャットの応答として採用される)
+                            compare_models = sorted(compare_models, key=lambda name: name != selected_model_for_api)
+
                         # --- チャット履歴の表示 ---
-                        messages = db.query(Message).filter(Message.thread_id == current_thread.id).order_by(Message.created_at).all()
-                        for msg in messages:
-                            with st.chat_message(msg.role):
-                                st.markdown(msg.content) # マークダウンとして表示
+                        with rerun_timer.phase("history_load"):
+                            messages = get_thread_history(db, current_thread.id) # 分岐元から共有しているメッセージを含む
+                        # 生成中の応答は完了するまで DB に無いため、ジョブの進捗として別に表示する (保存直後の応答も二重に表示しない)
+                        generating_ids = {job.assistant_message_id for job in get_generation_runner().jobs_for_thread(current_thread.id)}
+                        # 古いメッセージはキャッシュ済みのブロックにまとめ、直近のメッセージだけ吹き出しで表示する
+                        shown_messages = [msg for msg in messages if msg.id not in generating_ids]
+                        with rerun_timer.phase("history_load"):
+                            attachments = get_attachments_by_message(db, [msg.id for msg in shown_messages])
+                        render_chat_history(shown_messages, timer=rerun_timer, attachments=attachments)
+                        # 最後のプロンプトをモデル比較した場合は、全モデルの回答を並べて表示する
+                        last_user_message = next((msg for msg in reversed(messages) if msg.role == "user"), None)
+                        with rerun_timer.phase("history_load"):
+                            comparison = get_latest_comparison(db, current_thread.id) if last_user_message else []
+                        if comparison and comparison[0].user_message_id == last_user_message.id and not generating_ids:
+                            with st.expander(f"モデル比較 ({len(comparison)} モデル)", expanded=True):
+                                def adopt(answer_id):
+                                    if adopt_comparison_answer(db, answer_id):
+                                        st.rerun()
+                                    else:
+                                        st.error("回答の採用に失敗しました。")
+                                render_comparison_columns([comparison_answer_to_dict(answer) for answer in comparison], on_adopt=adopt)
+                        render_generation_progress(current_thread.id)
+
+                        # --- 分岐: 途中のメッセージから別の続きを試す (それまでの履歴はコピーせずに共有) ---
+                        if messages and not generating_ids:
+                            with st.expander("🌿 この時点から分岐", expanded=False):
+                                branch_options = {msg.id: f"{'👤' if msg.role == 'user' else '🤖'} {msg.content[:40]}"
+                                                  for msg in reversed(messages)}
+                                branch_message_id = st.selectbox("分岐点 (このメッセージまでを引き継ぎます)", list(branch_options),
+                                                                 format_func=branch_options.get, key=f"branch_point_{current_thread.id}")
+                                if st.button("分岐したチャットを作成", key=f"fork_thread_{current_thread.id}"):
+                                    forked = fork_thread(db, current_thread.id, branch_message_id)
+                                    if forked:
+                                        enqueue_thread_history_to_markdown(current_project.name, forked.id, forked.name,
+                                                                           get_thread_history(db, forked.id))
+                                        st.session_state.current_thread_id = forked.id
+                                        st.rerun()
+                                    else:
+                                        st.error("チャットの分岐に失敗しました。")
 
                         # チャット入力欄に自動フォーカスするJavaScriptを適用
                         st.markdown(js_focus_script, unsafe_allow_html=True)
                         
-                        # --- ★★★ チャット入力と後続処理を復元 ★★★ ---
-                        if prompt := st.chat_input("メッセージを入力してください"):
-                            # 1. ユーザーメッセージを表示し、DBに保存
-                            with st.chat_message("user"):
-                                st.markdown(prompt)
-                            
-                            user_message = Message(thread_id=current_thread.id, role="user", content=prompt)
-                            db.add(user_message)
-                            
-                            # チャットの最終更新日時を更新
-                            current_thread.updated_at = datetime.datetime.utcnow()
-                            db.add(current_thread)
-                            
-                            db.commit()
-
-                            # --- ★マークダウンエクスポート (ユーザー) ---
-                            export_message_to_markdown(
-                                project_name=current_project.name,
-                                thread_id=current_thread.id,
-                                thread_name=current_thread.name,
-                                role="user",
-                                content=prompt
-                            )
-                            # --- ★マークダウンエクスポートここまで ---
-
-                            # 2. Gemini API 呼び出し準備
-                            #    - 履歴を API 用の形式に変換 (システムプロンプトは別途渡す)
-                            history_for_api = []
-                            for m in messages:
-                                try:
-                                    # 役割(role)に応じて Content オブジェクトを作成
-                                    # DBの 'assistant' を API の 'model' に変換
-                                    api_role = 'model' if m.role == 'assistant' else m.role
-                                    # parts はリストである必要があるため、Part オブジェクトを生成
-                                    # Part.from_text でエラーが出たため Part(text=...) を使用
-                                    history_for_api.append(types.Content(role=api_role, parts=[types.Part(text=m.content)]))
-                                except ValueError as e:
-                                    st.error(f"履歴メッセージのフォーマットエラー (ID: {m.id}, Role: {m.role}): {e}")
-                                    continue 
-                            
-                            # 最新のユーザーメッセージを Content オブジェクトとして追加 (role は 'user' で確定)
-                            try:
-                                # Part.from_text でエラーが出たため Part(text=...) を使用
-                                history_for_api.append(types.Content(role="user", parts=[types.Part(text=prompt)]))
-                            except ValueError as e:
-                                st.error(f"ユーザー入力のフォーマットエラー: {e}")
-                                db.rollback() 
-                                st.stop()
-
-                            # 3. Gemini API 呼び出しと応答表示 (ストリーミング)
-                            try:
-                                # Client の初期化を変更 (引数なし)
-                                client = GeminiClient()
-
-                                # --- デバッグログ追加 ---
-                                logging.debug(f"Project ID: {current_project.id}, Thread ID: {current_thread.id}")
-                                logging.debug(f"Selected Model: {selected_model_for_api}")
-                                logging.debug(f"System Prompt: {current_project.system_prompt}")
-                                logging.debug(f"History for API (first 5 items): {history_for_api[:5]}") # 全部は多いので先頭5件
-                                logging.debug(f"Total history items for API: {len(history_for_api)}")
-                                # --- デバッグログここまで ---
-
-                                with st.chat_message("assistant"):
-                                    # ストリーミング応答を表示するプレースホルダー
-                                    response_placeholder = st.empty()
-                                    full_response = ""
-                                    # メソッド呼び出しに session_state からモデル名を取得して渡す
-                                    stream = client.generate_content_stream(
-                                        model_name=selected_model_for_api, # 選択されたモデルを使用
-                                        history=history_for_api, 
-                                        system_prompt=current_project.system_prompt
-                                    )
-                                    for chunk in stream:
-                                        full_response += chunk
-                                        response_placeholder.markdown(full_response + "▌") 
-                                    response_placeholder.markdown(full_response) 
-
-                                # 4. アシスタントの応答をDBに保存
-                                assistant_message = Message(thread_id=current_thread.id, role="assistant", content=full_response)
-                                db.add(assistant_message)
-                                
-                                # チャットの最終更新日時を再度更新
-                                current_thread.updated_at = datetime.datetime.utcnow()
-                                db.add(current_thread)
-
-                                db.commit()
-
-                                # --- ★マークダウンエクスポート (アシスタント) ---
-                                export_message_to_markdown(
-                                    project_name=current_project.name,
-                                    thread_id=current_thread.id,
-                                    thread_name=current_thread.name,
-                                    role="assistant",
-                                    content=full_response
-                                )
-                                # --- ★マークダウンエクスポートここまで ---
-
-                                # --- ★★★ チャット名の自動設定 (最初のやり取り後) ★★★ ---
-                                if not messages: # API呼び出し前のメッセージリストが空だったら
-                                    new_thread_name = prompt[:60] # ユーザー入力の先頭60文字
-                                    if new_thread_name:
-                                        logging.info(f"最初のやり取りを検出。チャット ID {current_thread.id} の名前を自動設定: '{new_thread_name}'")
-                                        # update_thread_name を直接呼び出すのではなく、セッションを再利用
-                                        update_success = update_thread_name(db, current_thread.id, new_thread_name)
-                                        if update_success:
-                                            # 即時反映のため rerun
-                                            st.rerun()
-                                        else:
-                                            logging.warning("チャット名の自動設定に失敗しました。")
-                                # --- ★★★ 自動設定ここまで ★★★ ---
-
-                            except Exception as e:
-                                st.error(f"Gemini API の呼び出し中にエラーが発生しました: {e}")
-                        # --- ★★★ チャット入力復元ここまで ★★★ ---
+                        # --- チャット入力 ---
+                        # 応答の生成はバックグラウンドのジョブで行う (チャットを切り替えても中断されない)
+                        # 添付ファイルは内容のハッシュで保存するため、同じファイルを何度添付してもディスクは増えない
+                        if chat_value := st.chat_input("メッセージを入力してください", accept_file="multiple",
+                                                       file_type=ATTACHMENT_FILE_TYPES):
+                            from utils.blob_store import get_blob_store
+                            prompt = chat_value.text or "添付ファイルについて説明してください。"
+                            attachment_ids = [store_attachment(db, get_blob_store(), uploaded_file, uploaded_file.name,
+                                                               uploaded_file.type or "application/octet-stream").id
+                                              for uploaded_file in chat_value.files]
+                            if compare_mode and compare_models:
+                                get_generation_runner().submit_comparison(current_thread.id, prompt, compare_models, attachment_ids,
+                                                                          user=st.session_state.sweeper_session_key)
+                            else:
+                                get_generation_runner().submit(current_thread.id, prompt, selected_model_for_api, attachment_ids,
+                                                               user=st.session_state.sweeper_session_key)
+                            st.rerun()
+                        # --- チャット入力ここまで ---
 
                     else:
                         st.warning("選択されたチャットが見つかりません。")
@@ -754,5 +839,21 @@ else:
                 st.session_state.current_thread_id = None
         finally:
             db.close()
+            chat_queries.stop()
     else:
         st.info("サイドバーからプロジェクトを選択または作成してください。")
+
+# --- パフォーマンス計測 (PERF_TIMING=1 のときだけ表示・記録) ---
+if rerun_timer.enabled:
+    rerun_timer.context.update(project_id=st.session_state.current_project_id,
+                               thread_id=st.session_state.current_thread_id)
+    with st.expander("⏱️ パフォーマンス計測 (デバッグ)", expanded=False):
+        st.markdown("**この再実行**")
+        st.markdown(format_phases(rerun_timer.to_dict()))
+        # 初回トークンまでの時間・ストリーミング・マークダウン書き出しはバックグラウンドの生成ジョブで計測される
+        finished_jobs = [job for job in get_generation_runner().jobs_for_thread(st.session_state.current_thread_id, active_only=False)
+                         if not job.is_active] if st.session_state.current_thread_id else []
+        if finished_jobs:
+            st.markdown(f"**直近の応答生成** ({finished_jobs[-1].model_name})")
+            st.markdown(format_phases(finished_jobs[-1].timings.to_dict()))
+    rerun_timer.emit()
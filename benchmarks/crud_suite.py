@@ -0,0 +1,229 @@
+"""
+CRUD・検索・エクスポートの規模別ベンチマーク。
+
+benchmarks.synthetic の合成データ (既定: 1万 / 10万メッセージ。100万は --sizes で指定) に対して、
+検索 (search_messages)、エクスポート (get_all_data_as_dataframe)、空チャットの削除
+(delete_empty_threads_in_project)、プロジェクトの削除 (delete_project) を繰り返し実行し、
+レイテンシのパーセンタイル、メモリのピーク (tracemalloc)、発行した SQL 文の数を計測します。
+結果は benchmarks/results/crud_suite.jsonl に追記され、--compare で以前のコミットの結果と比較できます。
+
+    python -m benchmarks.crud_suite                             # 計測して結果を追記
+    python -m benchmarks.crud_suite --sizes 10000 100000        # 規模を指定
+    python -m benchmarks.crud_suite --sizes 1000000 --operations search_rare export_dataframe
+    python -m benchmarks.crud_suite --compare                   # 直前の別コミットの結果と比較
+    python -m benchmarks.crud_suite --compare 3c41b5a --fail-on-regression
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+from typing import Callable
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+RESULTS_FILE = os.path.join(PROJECT_ROOT, "benchmarks", "results", "crud_suite.jsonl")
+DEFAULT_DATA_DIR = os.path.join(PROJECT_ROOT, "benchmarks", ".data")
+
+# 100万件の delete_project は messages.thread_id にインデックスが無いため1回に数十分かかる
+# (スレッドごとに外部キーの確認で messages を全件走査する)。100万件は --operations で操作を絞って計測する
+DEFAULT_SIZES = [10_000, 100_000]
+# 比較時に p50 がこの割合以上遅くなっていたら回帰とみなす
+DEFAULT_REGRESSION_THRESHOLD = 0.2
+# delete_empty_threads_in_project の前に追加する空のチャット数
+EMPTY_THREADS_PER_RUN = 50
+
+class StatementCounter:
+    """Engine で実行された SQL 文の数を数える (executemany は1回と数える)"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+def measure(run: Callable[[int], object], repeat: int, counter: StatementCounter,
+            setup: Callable[[int], None] | None = None) -> dict:
+    """
+    run(i) を repeat 回実行してレイテンシと SQL 文の数を計測し、
+    最後にもう1回 tracemalloc を有効にして実行してメモリのピークを計測します。
+    setup(i) は計測対象外の準備 (削除するデータの用意など) です。
+    """
+    from utils.perf_timing import percentile
+    latencies, statements = [], []
+    for i in range(repeat + 1):
+        if setup is not None:
+            setup(i)
+        counter.count = 0
+        if i == repeat:
+            # tracemalloc は実行を遅くするので、時間の計測とは別に1回だけ実行する
+            tracemalloc.start()
+            run(i)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            break
+        started = time.perf_counter()
+        run(i)
+        latencies.append((time.perf_counter() - started) * 1000)
+        statements.append(counter.count)
+    return {
+        "p50_ms": round(percentile(latencies, 0.5), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "max_ms": round(max(latencies), 2),
+        "peak_memory_mb": round(peak / 1024 / 1024, 2),
+        "sql_statements": max(statements),
+    }
+
+OPERATIONS = ["search_rare", "search_common_en", "search_common_ja", "search_and", "search_miss",
+              "export_dataframe", "delete_empty_threads", "delete_project"]
+
+def run_suite(db_path: str, repeat: int, operations: list[str] | None = None) -> dict[str, dict]:
+    """
+    合成データの DB (作業用のコピー) に対して操作を計測します。削除を含むため DB は変更されます。
+    operations を指定した場合はその操作だけを計測します。
+    """
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.orm import sessionmaker
+    from database import crud
+    from utils.csv_export import get_all_data_as_dataframe
+    from benchmarks.synthetic import PROJECT_COUNT, RARE_TERM
+
+    engine = create_engine(f"sqlite:///{db_path}", connect_args={"check_same_thread": False})
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    counter = StatementCounter(engine)
+
+    def with_session(fn):
+        def run(i):
+            db = Session()
+            try:
+                return fn(db, i)
+            finally:
+                db.close()
+        return run
+
+    def add_empty_threads(i):
+        with engine.begin() as connection:
+            connection.execute(text(
+                "INSERT INTO threads (project_id, name, created_at, updated_at) "
+                "VALUES (:project_id, '新規チャット', '2025-01-01 00:00:00.000000', '2025-01-01 00:00:00.000000')"
+            ), [{"project_id": PROJECT_COUNT}] * EMPTY_THREADS_PER_RUN)
+
+    searches = {
+        "search_rare": RARE_TERM, # 約 0.1% のメッセージに含まれる
+        "search_common_en": "database",
+        "search_common_ja": "検索",
+        "search_and": "データベース performance",
+        "search_miss": "存在しない語zzz",
+    }
+    results = {}
+
+    def add(name: str, measure_operation: Callable[[], dict]) -> None:
+        if operations is not None and name not in operations:
+            return
+        results[name] = result = measure_operation()
+        # 100万件では1つの操作に数分かかるため、終わったものから表示する
+        print(f"{name:<22} p50 {result['p50_ms']:9.1f} ms  p95 {result['p95_ms']:9.1f} ms  "
+              f"peak {result['peak_memory_mb']:8.1f} MB  SQL {result['sql_statements']:>5}", flush=True)
+
+    for name, query in searches.items():
+        add(name, lambda q=query: measure(with_session(lambda db, i: crud.search_messages(db, q)), repeat, counter))
+    add("export_dataframe", lambda: measure(with_session(lambda db, i: get_all_data_as_dataframe(db)), repeat, counter))
+    add("delete_empty_threads", lambda: measure(
+        with_session(lambda db, i: crud.delete_empty_threads_in_project(db, PROJECT_COUNT)),
+        repeat, counter, setup=add_empty_threads))
+    # プロジェクトは1回ごとに別のものを削除する (各プロジェクトはメッセージ全体の約 1/PROJECT_COUNT)
+    add("delete_project", lambda: measure(with_session(lambda db, i: crud.delete_project(db, i + 1)), repeat, counter))
+    engine.dispose()
+    return results
+
+def _load_records() -> list[dict]:
+    try:
+        with open(RESULTS_FILE, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def find_baseline(records: list[dict], ref: str | None, current_commit: str | None) -> dict | None:
+    """比較対象の結果: ref を指定した場合はそのコミットの最新、省略時は現在と別のコミットの最新。"""
+    for record in reversed(records):
+        commit = record.get("commit") or ""
+        if (ref and commit.startswith(ref)) or (not ref and commit != current_commit):
+            return record
+    return None
+
+def compare(baseline: dict, current: dict, threshold: float) -> list[str]:
+    """規模・操作ごとに p50 を比較して表示し、回帰した操作の一覧を返します。"""
+    regressions = []
+    print(f"\n比較対象: {baseline.get('commit')} ({baseline.get('timestamp')})")
+    print(f"{'size':>9} {'operation':<22} {'base p50':>10} {'p50':>10} {'ratio':>7} {'SQL':>9}")
+    for size, operations in current["results"].items():
+        for name, result in operations.items():
+            base = baseline.get("results", {}).get(size, {}).get(name)
+            if base is None:
+                continue
+            ratio = result["p50_ms"] / base["p50_ms"] if base["p50_ms"] else float("inf")
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = "  <- 回帰"
+                regressions.append(f"{size}:{name}")
+            print(f"{size:>9} {name:<22} {base['p50_ms']:10.1f} {result['p50_ms']:10.1f} {ratio:7.2f} "
+                  f"{base['sql_statements']:>4}->{result['sql_statements']:<4}{flag}")
+    return regressions
+
+if __name__ == "__main__":
+    sys.path.insert(0, PROJECT_ROOT)
+
+    parser = argparse.ArgumentParser(description="CRUD・検索・エクスポートの規模別ベンチマーク")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="メッセージ数")
+    parser.add_argument("--repeat", type=int, default=5, help="操作ごとの計測回数")
+    parser.add_argument("--operations", nargs="+", choices=OPERATIONS, default=None, help="計測する操作 (既定: 全て)")
+    parser.add_argument("--seed", type=int, default=0, help="合成データのシード")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="合成データの保存先 (次回以降は再利用)")
+    parser.add_argument("--compare", nargs="?", const="", default=None, metavar="COMMIT",
+                        help="以前の結果と比較する (コミット省略時は直前の別コミット)")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD, help="回帰とみなす p50 の増加率")
+    parser.add_argument("--fail-on-regression", action="store_true", help="回帰があれば終了コード 1 で終わる")
+    parser.add_argument("--no-save", action="store_true", help="結果を results/crud_suite.jsonl に保存しない")
+    args = parser.parse_args()
+
+    from benchmarks.startup import _project_version, _git_commit
+    from benchmarks.synthetic import ensure_dataset
+
+    record = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "version": _project_version(),
+        "commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in args.sizes:
+            dataset = ensure_dataset(args.data_dir, size, args.seed)
+            work_path = os.path.join(work_dir, f"{size}.db")
+            shutil.copyfile(dataset, work_path) # 削除の計測で元データを変更しない
+            print(f"--- {size:,} メッセージ ---", flush=True)
+            record["results"][str(size)] = run_suite(work_path, args.repeat, args.operations)
+            os.remove(work_path)
+
+    regressions = []
+    if args.compare is not None:
+        baseline = find_baseline(_load_records(), args.compare or None, record["commit"])
+        if baseline is None:
+            print("\n比較対象の結果がありません。")
+        else:
+            regressions = compare(baseline, record, args.threshold)
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+        with open(RESULTS_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    if regressions and args.fail_on_regression:
+        sys.exit(f"回帰が見つかりました: {', '.join(regressions)}")
@@ -0,0 +1,396 @@
+"""
+複数ユーザーの同時利用を模擬する負荷試験。
+
+N 人の仮想ユーザーがそれぞれ「新規チャット → 数回の送信 → 検索・チャット切り替え → (時々) エクスポート」という
+セッションを同時に実行し、同時ユーザー数ごとのスループット・操作別のレイテンシ (p50 / p95 / p99)・
+DB の書き込み待ち・エラーを計測します。各操作は app.py と同じ CRUD 関数・クエリと、
+GenerationJobRunner → GeminiClient の経路を通ります (Gemini の代わりに遅延を設定できる疑似モデルを使用)。
+
+DB の書き込み (INSERT / UPDATE / DELETE と COMMIT) は sqlite3 の接続をラップして時間を計り、
+ロック待ち (busy timeout) による伸びと "database is locked" エラーの数を記録します。
+
+    python -m benchmarks.load_sessions                                  # 1 / 10 / 25 / 50 人で計測
+    python -m benchmarks.load_sessions --users 5 50 --sessions 3 --prompts 4
+    python -m benchmarks.load_sessions --ttft 0.8 --chunk-interval 0.05 --chunks 40
+    python -m benchmarks.load_sessions --base-messages 100000            # 既存データのある DB で計測
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import datetime
+import tempfile
+import threading
+from types import SimpleNamespace
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+RESULTS_FILE = os.path.join(PROJECT_ROOT, "benchmarks", "results", "load_sessions.jsonl")
+
+DEFAULT_USERS = [1, 10, 25, 50]
+ACTIONS = ["new_chat", "send_prompt", "search", "switch_thread", "export"]
+SEARCH_TERMS = ["データベース", "performance", "検索 index", "エラー", "cache"]
+PROMPTS = [
+    "データベースの検索を速くする方法を教えてください。",
+    "How should we cache the API response?",
+    "このエラーの原因は何ですか？ database is locked",
+    "非同期処理と thread pool の違いを説明してください。",
+]
+
+class ScriptedModel:
+    """
+    genai.Client の代わりに使う疑似モデル。
+    client.models.generate_content_stream と同じ呼び出し方で、ttft 秒後から chunk_interval 秒ごとにチャンクを返します。
+    """
+
+    def __init__(self, ttft: float, chunk_interval: float, chunks: int, error_rate: float = 0.0, seed: int = 0):
+        self.ttft = ttft
+        self.chunk_interval = chunk_interval
+        self.chunks = chunks
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.models = self
+
+    def generate_content_stream(self, model, contents, config=None):
+        with self._lock:
+            fail = self._rng.random() < self.error_rate
+        time.sleep(self.ttft)
+        if fail:
+            raise RuntimeError("503 UNAVAILABLE (疑似エラー)")
+        for i in range(self.chunks):
+            if i:
+                time.sleep(self.chunk_interval)
+            usage = None
+            if i == self.chunks - 1:
+                usage = SimpleNamespace(prompt_token_count=len(contents) * 20, candidates_token_count=self.chunks * 8,
+                                        total_token_count=len(contents) * 20 + self.chunks * 8)
+            yield SimpleNamespace(text=f"チャンク {i} の回答です。The answer continues here. ", usage_metadata=usage)
+
+class WriteTimer:
+    """DB の書き込み文と COMMIT の所要時間 (ロック待ちを含む) と、ロックによるエラーの数を集計する"""
+
+    _WRITE_PREFIXES = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples_ms: list[float] = []
+        self.locked_errors = 0
+
+    def reset(self) -> None:
+        with self._lock:
+            self.samples_ms = []
+            self.locked_errors = 0
+
+    def timed(self, fn, *args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e):
+                with self._lock:
+                    self.locked_errors += 1
+            raise
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.samples_ms.append(elapsed)
+
+    def connection_factory(self):
+        """sqlite3.connect(factory=...) に渡す、書き込みの時間を計る接続クラス"""
+        timer = self
+
+        class TimedCursor(sqlite3.Cursor):
+            def execute(self, sql, parameters=()):
+                if sql.lstrip().upper().startswith(WriteTimer._WRITE_PREFIXES):
+                    return timer.timed(super().execute, sql, parameters)
+                return super().execute(sql, parameters)
+
+            def executemany(self, sql, seq_of_parameters):
+                return timer.timed(super().executemany, sql, seq_of_parameters)
+
+        class TimedConnection(sqlite3.Connection):
+            def cursor(self, factory=TimedCursor):
+                return super().cursor(factory)
+
+            def commit(self):
+                return timer.timed(super().commit)
+
+        return TimedConnection
+
+def _percentiles(values: list[float]) -> dict:
+    from utils.perf_timing import percentile
+    if not values:
+        return {"count": 0}
+    pick = lambda q: round(percentile(values, q), 1)
+    return {"count": len(values), "p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99),
+            "max_ms": round(max(values), 1)}
+
+class SimulatedApp:
+    """
+    app.py の操作を1ユーザー分再現します。どの操作も最後に再実行 (rerun) 時のクエリ
+    (プロジェクト一覧・チャット一覧・表示中のチャットの履歴) を行います。
+    """
+
+    def __init__(self, Session, runner, model_name: str, sweeper=None):
+        self.Session = Session
+        self.runner = runner
+        self.model_name = model_name
+        self.sweeper = sweeper # utils.thread_sweeper.EmptyThreadSweeper (表示中のチャットを登録する)
+
+    def rerun(self, db, project_id: int, thread_id: int | None) -> None:
+        from database.crud import list_projects, list_threads, get_thread_history
+
+        # app.py のサイドバーと履歴表示と同じ読み取り専用のクエリ
+        list_projects(db)
+        list_threads(db, project_id)
+        if thread_id is not None:
+            get_thread_history(db, thread_id)
+
+    def new_chat(self, project_id: int, session_key: str) -> int:
+        from models.models import Thread
+
+        db = self.Session()
+        try:
+            # app.py の「新規チャット」ボタンと同じ処理 (INSERT 1回。空チャットの削除はバックグラウンドの掃除が行う)
+            new_thread = Thread(project_id=project_id, name="新規チャット")
+            db.add(new_thread)
+            db.flush()
+            new_thread_id = new_thread.id
+            db.commit()
+            if self.sweeper is not None:
+                self.sweeper.protect(session_key, new_thread_id)
+            self.rerun(db, project_id, new_thread_id)
+            return new_thread_id
+        finally:
+            db.close()
+
+    def send_prompt(self, project_id: int, thread_id: int, prompt: str) -> None:
+        from utils.generation_jobs import DONE
+
+        job = self.runner.submit(thread_id, prompt, self.model_name)
+        if not job.wait(timeout=300):
+            raise TimeoutError("応答の生成がタイムアウトしました。")
+        if job.status != DONE:
+            raise RuntimeError(job.error or job.status)
+        db = self.Session()
+        try:
+            self.rerun(db, project_id, thread_id)
+        finally:
+            db.close()
+
+    def search(self, project_id: int, thread_id: int, query: str) -> None:
+        from database.crud import search_messages
+
+        db = self.Session()
+        try:
+            # app.py の検索ボタンと同じく、チャット名とプロジェクト名を JOIN した検索結果を読み込む
+            search_messages(db, query)
+            self.rerun(db, project_id, None)
+        finally:
+            db.close()
+
+    def switch_thread(self, project_id: int, thread_id: int, session_key: str) -> None:
+        if self.sweeper is not None:
+            self.sweeper.protect(session_key, thread_id)
+        db = self.Session()
+        try:
+            self.rerun(db, project_id, thread_id)
+        finally:
+            db.close()
+
+    def export(self, project_id: int, thread_id: int) -> None:
+        from utils.csv_export import get_all_data_as_dataframe, generate_csv_data
+
+        db = self.Session()
+        try:
+            generate_csv_data(get_all_data_as_dataframe(db))
+            self.rerun(db, project_id, thread_id)
+        finally:
+            db.close()
+
+def run_user(app: SimulatedApp, user: int, args, project_ids: list[int], record) -> None:
+    """1人の仮想ユーザーのセッションを args.sessions 回実行する"""
+    rng = random.Random(args.seed * 1000 + user)
+
+    def think():
+        time.sleep(rng.uniform(0.5, 1.5) * args.think_time)
+
+    own_threads = [] # このユーザーが作ったチャット (切り替え先)
+    for _ in range(args.sessions):
+        project_id = rng.choice(project_ids)
+        thread_id = record("new_chat", app.new_chat, project_id, f"user-{user}")
+        if thread_id is None:
+            continue
+        own_threads.append((project_id, thread_id))
+        for _ in range(args.prompts):
+            think()
+            record("send_prompt", app.send_prompt, project_id, thread_id, rng.choice(PROMPTS))
+            if rng.random() < args.search_rate:
+                think()
+                record("search", app.search, project_id, thread_id, rng.choice(SEARCH_TERMS))
+            if rng.random() < args.switch_rate:
+                think()
+                record("switch_thread", app.switch_thread, *rng.choice(own_threads), f"user-{user}")
+        if rng.random() < args.export_rate:
+            think()
+            record("export", app.export, project_id, thread_id)
+
+def run_level(db_path: str, users: int, args, timer: WriteTimer) -> dict:
+    """同時ユーザー数 users で全員のセッションを実行し、集計結果を返します。"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from api.gemini_client import GeminiClient
+    from models.models import Project
+    from utils.generation_jobs import GenerationJobRunner
+    from utils.thread_sweeper import EmptyThreadSweeper
+
+    engine = create_engine(f"sqlite:///{db_path}",
+                           connect_args={"check_same_thread": False, "factory": timer.connection_factory()})
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    model = ScriptedModel(args.ttft, args.chunk_interval, args.chunks, args.error_rate, args.seed)
+    client = GeminiClient(client=model)
+    runner = GenerationJobRunner(max_workers=args.generation_workers, session_factory=Session,
+                                 client_factory=lambda: client)
+    # 空チャットの掃除は app.py と同じくバックグラウンドで動かす (計測中に何度も走るよう間隔を短くする)
+    sweeper = EmptyThreadSweeper(session_factory=Session, interval=args.sweep_interval, grace_seconds=args.sweep_grace,
+                                 busy_thread_ids=runner.active_thread_ids).start()
+    app = SimulatedApp(Session, runner, "scripted-model", sweeper)
+
+    db = Session()
+    project_ids = [project_id for (project_id,) in db.query(Project.id).all()]
+    db.close()
+
+    latencies: dict[str, list[float]] = {action: [] for action in ACTIONS}
+    errors: dict[str, int] = {}
+    lock = threading.Lock()
+
+    def record(action, fn, *fn_args):
+        started = time.perf_counter()
+        try:
+            result = fn(*fn_args)
+        except Exception as e:
+            with lock:
+                # オブジェクトのアドレスを除いて、同じ種類のエラーをまとめる
+                key = f"{action}: {type(e).__name__}: {re.sub(r' at 0x[0-9a-f]+', '', str(e))[:80]}"
+                errors[key] = errors.get(key, 0) + 1
+            return None
+        with lock:
+            latencies[action].append((time.perf_counter() - started) * 1000)
+        return result
+
+    timer.reset()
+    started = time.perf_counter()
+    workers = [threading.Thread(target=run_user, args=(app, user, args, project_ids, record), name=f"user-{user}")
+               for user in range(users)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    wall = time.perf_counter() - started
+    sweeper.close()
+    runner.shutdown()
+    engine.dispose()
+
+    completed = sum(len(values) for values in latencies.values())
+    return {
+        "users": users,
+        "wall_seconds": round(wall, 2),
+        "actions": completed,
+        "actions_per_second": round(completed / wall, 2),
+        "prompts_per_second": round(len(latencies["send_prompt"]) / wall, 2),
+        "errors": sum(errors.values()),
+        "error_kinds": errors,
+        "latency": {action: _percentiles(values) for action, values in latencies.items()},
+        "db_writes": {**_percentiles(timer.samples_ms), "total_seconds": round(sum(timer.samples_ms) / 1000, 2),
+                      "locked_errors": timer.locked_errors},
+    }
+
+def prepare_database(work_dir: str, base_messages: int, seed: int) -> str:
+    """計測用の DB を作ります。base_messages > 0 なら合成データのコピー、0 なら空のプロジェクトだけの DB。"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from database.database import init_db
+    from models.models import Project
+
+    path = os.path.join(work_dir, "load.db")
+    if base_messages:
+        from benchmarks.synthetic import ensure_dataset
+        shutil.copyfile(ensure_dataset(os.path.join(PROJECT_ROOT, "benchmarks", ".data"), base_messages, seed), path)
+        return path
+    engine = create_engine(f"sqlite:///{path}")
+    init_db(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add_all([Project(name=f"Load Project {i}", system_prompt="あなたは負荷試験用のアシスタントです。") for i in range(5)])
+    db.commit()
+    db.close()
+    engine.dispose()
+    return path
+
+if __name__ == "__main__":
+    sys.path.insert(0, PROJECT_ROOT)
+
+    parser = argparse.ArgumentParser(description="複数ユーザーの同時利用を模擬する負荷試験")
+    parser.add_argument("--users", type=int, nargs="+", default=DEFAULT_USERS, help="同時ユーザー数")
+    parser.add_argument("--sessions", type=int, default=2, help="1ユーザーあたりのセッション数")
+    parser.add_argument("--prompts", type=int, default=3, help="1セッションあたりの送信数")
+    parser.add_argument("--think-time", type=float, default=0.5, help="操作の間隔の平均 (秒)")
+    parser.add_argument("--search-rate", type=float, default=0.3, help="送信後に検索する確率")
+    parser.add_argument("--switch-rate", type=float, default=0.3, help="送信後にチャットを切り替える確率")
+    parser.add_argument("--export-rate", type=float, default=0.05, help="セッションの最後にエクスポートする確率")
+    parser.add_argument("--ttft", type=float, default=0.5, help="疑似モデルの最初のチャンクまでの時間 (秒)")
+    parser.add_argument("--chunk-interval", type=float, default=0.05, help="疑似モデルのチャンクの間隔 (秒)")
+    parser.add_argument("--chunks", type=int, default=20, help="疑似モデルの1応答のチャンク数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="疑似モデルがエラーを返す確率")
+    parser.add_argument("--generation-workers", type=int, default=None, help="GenerationJobRunner のワーカー数 (既定: GENERATION_WORKERS)")
+    parser.add_argument("--sweep-interval", type=float, default=1.0, help="空チャットの掃除の間隔 (秒)")
+    parser.add_argument("--sweep-grace", type=float, default=5.0, help="作成から空チャットを削除するまでの猶予 (秒)")
+    parser.add_argument("--base-messages", type=int, default=0, help="最初から入っているメッセージ数 (合成データ)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-save", action="store_true", help="結果を results/load_sessions.jsonl に保存しない")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    os.environ["MARKDOWN_SAVE_DIR"] = os.path.join(work_dir, "markdown") # マークダウンも実際に書き出す (一時ディレクトリへ)
+
+    from benchmarks.startup import _project_version, _git_commit
+    from utils.generation_jobs import GENERATION_WORKERS
+
+    if args.generation_workers is None:
+        args.generation_workers = GENERATION_WORKERS
+    timer = WriteTimer()
+    levels = []
+    try:
+        for users in args.users:
+            db_path = prepare_database(work_dir, args.base_messages, args.seed) # 同時ユーザー数ごとに同じ状態から始める
+            result = run_level(db_path, users, args, timer)
+            levels.append(result)
+            latency = result["latency"]
+            print(f"users={users:3d}  {result['actions_per_second']:6.2f} 操作/秒  {result['prompts_per_second']:6.2f} 送信/秒  "
+                  f"送信 p95 {latency['send_prompt'].get('p95_ms', 0):8.0f} ms  新規 p95 {latency['new_chat'].get('p95_ms', 0):7.0f} ms  "
+                  f"検索 p95 {latency['search'].get('p95_ms', 0):7.0f} ms  書き込み p95 {result['db_writes'].get('p95_ms', 0):7.0f} ms  "
+                  f"locked {result['db_writes']['locked_errors']}  errors {result['errors']}")
+            for kind, count in result["error_kinds"].items():
+                print(f"    {count:4d} x {kind}")
+            os.remove(db_path)
+    finally:
+        from utils.markdown_export import get_markdown_writer
+        get_markdown_writer().close() # 残りを書き出してから一時ディレクトリを消す
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+        record = {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "version": _project_version(),
+            "commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "config": {key: value for key, value in vars(args).items() if key not in ("users", "no_save")},
+            "levels": levels,
+        }
+        with open(RESULTS_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
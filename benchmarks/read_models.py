@@ -0,0 +1,125 @@
+"""
+大きなスレッドの履歴読み込みの時間とメモリの計測。
+
+1,000 / 10,000 / 50,000 件のメッセージを持つスレッドを一時 DB に作り、履歴を次の2通りで読み込んで比較します。
+
+- orm:  ORM の Message オブジェクトとして読み込む (従来の実装。セッションの ID マップと変更の追跡を伴う)
+- rows: database.crud.get_thread_history (必要な列だけを select() で読み込み、MessageRow のタプルで返す)
+
+時間は repeat 回の中央値、メモリは tracemalloc で計測した読み込み中のピーク (1回目) です。
+
+    python -m benchmarks.read_models                      # 計測して結果を追記
+    python -m benchmarks.read_models --sizes 1000 10000   # スレッドのサイズを指定
+    python -m benchmarks.read_models --no-save            # 結果を保存しない
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import statistics
+import tracemalloc
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+RESULTS_FILE = os.path.join(PROJECT_ROOT, "benchmarks", "results", "read_models.jsonl")
+
+DEFAULT_SIZES = [1_000, 10_000, 50_000]
+MODES = ["orm", "rows"]
+
+def seed_database(engine, sizes: list[int]) -> dict[int, int]:
+    """サイズごとにスレッドを1つ作り、サイズ -> スレッド ID を返します。"""
+    from sqlalchemy import insert
+    from sqlalchemy.orm import Session
+    from database.database import init_db
+    from models.models import Project, Thread, Message
+
+    init_db(bind=engine)
+    rng = random.Random(0)
+    started = datetime.datetime(2025, 1, 1)
+    with Session(engine) as db:
+        project = Project(name="Read Model Benchmark", system_prompt="")
+        db.add(project)
+        db.commit()
+        thread_ids = {}
+        for size in sizes:
+            thread = Thread(project_id=project.id, name=f"{size} messages")
+            db.add(thread)
+            db.commit()
+            db.execute(insert(Message), [
+                {"thread_id": thread.id,
+                 "role": "user" if i % 2 == 0 else "assistant",
+                 "content": (f"質問 {i}: " + "テキスト " * rng.randint(5, 40)) if i % 2 == 0 else
+                            (f"回答 {i}\n\n" + "説明 " * rng.randint(20, 120)),
+                 "created_at": started + datetime.timedelta(seconds=i)}
+                for i in range(size)
+            ])
+            db.commit()
+            thread_ids[size] = thread.id
+        return thread_ids
+
+def load(engine, thread_id: int, mode: str) -> int:
+    """app.py の履歴表示と同じ順序で履歴を読み込み、件数を返す (セッションは読み込みごとに作る)"""
+    from sqlalchemy.orm import Session
+    from models.models import Message
+    from database.crud import get_thread_history
+
+    with Session(engine) as db:
+        if mode == "orm":
+            messages = db.query(Message).filter(Message.thread_id == thread_id).order_by(Message.created_at, Message.id).all()
+        else:
+            messages = get_thread_history(db, thread_id)
+        # 表示と同じく本文に触れる (ORM は属性の読み込みを含めて計測する)
+        return sum(len(message.content) > 0 for message in messages)
+
+def measure(engine, thread_id: int, mode: str, repeat: int = 5) -> dict:
+    """読み込み時間の中央値と、1回目の読み込み中のメモリのピークを返します。"""
+    tracemalloc.start()
+    count = load(engine, thread_id, mode)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        load(engine, thread_id, mode)
+        times.append(time.perf_counter() - started)
+    return {"load_seconds": statistics.median(times), "peak_bytes": peak, "loaded": count}
+
+if __name__ == "__main__":
+    sys.path.insert(0, PROJECT_ROOT)
+    from sqlalchemy import create_engine
+    from benchmarks.startup import _project_version, _git_commit
+
+    parser = argparse.ArgumentParser(description="大きなスレッドの履歴読み込みの時間とメモリを計測します。")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="スレッドのメッセージ数")
+    parser.add_argument("--repeat", type=int, default=5, help="読み込みの回数 (中央値を記録)")
+    parser.add_argument("--no-save", action="store_true", help="結果を results/read_models.jsonl に保存しない")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        engine = create_engine(f"sqlite:///{os.path.join(work_dir, 'read_models.db')}")
+        thread_ids = seed_database(engine, args.sizes)
+        print(f"{'messages':>8} {'mode':>5} {'load ms':>9} {'peak MiB':>9}")
+        for size in args.sizes:
+            for mode in MODES:
+                result = measure(engine, thread_ids[size], mode, repeat=args.repeat)
+                result.update({"messages": size, "mode": mode})
+                results.append(result)
+                print(f"{size:8d} {mode:>5} {result['load_seconds'] * 1000:9.1f} {result['peak_bytes'] / 2**20:9.1f}")
+        engine.dispose()
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+        record = {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "version": _project_version(),
+            "commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "results": results,
+        }
+        with open(RESULTS_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
@@ -0,0 +1,163 @@
+"""
+チャット履歴表示の再実行 (rerun) 時間の計測。
+
+100 / 1,000 / 5,000 件のメッセージを持つスレッドを一時 DB に作り、Streamlit の AppTest で
+app.py と同じクエリ + 履歴表示を繰り返し再実行して、1回あたりの時間を比較します。
+
+- baseline: 全メッセージを st.chat_message + st.markdown で表示する (従来の実装)
+- cached:   utils.render_cache.render_chat_history (古いメッセージはキャッシュ済みのブロックで表示)
+
+    python -m benchmarks.render_history                      # 計測して結果を追記
+    python -m benchmarks.render_history --sizes 100 1000     # スレッドのサイズを指定
+    python -m benchmarks.render_history --no-save            # 結果を保存しない
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import statistics
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+RESULTS_FILE = os.path.join(PROJECT_ROOT, "benchmarks", "results", "render_history.jsonl")
+
+DEFAULT_SIZES = [100, 1_000, 5_000]
+MODES = ["baseline", "cached"]
+
+# AppTest のスクリプトから使う Engine (パスごとに1つ)
+_engines: dict = {}
+
+def _get_engine(path: str):
+    from sqlalchemy import create_engine
+    if path not in _engines:
+        _engines[path] = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    return _engines[path]
+
+def seed_database(path: str, sizes: list[int]) -> dict[int, int]:
+    """サイズごとにスレッドを1つ作り、サイズ -> スレッド ID を返します。"""
+    from sqlalchemy.orm import sessionmaker
+    from database.database import init_db
+    from models.models import Project, Thread, Message
+
+    engine = _get_engine(path)
+    init_db(bind=engine)
+    db = sessionmaker(bind=engine)()
+    rng = random.Random(0)
+    try:
+        project = Project(name="Render Benchmark", system_prompt="")
+        db.add(project)
+        db.commit()
+        thread_ids = {}
+        started = datetime.datetime(2025, 1, 1)
+        for size in sizes:
+            thread = Thread(project_id=project.id, name=f"{size} messages")
+            db.add(thread)
+            db.commit()
+            db.bulk_save_objects([
+                Message(
+                    thread_id=thread.id,
+                    role="user" if i % 2 == 0 else "assistant",
+                    # コードブロックや箇条書きを含む、実際の応答に近い長さの本文
+                    content=(f"質問 {i}: " + "テキスト " * rng.randint(5, 40)) if i % 2 == 0 else
+                            (f"回答 {i}\n\n- 項目 A\n- 項目 B\n\n```python\nprint({i})\n```\n\n" + "説明 " * rng.randint(20, 120)),
+                    created_at=started + datetime.timedelta(seconds=i),
+                )
+                for i in range(size)
+            ])
+            db.commit()
+            thread_ids[size] = thread.id
+        return thread_ids
+    finally:
+        db.close()
+
+def render_thread(db_path: str, thread_id: int, mode: str) -> None:
+    """AppTest のスクリプトから呼ばれる: app.py と同じクエリで履歴を読み込み、指定の方法で表示する"""
+    import streamlit as st
+    from sqlalchemy.orm import Session
+    from models.models import Message
+    from utils.render_cache import render_chat_history
+
+    with Session(_get_engine(db_path)) as db:
+        messages = db.query(Message).filter(Message.thread_id == thread_id).order_by(Message.created_at).all()
+        if mode == "baseline":
+            for msg in messages:
+                with st.chat_message(msg.role):
+                    st.markdown(msg.content)
+        else:
+            render_chat_history(messages)
+
+def _app_script():
+    # AppTest.from_function はこの関数の本体をスクリプトとして実行する
+    import streamlit as st
+    from benchmarks.render_history import render_thread
+    render_thread(st.session_state.bench_db_path, st.session_state.bench_thread_id, st.session_state.bench_mode)
+
+def measure(db_path: str, thread_id: int, mode: str, reruns: int = 5) -> dict:
+    """
+    初回実行の時間と、その後 reruns 回再実行したときの中央値を返します。
+    cached の初回はキャッシュが空の状態 (プロセス内キャッシュをクリアしてから実行) です。
+    """
+    from streamlit.testing.v1 import AppTest
+    import utils.render_cache as render_cache
+
+    render_cache._cache = None # キャッシュを空にして初回を計測する
+    app = AppTest.from_function(_app_script, default_timeout=600)
+    app.session_state.bench_db_path = db_path
+    app.session_state.bench_thread_id = thread_id
+    app.session_state.bench_mode = mode
+
+    started = time.perf_counter()
+    app.run()
+    first_seconds = time.perf_counter() - started
+    if app.exception:
+        raise RuntimeError(f"スクリプトの実行に失敗しました: {app.exception}")
+
+    rerun_times = []
+    for _ in range(reruns):
+        started = time.perf_counter()
+        app.run()
+        rerun_times.append(time.perf_counter() - started)
+    return {
+        "first_seconds": first_seconds,
+        "rerun_seconds": statistics.median(rerun_times),
+        "elements": len(app.markdown),
+    }
+
+if __name__ == "__main__":
+    sys.path.insert(0, PROJECT_ROOT)
+    from benchmarks.startup import _project_version, _git_commit
+
+    parser = argparse.ArgumentParser(description="チャット履歴表示の再実行時間を計測します。")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="スレッドのメッセージ数")
+    parser.add_argument("--reruns", type=int, default=5, help="再実行の回数 (中央値を記録)")
+    parser.add_argument("--no-save", action="store_true", help="結果を results/render_history.jsonl に保存しない")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        db_path = os.path.join(work_dir, "render_benchmark.db")
+        thread_ids = seed_database(db_path, args.sizes)
+        print(f"{'messages':>8} {'mode':>9} {'first ms':>9} {'rerun ms':>9} {'markdown':>9}")
+        for size in args.sizes:
+            for mode in MODES:
+                result = measure(db_path, thread_ids[size], mode, reruns=args.reruns)
+                result.update({"messages": size, "mode": mode})
+                results.append(result)
+                print(f"{size:8d} {mode:>9} {result['first_seconds'] * 1000:9.0f} "
+                      f"{result['rerun_seconds'] * 1000:9.0f} {result['elements']:9d}")
+        _get_engine(db_path).dispose()
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+        record = {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "version": _project_version(),
+            "commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "results": results,
+        }
+        with open(RESULTS_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
@@ -0,0 +1,194 @@
+"""
+API サーバー (api.server) の負荷試験: 同時ストリーム数とコアあたりの処理能力の計測。
+
+Gemini の代わりに一定間隔でチャンクを返す疑似クライアントを使い、一時 DB を使う
+1ワーカーの uvicorn サーバーを別プロセスで起動します。同時に C 本のチャットを SSE で受信し、
+初回チャンクまでの時間 (TTFT)・ストリーム全体の時間・サーバープロセスの CPU 時間を計測します。
+「コアあたりの同時ストリーム数」は、C 本を処理したときの CPU 使用率から
+1コアを使い切るまでに処理できる同時ストリーム数を見積もった値です。
+
+    python -m benchmarks.server_load                              # 計測して結果を追記
+    python -m benchmarks.server_load --concurrency 50 500         # 同時ストリーム数を指定
+    python -m benchmarks.server_load --chunks 40 --chunk-interval 0.025
+    python -m benchmarks.server_load --no-save
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+RESULTS_FILE = os.path.join(PROJECT_ROOT, "benchmarks", "results", "server_load.jsonl")
+
+DEFAULT_CONCURRENCY = [10, 100, 500]
+
+class FakeStreamingClient:
+    """chunks 個のチャンクを interval 秒ごとに返す疑似 Gemini クライアント (ネットワーク待ちを模擬)"""
+
+    def __init__(self, chunks: int, interval: float):
+        self.chunks = chunks
+        self.interval = interval
+
+    async def generate_content_stream_async(self, model_name, history, system_prompt=None, usage=None, **scheduling):
+        for i in range(self.chunks):
+            await asyncio.sleep(self.interval)
+            yield f"チャンク {i} " * 5
+        if usage is not None:
+            usage.update(prompt_tokens=len(history), output_tokens=self.chunks, total_tokens=len(history) + self.chunks)
+
+def run_server(port: int, db_path: str, chunks: int, interval: float) -> None:
+    """負荷試験用のサーバーを起動します (子プロセスで実行)。"""
+    import uvicorn
+    from unittest import mock
+    from sqlalchemy import create_engine
+    from api.server import create_app
+
+    engine = create_engine(f"sqlite:///{db_path}", connect_args={"check_same_thread": False})
+    # マークダウンファイルは書き出さない (ディスク I/O を計測に含めない)
+    with mock.patch("api.server.enqueue_message_to_markdown"):
+        app = create_app(engine=engine, client_factory=lambda: FakeStreamingClient(chunks, interval))
+        uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _cpu_seconds(pid: int) -> float | None:
+    """プロセスの CPU 時間 (user + system)。/proc が無い環境では None。"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+async def _stream_chat(client, thread_id: int) -> dict:
+    started = time.perf_counter()
+    ttft = None
+    done = False
+    async with client.stream("POST", f"/threads/{thread_id}/chat", json={"prompt": "負荷試験"}) as response:
+        async for line in response.aiter_lines():
+            if line == "event: delta" and ttft is None:
+                ttft = time.perf_counter() - started
+            elif line == "event: done":
+                done = True
+    return {"ttft": ttft, "total": time.perf_counter() - started, "ok": response.status_code == 200 and done}
+
+async def measure(base_url: str, server_pid: int, concurrency: list[int]) -> list[dict]:
+    import httpx
+    from utils.perf_timing import percentile
+
+    results = []
+    limits = httpx.Limits(max_connections=max(concurrency) + 10, max_keepalive_connections=max(concurrency) + 10)
+    async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=limits) as client:
+        project = (await client.post("/projects", json={"name": "Load Test", "system_prompt": ""})).json()
+        thread_ids = [(await client.post(f"/projects/{project['id']}/threads")).json()["id"] for _ in range(max(concurrency) + 1)]
+        # 初回リクエストの遅延 (モジュールの読み込みなど) を計測に含めない
+        await _stream_chat(client, thread_ids.pop())
+
+        for level in concurrency:
+            cpu_before = _cpu_seconds(server_pid)
+            started = time.perf_counter()
+            streams = await asyncio.gather(*[_stream_chat(client, thread_id) for thread_id in thread_ids[:level]],
+                                           return_exceptions=True)
+            wall = time.perf_counter() - started
+            cpu_after = _cpu_seconds(server_pid)
+
+            succeeded = [s for s in streams if isinstance(s, dict) and s["ok"]]
+            cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+            cpu_utilization = cpu / wall if cpu is not None else None
+            results.append({
+                "concurrency": level,
+                "succeeded": len(succeeded),
+                "failed": level - len(succeeded),
+                "wall_seconds": wall,
+                "streams_per_second": len(succeeded) / wall,
+                "ttft_p50_ms": percentile([s["ttft"] for s in succeeded if s["ttft"]], 0.5, default=0.0) * 1000,
+                "ttft_p95_ms": percentile([s["ttft"] for s in succeeded if s["ttft"]], 0.95, default=0.0) * 1000,
+                "total_p50_ms": percentile([s["total"] for s in succeeded], 0.5, default=0.0) * 1000,
+                "total_p95_ms": percentile([s["total"] for s in succeeded], 0.95, default=0.0) * 1000,
+                "server_cpu_seconds": cpu,
+                "server_cpu_utilization": cpu_utilization,
+                "cpu_ms_per_stream": cpu / len(succeeded) * 1000 if cpu is not None and succeeded else None,
+                # CPU 使用率から見積もった、1コアを使い切るまでに処理できる同時ストリーム数
+                "streams_per_core": level / cpu_utilization if cpu_utilization else None,
+            })
+    return results
+
+def _wait_until_ready(base_url: str, timeout: float = 30) -> None:
+    import httpx
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{base_url}/health").status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError("サーバーが起動しませんでした。")
+
+if __name__ == "__main__":
+    sys.path.insert(0, PROJECT_ROOT)
+
+    parser = argparse.ArgumentParser(description="API サーバーの同時ストリーム数と CPU 使用量を計測します。")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=DEFAULT_CONCURRENCY, help="同時ストリーム数")
+    parser.add_argument("--chunks", type=int, default=20, help="1ストリームのチャンク数")
+    parser.add_argument("--chunk-interval", type=float, default=0.05, help="チャンクの間隔 (秒)")
+    parser.add_argument("--no-save", action="store_true", help="結果を results/server_load.jsonl に保存しない")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS) # 子プロセス用
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        run_server(args.port, args.db, args.chunks, args.chunk_interval)
+        sys.exit(0)
+
+    from benchmarks.startup import _project_version, _git_commit
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        port = _free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        server = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.server_load", "--serve", "--port", str(port),
+             "--db", os.path.join(work_dir, "load.db"),
+             "--chunks", str(args.chunks), "--chunk-interval", str(args.chunk_interval)],
+            cwd=PROJECT_ROOT, env=dict(os.environ, PYTHONPATH=PROJECT_ROOT),
+        )
+        try:
+            _wait_until_ready(base_url)
+            results = asyncio.run(measure(base_url, server.pid, args.concurrency))
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+    print(f"1ストリーム: {args.chunks} チャンク x {args.chunk_interval * 1000:.0f} ms (サーバー 1 ワーカー)")
+    print(f"{'streams':>8} {'ok':>6} {'streams/s':>10} {'TTFT p50':>9} {'TTFT p95':>9} {'total p95':>10} "
+          f"{'CPU %':>6} {'CPU ms/stream':>14} {'streams/core':>13}")
+    for r in results:
+        cpu_percent = f"{r['server_cpu_utilization'] * 100:6.0f}" if r["server_cpu_utilization"] is not None else f"{'-':>6}"
+        cpu_per_stream = f"{r['cpu_ms_per_stream']:14.1f}" if r["cpu_ms_per_stream"] is not None else f"{'-':>14}"
+        per_core = f"{r['streams_per_core']:13.0f}" if r["streams_per_core"] else f"{'-':>13}"
+        print(f"{r['concurrency']:8d} {r['succeeded']:6d} {r['streams_per_second']:10.1f} {r['ttft_p50_ms']:9.0f} "
+              f"{r['ttft_p95_ms']:9.0f} {r['total_p95_ms']:10.0f} {cpu_percent} {cpu_per_stream} {per_core}")
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+        record = {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "version": _project_version(),
+            "commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "chunks": args.chunks,
+            "chunk_interval": args.chunk_interval,
+            "results": results,
+        }
+        with open(RESULTS_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
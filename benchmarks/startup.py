@@ -0,0 +1,153 @@
+"""
+コールドスタート (新しい Streamlit ワーカーが app.py の依存モジュールを読み込むまで) の計測。
+
+app.py のトップレベルの import 文だけを新しい Python プロセスで実行し、
+-X importtime のレポート、起動時間、常駐メモリ (最大 RSS) を計測して
+benchmarks/results/startup.jsonl に追記します。リリースごとに実行して推移を追跡します。
+
+    python -m benchmarks.startup              # 計測して結果を追記
+    python -m benchmarks.startup --top 30     # importtime の上位 30 件を表示
+    python -m benchmarks.startup --no-save    # 結果を保存しない
+"""
+import os
+import re
+import ast
+import sys
+import json
+import argparse
+import datetime
+import statistics
+import subprocess
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+RESULTS_FILE = os.path.join(PROJECT_ROOT, "benchmarks", "results", "startup.jsonl")
+
+# 起動時に読み込まれていないことを確認する重いモジュール (遅延インポートの対象)
+LAZY_MODULES = ["pandas", "google.genai", "utils.csv_export", "api.gemini_client"]
+
+# "import time: self [us] | cumulative | imported package"
+_IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+def top_level_imports(script_path: str) -> list[str]:
+    """スクリプトのトップレベル (関数・分岐の外) にある import 文をソースコードとして返します。"""
+    with open(script_path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    return [ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+
+def _child_code(import_lines: list[str]) -> str:
+    """子プロセスで実行するコード: import して経過時間・最大 RSS・遅延対象モジュールの読み込み有無を出力する"""
+    return "\n".join([
+        "import time, resource, sys, json",
+        "_started = time.perf_counter()",
+        *import_lines,
+        "_elapsed = time.perf_counter() - _started",
+        "_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss",
+        # Linux は KB、macOS は バイト単位
+        "_rss_mb = _rss / 1024 / 1024 if sys.platform == 'darwin' else _rss / 1024",
+        f"_lazy = {LAZY_MODULES!r}",
+        "print(json.dumps({'import_seconds': _elapsed, 'max_rss_mb': _rss_mb,"
+        " 'loaded_lazy_modules': [m for m in _lazy if m in sys.modules]}))",
+    ])
+
+def parse_importtime(stderr: str) -> list[dict]:
+    """-X importtime の出力をモジュールごとの dict のリストに変換します (累積時間の降順)。"""
+    entries = []
+    for line in stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            entries.append({
+                "module": module,
+                "self_ms": int(self_us) / 1000,
+                "cumulative_ms": int(cumulative_us) / 1000,
+                "depth": len(indent) // 2,
+            })
+    return sorted(entries, key=lambda entry: entry["cumulative_ms"], reverse=True)
+
+def measure(script_path: str, runs: int = 5) -> dict:
+    """
+    新しいプロセスで app.py のトップレベルの import を runs 回実行し、中央値を返します。
+    1回目の importtime レポートも結果に含めます。
+    """
+    code = _child_code(top_level_imports(script_path))
+    env = dict(os.environ, PYTHONPATH=PROJECT_ROOT)
+    wall_times, import_times, rss_values = [], [], []
+    report, loaded_lazy_modules = [], []
+    for run in range(runs):
+        args = [sys.executable] + (["-X", "importtime"] if run == 0 else []) + ["-c", code]
+        started = datetime.datetime.now()
+        completed = subprocess.run(args, cwd=PROJECT_ROOT, env=env, capture_output=True, text=True, check=True)
+        wall_times.append((datetime.datetime.now() - started).total_seconds())
+        child = json.loads(completed.stdout.strip().splitlines()[-1])
+        import_times.append(child["import_seconds"])
+        rss_values.append(child["max_rss_mb"])
+        if run == 0:
+            report = parse_importtime(completed.stderr)
+            loaded_lazy_modules = child["loaded_lazy_modules"]
+    return {
+        "process_seconds": statistics.median(wall_times),
+        "import_seconds": statistics.median(import_times),
+        "max_rss_mb": statistics.median(rss_values),
+        "loaded_lazy_modules": loaded_lazy_modules,
+        "importtime": report,
+    }
+
+def _project_version() -> str:
+    with open(os.path.join(PROJECT_ROOT, "pyproject.toml"), encoding="utf-8") as f:
+        match = re.search(r'^version\s*=\s*"([^"]+)"', f.read(), re.MULTILINE)
+    return match.group(1) if match else "unknown"
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _last_result() -> dict | None:
+    try:
+        with open(RESULTS_FILE, encoding="utf-8") as f:
+            lines = [line for line in f if line.strip()]
+        return json.loads(lines[-1]) if lines else None
+    except FileNotFoundError:
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="app.py のコールドスタート時間とメモリを計測します。")
+    parser.add_argument("--runs", type=int, default=5, help="計測回数 (中央値を記録)")
+    parser.add_argument("--top", type=int, default=15, help="表示する importtime の上位件数")
+    parser.add_argument("--no-save", action="store_true", help="結果を results/startup.jsonl に保存しない")
+    args = parser.parse_args()
+
+    result = measure(os.path.join(PROJECT_ROOT, "app.py"), runs=args.runs)
+
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for entry in [e for e in result["importtime"] if e["depth"] == 0][:args.top]:
+        print(f"{entry['cumulative_ms']:14.1f} {entry['self_ms']:9.1f}  {entry['module']}")
+    print()
+    print(f"import: {result['import_seconds'] * 1000:.0f} ms, process: {result['process_seconds'] * 1000:.0f} ms, "
+          f"max RSS: {result['max_rss_mb']:.1f} MB")
+    if result["loaded_lazy_modules"]:
+        print(f"警告: 遅延インポートの対象が起動時に読み込まれています: {result['loaded_lazy_modules']}")
+
+    previous = _last_result()
+    if previous:
+        print(f"前回 ({previous.get('version')} / {previous.get('commit')}): "
+              f"import {previous['import_seconds'] * 1000:.0f} ms, max RSS {previous['max_rss_mb']:.1f} MB")
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+        record = {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "version": _project_version(),
+            "commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "import_seconds": result["import_seconds"],
+            "process_seconds": result["process_seconds"],
+            "max_rss_mb": result["max_rss_mb"],
+            "loaded_lazy_modules": result["loaded_lazy_modules"],
+            # 上位のトップレベルモジュールのみ保存する
+            "top_imports": [e for e in result["importtime"] if e["depth"] == 0][:args.top],
+        }
+        with open(RESULTS_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
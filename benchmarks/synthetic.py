@@ -0,0 +1,165 @@
+"""
+ベンチマーク用の合成データ (プロジェクト・スレッド・メッセージ) の生成。
+
+日本語と英語が混ざった会話文をシード付きの乱数で生成するため、同じ (メッセージ数, シード) からは
+常に同じ DB ができます。生成した DB は data_dir に保存しておけば次回以降は再利用されます。
+
+    python -m benchmarks.synthetic 100000 --data-dir benchmarks/.data   # 生成だけ行う
+"""
+import os
+import time
+import random
+import logging
+import argparse
+import datetime
+
+log = logging.getLogger(__name__)
+
+# 生成ロジックを変えたら上げる (保存済みの DB を作り直すため)
+GENERATOR_VERSION = 2 # 2: FTS のトリガー修正後のスキーマで作り直す
+
+PROJECT_COUNT = 20
+MEAN_MESSAGES_PER_THREAD = 20
+EMPTY_THREAD_RATIO = 0.05 # メッセージの無いスレッドの割合 (delete_empty_threads_in_project の対象)
+SENTENCE_POOL_SIZE = 20_000
+
+# 検索のベンチマークで使う語。RARE_TERM は約 0.1% のメッセージにだけ含まれる
+RARE_TERM = "Kubernetes"
+RARE_TERM_RATIO = 0.001
+
+_JA_FRAGMENTS = [
+    "データベースの", "検索機能を", "改善する方法について", "教えてください。", "エラーが発生しました。",
+    "東京の天気は", "明日のミーティングで", "プロジェクトの進捗を", "確認しました。", "この関数は",
+    "非同期処理で", "パフォーマンスが", "大きく向上します。", "ユーザーの入力を", "検証する必要があります。",
+    "機械学習モデルの", "学習データを", "準備しています。", "おすすめのレシピは", "何ですか？",
+    "設定ファイルを", "読み込むときに", "文字化けが", "起きる場合は", "エンコーディングを確認してください。",
+    "キャッシュを", "無効にすると", "レスポンスが遅くなります。", "次のリリースでは", "新しい機能を追加します。",
+    "ログを見ると", "タイムアウトが", "頻繁に起きています。", "インデックスを追加したら", "検索が速くなりました。",
+]
+_EN_WORDS = [
+    "the", "database", "query", "search", "performance", "latency", "Python", "async", "server", "cache",
+    "index", "error", "request", "response", "model", "token", "stream", "thread", "project", "export",
+    "memory", "benchmark", "deploy", "release", "user", "feature", "test", "migration", "schema", "API",
+    "is", "a", "to", "of", "and", "with", "for", "when", "we", "should", "can", "this", "that", "slow", "fast",
+]
+_CODE_SNIPPETS = [
+    "```python\nfor row in rows:\n    print(row)\n```",
+    "```sql\nSELECT id, content FROM messages WHERE thread_id = ?;\n```",
+    "`pip install sqlalchemy`",
+    "```bash\nstreamlit run app.py\n```",
+]
+
+def _timestamp(value: datetime.datetime) -> str:
+    # SQLAlchemy が SQLite に保存するのと同じ形式
+    return value.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+def dataset_path(data_dir: str, messages: int, seed: int) -> str:
+    return os.path.join(data_dir, f"synthetic-{messages}-seed{seed}-v{GENERATOR_VERSION}.db")
+
+def _sentence_pool(rng: random.Random) -> list[str]:
+    """メッセージの材料になる文 (日本語 6 割、英語 4 割) をまとめて作る"""
+    pool = []
+    for _ in range(SENTENCE_POOL_SIZE):
+        if rng.random() < 0.6:
+            pool.append("".join(rng.choices(_JA_FRAGMENTS, k=rng.randint(2, 5))))
+        else:
+            words = rng.choices(_EN_WORDS, k=rng.randint(6, 18))
+            pool.append(" ".join([words[0].capitalize(), *words[1:]]) + ".")
+    return pool
+
+def _message_text(rng: random.Random, pool: list[str], role: str) -> str:
+    # ユーザーは短い質問、アシスタントは長めの回答 (時々コード付き)
+    sentences = rng.choices(pool, k=rng.randint(1, 3) if role == "user" else rng.randint(3, 15))
+    if role == "assistant" and rng.random() < 0.2:
+        sentences.append(rng.choice(_CODE_SNIPPETS))
+    if rng.random() < RARE_TERM_RATIO:
+        sentences.append(f"{RARE_TERM} の設定について。")
+    return " ".join(sentences)
+
+def generate_database(path: str, messages: int, seed: int = 0, batch_size: int = 50_000) -> dict:
+    """
+    messages 件のメッセージを持つ DB を path に作成します。
+
+    挿入は DBAPI の executemany で行い、FTS インデックスは最後にまとめて作ります (database.bulk と同じ方法)。
+
+    Returns:
+        件数と生成時間。
+    """
+    from sqlalchemy import create_engine
+    from database.database import init_db, FTS_INSERT_TRIGGER_DDL
+
+    started = time.perf_counter()
+    engine = create_engine(f"sqlite:///{path}")
+    init_db(bind=engine)
+    rng = random.Random(seed)
+    pool = _sentence_pool(rng)
+    base_time = datetime.datetime(2025, 1, 1)
+
+    raw_connection = engine.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        cursor.execute("DROP TRIGGER IF EXISTS message_ai")
+        cursor.executemany(
+            "INSERT INTO projects (id, name, system_prompt, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            [(i, f"Project {i:02d}", f"あなたはプロジェクト {i} のアシスタントです。",
+              _timestamp(base_time), _timestamp(base_time))
+             for i in range(1, PROJECT_COUNT + 1)],
+        )
+
+        thread_rows, message_rows = [], []
+        thread_id = message_id = 0
+        while message_id < messages:
+            thread_id += 1
+            created_at = base_time + datetime.timedelta(seconds=rng.randint(0, 365 * 24 * 3600))
+            thread_rows.append((thread_id, rng.randint(1, PROJECT_COUNT), f"スレッド {thread_id}",
+                                _timestamp(created_at), _timestamp(created_at)))
+            count = 0 if rng.random() < EMPTY_THREAD_RATIO else 1 + int(rng.expovariate(1 / MEAN_MESSAGES_PER_THREAD))
+            for i in range(min(count, messages - message_id)):
+                message_id += 1
+                role = "user" if i % 2 == 0 else "assistant"
+                timestamp = _timestamp(created_at + datetime.timedelta(seconds=30 * i))
+                message_rows.append((message_id, thread_id, role, _message_text(rng, pool, role), timestamp))
+            if len(message_rows) >= batch_size:
+                cursor.executemany("INSERT INTO threads (id, project_id, name, created_at, updated_at) VALUES (?, ?, ?, ?, ?)", thread_rows)
+                cursor.executemany("INSERT INTO messages (id, thread_id, role, content, created_at) VALUES (?, ?, ?, ?, ?)", message_rows)
+                thread_rows.clear()
+                message_rows.clear()
+        cursor.executemany("INSERT INTO threads (id, project_id, name, created_at, updated_at) VALUES (?, ?, ?, ?, ?)", thread_rows)
+        cursor.executemany("INSERT INTO messages (id, thread_id, role, content, created_at) VALUES (?, ?, ?, ?, ?)", message_rows)
+
+        cursor.execute("INSERT INTO message_fts (message_fts) VALUES ('rebuild')")
+        cursor.execute(FTS_INSERT_TRIGGER_DDL)
+        raw_connection.commit()
+        cursor.execute("ANALYZE")
+    finally:
+        raw_connection.close()
+        engine.dispose()
+
+    stats = {"projects": PROJECT_COUNT, "threads": thread_id, "messages": message_id,
+             "file_mb": round(os.path.getsize(path) / 1024 / 1024, 1),
+             "generate_seconds": round(time.perf_counter() - started, 1)}
+    log.info(f"合成データを生成しました ({path}): {stats}")
+    return stats
+
+def ensure_dataset(data_dir: str, messages: int, seed: int = 0) -> str:
+    """保存済みの DB があればそのパスを、無ければ生成してパスを返します。"""
+    os.makedirs(data_dir, exist_ok=True)
+    path = dataset_path(data_dir, messages, seed)
+    if not os.path.exists(path):
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        generate_database(tmp_path, messages, seed)
+        os.replace(tmp_path, path)
+    return path
+
+if __name__ == "__main__":
+    from utils.logging_setup import setup_logging
+    setup_logging()
+
+    parser = argparse.ArgumentParser(description="ベンチマーク用の合成データを生成します。")
+    parser.add_argument("messages", type=int, help="メッセージ数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=os.path.join(os.path.dirname(__file__), ".data"))
+    args = parser.parse_args()
+    print(ensure_dataset(args.data_dir, args.messages, args.seed))
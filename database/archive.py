@@ -0,0 +1,408 @@
+"""
+長い間使われていないスレッドのコールドアーカイブ。
+
+    python -m database.archive                   # ARCHIVE_AFTER_DAYS 日間更新されていないスレッドをアーカイブに移す
+    python -m database.archive --days 90 --vacuum # 90日で移し、移した後に DB を VACUUM してファイルを縮める
+
+- アーカイブは DB ファイルの隣の <名前>.archive.db (分割保存ではプロジェクトの DB ごと) です。
+  スレッドごとにメッセージとモデル比較の回答の行を、元の DB に保存された値のまま JSON にして zlib で圧縮して保存します。
+- 元の DB にはメッセージの無いスレッドの行 (archived_at を設定したもの) を残すため、チャットの一覧にはそのまま表示されます。
+  開いたとき (restore_thread) にメッセージを元の ID のまま戻します。
+- 添付ファイルの参照は元の DB の archived_attachments に移し、アーカイブ中も添付ファイルは削除されません。
+- 通常の検索はアーカイブを対象にしません。search_archived_messages はアーカイブを展開して検索します (遅い)。
+- 分岐元になっているスレッドは、分岐先が履歴を共有しているためアーカイブしません。
+- 表示中・生成中のスレッドは、アプリが thread_leases に印を付けている間 (lease_threads) アーカイブしません。
+"""
+import os
+import json
+import zlib
+import logging
+import argparse
+import datetime
+import threading
+from typing import Callable
+
+from sqlalchemy import (MetaData, Table, Column, Integer, String, DateTime, LargeBinary,
+                        create_engine, select, delete, update, exists, text, literal)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, aliased
+
+from database.database import Base, track_queries
+from models.models import Thread, Project, Message, ModelComparisonAnswer, ArchivedAttachment, ThreadLease
+
+log = logging.getLogger(__name__)
+
+# アーカイブの設定 (環境変数で上書き可能)
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "180")) # この日数の間更新されていないスレッドをアーカイブに移す
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "100")) # 1トランザクションで移す最大スレッド数
+
+# アーカイブに移すテーブル (戻すときはこの順に挿入する)。どちらも thread_id 列でスレッドの行を選ぶ
+ARCHIVED_TABLES = ("messages", "model_comparison_answers")
+
+# アーカイブの DB のスキーマ (アプリの DB とは別の MetaData)
+archive_metadata = MetaData()
+archived_threads = Table(
+    "archived_threads", archive_metadata,
+    Column("thread_id", Integer, primary_key=True),
+    Column("project_id", Integer, nullable=False),
+    Column("message_count", Integer, nullable=False),
+    Column("last_message_at", String, nullable=True, index=True), # 最後のメッセージの created_at (元の DB に保存された値)
+    Column("archived_at", DateTime, nullable=False),
+    Column("payload", LargeBinary, nullable=False), # zlib で圧縮した {テーブル名: {"columns": [...], "rows": [[...]]}}
+)
+
+# アーカイブの DB のパス -> Engine (プロセス全体で共有する)
+_archive_engines: dict[str, Engine] = {}
+_archive_lock = threading.Lock()
+
+def archive_path_for(database_path: str) -> str:
+    """DB ファイルのパスから、そのアーカイブのパス (gemini_chat.db -> gemini_chat.archive.db) を返します。"""
+    root, _ = os.path.splitext(database_path)
+    return root + ".archive.db"
+
+def archive_engine(db: Session) -> Engine:
+    """db が接続している DB のアーカイブの Engine を返します (無ければ作成します)。"""
+    return _archive_engine_for(db.get_bind())
+
+def _archive_engine_for(bind: Engine) -> Engine:
+    database_path = bind.url.database
+    if not database_path or database_path == ":memory:":
+        raise ValueError("アーカイブはファイルに保存した DB でのみ使用できます。")
+    path = os.path.abspath(archive_path_for(database_path))
+    with _archive_lock:
+        engine = _archive_engines.get(path)
+        if engine is None:
+            engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+            archive_metadata.create_all(engine)
+            _archive_engines[path] = engine
+        return engine
+
+def dispose_archive(database_path: str) -> str:
+    """DB のアーカイブの Engine を閉じ、アーカイブのパスを返します (プロジェクトの DB を削除する前に呼ぶ)。"""
+    path = os.path.abspath(archive_path_for(database_path))
+    with _archive_lock:
+        engine = _archive_engines.pop(path, None)
+    if engine is not None:
+        engine.dispose()
+    return path
+
+def _encode(tables: dict) -> bytes:
+    return zlib.compress(json.dumps(tables, ensure_ascii=False).encode("utf-8"), 9)
+
+def _decode(payload: bytes) -> dict:
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+def _parse_datetime(value: str | None) -> datetime.datetime | None:
+    return datetime.datetime.fromisoformat(value) if value else None
+
+def _read_thread_rows(db: Session, thread_id: int) -> dict:
+    """スレッドのメッセージと比較の回答の行を、元の DB に保存された値のまま読み出します。"""
+    connection = db.connection()
+    tables = {}
+    for table in ARCHIVED_TABLES:
+        result = connection.exec_driver_sql(f"SELECT * FROM {table} WHERE thread_id = ? ORDER BY id", (thread_id,))
+        tables[table] = {"columns": list(result.keys()), "rows": [list(row) for row in result]}
+    return tables
+
+def _write_thread_rows(db: Session, tables: dict) -> None:
+    """_read_thread_rows で読み出した行を元の ID のまま挿入します (現在のスキーマに無い列は捨てる)。"""
+    connection = db.connection()
+    for table in ARCHIVED_TABLES:
+        stored = tables.get(table)
+        if not stored or not stored["rows"]:
+            continue
+        current_columns = set(Base.metadata.tables[table].columns.keys())
+        indexes = [i for i, column in enumerate(stored["columns"]) if column in current_columns]
+        columns = ", ".join(stored["columns"][i] for i in indexes)
+        placeholders = ", ".join("?" for _ in indexes)
+        connection.exec_driver_sql(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})",
+                                   [tuple(row[i] for i in indexes) for row in stored["rows"]])
+
+@track_queries
+def lease_threads(db: Session, thread_ids: set[int] | frozenset, seconds: float) -> int:
+    """
+    thread_ids のうちこの DB にあるスレッドに、seconds 秒後まで有効なアーカイブ除けの印を付けます (期限切れの印は消す)。
+
+    Returns:
+        印を付けたスレッドの数。エラー時は 0。
+    """
+    now = datetime.datetime.utcnow()
+    try:
+        db.execute(delete(ThreadLease).where(ThreadLease.expires_at <= now))
+        leased = 0
+        if thread_ids:
+            expires_at = literal(now + datetime.timedelta(seconds=seconds), DateTime)
+            statement = sqlite_insert(ThreadLease).from_select(
+                ["thread_id", "expires_at"], select(Thread.id, expires_at).where(Thread.id.in_(thread_ids)))
+            leased = db.execute(statement.on_conflict_do_update(
+                index_elements=[ThreadLease.thread_id], set_={"expires_at": statement.excluded.expires_at})).rowcount
+        db.commit()
+        return leased
+    except Exception as e:
+        db.rollback()
+        log.error(f"スレッドの印の更新中にエラーが発生しました: {e}", exc_info=True)
+        return 0
+
+def _leased(now: datetime.datetime):
+    """期限内の印があるスレッドの ID を選ぶ副問い合わせ"""
+    return select(ThreadLease.thread_id).where(ThreadLease.expires_at > now)
+
+@track_queries
+def archive_stale_threads(db: Session, updated_before: datetime.datetime, limit: int = ARCHIVE_BATCH,
+                          exclude_thread_ids: set[int] | frozenset = frozenset()) -> int:
+    """
+    updated_before より前から更新されていないスレッドを最大 limit 件アーカイブに移します。
+    先にアーカイブに書き込んでから元の DB のメッセージを削除するため、途中で止まってもメッセージは失われません
+    (アーカイブに残った行は次の実行で上書きされるか、prune_archive で削除されます)。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        updated_before: これより後に更新されたスレッドは対象外。
+        limit: 1回に移す最大件数。
+        exclude_thread_ids: 移さないスレッドの ID (表示中・生成中のスレッド)。thread_leases に印のあるスレッドも移さない。
+
+    Returns:
+        アーカイブに移したスレッドの数。エラー時は 0。
+    """
+    child = aliased(Thread)
+    statement = (select(Thread.id, Thread.project_id)
+                 .where(Thread.archived_at.is_(None), Thread.updated_at < updated_before,
+                        exists().where(Message.thread_id == Thread.id),
+                        ~exists().where(child.parent_thread_id == Thread.id),
+                        Thread.id.notin_(_leased(datetime.datetime.utcnow())))
+                 .order_by(Thread.updated_at).limit(limit))
+    if exclude_thread_ids:
+        statement = statement.where(Thread.id.notin_(exclude_thread_ids))
+    try:
+        candidates = dict(db.execute(statement).all())
+        if not candidates:
+            db.rollback()
+            return 0
+        now = datetime.datetime.utcnow()
+        records = []
+        for thread_id, project_id in candidates.items():
+            tables = _read_thread_rows(db, thread_id)
+            messages = tables["messages"]
+            created_at_index = messages["columns"].index("created_at")
+            records.append({"thread_id": thread_id, "project_id": project_id, "message_count": len(messages["rows"]),
+                            "last_message_at": max((row[created_at_index] or "" for row in messages["rows"]), default=None),
+                            "archived_at": now, "payload": _encode(tables)})
+        db.rollback() # 読み取りのトランザクションを終える (アーカイブへの書き込み中に元の DB をロックしない)
+    except Exception as e:
+        db.rollback()
+        log.error(f"アーカイブするスレッドの読み込み中にエラーが発生しました: {e}", exc_info=True)
+        return 0
+
+    archive = archive_engine(db)
+    with archive.begin() as connection:
+        statement = sqlite_insert(archived_threads)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[archived_threads.c.thread_id],
+            set_={column: statement.excluded[column] for column in records[0] if column != "thread_id"}), records)
+
+    thread_ids = list(candidates)
+    try:
+        # 読み込んだ後に更新された (メッセージが追加された・開かれた) スレッドは移さない。並び順を変えないよう updated_at はそのまま
+        db.execute(update(Thread)
+                   .where(Thread.id.in_(thread_ids), Thread.archived_at.is_(None), Thread.updated_at < updated_before,
+                          Thread.id.notin_(_leased(now)))
+                   .values(archived_at=now, updated_at=Thread.updated_at))
+        archived_ids = db.execute(select(Thread.id).where(Thread.id.in_(thread_ids), Thread.archived_at == now)).scalars().all()
+        if archived_ids:
+            # 添付ファイルの参照を先に移す (メッセージの削除で message_attachments の行が消えても ref_count は減らない)
+            db.execute(text(
+                "INSERT INTO archived_attachments (message_id, attachment_id, thread_id, position) "
+                "SELECT ma.message_id, ma.attachment_id, m.thread_id, ma.position "
+                "FROM message_attachments ma JOIN messages m ON m.id = ma.message_id "
+                f"WHERE m.thread_id IN ({', '.join(str(int(thread_id)) for thread_id in archived_ids)})"))
+            db.query(ModelComparisonAnswer).filter(ModelComparisonAnswer.thread_id.in_(archived_ids)).delete(synchronize_session=False)
+            db.query(Message).filter(Message.thread_id.in_(archived_ids)).delete(synchronize_session=False)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        log.error(f"スレッドのアーカイブ中にエラーが発生しました: {e}", exc_info=True)
+        archived_ids = []
+
+    # 移さなかったスレッドの分はアーカイブから消す
+    archived_set = set(archived_ids)
+    skipped = [thread_id for thread_id in thread_ids if thread_id not in archived_set]
+    if skipped:
+        with archive.begin() as connection:
+            connection.execute(delete(archived_threads).where(archived_threads.c.thread_id.in_(skipped)))
+    if archived_ids:
+        log.info(f"{len(archived_ids)} 件のスレッドをアーカイブに移しました。")
+    return len(archived_ids)
+
+@track_queries
+def restore_thread(db: Session, thread_id: int) -> bool:
+    """
+    アーカイブしたスレッドのメッセージを元の DB に戻します (スレッドを開いたときに呼ぶ)。
+    戻したスレッドは使われたものとして updated_at を更新します (すぐに再びアーカイブされないように)。
+
+    Returns:
+        戻した場合は True。スレッドが無い・アーカイブされていない・アーカイブに見つからない場合は False。
+    """
+    thread = db.get(Thread, thread_id)
+    if thread is None or thread.archived_at is None:
+        return False
+    archive = archive_engine(db)
+    with archive.connect() as connection:
+        payload = connection.execute(select(archived_threads.c.payload)
+                                     .where(archived_threads.c.thread_id == thread_id)).scalar()
+    if payload is None:
+        log.error(f"アーカイブにスレッド ID {thread_id} のメッセージが見つかりません。")
+        return False
+    try:
+        _write_thread_rows(db, _decode(payload))
+        db.execute(text("INSERT INTO message_attachments (message_id, attachment_id, position) "
+                        "SELECT message_id, attachment_id, position FROM archived_attachments WHERE thread_id = :thread_id"),
+                   {"thread_id": thread_id})
+        db.query(ArchivedAttachment).filter(ArchivedAttachment.thread_id == thread_id).delete(synchronize_session=False)
+        thread.archived_at = None
+        thread.updated_at = datetime.datetime.utcnow()
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        log.error(f"スレッド ID {thread_id} をアーカイブから戻す際にエラーが発生しました: {e}", exc_info=True)
+        return False
+    with archive.begin() as connection:
+        connection.execute(delete(archived_threads).where(archived_threads.c.thread_id == thread_id))
+    log.info(f"スレッド ID {thread_id} をアーカイブから戻しました。")
+    return True
+
+@track_queries
+def search_archived_messages(db: Session, query: str, limit: int | None = None) -> list:
+    """
+    アーカイブしたスレッドのメッセージを crud.search_messages と同じ条件 (全てのキーワードを大文字小文字を区別せずに含む) で検索します。
+    最後のメッセージが新しいスレッドから順に展開し、limit 件に達したらそれより古いスレッドは展開しません。
+
+    Returns:
+        crud.SearchHit のリスト (新しい順)。
+    """
+    from database.crud import SearchHit, search_rank_key
+
+    terms = [term.lower() for term in query.split()]
+    if not terms:
+        return []
+    stubs = {thread_id: (thread_name, project_id, project_name) for thread_id, thread_name, project_id, project_name in db.execute(
+        select(Thread.id, Thread.name, Thread.project_id, Project.name)
+        .join(Project, Thread.project_id == Project.id).where(Thread.archived_at.isnot(None)))}
+    if not stubs:
+        return []
+
+    hits = []
+    with archive_engine(db).connect() as connection:
+        result = connection.execute(select(archived_threads.c.thread_id, archived_threads.c.last_message_at,
+                                           archived_threads.c.payload)
+                                    .order_by(archived_threads.c.last_message_at.desc()))
+        for thread_id, last_message_at, payload in result:
+            if limit is not None and len(hits) >= limit and \
+                    (_parse_datetime(last_message_at) or datetime.datetime.min) < (hits[limit - 1].created_at or datetime.datetime.min):
+                break
+            if thread_id not in stubs: # 削除された・戻されたスレッドの残り
+                continue
+            thread_name, project_id, project_name = stubs[thread_id]
+            messages = _decode(payload)["messages"]
+            columns = {name: i for i, name in enumerate(messages["columns"])}
+            for row in messages["rows"]:
+                content = row[columns["content"]]
+                if all(term in content.lower() for term in terms):
+                    hits.append(SearchHit(row[columns["id"]], thread_id, row[columns["role"]], content,
+                                          _parse_datetime(row[columns["created_at"]]), thread_name, project_id, project_name))
+            hits.sort(key=search_rank_key, reverse=True)
+            if limit is not None:
+                del hits[limit:]
+    return hits
+
+def iter_archived_messages(bind: Engine, thread_ids: list[int]):
+    """
+    アーカイブ中のスレッドのメッセージの行を {列名: 元の DB に保存された値} としてスレッドの順に返します (JSONL エクスポート用)。
+    アーカイブのファイルが無い場合は何も返しません。
+    """
+    database_path = bind.url.database
+    if not thread_ids or not database_path or database_path == ":memory:" or \
+            not os.path.exists(archive_path_for(database_path)):
+        return
+    with _archive_engine_for(bind).connect() as connection:
+        for start in range(0, len(thread_ids), 500):
+            result = connection.execute(select(archived_threads.c.thread_id, archived_threads.c.payload)
+                                        .where(archived_threads.c.thread_id.in_(thread_ids[start:start + 500])))
+            for _, payload in sorted(result):
+                messages = _decode(payload)["messages"]
+                for row in messages["rows"]:
+                    yield dict(zip(messages["columns"], row))
+
+@track_queries
+def prune_archive(db: Session) -> int:
+    """アーカイブから、元の DB でアーカイブ中ではなくなった (削除された・戻された) スレッドの行を削除します。"""
+    stub_ids = set(db.execute(select(Thread.id).where(Thread.archived_at.isnot(None))).scalars())
+    archive = archive_engine(db)
+    with archive.connect() as connection:
+        orphan_ids = [thread_id for thread_id in connection.execute(select(archived_threads.c.thread_id)).scalars()
+                      if thread_id not in stub_ids]
+    for start in range(0, len(orphan_ids), 500):
+        with archive.begin() as connection:
+            connection.execute(delete(archived_threads).where(archived_threads.c.thread_id.in_(orphan_ids[start:start + 500])))
+    if orphan_ids:
+        log.info(f"アーカイブから不要になった {len(orphan_ids)} 件のスレッドを削除しました。")
+    return len(orphan_ids)
+
+def archive_inactive_threads(session_factory: Callable[[], Session], days: float = ARCHIVE_AFTER_DAYS,
+                             batch_size: int = ARCHIVE_BATCH,
+                             exclude_thread_ids: set[int] | frozenset = frozenset()) -> dict[str, int]:
+    """
+    1つの DB について、days 日間更新されていないスレッドを batch_size 件ずつ、無くなるまでアーカイブに移します。
+    アプリが表示中・生成中の印 (thread_leases) を付けているスレッドは、別のプロセスから実行しても移しません。
+
+    Returns:
+        {"archived": 移したスレッド数, "pruned": アーカイブから削除した不要な行の数}
+    """
+    updated_before = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    batch_size = max(1, batch_size)
+    archived = 0
+    db = session_factory()
+    try:
+        while True:
+            moved = archive_stale_threads(db, updated_before, batch_size, exclude_thread_ids)
+            archived += moved
+            if moved < batch_size:
+                break
+        pruned = prune_archive(db)
+    finally:
+        db.close()
+    return {"archived": archived, "pruned": pruned}
+
+def _vacuum(engine: Engine) -> None:
+    """削除したメッセージの領域を解放してファイルを縮めます (VACUUM はトランザクションの外で実行する)。"""
+    with engine.connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT").exec_driver_sql("VACUUM")
+
+if __name__ == "__main__":
+    import functools
+    from database.database import init_db, engine, SessionLocal
+    from database.sharding import get_shard_router
+    from utils.logging_setup import setup_logging
+
+    parser = argparse.ArgumentParser(description="長い間更新されていないスレッドをコールドアーカイブに移します。")
+    parser.add_argument("--days", type=float, default=ARCHIVE_AFTER_DAYS, help="この日数の間更新されていないスレッドを移す")
+    parser.add_argument("--batch", type=int, default=ARCHIVE_BATCH, help="1トランザクションで移す最大スレッド数")
+    parser.add_argument("--vacuum", action="store_true", help="移した後に DB を VACUUM してファイルを縮める")
+    args = parser.parse_args()
+
+    setup_logging()
+    init_db()
+    shards = get_shard_router()
+    if shards is None:
+        targets = [(SessionLocal, lambda: engine)]
+    else: # 分割保存ではプロジェクトの DB ごとに移す (Engine は使うときに開く)
+        targets = [(functools.partial(shards.session_for_project, project_id), functools.partial(shards.engine_for, project_id))
+                   for project_id in shards.project_ids()]
+    totals = {"archived": 0, "pruned": 0}
+    for session_factory, engine_factory in targets:
+        result = archive_inactive_threads(session_factory, args.days, args.batch)
+        for key, value in result.items():
+            totals[key] += value
+        if args.vacuum and result["archived"]:
+            _vacuum(engine_factory())
+    print(json.dumps(totals, ensure_ascii=False))
@@ -0,0 +1,363 @@
+"""
+プロジェクト・スレッド・メッセージを JSONL でまとめてエクスポート/インポートします。
+
+    python -m database.bulk export history.jsonl
+    python -m database.bulk import history.jsonl   # 中断した場合は同じコマンドで再開
+"""
+import os
+import json
+import time
+import logging
+import argparse
+
+from sqlalchemy.engine import Engine
+
+from database.database import FTS_INSERT_TRIGGER_DDL
+from database.crud import ADD_USAGE_ROLLUPS_SQL
+from database.archive import iter_archived_messages
+
+log = logging.getLogger(__name__)
+
+# 1トランザクションで挿入する最大行数 (種類ごと)
+DEFAULT_BATCH_SIZE = 50_000
+
+# JSONL の各レコードの列 (type 以外)。エクスポートとインポートで共通
+PROJECT_FIELDS = ("id", "name", "system_prompt", "created_at", "updated_at")
+THREAD_FIELDS = ("id", "project_id", "name", "created_at", "updated_at")
+# 分岐したスレッドの分岐元と分岐点 (古いファイルには無いため、インポート時は省略可能)
+THREAD_BRANCH_FIELDS = ("parent_thread_id", "branch_message_id")
+# コールドアーカイブに移した日時 (エクスポートの記録用)。メッセージはアーカイブから読み出して通常のメッセージとして出力するため、
+# インポートしたスレッドはアーカイブから戻した状態になる
+THREAD_ARCHIVE_FIELDS = ("archived_at",)
+MESSAGE_FIELDS = ("id", "thread_id", "role", "content", "created_at")
+# アシスタントの応答の使用量 (古いファイルには無いため、インポート時は省略可能)
+MESSAGE_USAGE_FIELDS = ("model_name", "prompt_tokens", "output_tokens", "total_tokens", "time_to_first_token_ms", "latency_ms")
+
+def _resolve_engine(bind: Engine | None) -> Engine:
+    if bind is not None:
+        return bind
+    from database.database import engine
+    return engine
+
+def export_jsonl(path: str, bind: Engine | None = None, project_id: int | None = None) -> dict[str, int]:
+    """
+    データベースの内容を JSONL ファイルに書き出します。
+    プロジェクト → スレッド → メッセージの順に出力するため、インポート時に親が必ず先に現れます。
+    コールドアーカイブ中のスレッドのメッセージは、アーカイブから読み出して最後に出力します。
+    bind を省略し分割保存 (DB_SHARDING) が有効な場合は、カタログに続けて各プロジェクトの DB の
+    スレッドとメッセージを出力します (ID はプロジェクトごとの範囲から採番されているため重なりません)。
+
+    Args:
+        path: 出力先のファイルパス。
+        bind: 読み出す Engine。省略時はアプリの DB。
+        project_id: 指定した場合はそのプロジェクトのみ出力します。
+
+    Returns:
+        種類ごとの出力件数。
+    """
+    engine = _resolve_engine(bind)
+    shards = []
+    if bind is None:
+        from database.sharding import get_shard_router
+        router = get_shard_router()
+        if router is not None:
+            shards = [router.engine_for(shard_id) for shard_id in router.project_ids()
+                      if project_id is None or shard_id == project_id]
+
+    counts = {"projects": 0, "threads": 0, "messages": 0}
+    with open(path, "w", encoding="utf-8") as f:
+        _write_database(engine, f, counts, project_id, include_projects=True)
+        for shard in shards:
+            # プロジェクトの行はカタログから出力済み (プロジェクトの DB には写しがあるだけ)
+            _write_database(shard, f, counts, project_id, include_projects=False)
+
+    log.info(f"JSONL エクスポートが完了しました ({path}): {counts}")
+    return counts
+
+def _write_database(engine: Engine, f, counts: dict[str, int], project_id: int | None, include_projects: bool) -> None:
+    """1つの DB のプロジェクト・スレッド・メッセージを f に書き出し、counts に件数を加えます。"""
+    project_filter = "" if project_id is None else " WHERE p.id = :project_id"
+    queries = [
+        # 分岐元のスレッドが分岐先より先に現れるよう、分岐の深さ順に出力する
+        ("thread", "threads", THREAD_FIELDS + THREAD_BRANCH_FIELDS + THREAD_ARCHIVE_FIELDS,
+         f"WITH RECURSIVE depth (id, level) AS (SELECT id, 0 FROM threads WHERE parent_thread_id IS NULL "
+         f"UNION ALL SELECT c.id, d.level + 1 FROM threads c JOIN depth d ON c.parent_thread_id = d.id) "
+         f"SELECT t.id, t.project_id, t.name, t.created_at, t.updated_at, t.parent_thread_id, t.branch_message_id, t.archived_at "
+         f"FROM threads t JOIN depth d ON d.id = t.id "
+         f"JOIN projects p ON p.id = t.project_id{project_filter} ORDER BY d.level, t.id"),
+        ("message", "messages", MESSAGE_FIELDS + MESSAGE_USAGE_FIELDS,
+         f"SELECT m.id, m.thread_id, m.role, m.content, m.created_at, "
+         f"m.model_name, m.prompt_tokens, m.output_tokens, m.total_tokens, m.time_to_first_token_ms, m.latency_ms FROM messages m "
+         f"JOIN threads t ON t.id = m.thread_id JOIN projects p ON p.id = t.project_id{project_filter} ORDER BY m.id"),
+    ]
+    if include_projects:
+        queries.insert(0, ("project", "projects", PROJECT_FIELDS,
+                           f"SELECT p.id, p.name, p.system_prompt, p.created_at, p.updated_at FROM projects p{project_filter} ORDER BY p.id"))
+    params = {} if project_id is None else {"project_id": project_id}
+
+    # ORM を通さず DBAPI カーソルから直接書き出す (値は SQLite に保存された形式のまま)
+    raw_connection = engine.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        for record_type, count_key, fields, sql in queries:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(10_000)
+                if not rows:
+                    break
+                for row in rows:
+                    record = {"type": record_type}
+                    record.update(zip(fields, row))
+                    f.write(json.dumps(record, ensure_ascii=False))
+                    f.write("\n")
+                counts[count_key] += len(rows)
+        # アーカイブ中のスレッドのメッセージ (元の DB には無い)
+        cursor.execute(f"SELECT t.id FROM threads t JOIN projects p ON p.id = t.project_id{project_filter}"
+                       f"{' AND' if project_filter else ' WHERE'} t.archived_at IS NOT NULL ORDER BY t.id", params)
+        stub_ids = [row[0] for row in cursor.fetchall()]
+        for row in iter_archived_messages(engine, stub_ids):
+            record = {"type": "message"}
+            record.update((field, row.get(field)) for field in MESSAGE_FIELDS + MESSAGE_USAGE_FIELDS)
+            f.write(json.dumps(record, ensure_ascii=False))
+            f.write("\n")
+            counts["messages"] += 1
+        cursor.close()
+    finally:
+        raw_connection.close()
+
+def _load_state(cursor, path: str) -> dict | None:
+    row = cursor.execute("SELECT state FROM import_checkpoints WHERE path = ?", (os.path.abspath(path),)).fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+def _save_state(cursor, path: str, state: dict) -> None:
+    """インポートの進捗を記録します (コミットは呼び出し側で、取り込んだ行と同じトランザクションで行う)。"""
+    cursor.execute("INSERT INTO import_checkpoints (path, state) VALUES (?, ?) "
+                   "ON CONFLICT (path) DO UPDATE SET state = excluded.state",
+                   (os.path.abspath(path), json.dumps(state)))
+
+def _new_state(cursor) -> dict:
+    """
+    初回インポート時の状態を作ります。
+    既存データと ID がぶつからないよう、各テーブルの現在の最大 ID をオフセットとして記録します
+    (空のテーブルならオフセット 0 で元の ID をそのまま使います)。
+    アーカイブ中のメッセージの ID は messages に無いため、AUTOINCREMENT の採番済みの ID (sqlite_sequence) も含めます。
+    """
+    def max_id(table: str) -> int:
+        return cursor.execute(f"SELECT MAX((SELECT COALESCE(MAX(id), 0) FROM {table}), "
+                              f"COALESCE((SELECT seq FROM sqlite_sequence WHERE name = ?), 0))", (table,)).fetchone()[0]
+
+    has_trigger = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'message_ai'"
+    ).fetchone() is not None
+    message_offset = max_id("messages")
+    return {
+        "byte_offset": 0,
+        "project_offset": max_id("projects"),
+        "thread_offset": max_id("threads"),
+        "message_offset": message_offset,
+        "project_map": {}, # 元のプロジェクト ID (文字列) -> 新しい ID
+        "fts_indexed_upto": message_offset, # この ID までは FTS インデックス済み
+        "has_fts_trigger": has_trigger,
+        "counts": {"projects": 0, "threads": 0, "messages": 0, "merged_projects": 0},
+        "completed": False,
+    }
+
+def _restore_fts(cursor, state: dict) -> None:
+    """削除していた INSERT トリガーを戻し、未インデックスのメッセージを1回の INSERT ... SELECT で索引付けします。"""
+    if not state["has_fts_trigger"]:
+        return
+    restored_elsewhere = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'message_ai'"
+    ).fetchone() is not None
+    if restored_elsewhere:
+        # 取り込み中にアプリの起動 (init_db) がトリガーを戻した。どこまで索引付けされたか分からないため作り直す
+        cursor.execute("INSERT INTO message_fts (message_fts) VALUES ('rebuild')")
+    else:
+        cursor.execute(
+            "INSERT INTO message_fts (rowid, content) SELECT id, content FROM messages WHERE id > ?",
+            (state["fts_indexed_upto"],),
+        )
+    state["fts_indexed_upto"] = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+    cursor.execute(FTS_INSERT_TRIGGER_DDL)
+
+def import_jsonl(path: str, bind: Engine | None = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                 restart: bool = False) -> dict[str, int]:
+    """
+    export_jsonl で書き出した JSONL ファイルをデータベースに一括で取り込みます。
+
+    - ORM を使わず、種類ごとに batch_size 行ずつ executemany で挿入し、大きなトランザクションでコミットします。
+    - 取り込み中は FTS の INSERT トリガーを外し、最後に取り込んだメッセージを1回でまとめて索引付けします。
+    - 既存データがあるテーブルでは、ID を「取り込み開始時の最大 ID + 元の ID」に振り直します。
+      同名のプロジェクトが既にある場合はそのプロジェクトにスレッドを追加します。
+    - ファイル内の位置と ID の対応を、取り込んだ行と同じトランザクションで import_checkpoints に記録します。
+      中断した場合 (プロセスが強制終了された場合も) は同じ引数で再実行すると続きから再開します。
+      外したトリガーが戻らないまま止まった場合は、次の init_db がトリガーを戻して FTS 索引を作り直します。
+
+    取り込み中はアプリからの書き込みを止めてください (トリガーが外れており、ID も先取りしているため)。
+
+    Args:
+        path: 取り込む JSONL ファイルのパス。
+        bind: 書き込み先の Engine。省略時はアプリの DB (分割保存が有効な場合は RuntimeError)。
+        batch_size: 1トランザクションで挿入する種類ごとの最大行数。
+        restart: True の場合は前回の記録を捨て、同じファイルを最初から取り込み直します (ID は振り直す)。
+
+    Returns:
+        種類ごとの取り込み件数 (再開した場合は前回分を含む)。
+    """
+    if bind is None:
+        from database.sharding import get_shard_router
+        if get_shard_router() is not None:
+            # カタログに取り込んでも分割保存の画面・API からは見えないため取り込まない
+            raise RuntimeError("分割保存 (DB_SHARDING) が有効な場合は取り込めません。bind に取り込み先の Engine を指定してください。")
+    engine = _resolve_engine(bind)
+    raw_connection = engine.raw_connection()
+    started = time.perf_counter()
+    state = None if restart else _load_state(raw_connection.cursor(), path)
+    if state and state.get("completed"):
+        log.info(f"{path} は既に取り込み済みです。")
+        raw_connection.close()
+        return state["counts"]
+
+    try:
+        cursor = raw_connection.cursor()
+        if state is None:
+            state = _new_state(cursor)
+            _save_state(cursor, path, state)
+            raw_connection.commit()
+        else:
+            log.info(f"{path} の取り込みを {state['byte_offset']} バイト目から再開します。")
+
+        counts = state["counts"]
+        project_map = state["project_map"]
+        existing_projects = dict(cursor.execute("SELECT name, id FROM projects").fetchall())
+
+        if state["has_fts_trigger"]:
+            cursor.execute("DROP TRIGGER IF EXISTS message_ai")
+            raw_connection.commit()
+
+        projects, threads, messages = [], [], []
+
+        def flush(byte_offset: int) -> None:
+            # 親から順に挿入し、同じトランザクションでチェックポイントを進める
+            if projects:
+                cursor.executemany(
+                    "INSERT INTO projects (id, name, system_prompt, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    projects,
+                )
+            if threads:
+                cursor.executemany(
+                    "INSERT INTO threads (id, project_id, name, created_at, updated_at, parent_thread_id, branch_message_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    threads,
+                )
+            if messages:
+                cursor.executemany(
+                    "INSERT INTO messages (id, thread_id, role, content, created_at, model_name, prompt_tokens, "
+                    "output_tokens, total_tokens, time_to_first_token_ms, latency_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    messages,
+                )
+                # 取り込んだ応答の使用量を集計に加える (同じトランザクションなので再開しても二重に加算されない)
+                cursor.execute(ADD_USAGE_ROLLUPS_SQL, {"min_message_id": min(row[0] for row in messages) - 1})
+            counts["projects"] += len(projects)
+            counts["threads"] += len(threads)
+            counts["messages"] += len(messages)
+            state["byte_offset"] = byte_offset
+            _save_state(cursor, path, state)
+            raw_connection.commit()
+            projects.clear()
+            threads.clear()
+            messages.clear()
+
+        project_offset = state["project_offset"]
+        thread_offset = state["thread_offset"]
+        message_offset = state["message_offset"]
+
+        with open(path, "rb") as f:
+            f.seek(state["byte_offset"])
+            byte_offset = state["byte_offset"]
+            for line in f:
+                byte_offset += len(line)
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                record_type = record["type"]
+                if record_type == "message":
+                    messages.append((
+                        record["id"] + message_offset, record["thread_id"] + thread_offset,
+                        record["role"], record["content"], record["created_at"],
+                        *(record.get(field) for field in MESSAGE_USAGE_FIELDS),
+                    ))
+                elif record_type == "thread":
+                    new_project_id = project_map.get(str(record["project_id"]))
+                    if new_project_id is None:
+                        raise ValueError(f"スレッド {record['id']} のプロジェクト {record['project_id']} がファイル内にありません。")
+                    parent_thread_id, branch_message_id = (record.get(field) for field in THREAD_BRANCH_FIELDS)
+                    threads.append((
+                        record["id"] + thread_offset, new_project_id,
+                        record["name"], record["created_at"], record["updated_at"],
+                        None if parent_thread_id is None else parent_thread_id + thread_offset,
+                        None if branch_message_id is None else branch_message_id + message_offset,
+                    ))
+                elif record_type == "project":
+                    if record["name"] in existing_projects:
+                        # 同名のプロジェクトには合流させる
+                        project_map[str(record["id"])] = existing_projects[record["name"]]
+                        counts["merged_projects"] += 1
+                        continue
+                    new_project_id = record["id"] + project_offset
+                    project_map[str(record["id"])] = new_project_id
+                    existing_projects[record["name"]] = new_project_id
+                    projects.append((
+                        new_project_id, record["name"], record["system_prompt"],
+                        record["created_at"], record["updated_at"],
+                    ))
+                else:
+                    raise ValueError(f"不明なレコード種別です: {record_type}")
+
+                if max(len(projects), len(threads), len(messages)) >= batch_size:
+                    flush(byte_offset)
+            flush(byte_offset)
+
+        state["completed"] = True
+    except Exception as e:
+        raw_connection.rollback()
+        # 未コミット分の変更を含まない、最後にコミットした時点の状態に戻す
+        state = _load_state(raw_connection.cursor(), path) or state
+        log.error(f"JSONL インポート中にエラーが発生しました ({path}): {e}", exc_info=True)
+        raise
+    finally:
+        # 成功・失敗にかかわらずトリガーと FTS インデックスを元に戻す
+        if state is not None:
+            try:
+                cursor = raw_connection.cursor()
+                _restore_fts(cursor, state)
+                _save_state(cursor, path, state)
+                raw_connection.commit()
+            finally:
+                raw_connection.close()
+        else:
+            raw_connection.close()
+
+    elapsed = time.perf_counter() - started
+    rate = counts["messages"] / elapsed if elapsed > 0 else 0
+    log.info(f"JSONL インポートが完了しました ({path}): {counts}, {elapsed:.1f} 秒 ({rate:,.0f} メッセージ/秒)")
+    return counts
+
+if __name__ == "__main__":
+    from utils.logging_setup import setup_logging
+    setup_logging()
+
+    parser = argparse.ArgumentParser(description="会話履歴を JSONL でエクスポート/インポートします。")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", help="JSONL ファイルのパス")
+    parser.add_argument("--project-id", type=int, default=None, help="export: このプロジェクトのみ出力する")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="import: 1トランザクションの行数")
+    parser.add_argument("--restart", action="store_true", help="import: 前回の記録を捨てて最初から取り込み直す")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        print(export_jsonl(args.path, project_id=args.project_id))
+    else:
+        from database.database import init_db
+        init_db()
+        print(import_jsonl(args.path, batch_size=args.batch_size, restart=args.restart))
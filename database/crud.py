@@ -1,23 +1,121 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import text
-from models.models import Message, Thread, Project # モデルをインポート
+from sqlalchemy import text, insert, func, select, literal, null, or_, exists
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models.models import (Message, Thread, Project, Tombstone, ModelComparisonAnswer, UsageRollup, # モデルをインポート
+                           Attachment, MessageAttachment)
+from database.database import track_queries # CRUD 関数ごとに SQL 文の数と時間を集計する
 import logging
 import datetime
+from typing import NamedTuple
 
 # モジュールレベルのロガーを取得
 log = logging.getLogger(__name__)
 
-def search_messages(db: Session, query: str) -> list[Message]:
+# --- 読み取り専用のレコード ---
+# 表示・検索・API の一覧のように読むだけの処理は、ORM のオブジェクト (ID マップへの登録や変更の追跡を伴う) ではなく
+# 必要な列だけを select() で読み込んだ軽いタプルを返す。書き込みは従来どおり ORM のモデルを使う。
+class ProjectRow(NamedTuple):
+    id: int
+    name: str
+    system_prompt: str | None
+    created_at: datetime.datetime | None
+    updated_at: datetime.datetime | None
+
+class ThreadRow(NamedTuple):
+    id: int
+    project_id: int
+    name: str
+    created_at: datetime.datetime | None
+    updated_at: datetime.datetime | None
+    parent_thread_id: int | None
+    branch_message_id: int | None
+    archived_at: datetime.datetime | None
+
+class MessageRow(NamedTuple):
+    id: int
+    thread_id: int
+    role: str
+    content: str
+    created_at: datetime.datetime | None
+
+class SearchHit(NamedTuple):
+    """検索にヒットしたメッセージと、その所属するスレッド・プロジェクトの名前"""
+    id: int
+    thread_id: int
+    role: str
+    content: str
+    created_at: datetime.datetime | None
+    thread_name: str
+    project_id: int
+    project_name: str
+
+_PROJECT_COLUMNS = (Project.id, Project.name, Project.system_prompt, Project.created_at, Project.updated_at)
+_THREAD_COLUMNS = (Thread.id, Thread.project_id, Thread.name, Thread.created_at, Thread.updated_at,
+                   Thread.parent_thread_id, Thread.branch_message_id, Thread.archived_at)
+_MESSAGE_COLUMNS = (Message.id, Message.thread_id, Message.role, Message.content, Message.created_at)
+
+def _rows(db: Session, statement, record: type) -> list:
+    """select() の結果の各行を record (NamedTuple) に詰め替えます。"""
+    return [record._make(row) for row in db.execute(statement)]
+
+@track_queries
+def list_projects(db: Session) -> list[ProjectRow]:
+    """全てのプロジェクトを名前順に返します (読み取り専用)。"""
+    return _rows(db, select(*_PROJECT_COLUMNS).order_by(Project.name), ProjectRow)
+
+@track_queries
+def list_threads(db: Session, project_id: int, offset: int = 0, limit: int | None = None) -> list[ThreadRow]:
+    """
+    プロジェクトのスレッドを更新日時の新しい順に返します (読み取り専用)。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        project_id: プロジェクトの ID。
+        offset: 先頭から読み飛ばす件数 (ページング用)。
+        limit: 返す最大件数。
+    """
+    statement = (select(*_THREAD_COLUMNS).where(Thread.project_id == project_id)
+                 .order_by(Thread.updated_at.desc()).offset(offset).limit(limit))
+    return _rows(db, statement, ThreadRow)
+
+def _record_tombstones(db: Session, entity_type: str, entity_ids: list[int], project_id: int | None = None) -> None:
+    """
+    削除したエンティティを tombstones テーブルに記録します (コミットは呼び出し側で行う)。
+    増分エクスポートはこの記録を読んで削除を出力先に伝えます。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        entity_type: 'project' または 'thread'。
+        entity_ids: 削除したエンティティの ID のリスト。
+        project_id: スレッドの場合は所属プロジェクトの ID。
+    """
+    if not entity_ids:
+        return
+    now = datetime.datetime.utcnow()
+    db.execute(insert(Tombstone), [
+        {"entity_type": entity_type, "entity_id": entity_id, "project_id": project_id, "deleted_at": now}
+        for entity_id in entity_ids
+    ])
+
+def search_rank_key(hit: SearchHit) -> tuple:
+    """検索結果の並び順のキー (大きいほど先)。複数の DB の検索結果を合わせるときにも使う。"""
+    return (hit.created_at or datetime.datetime.min, hit.id)
+
+@track_queries
+def search_messages(db: Session, query: str, limit: int | None = None, include_archived: bool = False) -> list[SearchHit]:
     """
     指定されたクエリ文字列を使用して、メッセージ履歴を全文検索します。
     検索は AND 条件で行われます（すべてのキーワードを含むメッセージを検索）。
+    スレッド名とプロジェクト名も同じクエリで JOIN して返します (ヒットごとに問い合わせない)。
 
     Args:
         db: SQLAlchemy セッションオブジェクト。
         query: 検索クエリ文字列 (半角スペース区切り)。
+        limit: 返す最大件数。
+        include_archived: True の場合、コールドアーカイブ (database.archive) に移したスレッドのメッセージも検索します。
 
     Returns:
-        検索にヒットした Message オブジェクトのリスト。
+        検索にヒットしたメッセージの SearchHit のリスト (新しい順。search_rank_key の降順)。
     """
     if not query.strip():
         return []
@@ -30,25 +128,52 @@ def search_messages(db: Session, query: str) -> list[Message]:
     try:
         # FTS5を使わず、SQLのLIKE演算子を使用して検索
         # 各検索用語を含むメッセージをAND条件で検索
-        query_obj = db.query(Message)
+        statement = (select(*_MESSAGE_COLUMNS, Thread.name, Thread.project_id, Project.name)
+                     .join(Thread, Message.thread_id == Thread.id)
+                     .join(Project, Thread.project_id == Project.id))
         
         # すべての用語に対してフィルターを適用
         for term in terms:
-            query_obj = query_obj.filter(Message.content.ilike(f'%{term}%'))
+            statement = statement.where(Message.content.ilike(f'%{term}%'))
         
         # 結果を取得
-        messages = query_obj.all()
-        return messages
+        statement = statement.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit)
+        hits = _rows(db, statement, SearchHit)
+        if include_archived:
+            from database.archive import search_archived_messages # アーカイブは別の DB に保存している
+            hits = sorted(hits + search_archived_messages(db, query, limit=limit), key=search_rank_key, reverse=True)[:limit]
+        return hits
 
     except Exception as e:
-        logging.error(f"メッセージ検索中にエラーが発生しました (Query: {query}): {e}", exc_info=True)
+        log.error(f"メッセージ検索中にエラーが発生しました (Query: {query}): {e}", exc_info=True)
         # エラーが発生した場合は空リストを返すか、例外を再発生させる
         return []
 
+def _hand_over_to_forks(db: Session, thread: Thread) -> None:
+    """
+    削除するスレッドから分岐したスレッドが共有しているメッセージを、分岐点が最も後ろのスレッドに移します (コミットは呼び出し側)。
+    メッセージの ID は変わらないため、他の分岐先は分岐点をそのままに分岐元を付け替えるだけで済みます。
+    """
+    forks = (db.query(Thread).filter(Thread.parent_thread_id == thread.id)
+             .order_by(Thread.branch_message_id.desc(), Thread.id).all())
+    if not forks:
+        return
+    heir = forks[0]
+    moved = (db.query(Message).filter(Message.thread_id == thread.id, Message.id <= heir.branch_message_id)
+             .update({Message.thread_id: heir.id}, synchronize_session=False))
+    log.info(f"スレッド ID {thread.id} の {moved} 件のメッセージを分岐先のスレッド ID {heir.id} に引き継ぎます")
+    for fork in forks[1:]:
+        fork.parent_thread_id = heir.id
+    heir.parent_thread_id = thread.parent_thread_id
+    heir.branch_message_id = thread.branch_message_id
+    db.flush()
+
+@track_queries
 def delete_thread(db: Session, thread_id: int) -> bool:
     """
     指定された ID のスレッドを削除します。
     関連するメッセージもカスケード削除されます。
+    分岐先のスレッドがある場合、共有しているメッセージは分岐先に引き継がれます。
 
     Args:
         db: SQLAlchemy セッションオブジェクト。
@@ -60,9 +185,12 @@ def delete_thread(db: Session, thread_id: int) -> bool:
     thread_to_delete = db.query(Thread).filter(Thread.id == thread_id).first()
     if thread_to_delete:
         try:
+            # 分岐先のスレッドが共有しているメッセージは削除せずに引き継ぐ
+            _hand_over_to_forks(db, thread_to_delete)
+
             # 明示的に関連メッセージを先に削除（FTSのトリガー関連の問題を回避するため）
             messages = db.query(Message).filter(Message.thread_id == thread_id).all()
-            logging.info(f"スレッド ID {thread_id} から {len(messages)} 件のメッセージを削除します")
+            log.info(f"スレッド ID {thread_id} から {len(messages)} 件のメッセージを削除します")
             
             # 一つずつ削除する（メッセージが多い場合はバルク削除を検討）
             for message in messages:
@@ -70,21 +198,23 @@ def delete_thread(db: Session, thread_id: int) -> bool:
             
             # 一旦コミットしてメッセージ削除を確定
             db.commit()
-            logging.info(f"スレッド ID {thread_id} のメッセージを削除しました")
+            log.info(f"スレッド ID {thread_id} のメッセージを削除しました")
             
-            # 次にスレッド自体を削除
+            # 次にスレッド自体を削除 (削除記録も同じトランザクションで残す)
+            _record_tombstones(db, "thread", [thread_id], thread_to_delete.project_id)
             db.delete(thread_to_delete)
             db.commit()
-            logging.info(f"スレッド ID {thread_id} を削除しました。")
+            log.info(f"スレッド ID {thread_id} を削除しました。")
             return True
         except Exception as e:
             db.rollback()
-            logging.error(f"スレッド ID {thread_id} の削除中にエラーが発生しました: {e}", exc_info=True)
+            log.error(f"スレッド ID {thread_id} の削除中にエラーが発生しました: {e}", exc_info=True)
             return False
     else:
-        logging.warning(f"削除対象のスレッド ID {thread_id} が見つかりません。")
+        log.warning(f"削除対象のスレッド ID {thread_id} が見つかりません。")
         return False
 
+@track_queries
 def update_thread_name(db: Session, thread_id: int, new_name: str) -> bool:
     """
     指定された ID のスレッドの名前を更新します。
@@ -99,7 +229,7 @@ def update_thread_name(db: Session, thread_id: int, new_name: str) -> bool:
         名前が空の場合は False。
     """
     if not new_name or not new_name.strip():
-        logging.warning(f"スレッド ID {thread_id} の新しい名前が空です。")
+        log.warning(f"スレッド ID {thread_id} の新しい名前が空です。")
         return False
 
     thread_to_update = db.query(Thread).filter(Thread.id == thread_id).first()
@@ -108,16 +238,17 @@ def update_thread_name(db: Session, thread_id: int, new_name: str) -> bool:
             thread_to_update.name = new_name
             thread_to_update.updated_at = datetime.datetime.utcnow() # 更新日時も更新
             db.commit()
-            logging.info(f"スレッド ID {thread_id} の名前を '{new_name}' に更新しました。")
+            log.info(f"スレッド ID {thread_id} の名前を '{new_name}' に更新しました。")
             return True
         except Exception as e:
             db.rollback()
-            logging.error(f"スレッド ID {thread_id} の名前更新中にエラーが発生しました: {e}", exc_info=True)
+            log.error(f"スレッド ID {thread_id} の名前更新中にエラーが発生しました: {e}", exc_info=True)
             return False
     else:
-        logging.warning(f"更新対象のスレッド ID {thread_id} が見つかりません。")
+        log.warning(f"更新対象のスレッド ID {thread_id} が見つかりません。")
         return False
 
+@track_queries
 def delete_project(db: Session, project_id: int) -> bool:
     """
     指定された ID のプロジェクトを削除します。
@@ -135,42 +266,49 @@ def delete_project(db: Session, project_id: int) -> bool:
         try:
             # 関連するスレッド ID を取得
             thread_ids = [thread.id for thread in project_to_delete.threads]
-            logging.info(f"プロジェクト ID {project_id} ('{project_to_delete.name}') に関連する {len(thread_ids)} 件のスレッドを削除します")
+            log.info(f"プロジェクト ID {project_id} ('{project_to_delete.name}') に関連する {len(thread_ids)} 件のスレッドを削除します")
 
             # 各スレッドに対して、まずメッセージを削除 (delete_thread 関数を利用できるか？)
             # delete_thread はコミットを含むので、ここでは直接メッセージを削除する方が良いかも
             if thread_ids:
                 message_count = db.query(Message).filter(Message.thread_id.in_(thread_ids)).count()
-                logging.info(f"{message_count} 件の関連メッセージを削除します")
+                log.info(f"{message_count} 件の関連メッセージを削除します")
                 db.query(Message).filter(Message.thread_id.in_(thread_ids)).delete(synchronize_session=False)
                 db.commit() # メッセージ削除をコミット (FTS トリガーのため)
-                logging.info("関連メッセージを削除しました")
+                log.info("関連メッセージを削除しました")
             
             # 次に関連スレッドを削除 (カスケードで削除されるはずだが、明示的に行う)
             # ここで project_to_delete.threads を使って削除すると、メッセージ削除後に
             # session が expire している可能性があるので、再度クエリする方が安全
             threads_to_delete = db.query(Thread).filter(Thread.project_id == project_id).all()
             if threads_to_delete:
-                 logging.info(f"{len(threads_to_delete)} 件のスレッドを削除します")
+                 log.info(f"{len(threads_to_delete)} 件のスレッドを削除します")
+                 # 分岐元への参照を外しておく (削除の順序で外部キー制約に違反しないように)
+                 for thread in threads_to_delete:
+                     thread.parent_thread_id = None
+                 db.flush()
+                 _record_tombstones(db, "thread", [thread.id for thread in threads_to_delete], project_id)
                  for thread in threads_to_delete:
                      db.delete(thread)
                  db.commit() # スレッド削除をコミット
-                 logging.info("関連スレッドを削除しました")
+                 log.info("関連スレッドを削除しました")
             
             # 最後にプロジェクト自体を削除
-            logging.info(f"プロジェクト ID {project_id} ('{project_to_delete.name}') を削除します")
+            log.info(f"プロジェクト ID {project_id} ('{project_to_delete.name}') を削除します")
+            _record_tombstones(db, "project", [project_id])
             db.delete(project_to_delete)
             db.commit()
-            logging.info(f"プロジェクト ID {project_id} を削除しました。")
+            log.info(f"プロジェクト ID {project_id} を削除しました。")
             return True
         except Exception as e:
             db.rollback()
-            logging.error(f"プロジェクト ID {project_id} の削除中にエラーが発生しました: {e}", exc_info=True)
+            log.error(f"プロジェクト ID {project_id} の削除中にエラーが発生しました: {e}", exc_info=True)
             return False
     else:
-        logging.warning(f"削除対象のプロジェクト ID {project_id} が見つかりません。")
+        log.warning(f"削除対象のプロジェクト ID {project_id} が見つかりません。")
         return False
 
+@track_queries
 def update_project(db: Session, project_id: int, new_name: str, new_system_prompt: str) -> bool:
     """
     指定された ID のプロジェクトの名前とシステムプロンプトを更新します。
@@ -186,7 +324,7 @@ def update_project(db: Session, project_id: int, new_name: str, new_system_promp
         名前が空または重複している場合は False。
     """
     if not new_name or not new_name.strip():
-        logging.warning(f"プロジェクト ID {project_id} の新しい名前が空です。")
+        log.warning(f"プロジェクト ID {project_id} の新しい名前が空です。")
         return False
 
     project_to_update = db.query(Project).filter(Project.id == project_id).first()
@@ -196,7 +334,7 @@ def update_project(db: Session, project_id: int, new_name: str, new_system_promp
             if project_to_update.name != new_name:
                 existing_project = db.query(Project).filter(Project.name == new_name, Project.id != project_id).first()
                 if existing_project:
-                    logging.error(f"プロジェクト名 '{new_name}' は既に別のプロジェクトで使用されています。")
+                    log.error(f"プロジェクト名 '{new_name}' は既に別のプロジェクトで使用されています。")
                     # エラーをユーザーに返す必要がある (例: False を返す)
                     return False
             
@@ -204,16 +342,17 @@ def update_project(db: Session, project_id: int, new_name: str, new_system_promp
             project_to_update.system_prompt = new_system_prompt
             project_to_update.updated_at = datetime.datetime.utcnow() # 更新日時も更新
             db.commit()
-            logging.info(f"プロジェクト ID {project_id} を更新しました。名前: '{new_name}")
+            log.info(f"プロジェクト ID {project_id} を更新しました。名前: '{new_name}")
             return True
         except Exception as e:
             db.rollback()
-            logging.error(f"プロジェクト ID {project_id} の更新中にエラーが発生しました: {e}", exc_info=True)
+            log.error(f"プロジェクト ID {project_id} の更新中にエラーが発生しました: {e}", exc_info=True)
             return False
     else:
-        logging.warning(f"更新対象のプロジェクト ID {project_id} が見つかりません。")
+        log.warning(f"更新対象のプロジェクト ID {project_id} が見つかりません。")
         return False
 
+@track_queries
 def delete_all_threads_in_project(db: Session, project_id: int) -> bool:
     """
     指定されたプロジェクト ID に属する全てのスレッドと関連メッセージを削除します。
@@ -228,7 +367,7 @@ def delete_all_threads_in_project(db: Session, project_id: int) -> bool:
     # プロジェクトが存在するか一応確認 (任意)
     project = db.query(Project).filter(Project.id == project_id).first()
     if not project:
-        logging.warning(f"全スレッド削除対象のプロジェクト ID {project_id} が見つかりません。")
+        log.warning(f"全スレッド削除対象のプロジェクト ID {project_id} が見つかりません。")
         return False
 
     try:
@@ -237,38 +376,44 @@ def delete_all_threads_in_project(db: Session, project_id: int) -> bool:
         thread_ids = [thread.id for thread in threads_to_delete]
 
         if not thread_ids:
-            logging.info(f"プロジェクト ID {project_id} に削除対象のスレッドはありません。")
+            log.info(f"プロジェクト ID {project_id} に削除対象のスレッドはありません。")
             return True # 何も削除しないが、処理としては成功
         
-        logging.info(f"プロジェクト ID {project_id} から {len(thread_ids)} 件のスレッドとそのメッセージを削除します。")
+        log.info(f"プロジェクト ID {project_id} から {len(thread_ids)} 件のスレッドとそのメッセージを削除します。")
 
         # 1. 関連するメッセージを全て削除 (FTS トリガーのため先にコミット)
         message_count = db.query(Message).filter(Message.thread_id.in_(thread_ids)).count()
         if message_count > 0:
-            logging.info(f"{message_count} 件の関連メッセージを削除します。")
+            log.info(f"{message_count} 件の関連メッセージを削除します。")
             db.query(Message).filter(Message.thread_id.in_(thread_ids)).delete(synchronize_session=False)
             db.commit()
-            logging.info("関連メッセージを削除しました。")
+            log.info("関連メッセージを削除しました。")
         else:
-            logging.info("削除対象のメッセージはありませんでした。")
+            log.info("削除対象のメッセージはありませんでした。")
 
         # 2. スレッドを全て削除
-        logging.info(f"{len(threads_to_delete)} 件のスレッドを削除します。")
+        log.info(f"{len(threads_to_delete)} 件のスレッドを削除します。")
+        _record_tombstones(db, "thread", thread_ids, project_id)
+        # 分岐元への参照を外しておく (削除の順序で外部キー制約に違反しないように)
+        for thread in threads_to_delete:
+            thread.parent_thread_id = None
+        db.flush()
         # delete() を使うより、オブジェクトを渡して削除する方が確実な場合がある
         for thread in threads_to_delete:
             db.delete(thread)
         # db.query(Thread).filter(Thread.project_id == project_id).delete(synchronize_session=False)
         db.commit()
-        logging.info("関連スレッドを削除しました。")
+        log.info("関連スレッドを削除しました。")
 
-        logging.info(f"プロジェクト ID {project_id} の全スレッド削除が完了しました。")
+        log.info(f"プロジェクト ID {project_id} の全スレッド削除が完了しました。")
         return True
 
     except Exception as e:
         db.rollback()
-        logging.error(f"プロジェクト ID {project_id} の全スレッド削除中にエラーが発生しました: {e}", exc_info=True)
+        log.error(f"プロジェクト ID {project_id} の全スレッド削除中にエラーが発生しました: {e}", exc_info=True)
         return False
 
+@track_queries
 def delete_empty_threads_in_project(db: Session, project_id: int, exclude_thread_id: int | None = None) -> int:
     """
     指定されたプロジェクト内で、メッセージが存在しないチャット（スレッド）を削除します。
@@ -285,8 +430,12 @@ def delete_empty_threads_in_project(db: Session, project_id: int, exclude_thread
     try:
         # メッセージが存在しないスレッドの ID を取得
         # LEFT JOIN を使用し、Message が NULL のものを探す
+        # 分岐したスレッドは自分のメッセージが無くても分岐元の履歴を表示するため対象外
+        # (アーカイブしたスレッドも、メッセージがアーカイブにあるだけなので対象外)
         query = db.query(Thread.id).outerjoin(Message).filter(
             Thread.project_id == project_id,
+            Thread.parent_thread_id == None,
+            Thread.archived_at == None,
             Message.id == None
         )
         # 除外IDが指定されていれば、条件に追加
@@ -296,21 +445,589 @@ def delete_empty_threads_in_project(db: Session, project_id: int, exclude_thread
         empty_thread_ids = [item[0] for item in query.all()]
 
         if not empty_thread_ids:
-            logging.debug(f"プロジェクト ID {project_id} に削除対象の空チャットは見つかりませんでした (除外ID: {exclude_thread_id})。")
+            log.debug(f"プロジェクト ID {project_id} に削除対象の空チャットは見つかりませんでした (除外ID: {exclude_thread_id})。")
             return 0
 
-        logging.info(f"プロジェクト ID {project_id} の {len(empty_thread_ids)} 件の空のチャットを削除します (除外ID: {exclude_thread_id}): {empty_thread_ids}")
+        log.info(f"プロジェクト ID {project_id} の {len(empty_thread_ids)} 件の空のチャットを削除します (除外ID: {exclude_thread_id}): {empty_thread_ids}")
         
         # 取得した ID のスレッドを削除
+        _record_tombstones(db, "thread", empty_thread_ids, project_id)
         deleted_count = db.query(Thread).filter(Thread.id.in_(empty_thread_ids)).delete(synchronize_session=False)
         db.commit()
-        logging.info(f"{deleted_count} 件の空のチャットを削除しました。")
+        log.info(f"{deleted_count} 件の空のチャットを削除しました。")
         return deleted_count if deleted_count is not None else 0
 
     except Exception as e:
         db.rollback()
-        logging.error(f"プロジェクト ID {project_id} の空チャット削除中にエラーが発生しました: {e}", exc_info=True)
+        log.error(f"プロジェクト ID {project_id} の空チャット削除中にエラーが発生しました: {e}", exc_info=True)
+        return 0
+
+@track_queries
+def delete_stale_empty_threads(db: Session, created_before: datetime.datetime, limit: int = 200,
+                               exclude_thread_ids: set[int] | frozenset = frozenset()) -> int:
+    """
+    全プロジェクトから、created_before より前に作成されてメッセージが1件も無いチャットを最大 limit 件削除します。
+    バックグラウンドの掃除 (utils.thread_sweeper) から少しずつ呼び出すためのもので、1回の呼び出しが1トランザクションです。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        created_before: これより後に作成されたチャットは対象外 (作成直後のチャットを消さないための猶予)。
+        limit: 1回に削除する最大件数。
+        exclude_thread_ids: 削除しないチャットの ID (表示中・生成中のチャット)。
+
+    Returns:
+        削除したチャットの数。エラー時は 0。
+    """
+    has_messages = exists().where(Message.thread_id == Thread.id)
+    try:
+        # 分岐したスレッドは自分のメッセージが無くても分岐元の履歴を表示するため対象外 (アーカイブしたスレッドも同様)
+        query = db.query(Thread.id, Thread.project_id).filter(
+            Thread.parent_thread_id == None, Thread.archived_at == None, Thread.created_at < created_before, ~has_messages)
+        if exclude_thread_ids:
+            query = query.filter(Thread.id.notin_(exclude_thread_ids))
+        candidates = dict(query.order_by(Thread.id).limit(limit).all())
+        if not candidates:
+            return 0
+
+        # 候補を選んだ後にメッセージが追加されたチャットは残す (削除と確認は同じ書き込みトランザクション内)
+        db.query(Thread).filter(Thread.id.in_(candidates), ~has_messages).delete(synchronize_session=False)
+        remaining = {row[0] for row in db.query(Thread.id).filter(Thread.id.in_(candidates)).all()}
+        deleted_by_project: dict[int, list[int]] = {}
+        for thread_id, project_id in candidates.items():
+            if thread_id not in remaining:
+                deleted_by_project.setdefault(project_id, []).append(thread_id)
+        for project_id, thread_ids in deleted_by_project.items():
+            _record_tombstones(db, "thread", thread_ids, project_id)
+        db.commit()
+        deleted_count = len(candidates) - len(remaining)
+        log.info(f"{deleted_count} 件の空のチャットを削除しました (プロジェクト数: {len(deleted_by_project)})。")
+        return deleted_count
+
+    except Exception as e:
+        db.rollback()
+        log.error(f"空チャットの削除中にエラーが発生しました: {e}", exc_info=True)
         return 0
 
+@track_queries
+def get_latest_comparison(db: Session, thread_id: int) -> list[ModelComparisonAnswer]:
+    """
+    スレッドで最後に行ったモデル比較の回答を、モデルの指定順に返します。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        thread_id: スレッドの ID。
+
+    Returns:
+        ModelComparisonAnswer のリスト。比較していない場合は空のリスト。
+    """
+    latest = (db.query(ModelComparisonAnswer.comparison_id)
+              .filter(ModelComparisonAnswer.thread_id == thread_id)
+              .order_by(ModelComparisonAnswer.id.desc())
+              .first())
+    if latest is None:
+        return []
+    return (db.query(ModelComparisonAnswer)
+            .filter(ModelComparisonAnswer.comparison_id == latest[0])
+            .order_by(ModelComparisonAnswer.id)
+            .all())
+
+@track_queries
+def adopt_comparison_answer(db: Session, answer_id: int) -> bool:
+    """
+    モデル比較の回答のうち、指定したものをスレッドの応答として採用します。
+    採用済みの応答メッセージの内容と使用量 (モデル名・トークン数・レイテンシ) を置き換えるため、
+    以降の会話の履歴にはこの回答が使われます。usage_rollups も前に採用していた回答と入れ替えます。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        answer_id: 採用する ModelComparisonAnswer の ID。
+
+    Returns:
+        採用できた場合は True、回答や応答メッセージが見つからない場合は False。
+    """
+    answer = db.query(ModelComparisonAnswer).filter(ModelComparisonAnswer.id == answer_id).first()
+    if answer is None or not answer.content or answer.assistant_message_id is None:
+        log.warning(f"採用できる比較回答が見つかりません (ID: {answer_id})。")
+        return False
+    message = db.query(Message).filter(Message.id == answer.assistant_message_id).first()
+    if message is None:
+        log.warning(f"比較回答 {answer_id} の応答メッセージが見つかりません。")
+        return False
+    try:
+        previous = (db.query(ModelComparisonAnswer)
+                    .filter(ModelComparisonAnswer.comparison_id == answer.comparison_id, ModelComparisonAnswer.adopted)
+                    .first())
+        if previous is not answer:
+            # 応答メッセージの使用量を採用する回答のものに入れ替え、集計も前の回答とモデルごとに付け替える
+            project_id = db.query(Thread.project_id).filter(Thread.id == message.thread_id).scalar()
+            if message.model_name is not None:
+                _add_usage_rollup(db, message.created_at, project_id, message.thread_id, message.model_name, message, sign=-1)
+            if previous is not None:
+                previous.adopted = False
+                record_comparison_usage(db, previous, project_id)
+            if answer.content or answer.total_tokens is not None:
+                _add_usage_rollup(db, answer.created_at, project_id, answer.thread_id, answer.model_name, answer, sign=-1)
+            message.model_name = answer.model_name
+            for name in USAGE_COLUMNS:
+                setattr(message, name, getattr(answer, name))
+            _add_usage_rollup(db, message.created_at, project_id, message.thread_id, message.model_name, message)
+        message.content = answer.content
+        (db.query(ModelComparisonAnswer)
+         .filter(ModelComparisonAnswer.comparison_id == answer.comparison_id)
+         .update({ModelComparisonAnswer.adopted: ModelComparisonAnswer.id == answer_id}, synchronize_session=False))
+        db.commit()
+        log.info(f"比較回答 {answer_id} ({answer.model_name}) をメッセージ {message.id} に採用しました。")
+        return True
+    except Exception as e:
+        db.rollback()
+        log.error(f"比較回答 {answer_id} の採用中にエラーが発生しました: {e}", exc_info=True)
+        return False
+
+@track_queries
+def create_project(db: Session, name: str, system_prompt: str) -> Project | None:
+    """
+    プロジェクトを作成します。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        name: プロジェクト名 (一意)。
+        system_prompt: システムプロンプト。
+
+    Returns:
+        作成した Project。名前が空または重複している場合は None。
+    """
+    if not name or not name.strip():
+        log.warning("新しいプロジェクトの名前が空です。")
+        return None
+    if db.query(Project.id).filter(Project.name == name).first():
+        log.warning(f"プロジェクト名 '{name}' は既に使用されています。")
+        return None
+    project = Project(name=name, system_prompt=system_prompt)
+    db.add(project)
+    db.commit()
+    db.refresh(project)
+    log.info(f"プロジェクト '{name}' (ID: {project.id}) を作成しました。")
+    return project
+
+@track_queries
+def create_thread(db: Session, project_id: int, name: str = "新規チャット") -> Thread | None:
+    """
+    プロジェクトにスレッドを作成します。
+
+    Returns:
+        作成した Thread。プロジェクトが見つからない場合は None。
+    """
+    if not db.query(Project.id).filter(Project.id == project_id).first():
+        log.warning(f"スレッド作成対象のプロジェクト ID {project_id} が見つかりません。")
+        return None
+    thread = Thread(project_id=project_id, name=name)
+    db.add(thread)
+    db.commit()
+    db.refresh(thread)
+    return thread
+
+def _lineage_cte(thread_id: int):
+    """
+    スレッド自身と分岐元を辿った祖先のスレッドの再帰 CTE (thread_id, cutoff, depth)。
+    cutoff はそのスレッドから共有するメッセージ ID の上限 (自身は NULL = 全て)、depth は自身が 0 で祖先ほど大きい。
+    """
+    lineage = select(literal(thread_id).label("thread_id"), null().label("cutoff"), literal(0).label("depth")) \
+        .cte("lineage", recursive=True)
+    return lineage.union_all(
+        select(Thread.parent_thread_id, Thread.branch_message_id, lineage.c.depth + 1)
+        .where(Thread.id == lineage.c.thread_id, Thread.parent_thread_id.isnot(None))
+    )
+
+@track_queries
+def get_thread_history(db: Session, thread_id: int, after_id: int = 0, limit: int | None = None) -> list[MessageRow]:
+    """
+    スレッドの履歴を、分岐元から共有しているメッセージを含めて古い順に返します (再帰クエリ1回)。
+    表示と API に渡すだけなので、ORM のオブジェクトではなく MessageRow (読み取り専用) で返します。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        thread_id: スレッドの ID。
+        after_id: この ID より後のメッセージだけを返します (ページング用)。
+        limit: 返す最大件数。
+
+    Returns:
+        MessageRow のリスト。スレッドが無い場合は空リスト。
+    """
+    lineage = _lineage_cte(thread_id)
+    statement = (select(*_MESSAGE_COLUMNS).join(lineage, Message.thread_id == lineage.c.thread_id)
+                 .where(or_(lineage.c.cutoff.is_(None), Message.id <= lineage.c.cutoff), Message.id > after_id)
+                 .order_by(lineage.c.depth.desc(), Message.created_at, Message.id)
+                 .limit(limit))
+    return _rows(db, statement, MessageRow)
+
+@track_queries
+def fork_thread(db: Session, thread_id: int, branch_message_id: int, name: str | None = None) -> Thread | None:
+    """
+    スレッドを指定したメッセージの時点で分岐させた新しいスレッドを作成します。
+    分岐点までのメッセージはコピーせずに共有するため、履歴の長さによらずスレッドを1行追加するだけです。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        thread_id: 分岐元のスレッドの ID。
+        branch_message_id: 分岐点のメッセージ (このメッセージまでを引き継ぐ)。分岐元が共有している祖先のメッセージも指定できます。
+        name: 新しいスレッドの名前。省略時は分岐元の名前に「(分岐)」を付けます。
+
+    Returns:
+        作成したスレッド。スレッドが無い場合や、メッセージがそのスレッドの履歴に含まれない場合は None。
+    """
+    source = db.get(Thread, thread_id)
+    message = db.get(Message, branch_message_id)
+    if source is None or message is None:
+        log.warning(f"分岐元のスレッド ID {thread_id} またはメッセージ ID {branch_message_id} が見つかりません。")
+        return None
+    lineage = _lineage_cte(thread_id)
+    visible = (db.query(lineage.c.thread_id)
+               .filter(lineage.c.thread_id == message.thread_id,
+                       or_(lineage.c.cutoff.is_(None), lineage.c.cutoff >= message.id))
+               .first())
+    if visible is None:
+        log.warning(f"メッセージ ID {branch_message_id} はスレッド ID {thread_id} の履歴に含まれません。")
+        return None
+    # 分岐点のメッセージを持つスレッドを直接の分岐元にする (祖先を辿る段数を増やさない)
+    thread = Thread(project_id=source.project_id, name=name or f"{source.name} (分岐)",
+                    parent_thread_id=message.thread_id, branch_message_id=message.id)
+    db.add(thread)
+    db.commit()
+    db.refresh(thread)
+    return thread
+
+@track_queries
+def add_message(db: Session, thread: Thread, role: str, content: str,
+                model_name: str | None = None, usage: dict | None = None,
+                attachment_ids: list[int] | None = None) -> Message:
+    """
+    スレッドにメッセージを追加し、スレッドの最終更新日時を更新します。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        thread: 追加先のスレッド。
+        role: 'user' または 'assistant'。
+        content: メッセージの内容。
+        model_name: アシスタントの応答の場合、生成したモデル。指定すると使用量を記録します (record_message_usage)。
+        usage: GeminiClient.generate_content_stream が書き込んだトークン数とレイテンシ。
+        attachment_ids: メッセージに添付するファイルの ID (store_attachment で保存済みのもの)。
+
+    Returns:
+        追加した Message。
+    """
+    message = Message(thread_id=thread.id, role=role, content=content)
+    db.add(message)
+    thread.updated_at = datetime.datetime.utcnow()
+    if model_name is not None or attachment_ids:
+        db.flush()
+    if model_name is not None:
+        record_message_usage(db, message, thread.project_id, model_name, usage)
+    if attachment_ids:
+        link_attachments(db, message, attachment_ids)
+    db.commit()
+    return message
+
+# usage_rollups に messages の使用量を加算する SQL (:min_message_id より大きい ID の記録済みメッセージが対象)
+ADD_USAGE_ROLLUPS_SQL = """
+INSERT INTO usage_rollups (day, project_id, thread_id, model_name, message_count, timed_message_count, prompt_tokens,
+                           output_tokens, total_tokens, time_to_first_token_ms_sum, latency_ms_sum)
+SELECT date(m.created_at), t.project_id, m.thread_id, m.model_name, COUNT(*), COUNT(m.latency_ms), COALESCE(SUM(m.prompt_tokens), 0),
+       COALESCE(SUM(m.output_tokens), 0), COALESCE(SUM(m.total_tokens), 0),
+       COALESCE(SUM(m.time_to_first_token_ms), 0), COALESCE(SUM(m.latency_ms), 0)
+FROM messages m JOIN threads t ON t.id = m.thread_id
+WHERE m.id > :min_message_id AND m.model_name IS NOT NULL
+GROUP BY date(m.created_at), t.project_id, m.thread_id, m.model_name
+ON CONFLICT (day, project_id, thread_id, model_name) DO UPDATE SET
+    message_count = message_count + excluded.message_count,
+    timed_message_count = timed_message_count + excluded.timed_message_count,
+    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+    output_tokens = output_tokens + excluded.output_tokens,
+    total_tokens = total_tokens + excluded.total_tokens,
+    time_to_first_token_ms_sum = time_to_first_token_ms_sum + excluded.time_to_first_token_ms_sum,
+    latency_ms_sum = latency_ms_sum + excluded.latency_ms_sum
+"""
+
+# usage_rollups にモデル比較の採用されなかった回答の使用量を加算する SQL (採用した回答は応答メッセージとして集計される)。
+# 途中で失敗・キャンセルした回答も、出力やトークン数があれば課金されているため含める
+ADD_COMPARISON_USAGE_ROLLUPS_SQL = """
+INSERT INTO usage_rollups (day, project_id, thread_id, model_name, message_count, timed_message_count, prompt_tokens,
+                           output_tokens, total_tokens, time_to_first_token_ms_sum, latency_ms_sum)
+SELECT date(a.created_at), t.project_id, a.thread_id, a.model_name, COUNT(*), COUNT(a.latency_ms), COALESCE(SUM(a.prompt_tokens), 0),
+       COALESCE(SUM(a.output_tokens), 0), COALESCE(SUM(a.total_tokens), 0),
+       COALESCE(SUM(a.time_to_first_token_ms), 0), COALESCE(SUM(a.latency_ms), 0)
+FROM model_comparison_answers a JOIN threads t ON t.id = a.thread_id
+WHERE a.adopted = 0 AND (a.content != '' OR a.total_tokens IS NOT NULL)
+GROUP BY date(a.created_at), t.project_id, a.thread_id, a.model_name
+ON CONFLICT (day, project_id, thread_id, model_name) DO UPDATE SET
+    message_count = message_count + excluded.message_count,
+    timed_message_count = timed_message_count + excluded.timed_message_count,
+    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+    output_tokens = output_tokens + excluded.output_tokens,
+    total_tokens = total_tokens + excluded.total_tokens,
+    time_to_first_token_ms_sum = time_to_first_token_ms_sum + excluded.time_to_first_token_ms_sum,
+    latency_ms_sum = latency_ms_sum + excluded.latency_ms_sum
+"""
+
+# 使用量を記録する列 (messages と model_comparison_answers で共通)
+USAGE_COLUMNS = ("prompt_tokens", "output_tokens", "total_tokens", "time_to_first_token_ms", "latency_ms")
+
+def _add_usage_rollup(db: Session, created_at: datetime.datetime | None, project_id: int, thread_id: int,
+                      model_name: str, record, sign: int = 1) -> None:
+    """record (Message または ModelComparisonAnswer) の使用量を usage_rollups に加算します (sign=-1 で減算)。"""
+    values = {
+        "day": (created_at or datetime.datetime.utcnow()).date(),
+        "project_id": project_id,
+        "thread_id": thread_id,
+        "model_name": model_name,
+        "message_count": sign,
+        "timed_message_count": 0 if record.latency_ms is None else sign,
+        "prompt_tokens": sign * (record.prompt_tokens or 0),
+        "output_tokens": sign * (record.output_tokens or 0),
+        "total_tokens": sign * (record.total_tokens or 0),
+        "time_to_first_token_ms_sum": sign * (record.time_to_first_token_ms or 0.0),
+        "latency_ms_sum": sign * (record.latency_ms or 0.0),
+    }
+    statement = sqlite_insert(UsageRollup).values(**values)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=["day", "project_id", "thread_id", "model_name"],
+        set_={name: getattr(UsageRollup, name) + statement.excluded[name]
+              for name in values if name not in ("day", "project_id", "thread_id", "model_name")},
+    ))
+
+def record_message_usage(db: Session, message: Message, project_id: int, model_name: str, usage: dict | None) -> None:
+    """
+    アシスタントのメッセージにモデル名・トークン数・レイテンシを記録し、usage_rollups に加算します (コミットは呼び出し側で行う)。
+    同じメッセージを2回記録しても加算は1回だけです。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        message: 記録するメッセージ (ID が確定していること)。
+        project_id: メッセージのスレッドが属するプロジェクト。
+        model_name: 応答を生成したモデル。
+        usage: prompt_tokens / output_tokens / total_tokens / time_to_first_token_ms / latency_ms (無い値は NULL)。
+    """
+    if message.model_name is not None:
+        return
+    usage = usage or {}
+    message.model_name = model_name
+    message.prompt_tokens = usage.get("prompt_tokens")
+    message.output_tokens = usage.get("output_tokens")
+    message.total_tokens = usage.get("total_tokens")
+    message.time_to_first_token_ms = usage.get("time_to_first_token_ms")
+    message.latency_ms = usage.get("latency_ms")
+    _add_usage_rollup(db, message.created_at, project_id, message.thread_id, model_name, message)
+
+def record_comparison_usage(db: Session, answer: ModelComparisonAnswer, project_id: int) -> None:
+    """
+    モデル比較の採用されなかった回答の使用量を、その回答のモデルで usage_rollups に加算します (コミットは呼び出し側で行う)。
+    採用した回答は record_message_usage で応答メッセージとして記録してください。出力もトークン数も無い回答は加算しません。
+    """
+    if answer.adopted or not (answer.content or answer.total_tokens is not None):
+        return
+    _add_usage_rollup(db, answer.created_at, project_id, answer.thread_id, answer.model_name, answer)
+
+@track_queries
+def rebuild_usage_rollups(db: Session) -> int:
+    """
+    usage_rollups を messages とモデル比較の採用されなかった回答から作り直します (集計がずれた場合の修復用)。
+    削除済みのスレッドの使用量は messages に残っていないため、作り直すと集計から消えます。
+    アーカイブしたスレッドのメッセージも messages に無いため、その集計は作り直さずに残します。
+
+    Returns:
+        作り直した集計の行数。
+    """
+    archived_thread_ids = select(Thread.id).where(Thread.archived_at.isnot(None))
+    db.query(UsageRollup).filter(UsageRollup.thread_id.notin_(archived_thread_ids)).delete(synchronize_session=False)
+    db.execute(text(ADD_USAGE_ROLLUPS_SQL), {"min_message_id": 0})
+    db.execute(text(ADD_COMPARISON_USAGE_ROLLUPS_SQL))
+    db.commit()
+    return db.query(func.count(UsageRollup.id)).scalar()
+
+# get_usage_summary の group_by に指定できる軸 -> usage_rollups の列
+USAGE_GROUPS = {
+    "project": UsageRollup.project_id,
+    "thread": UsageRollup.thread_id,
+    "model": UsageRollup.model_name,
+    "day": UsageRollup.day,
+}
+
+@track_queries
+def get_usage_summary(db: Session, group_by: list[str] | tuple[str, ...] = ("project",),
+                      start_day: datetime.date | None = None, end_day: datetime.date | None = None,
+                      project_id: int | None = None) -> list[dict]:
+    """
+    トークン使用量とレイテンシを group_by の軸 (project / thread / model / day) ごとに集計します。
+    messages ではなく usage_rollups を集計するため、メッセージ数が多くても速く返ります。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        group_by: 集計の軸。空の場合は全体の合計を1行で返します。
+        start_day, end_day: 対象期間 (両端を含む、UTC の日付)。
+        project_id: 指定した場合はそのプロジェクトのみ集計します。
+
+    Returns:
+        軸の値 (project の場合は project_name も) と messages / prompt_tokens / output_tokens / total_tokens /
+        avg_time_to_first_token_ms / avg_latency_ms (レイテンシを計測できたメッセージの平均。無ければ None) を持つ dict のリスト。
+
+    Raises:
+        ValueError: 不明な軸を指定した場合。
+    """
+    unknown = [name for name in group_by if name not in USAGE_GROUPS]
+    if unknown:
+        raise ValueError(f"不明な集計の軸です: {', '.join(unknown)} (指定できるのは {', '.join(USAGE_GROUPS)})")
+
+    group_columns = [USAGE_GROUPS[name].label(f"{name}_id" if name in ("project", "thread") else name) for name in group_by]
+    timed_count = func.nullif(func.sum(UsageRollup.timed_message_count), 0)
+    columns = [
+        *group_columns,
+        func.sum(UsageRollup.message_count).label("messages"),
+        func.sum(UsageRollup.prompt_tokens).label("prompt_tokens"),
+        func.sum(UsageRollup.output_tokens).label("output_tokens"),
+        func.sum(UsageRollup.total_tokens).label("total_tokens"),
+        (func.sum(UsageRollup.time_to_first_token_ms_sum) / timed_count).label("avg_time_to_first_token_ms"),
+        (func.sum(UsageRollup.latency_ms_sum) / timed_count).label("avg_latency_ms"),
+    ]
+    query = db.query(*columns)
+    if start_day is not None:
+        query = query.filter(UsageRollup.day >= start_day)
+    if end_day is not None:
+        query = query.filter(UsageRollup.day <= end_day)
+    if project_id is not None:
+        query = query.filter(UsageRollup.project_id == project_id)
+    if group_by:
+        query = query.group_by(*[USAGE_GROUPS[name] for name in group_by]).order_by(*[USAGE_GROUPS[name] for name in group_by])
+    rows = [dict(row._mapping) for row in query.all() if row.messages]
+
+    if "project" in group_by and rows:
+        # 削除済みのプロジェクトは名前が無い (None)
+        names = dict(db.query(Project.id, Project.name).filter(Project.id.in_({row["project_id"] for row in rows})).all())
+        for row in rows:
+            row["project_name"] = names.get(row["project_id"])
+    return rows
+
+@track_queries
+def store_attachment(db: Session, store, data, filename: str, mime_type: str) -> Attachment:
+    """
+    添付ファイルを内容アドレスの保存先に保存し、attachments の行を返します。
+    同じ内容が保存済みの場合はファイルも行も増やさず、既存の行を返します (ファイル名は最初のものを残す)。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        store: utils.blob_store.BlobStore。
+        data: ファイルの内容 (bytes またはバイナリモードのファイルオブジェクト)。
+        filename: 元のファイル名。
+        mime_type: MIME タイプ (例: "application/pdf")。
+
+    Returns:
+        保存した Attachment。まだどのメッセージからも参照されていない場合、ref_count は 0 です。
+    """
+    digest, size = store.put(data)
+    now = datetime.datetime.utcnow()
+    statement = sqlite_insert(Attachment).values(sha256=digest, size_bytes=size, mime_type=mime_type, filename=filename,
+                                                 ref_count=0, created_at=now, last_used_at=now)
+    # 未参照のファイルの削除 (collect_unreferenced_attachments) の猶予を延ばす
+    db.execute(statement.on_conflict_do_update(index_elements=["sha256"], set_={"last_used_at": now}))
+    db.commit()
+    if not store.exists(digest):
+        # 書き込みと行の更新の間に、未参照のファイルとして削除された場合は書き直す
+        if hasattr(data, "seek"):
+            data.seek(0)
+        store.put(data)
+    return db.query(Attachment).filter(Attachment.sha256 == digest).one()
+
+def link_attachments(db: Session, message: Message, attachment_ids: list[int]) -> None:
+    """
+    メッセージに添付ファイルを関連付けます (コミットは呼び出し側で行う)。参照数はトリガーで増えます。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        message: 添付先のメッセージ (ID が確定していること)。
+        attachment_ids: 添付ファイルの ID (この順番で表示・送信する。重複は1つにまとめる)。
+    """
+    unique_ids = list(dict.fromkeys(attachment_ids))
+    if unique_ids:
+        db.execute(insert(MessageAttachment), [
+            {"message_id": message.id, "attachment_id": attachment_id, "position": position}
+            for position, attachment_id in enumerate(unique_ids)
+        ])
+
+@track_queries
+def get_attachments_by_message(db: Session, message_ids: list[int]) -> dict[int, list[Attachment]]:
+    """
+    メッセージごとの添付ファイルを1回のクエリで取得します。
+
+    Returns:
+        メッセージ ID -> 添付順の Attachment のリスト (添付の無いメッセージは含まない)。
+    """
+    if not message_ids:
+        return {}
+    rows = (db.query(MessageAttachment.message_id, Attachment)
+            .join(Attachment, Attachment.id == MessageAttachment.attachment_id)
+            .filter(MessageAttachment.message_id.in_(message_ids))
+            .order_by(MessageAttachment.message_id, MessageAttachment.position)
+            .all())
+    attachments: dict[int, list[Attachment]] = {}
+    for message_id, attachment in rows:
+        attachments.setdefault(message_id, []).append(attachment)
+    return attachments
+
+def record_gemini_file(db: Session, attachment: Attachment, uploaded) -> None:
+    """
+    Gemini の Files API にアップロードしたファイルの参照を記録します (期限内は再アップロードせずに再利用する)。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        attachment: アップロードした添付ファイル。
+        uploaded: Files API が返した File (name / uri / expiration_time を持つオブジェクト)。
+    """
+    expires_at = uploaded.expiration_time
+    if expires_at is not None and expires_at.tzinfo is not None:
+        expires_at = expires_at.astimezone(datetime.timezone.utc).replace(tzinfo=None) # DB の日時は UTC の naive で統一
+    attachment.gemini_file_name = uploaded.name
+    attachment.gemini_file_uri = uploaded.uri
+    attachment.gemini_file_expires_at = expires_at
+    db.commit()
+
+@track_queries
+def collect_unreferenced_attachments(db: Session, store, unused_before: datetime.datetime, limit: int = 200) -> int:
+    """
+    どのメッセージからも参照されておらず、unused_before より前から使われていない添付ファイルを、行とファイルの両方から削除します。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        store: utils.blob_store.BlobStore。
+        unused_before: これより後に保存・添付されたファイルは対象外 (保存してからメッセージを送るまでの猶予)。
+        limit: 1回に削除する最大件数。
+
+    Returns:
+        削除した添付ファイルの数。エラー時は 0。
+    """
+    try:
+        candidates = [digest for (digest,) in db.query(Attachment.sha256)
+                      .filter(Attachment.ref_count <= 0, Attachment.last_used_at < unused_before)
+                      .order_by(Attachment.id).limit(limit).all()]
+        if not candidates:
+            return 0
+        # 候補を選んだ後に添付された・保存し直されたファイルは残す
+        db.query(Attachment).filter(Attachment.sha256.in_(candidates), Attachment.ref_count <= 0,
+                                    Attachment.last_used_at < unused_before).delete(synchronize_session=False)
+        remaining = {digest for (digest,) in db.query(Attachment.sha256).filter(Attachment.sha256.in_(candidates)).all()}
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        log.error(f"未参照の添付ファイルの削除中にエラーが発生しました: {e}", exc_info=True)
+        return 0
+
+    deleted = [digest for digest in candidates if digest not in remaining]
+    # 行を消してからファイルを消すまでの間に同じ内容が保存し直された場合は、ファイルを残す
+    stored_again = {digest for (digest,) in db.query(Attachment.sha256).filter(Attachment.sha256.in_(deleted)).all()}
+    db.commit()
+    for digest in deleted:
+        if digest not in stored_again:
+            store.delete(digest)
+    if deleted:
+        log.info(f"未参照の添付ファイルを {len(deleted)} 件削除しました。")
+    return len(deleted)
+
 # 他の CRUD 操作関数もここに追加していく想定
 # (例: get_project, create_thread, get_messages_by_thread など) 
@@ -8,9 +8,16 @@ from sqlalchemy.engine import Engine
 from sqlalchemy import text
 import logging # logging をインポート
 from sqlalchemy import inspect
+import threading
+import time
+import weakref
+import re
+import functools
+from collections import Counter
+from contextvars import ContextVar
+from utils.logging_setup import TruncatedText, should_log_content
 
-# ロガーの設定 (既にあれば不要)
-logging.basicConfig(level=logging.DEBUG)
+# ログの出力先とレベルは utils.logging_setup.setup_logging で設定する
 log = logging.getLogger(__name__)
 
 DATABASE_URL = "sqlite:///gemini_chat.db"
@@ -30,87 +37,472 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor.close()
 # ----------------------------------------------------
 
-def init_db():
-    """データベースを初期化し、通常のテーブルと FTS 関連を作成します。"""
+# --- SQL の計測: 操作ごとの文の数と時間、遅いクエリのログ、N+1 の検出 ---
+#   SQL_SLOW_QUERY_MS        : この時間 (ミリ秒) 以上かかった文をパラメータと実行計画付きでログに出す (デフォルト 200、0 で無効)
+#                              パラメータの値はメッセージ本文を含むため、LOG_CONTENT_SAMPLE_RATE で抽出したときだけ出す
+#   SQL_N_PLUS_ONE_THRESHOLD : 1つの操作で同じ形の SELECT がこの回数以上実行されたら N+1 の疑いとして警告する (デフォルト 10)
+SQL_SLOW_QUERY_MS = float(os.getenv("SQL_SLOW_QUERY_MS", "200"))
+SQL_N_PLUS_ONE_THRESHOLD = int(os.getenv("SQL_N_PLUS_ONE_THRESHOLD", "10"))
+sql_log = logging.getLogger("database.sql")
+
+# 実行中の QueryTracker (入れ子にした場合は外側から順に並ぶ)。スレッド・タスクごとに独立している
+_active_trackers: ContextVar[tuple] = ContextVar("active_query_trackers", default=())
+
+_PLACEHOLDER_LIST = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+_NUMBER_LITERAL = re.compile(r"\b\d+\b")
+_WHITESPACE = re.compile(r"\s+")
+
+def statement_shape(statement: str) -> str:
+    """SQL 文の形 (IN 句のプレースホルダーの数や数値リテラルを除いたもの)。N+1 の検出に使う"""
+    shape = _PLACEHOLDER_LIST.sub("(?, ...)", statement)
+    shape = _NUMBER_LITERAL.sub("N", shape)
+    return _WHITESPACE.sub(" ", shape).strip()
+
+class QueryTracker:
+    """
+    1つの論理的な操作 (CRUD 関数・API リクエスト・画面の一部の描画など) で実行された SQL を集計します。
+
+    例:
+        with QueryTracker("search") as tracker:
+            search_messages(db, "検索語")
+        tracker.count, tracker.total_ms, tracker.likely_n_plus_one()
+
+    with 文が使えない場所 (Streamlit のスクリプトの try / finally など) では start() / stop() を使います。
+    入れ子にした場合、内側の文は外側の操作にも数えられます。
+    """
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.count = 0
+        self.total_ms = 0.0
+        self.shapes: Counter = Counter() # 文の形 -> 実行回数
+        self.select_shapes: Counter = Counter()
+        self.slow_queries: list[dict] = []
+
+    def start(self) -> "QueryTracker":
+        _active_trackers.set(_active_trackers.get() + (self,))
+        return self
+
+    def stop(self) -> None:
+        """集計を終えてログに出します。N+1 の警告は一番外側の操作でだけ出します (重複して出さないため)。"""
+        remaining = tuple(tracker for tracker in _active_trackers.get() if tracker is not self)
+        _active_trackers.set(remaining)
+        if sql_log.isEnabledFor(logging.DEBUG):
+            sql_log.debug("%s: %d statements, %.1f ms", self.operation, self.count, self.total_ms)
+        if not remaining:
+            for shape, count in self.likely_n_plus_one().items():
+                sql_log.warning("N+1 の疑い: %s で同じ形の SELECT が %d 回実行されました: %s", self.operation, count, shape)
+
+    def __enter__(self) -> "QueryTracker":
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.stop()
+
+    def likely_n_plus_one(self, threshold: int | None = None) -> dict[str, int]:
+        """同じ形の SELECT が threshold 回以上実行されたもの (文の形 -> 回数)"""
+        threshold = SQL_N_PLUS_ONE_THRESHOLD if threshold is None else threshold
+        return {shape: count for shape, count in self.select_shapes.items() if count >= threshold}
+
+    def _record(self, statement: str, elapsed_ms: float, slow_query: dict | None) -> None:
+        shape = statement_shape(statement)
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.shapes[shape] += 1
+        if shape.upper().startswith(("SELECT", "WITH")):
+            self.select_shapes[shape] += 1
+        if slow_query is not None:
+            self.slow_queries.append(slow_query)
+
+def track_queries(fn):
+    """関数の呼び出しを1つの操作 (名前は関数名) として QueryTracker で集計するデコレーター"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with QueryTracker(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+class assert_max_queries(QueryTracker):
+    """
+    with 文の中で実行された SQL 文が limit 個を超えたら AssertionError を送出します (テスト用)。
+
+    例:
+        with assert_max_queries(2):
+            crud.delete_thread(db, thread_id)
+    """
+
+    def __init__(self, limit: int, operation: str = "assert_max_queries"):
+        super().__init__(operation)
+        self.limit = limit
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.stop()
+        if exc_type is None and self.count > self.limit:
+            statements = "\n".join(f"  {count} x {shape}" for shape, count in self.shapes.items())
+            raise AssertionError(f"{self.operation}: SQL 文が {self.count} 個実行されました (上限 {self.limit}):\n{statements}")
+
+def _explain_query_plan(cursor, statement: str, parameters) -> str | None:
+    """SQLite の実行計画 (EXPLAIN QUERY PLAN) を別のカーソルで取得します。"""
+    if not statement.lstrip().upper().startswith(("SELECT", "WITH", "UPDATE", "DELETE", "INSERT")):
+        return None
+    plan_cursor = cursor.connection.cursor()
+    try:
+        rows = plan_cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters or ()).fetchall()
+        return "\n".join(str(row[-1]) for row in rows)
+    except Exception as e:
+        return f"(実行計画を取得できませんでした: {e})"
+    finally:
+        plan_cursor.close()
+
+def _describe_parameters(parameters, executemany: bool) -> str:
+    """
+    遅いクエリのログに出すパラメータ。値はプロンプトや応答の本文を含み得るため、本文のログと同じく
+    LOG_CONTENT_SAMPLE_RATE で抽出したときだけ LOG_CONTENT_MAX_CHARS までの値を出し、それ以外は型だけを出します。
+    """
+    if should_log_content():
+        return str(TruncatedText(parameters))
+    rows = list(parameters or ()) if executemany else [parameters]
+    first = rows[0] if rows else None
+    values = first.values() if isinstance(first, dict) else (first or ())
+    types = "(" + ", ".join(type(value).__name__ for value in values) + ")"
+    return f"{len(rows)} 行 × {types}" if executemany else types
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["query_started"].pop()) * 1000
+    trackers = _active_trackers.get()
+    is_slow = 0 < SQL_SLOW_QUERY_MS <= elapsed_ms
+    if not trackers and not is_slow:
+        return
+    slow_query = None
+    if is_slow:
+        operation = trackers[-1].operation if trackers else None
+        plan = None if executemany else _explain_query_plan(cursor, statement, parameters)
+        slow_query = {"operation": operation, "elapsed_ms": round(elapsed_ms, 1), "statement": statement,
+                      "parameters": _describe_parameters(parameters, executemany), "plan": plan}
+        sql_log.warning("遅いクエリ (%.1f ms, 操作: %s): %s\nパラメータ: %s\n実行計画:\n%s",
+                        elapsed_ms, operation, statement, slow_query["parameters"], plan)
+    for tracker in trackers:
+        tracker._record(statement, elapsed_ms, slow_query)
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    # 失敗した文は after_cursor_execute が呼ばれないため、開始時刻をここで捨てる
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_started"):
+        connection.info["query_started"].pop()
+# ----------------------------------------------------
+
+# メッセージ追加時に FTS インデックスを更新するトリガー
+# (一括インポートでは一時的に削除し、最後にまとめてインデックスを作るため定数にしている)
+FTS_INSERT_TRIGGER_DDL = """
+CREATE TRIGGER IF NOT EXISTS message_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content);
+END;
+"""
+
+# メッセージ削除・更新時のトリガー。message_fts は外部コンテンツ (content='messages') のため、
+# 古い内容を 'delete' コマンドで渡して索引から外す必要がある
+# (message_fts に直接 DELETE / UPDATE すると、既に変更された messages の内容で索引を外そうとして索引が壊れる)
+FTS_DELETE_TRIGGER_DDL = """
+CREATE TRIGGER IF NOT EXISTS message_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO message_fts (message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+"""
+FTS_UPDATE_TRIGGER_DDL = """
+CREATE TRIGGER IF NOT EXISTS message_au AFTER UPDATE OF content ON messages BEGIN
+    INSERT INTO message_fts (message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content);
+END;
+"""
+
+# 添付ファイルの参照数をメッセージとの対応の追加・削除に合わせて更新するトリガー
+# (メッセージの削除による ON DELETE CASCADE でも発火するため、どの削除経路でも数がずれない)
+ATTACHMENT_LINK_TRIGGER_DDL = """
+CREATE TRIGGER IF NOT EXISTS message_attachment_ai AFTER INSERT ON message_attachments BEGIN
+  UPDATE attachments SET ref_count = ref_count + 1 WHERE id = new.attachment_id;
+END;
+"""
+ATTACHMENT_UNLINK_TRIGGER_DDL = """
+CREATE TRIGGER IF NOT EXISTS message_attachment_ad AFTER DELETE ON message_attachments BEGIN
+  UPDATE attachments SET ref_count = ref_count - 1 WHERE id = old.attachment_id;
+END;
+"""
+
+# アーカイブしたスレッドの添付ファイルの参照も ref_count に数える (スレッドの削除による ON DELETE CASCADE でも発火する)
+ARCHIVED_ATTACHMENT_LINK_TRIGGER_DDL = """
+CREATE TRIGGER IF NOT EXISTS archived_attachment_ai AFTER INSERT ON archived_attachments BEGIN
+  UPDATE attachments SET ref_count = ref_count + 1 WHERE id = new.attachment_id;
+END;
+"""
+ARCHIVED_ATTACHMENT_UNLINK_TRIGGER_DDL = """
+CREATE TRIGGER IF NOT EXISTS archived_attachment_ad AFTER DELETE ON archived_attachments BEGIN
+  UPDATE attachments SET ref_count = ref_count - 1 WHERE id = old.attachment_id;
+END;
+"""
+
+def _create_schema(connection) -> None:
+    """
+    最新のスキーマを作成します。全ての DDL は冪等 (存在するものはスキップ) です。
+    新規 DB ではこれだけで最新になり、既存 DB ではマイグレーション後に不足分を補います。
+    """
+    # 1. SQLAlchemy のモデルに基づいて通常のテーブルを作成
+    # create_all は存在するテーブルをスキップするため、既存 DB でも
+    # 後から追加されたテーブル (tombstones など) だけが作成される
+    log.debug("init_db: Calling Base.metadata.create_all...")
+    Base.metadata.create_all(bind=connection) # ここで connection を渡す
+    log.debug("init_db: Base.metadata.create_all finished.")
+
+    # 既存 DB の threads テーブルにも updated_at のインデックスを追加
+    # (増分エクスポートで変更スレッドを範囲検索するため)
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_threads_updated_at ON threads (updated_at);"
+    ))
+    # 既存 DB の messages にも thread_id のインデックスを追加
+    # (履歴の読み込みと、メッセージの無いチャットを探す空チャットの掃除のため)
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_messages_thread_id ON messages (thread_id);"
+    ))
+
+    # 2. FTS 仮想テーブルとトリガーを直接作成
+    log.debug("init_db: Creating FTS table and triggers...")
+    # FTS5 仮想テーブル
+    connection.execute(text("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+        content, 
+        content='messages', 
+        content_rowid='id',
+        tokenize = 'unicode61 remove_diacritics 2' -- Use built-in tokenizer
+    );
+    """))
+    # トリガー: INSERT
+    connection.execute(text(FTS_INSERT_TRIGGER_DDL))
+    # トリガー: DELETE
+    connection.execute(text(FTS_DELETE_TRIGGER_DDL))
+    # トリガー: UPDATE
+    connection.execute(text(FTS_UPDATE_TRIGGER_DDL))
+    log.debug("init_db: FTS table and triggers created (or already exist).")
+
+    # 3. 添付ファイルの参照数のトリガー
+    connection.execute(text(ATTACHMENT_LINK_TRIGGER_DDL))
+    connection.execute(text(ATTACHMENT_UNLINK_TRIGGER_DDL))
+    connection.execute(text(ARCHIVED_ATTACHMENT_LINK_TRIGGER_DDL))
+    connection.execute(text(ARCHIVED_ATTACHMENT_UNLINK_TRIGGER_DDL))
+
+# スキーマのバージョン (SQLite の PRAGMA user_version に保存)。
+# スキーマを変更したら 1 増やし、既存 DB の変更が必要なら (ALTER TABLE など)
+# _MIGRATIONS にそのバージョンへの移行手順を追加する。
+# 新しいテーブル・インデックス・トリガーは _create_schema に追加すれば既存 DB にも作成される。
+SCHEMA_VERSION = 15 # 2: model_comparison_answers テーブルを追加, 3: FTS の削除・更新トリガーを修正, 4: メッセージの使用量と usage_rollups, 5: スレッドの分岐, 6: messages.thread_id のインデックス, 7: 添付ファイル, 8: スレッドのアーカイブ, 9: messages.updated_at, 10: thread_leases, 11: threads・messages・attachments の AUTOINCREMENT, 12: import_checkpoints, 13: 比較回答の使用量の集計, 14: FTS の更新トリガーを content の更新のみに, 15: export_watermarks.overlap_keys
+
+def _migrate_fts_triggers(connection) -> None:
+    """誤った削除・更新トリガーを作り直し、壊れている可能性のある FTS 索引を messages から再構築する"""
+    connection.execute(text("DROP TRIGGER IF EXISTS message_ad"))
+    connection.execute(text("DROP TRIGGER IF EXISTS message_au"))
+    if inspect(connection).has_table("message_fts"):
+        connection.execute(text("INSERT INTO message_fts (message_fts) VALUES ('rebuild')"))
+
+def _add_message_usage_columns(connection) -> None:
+    """messages にモデル名・トークン数・レイテンシの列を追加する (usage_rollups は _create_schema で作成される)"""
+    if not inspect(connection).has_table("messages"): # まだ無ければ _create_schema が最新の形で作る
+        return
+    existing = {column["name"] for column in inspect(connection).get_columns("messages")}
+    for name, column_type in [("model_name", "VARCHAR"), ("prompt_tokens", "INTEGER"), ("output_tokens", "INTEGER"),
+                              ("total_tokens", "INTEGER"), ("time_to_first_token_ms", "FLOAT"), ("latency_ms", "FLOAT")]:
+        if name not in existing:
+            connection.execute(text(f"ALTER TABLE messages ADD COLUMN {name} {column_type}"))
+
+def _add_thread_branch_columns(connection) -> None:
+    """threads に分岐元のスレッドと分岐点のメッセージの列を追加する"""
+    if not inspect(connection).has_table("threads"):
+        return
+    existing = {column["name"] for column in inspect(connection).get_columns("threads")}
+    if "parent_thread_id" not in existing:
+        connection.execute(text("ALTER TABLE threads ADD COLUMN parent_thread_id INTEGER REFERENCES threads (id)"))
+    if "branch_message_id" not in existing:
+        connection.execute(text("ALTER TABLE threads ADD COLUMN branch_message_id INTEGER"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_threads_parent_thread_id ON threads (parent_thread_id)"))
+
+def _add_thread_archived_column(connection) -> None:
+    """threads にコールドアーカイブに移した日時の列を追加する (archived_attachments は _create_schema で作成される)"""
+    if not inspect(connection).has_table("threads"):
+        return
+    existing = {column["name"] for column in inspect(connection).get_columns("threads")}
+    if "archived_at" not in existing:
+        connection.execute(text("ALTER TABLE threads ADD COLUMN archived_at DATETIME"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_threads_archived_at ON threads (archived_at)"))
+
+def _add_message_updated_column(connection) -> None:
+    """messages に変更日時の列を追加し、既存のメッセージは作成日時で埋める"""
+    if not inspect(connection).has_table("messages"):
+        return
+    existing = {column["name"] for column in inspect(connection).get_columns("messages")}
+    if "updated_at" not in existing:
+        connection.execute(text("ALTER TABLE messages ADD COLUMN updated_at DATETIME"))
+        # 古い更新トリガーは全ての列の更新で FTS の行を作り直すため、埋める前に外す (_create_schema で作り直される)
+        connection.execute(text("DROP TRIGGER IF EXISTS message_au"))
+        connection.execute(text("UPDATE messages SET updated_at = created_at"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_updated_at ON messages (updated_at)"))
+
+def _rebuild_autoincrement_tables(connection) -> None:
+    """
+    AUTOINCREMENT を指定したテーブル (threads, messages, attachments) のうち、指定する前に作られたものを作り直す。
+    通常の rowid のテーブルでは最大の ID の行を削除するとその ID が再利用され、
+    コールドアーカイブから元の ID のまま戻すときに衝突するため。sqlite_sequence は作り直しで MAX(id) から始まる。
+    """
+    from sqlalchemy import MetaData
+    from sqlalchemy.schema import CreateTable
+    targets = [table for table in Base.metadata.sorted_tables if table.kwargs.get("sqlite_autoincrement")]
+    legacy = []
+    for table in targets:
+        sql = connection.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                                 {"name": table.name}).scalar()
+        if sql is not None and "AUTOINCREMENT" not in sql.upper():
+            legacy.append(table)
+    if not legacy:
+        return
+    # 子テーブルの外部キーの動作 (ON DELETE CASCADE) を止めて作り直す。PRAGMA foreign_keys はトランザクションの外でのみ変更できる
+    connection.commit()
+    connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+    try:
+        # トリガーは作り直す途中のテーブルを参照していると名前の変更に失敗するため、全て削除する (_create_schema で作成される)
+        for (name,) in connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger'")).all():
+            connection.execute(text(f"DROP TRIGGER {name}"))
+        copied = MetaData()
+        for table in Base.metadata.sorted_tables:
+            table.to_metadata(copied)
+        for table in legacy:
+            new_name = f"{table.name}__autoincrement"
+            new_table = copied.tables[table.name].to_metadata(copied, name=new_name)
+            existing = {column["name"] for column in inspect(connection).get_columns(table.name)}
+            columns = ", ".join(column.name for column in table.columns if column.name in existing)
+            connection.execute(CreateTable(new_table))
+            connection.execute(text(f"INSERT INTO {new_name} ({columns}) SELECT {columns} FROM {table.name}"))
+            # インデックスはテーブルとともに削除されるため、名前を戻してから作り直す
+            connection.execute(text(f"DROP TABLE {table.name}"))
+            connection.execute(text(f"ALTER TABLE {new_name} RENAME TO {table.name}"))
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+            log.info(f"init_db: Rebuilt table {table.name} with AUTOINCREMENT.")
+        connection.commit()
+    except Exception:
+        connection.rollback() # 外部キーを戻す前にトランザクションを終える
+        raise
+    finally:
+        connection.exec_driver_sql("PRAGMA foreign_keys=ON")
+
+def _add_comparison_usage_rollups(connection) -> None:
+    """モデル比較の採用されなかった回答の使用量を usage_rollups に加算する (それまでは採用した回答だけを集計していた)"""
+    if not (inspect(connection).has_table("usage_rollups") and inspect(connection).has_table("model_comparison_answers")):
+        return
+    from database.crud import ADD_COMPARISON_USAGE_ROLLUPS_SQL # crud はこのモジュールを読み込むため、ここで読み込む
+    connection.execute(text(ADD_COMPARISON_USAGE_ROLLUPS_SQL))
+
+def _recreate_fts_update_trigger(connection) -> None:
+    """
+    FTS の更新トリガーを content の更新時だけ発火するものに作り直す (_create_schema で作成される)。
+    updated_at・使用量などの更新のたびに FTS の行を削除・再挿入しないため。
+    """
+    connection.execute(text("DROP TRIGGER IF EXISTS message_au"))
+
+def _add_export_overlap_column(connection) -> None:
+    """export_watermarks に、到達点の直前に出力した行のキーの列を追加する"""
+    if not inspect(connection).has_table("export_watermarks"):
+        return
+    existing = {column["name"] for column in inspect(connection).get_columns("export_watermarks")}
+    if "overlap_keys" not in existing:
+        connection.execute(text("ALTER TABLE export_watermarks ADD COLUMN overlap_keys TEXT"))
+
+# バージョン番号 -> そのバージョンへ移行する関数 (引数は Connection)
+_MIGRATIONS: dict = {3: _migrate_fts_triggers, 4: _add_message_usage_columns, 5: _add_thread_branch_columns,
+                     8: _add_thread_archived_column, 9: _add_message_updated_column,
+                     11: _rebuild_autoincrement_tables, 13: _add_comparison_usage_rollups,
+                     14: _recreate_fts_update_trigger, 15: _add_export_overlap_column}
+
+# 起動時の確認 (1文): スキーマバージョン、FTS の INSERT トリガーの有無、messages の有無
+# 一括インポート (database.bulk) はトリガーを外して取り込むため、強制終了されるとトリガーが無いまま残る
+_STARTUP_CHECK_SQL = ("SELECT (SELECT user_version FROM pragma_user_version), "
+                      "EXISTS (SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'message_ai'), "
+                      "EXISTS (SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages')")
+
+def _repair_fts_index(connection) -> None:
+    """
+    外れたままの FTS の INSERT トリガーを戻し、索引を messages から作り直す。
+    中断したインポートを再開したときに同じメッセージを二重に索引付けしないよう、その記録の索引済みの位置も進める。
+    """
+    connection.execute(text(FTS_INSERT_TRIGGER_DDL))
+    connection.execute(text("INSERT INTO message_fts (message_fts) VALUES ('rebuild')"))
+    if inspect(connection).has_table("import_checkpoints"):
+        connection.execute(text(
+            "UPDATE import_checkpoints SET state = json_set(state, '$.fts_indexed_upto', "
+            "(SELECT COALESCE(MAX(id), 0) FROM messages)) WHERE json_extract(state, '$.completed') = 0"))
+
+# このプロセスで初期化済みの Engine (Streamlit の再実行ごとに DB を確認しないため)
+_initialized_engines: "weakref.WeakSet[Engine]" = weakref.WeakSet()
+_init_lock = threading.Lock()
+
+def init_db(bind: Engine | None = None):
+    """
+    データベースを初期化し、通常のテーブルと FTS 関連を作成します。
+
+    初期化はプロセスごと・スキーマバージョンごとに1回だけ行われます。
+    - 同じプロセスで2回目以降の呼び出しは DB に接続せずに戻ります。
+    - DB の PRAGMA user_version が SCHEMA_VERSION 以上なら DDL を一切実行しません
+      (中断した一括インポートが FTS のトリガーを外したまま残した場合だけ、トリガーを戻して索引を作り直します)。
+
+    Args:
+        bind: 初期化する Engine。省略時はアプリの DB。
+    """
     import models.models # <-- モデル定義モジュールをここでインポート
-    
-    log.debug("init_db: Starting database initialization.")
-    log.debug(f"init_db: Tables known by Base.metadata before create_all: {Base.metadata.tables.keys()}")
-
-    with engine.connect() as connection:
-        # 同じ接続/トランザクション内で全ての DDL を実行
-        log.debug("init_db: Starting transaction.")
-        try:
-            # テーブルの存在確認
-            inspector = inspect(engine)
-            existing_tables = inspector.get_table_names()
-            log.debug(f"init_db: Existing tables: {existing_tables}")
-            
-            # 'projects'テーブルが既に存在する場合はスキップ
-            if 'projects' in existing_tables:
-                log.info("init_db: Projects table already exists, skipping table creation.")
-            else:
-                # 1. SQLAlchemy のモデルに基づいて通常のテーブルを作成
-                log.debug("init_db: Calling Base.metadata.create_all...")
-                Base.metadata.create_all(bind=connection) # ここで connection を渡す
-                log.debug("init_db: Base.metadata.create_all finished.")
-
-            # 2. FTS 仮想テーブルとトリガーを直接作成
-            log.debug("init_db: Creating FTS table...")
-            # FTS5 仮想テーブル
-            connection.execute(text("""
-            CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
-                content, 
-                content='messages', 
-                content_rowid='id',
-                tokenize = 'unicode61 remove_diacritics 2' -- Use built-in tokenizer
-            );
-            """))
-            log.debug("init_db: FTS table created (or already exists).")
-
-            log.debug("init_db: Creating INSERT trigger...")
-            # トリガー: INSERT
-            connection.execute(text("""
-            CREATE TRIGGER IF NOT EXISTS message_ai AFTER INSERT ON messages BEGIN
-                INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content);
-            END;
-            """))
-            log.debug("init_db: INSERT trigger created (or already exists).")
-
-            log.debug("init_db: Creating DELETE trigger...")
-            # トリガー: DELETE
-            connection.execute(text("""
-            CREATE TRIGGER IF NOT EXISTS message_ad AFTER DELETE ON messages BEGIN
-                DELETE FROM message_fts WHERE rowid=old.id;
-            END;
-            """))
-            log.debug("init_db: DELETE trigger created (or already exists).")
-            
-            log.debug("init_db: Creating UPDATE trigger...")
-            # トリガー: UPDATE
-            connection.execute(text("""
-            CREATE TRIGGER IF NOT EXISTS message_au AFTER UPDATE ON messages BEGIN
-                UPDATE message_fts SET content=new.content WHERE rowid=old.id;
-            END;
-            """))
-            log.debug("init_db: UPDATE trigger created (or already exists).")
-            
-            # トランザクションをコミット
-            log.debug("init_db: Committing transaction...")
-            connection.commit()
-            log.debug("init_db: Transaction committed.")
-
-        except Exception as e:
-            log.error(f"init_db: Error during initialization: {e}", exc_info=True)
-            raise # エラーを再発生させる
-        finally:
-             log.debug("init_db: Transaction finished (committed or rolled back).")
-
-    # TODOs は一旦削除 (必要なら後で復活)
-    # # TODO: Import all modules here ...
-    # # import models.models ...
-    # # TODO: Add any additional ...
-    # # TODO: Return a result ...
-
-    log.debug("init_db: Database initialization finished successfully.")
-    return True # Placeholder return, actual implementation needed
+    target = bind if bind is not None else engine
+
+    if target in _initialized_engines:
+        return True
+
+    with _init_lock:
+        if target in _initialized_engines:
+            return True
+
+        started = time.perf_counter()
+        with target.connect() as connection:
+            try:
+                current_version, has_fts_trigger, has_messages = connection.exec_driver_sql(_STARTUP_CHECK_SQL).one()
+                current_version = current_version or 0
+                needs_fts_repair = has_messages and not has_fts_trigger
+                if current_version >= SCHEMA_VERSION:
+                    if needs_fts_repair:
+                        log.warning("init_db: FTS insert trigger is missing (interrupted bulk import?), rebuilding the index.")
+                        _repair_fts_index(connection)
+                        connection.commit()
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                    log.info(f"init_db: Schema version {current_version} is current, skipped DDL ({elapsed_ms:.1f} ms).")
+                else:
+                    is_new_database = not inspect(connection).has_table("projects")
+                    log.info(f"init_db: Upgrading schema from version {current_version} to {SCHEMA_VERSION} "
+                             f"({'new database' if is_new_database else 'existing database'}).")
+                    # 新規 DB は _create_schema で最新の形になるので、移行手順は既存 DB のみ
+                    if not is_new_database:
+                        for version in range(current_version + 1, SCHEMA_VERSION + 1):
+                            migration = _MIGRATIONS.get(version)
+                            if migration is not None:
+                                log.info(f"init_db: Applying migration to version {version}...")
+                                migration(connection)
+                    _create_schema(connection)
+                    if needs_fts_repair:
+                        log.warning("init_db: FTS insert trigger was missing (interrupted bulk import?), rebuilding the index.")
+                        _repair_fts_index(connection)
+                    connection.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                    connection.commit()
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                    log.info(f"init_db: Schema is now version {SCHEMA_VERSION} ({elapsed_ms:.1f} ms).")
+            except Exception as e:
+                connection.rollback()
+                log.error(f"init_db: Error during initialization: {e}", exc_info=True)
+                raise # エラーを再発生させる
+
+        _initialized_engines.add(target)
+    return True
@@ -0,0 +1,303 @@
+"""
+プロジェクトごとの SQLite ファイルへの分割保存 (DB_SHARDING=1 で有効)。
+
+- カタログ (従来の gemini_chat.db) にはプロジェクトの一覧だけを置き、スレッド・メッセージ・添付ファイルなどは
+  プロジェクトごとの DB (SHARD_DIR/project_<ID>.db) に保存します。プロジェクトの DB にはプロジェクトの行の写しも置きます。
+- スレッド・メッセージ・添付ファイルの ID はプロジェクトごとの範囲 (SHARD_ID_SPAN) から採番するため、
+  ID だけでどのプロジェクトの DB にあるか分かります (project_id_for_record)。
+- 別のプロジェクトへの書き込みは別のファイルのロックを取るため並列に実行でき、大きなプロジェクトの FTS の更新が
+  小さなプロジェクトを待たせません。プロジェクトの削除はファイルを消すだけです。
+- 全プロジェクトの検索は各 DB で並列に実行し、結果を新しい順に合わせます。
+
+有効にする前の DB にあるスレッドはカタログに残り、分割保存の画面・API からは見えません (移行は行いません)。
+"""
+import os
+import heapq
+import functools
+import logging
+import threading
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from sqlalchemy import create_engine, select, text, exists
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from database.database import init_db
+
+log = logging.getLogger(__name__)
+
+# 分割保存の設定 (環境変数で上書き可能)
+DB_SHARDING = os.getenv("DB_SHARDING", "0").lower() in ("1", "true", "yes") # プロジェクトごとの DB に分割して保存する
+SHARD_DIR = os.getenv("SHARD_DIR", "shards") # プロジェクトごとの DB を置くディレクトリ
+SHARD_MAX_OPEN = int(os.getenv("SHARD_MAX_OPEN", "64")) # 開いておく DB の最大数 (超えたら最近使っていないものを閉じる)
+SHARD_FAN_OUT_WORKERS = int(os.getenv("SHARD_FAN_OUT_WORKERS", "8")) # 全プロジェクトの検索を並列に実行するスレッド数
+
+# プロジェクトの DB ごとの ID の範囲。プロジェクト ID * SHARD_ID_SPAN + 1 から採番する
+SHARD_ID_SPAN = 2 ** 32
+# 範囲から採番するテーブル (モデルで sqlite_autoincrement を指定し、sqlite_sequence に範囲の先頭を登録する)
+SHARDED_SEQUENCES = ("threads", "messages", "attachments")
+
+def project_id_for_record(record_id: int) -> int:
+    """分割保存のスレッド・メッセージ・添付ファイルの ID から、それを保存しているプロジェクトの ID を求めます。"""
+    return (record_id - 1) // SHARD_ID_SPAN
+
+class _SharedBlobStore:
+    """他のプロジェクトの DB がまだ参照しているファイルは削除しない BlobStore (未参照の添付ファイルの削除用)"""
+
+    def __init__(self, store, router: "ShardRouter"):
+        self._store = store
+        self._router = router
+
+    def delete(self, digest: str) -> bool:
+        if self._router.blob_in_use(digest):
+            return False
+        return self._store.delete(digest)
+
+    def __getattr__(self, name):
+        return getattr(self._store, name)
+
+class _ShardSession(Session):
+    """閉じたときにプロジェクトの DB の Engine の利用を返却するセッション (返却するまで Engine は閉じられない)"""
+
+    def __init__(self, release: Callable[[], None], **kwargs):
+        super().__init__(**kwargs)
+        self._release = release
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            release, self._release = self._release, None
+            if release is not None:
+                release()
+
+class ShardRouter:
+    """
+    プロジェクト ID (またはスレッド・メッセージ・添付ファイルの ID) から、そのプロジェクトの DB のセッションを返します。
+
+    プロジェクトの DB は初めて使うときにカタログのプロジェクトの行から作成し、SHARD_MAX_OPEN 個まで Engine を開いておきます。
+    セッションが開いている Engine は閉じず、上限を超えた分は最後のセッションが閉じられたときに閉じます。
+    カタログに無いプロジェクトを指定した場合は LookupError を送出します。
+    """
+
+    def __init__(self, catalog_engine: Engine, shard_dir: str = SHARD_DIR,
+                 max_open: int = SHARD_MAX_OPEN, fan_out_workers: int = SHARD_FAN_OUT_WORKERS):
+        self.catalog_engine = catalog_engine
+        self.CatalogSession = sessionmaker(autocommit=False, autoflush=False, bind=catalog_engine)
+        self.shard_dir = shard_dir
+        self.max_open = max(1, max_open)
+        self.fan_out_workers = max(1, fan_out_workers)
+        self._engines: OrderedDict[int, Engine] = OrderedDict() # プロジェクト ID -> Engine (最近使った順)
+        self._sessions: dict[int, int] = {} # プロジェクト ID -> 開いているセッションの数
+        self._lock = threading.Lock()
+
+    # --- ルーティング ---
+    def shard_path(self, project_id: int) -> str:
+        return os.path.join(self.shard_dir, f"project_{int(project_id)}.db")
+
+    def engine_for(self, project_id: int) -> Engine:
+        """プロジェクトの DB の Engine を返します (無ければ作成します)。"""
+        with self._lock:
+            return self._engine_locked(project_id)
+
+    def _engine_locked(self, project_id: int) -> Engine:
+        engine = self._engines.get(project_id)
+        if engine is not None:
+            self._engines.move_to_end(project_id)
+            return engine
+        project = self._catalog_project(project_id)
+        if project is None:
+            raise LookupError(f"プロジェクトが見つかりません (ID: {project_id})")
+        os.makedirs(self.shard_dir, exist_ok=True)
+        engine = create_engine(f"sqlite:///{self.shard_path(project_id)}", connect_args={"check_same_thread": False})
+        init_db(bind=engine)
+        self._prepare(engine, project)
+        self._engines[project_id] = engine
+        self._evict_idle_locked()
+        return engine
+
+    def _evict_idle_locked(self) -> None:
+        """上限を超えた分を、最近使っていない順にセッションの開いていない Engine から閉じます。"""
+        idle = [project_id for project_id in self._engines if not self._sessions.get(project_id)]
+        for project_id in idle[:max(0, len(self._engines) - self.max_open)]:
+            self._engines.pop(project_id).dispose()
+
+    def session_for_project(self, project_id: int) -> Session:
+        with self._lock:
+            engine = self._engine_locked(project_id)
+            self._sessions[project_id] = self._sessions.get(project_id, 0) + 1
+        return _ShardSession(functools.partial(self._release, project_id), bind=engine, autoflush=False)
+
+    def _release(self, project_id: int) -> None:
+        with self._lock:
+            remaining = self._sessions.get(project_id, 0) - 1
+            if remaining > 0:
+                self._sessions[project_id] = remaining
+            else:
+                self._sessions.pop(project_id, None)
+            self._evict_idle_locked()
+
+    def session_for_record(self, record_id: int) -> Session:
+        """スレッド・メッセージ・添付ファイルの ID から、それを保存しているプロジェクトの DB のセッションを返します。"""
+        return self.session_for_project(project_id_for_record(record_id))
+
+    def project_ids(self) -> list[int]:
+        """DB が作成済みのプロジェクトの ID (カタログにあるもの)。"""
+        from models.models import Project
+        with self.catalog_engine.connect() as connection:
+            project_ids = connection.execute(select(Project.id).order_by(Project.id)).scalars().all()
+        return [project_id for project_id in project_ids if os.path.exists(self.shard_path(project_id))]
+
+    def _catalog_project(self, project_id: int) -> dict | None:
+        from models.models import Project
+        with self.catalog_engine.connect() as connection:
+            row = connection.execute(select(Project.__table__).where(Project.id == project_id)).first()
+        return dict(row._mapping) if row is not None else None
+
+    def _prepare(self, engine: Engine, project: dict) -> None:
+        """ID の範囲を登録し、プロジェクトの行を写します (何度実行しても同じ結果になる)。"""
+        from models.models import Project
+        with engine.begin() as connection:
+            for table in SHARDED_SEQUENCES:
+                connection.execute(text("INSERT INTO sqlite_sequence (name, seq) SELECT :name, :seq "
+                                        "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)"),
+                                   {"name": table, "seq": project["id"] * SHARD_ID_SPAN})
+            statement = sqlite_insert(Project).values(**project)
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=[Project.id], set_={key: value for key, value in project.items() if key != "id"}))
+
+    # --- プロジェクトの操作 (カタログとプロジェクトの DB の両方を更新する) ---
+    def create_project(self, name: str, system_prompt: str):
+        """プロジェクトをカタログに作成し、プロジェクトの DB も作成します。crud.create_project と同じく、失敗時は None。"""
+        from database import crud
+        db = self.CatalogSession()
+        try:
+            project = crud.create_project(db, name, system_prompt)
+        finally:
+            db.close()
+        if project is not None:
+            self.engine_for(project.id)
+        return project
+
+    def update_project(self, project_id: int, new_name: str, new_system_prompt: str) -> bool:
+        """カタログのプロジェクトを更新し、プロジェクトの DB の写しにも反映します。"""
+        from database import crud
+        db = self.CatalogSession()
+        try:
+            updated = crud.update_project(db, project_id, new_name, new_system_prompt)
+        finally:
+            db.close()
+        if updated:
+            project = self._catalog_project(project_id)
+            if project is not None:
+                self._prepare(self.engine_for(project_id), project)
+        return updated
+
+    def delete_project(self, project_id: int) -> bool:
+        """カタログからプロジェクトを削除し、プロジェクトの DB とそのアーカイブのファイルを消します (行ごとの削除は行いません)。"""
+        from database import crud
+        from database.archive import dispose_archive
+        db = self.CatalogSession()
+        try:
+            deleted = crud.delete_project(db, project_id)
+        finally:
+            db.close()
+        if deleted:
+            with self._lock:
+                engine = self._engines.pop(project_id, None)
+            if engine is not None:
+                engine.dispose()
+            path = self.shard_path(project_id)
+            for file_path in (path, dispose_archive(path)):
+                for suffix in ("", "-wal", "-shm", "-journal"):
+                    try:
+                        os.remove(file_path + suffix)
+                    except FileNotFoundError:
+                        pass
+            log.info(f"プロジェクト ID {project_id} の DB ({path}) を削除しました。")
+        return deleted
+
+    # --- 全プロジェクトへの問い合わせ ---
+    def fan_out(self, fn: Callable[[Session], object]) -> list:
+        """
+        fn(db) を全プロジェクトの DB で並列に実行し、結果をプロジェクト ID の順に返します。
+        実行中に削除されたプロジェクトの結果は含めません。
+        """
+        missing = object()
+        def call(project_id: int):
+            try:
+                db = self.session_for_project(project_id)
+            except LookupError:
+                return missing
+            try:
+                return fn(db)
+            finally:
+                db.close()
+        project_ids = self.project_ids()
+        if not project_ids:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.fan_out_workers, len(project_ids)),
+                                thread_name_prefix="shard-fan-out") as pool:
+            return [result for result in pool.map(call, project_ids) if result is not missing]
+
+    def search_messages(self, query: str, limit: int | None = None, include_archived: bool = False) -> list:
+        """crud.search_messages を全プロジェクトの DB で並列に実行し、新しい順に合わせた SearchHit のリストを返します。"""
+        from database import crud
+        results = self.fan_out(lambda db: crud.search_messages(db, query, limit=limit, include_archived=include_archived))
+        merged = heapq.merge(*results, key=crud.search_rank_key, reverse=True)
+        return list(itertools.islice(merged, limit))
+
+    def blob_in_use(self, digest: str) -> bool:
+        """いずれかのプロジェクトの DB (またはカタログ) に、この内容の添付ファイルの行があるか。"""
+        from models.models import Attachment
+        def has_blob(db: Session) -> bool:
+            return db.query(exists().where(Attachment.sha256 == digest)).scalar()
+        catalog = self.CatalogSession()
+        try:
+            if has_blob(catalog):
+                return True
+        finally:
+            catalog.close()
+        return any(self.fan_out(has_blob))
+
+    def shared_blob_store(self, store) -> _SharedBlobStore:
+        """他のプロジェクトの DB が参照しているファイルを消さないように store を包みます。"""
+        return _SharedBlobStore(store, self)
+
+    def close(self) -> None:
+        with self._lock:
+            engines, self._engines = list(self._engines.values()), OrderedDict()
+        for engine in engines:
+            engine.dispose()
+
+# プロセス全体で共有するルーター
+_router: ShardRouter | None = None
+_router_lock = threading.Lock()
+
+def get_shard_router() -> ShardRouter | None:
+    """共有の ShardRouter を返します。DB_SHARDING が無効な場合は None。"""
+    global _router
+    if not DB_SHARDING:
+        return None
+    with _router_lock:
+        if _router is None:
+            from database.database import engine
+            _router = ShardRouter(engine)
+        return _router
+
+def open_session(project_id: int | None = None, record_id: int | None = None) -> Session:
+    """
+    プロジェクト (またはスレッド・メッセージ・添付ファイルの ID) のデータを読み書きするセッションを返します。
+    DB_SHARDING が無効な場合と、どちらも指定しない場合は従来の DB (カタログ) のセッションです。
+    """
+    router = get_shard_router()
+    if router is not None and project_id is not None:
+        return router.session_for_project(project_id)
+    if router is not None and record_id is not None:
+        return router.session_for_record(record_id)
+    from database.database import SessionLocal
+    return SessionLocal()
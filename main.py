@@ -1,5 +1,70 @@
-def main():
-    print("Hello from gemini-blog-sample!")
+"""
+コマンドラインのエントリーポイント。
+
+    python main.py serve [--host 127.0.0.1] [--port 8000] [--workers 1]   # HTTP/SSE API サーバーを起動
+    python main.py batch prompts.jsonl --project "My Project"             # プロンプトファイルを一括実行 (再実行で再開)
+"""
+import sys
+import json
+import argparse
+
+def serve(args: argparse.Namespace) -> None:
+    import uvicorn
+    from utils.logging_setup import setup_logging
+
+    setup_logging()
+    # uvicorn 自身のログ設定は使わず、アプリのログ設定 (キュー経由の出力) に任せる
+    uvicorn.run("api.server:app", host=args.host, port=args.port, workers=args.workers,
+                log_config=None, access_log=args.access_log)
+
+def batch(args: argparse.Namespace) -> None:
+    from database.database import init_db, SessionLocal
+    from utils.batch_runner import BatchRunner, resolve_project_id, default_summary_path
+    from utils.logging_setup import setup_logging
+
+    setup_logging()
+    init_db()
+    db = SessionLocal()
+    try:
+        project_id = resolve_project_id(db, args.project)
+    finally:
+        db.close()
+    if project_id is None:
+        sys.exit(f"プロジェクトが見つかりません: {args.project}")
+
+    runner = BatchRunner(project_id, args.model, concurrency=args.concurrency)
+    summary = runner.run(args.prompts, state_path=args.state)
+    summary_path = args.summary or default_summary_path(args.prompts)
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    # 失敗があれば cron などで検知できるよう終了コードを 1 にする
+    if summary["failed"]:
+        sys.exit(1)
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Gemini Search Chat のコマンドラインツール")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="HTTP/SSE API サーバーを起動します")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--workers", type=int, default=1, help="ワーカープロセス数 (CPU コアごとに1つが目安)")
+    serve_parser.add_argument("--access-log", action="store_true", help="リクエストごとのアクセスログを出力する")
+    serve_parser.set_defaults(func=serve)
+
+    from utils.batch_runner import BATCH_CONCURRENCY
+    batch_parser = subparsers.add_parser("batch", help="プロンプトファイル (JSONL / CSV) をプロジェクトで一括実行します")
+    batch_parser.add_argument("prompts", help="プロンプトファイルのパス (.jsonl または .csv)")
+    batch_parser.add_argument("--project", required=True, help="プロジェクト名または ID")
+    batch_parser.add_argument("--model", default="gemini-2.0-flash", help="使用するモデル")
+    batch_parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="同時に実行するプロンプト数")
+    batch_parser.add_argument("--state", default=None, help="チェックポイントのパス (既定: <prompts>.batch-state.jsonl)")
+    batch_parser.add_argument("--summary", default=None, help="集計結果の出力先 (既定: <prompts>.batch-summary.json)")
+    batch_parser.set_defaults(func=batch)
+
+    args = parser.parse_args(argv)
+    args.func(args)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,5 @@
 import datetime
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, Date, ForeignKey, Float, Boolean, UniqueConstraint
 from sqlalchemy.orm import relationship
 from database.database import Base
 
@@ -18,12 +18,20 @@ class Project(Base):
 class Thread(Base):
     """チャットスレッドを表すモデル"""
     __tablename__ = "threads"
+    # ID を再利用しない (AUTOINCREMENT)。分割保存 (database.sharding) ではプロジェクトごとの ID の範囲から採番する
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = Column(Integer, primary_key=True, index=True)
     project_id = Column(Integer, ForeignKey("projects.id"), nullable=False)
     name = Column(String, nullable=False, default="New Thread")
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, index=True)
+    # 分岐 (フォーク) したスレッドの場合、分岐元のスレッドと分岐点のメッセージ。
+    # 分岐元の branch_message_id までのメッセージはコピーせずに共有する (crud.get_thread_history で解決)
+    parent_thread_id = Column(Integer, ForeignKey("threads.id"), nullable=True, index=True)
+    branch_message_id = Column(Integer, nullable=True)
+    # コールドアーカイブ (database.archive) に移したスレッドの場合、移した日時。メッセージはアーカイブにあり、開くと戻す
+    archived_at = Column(DateTime, nullable=True, index=True)
 
     project = relationship("Project", back_populates="threads")
     messages = relationship("Message", back_populates="thread", cascade="all, delete-orphan")
@@ -31,14 +39,148 @@ class Thread(Base):
 class Message(Base):
     """チャットメッセージを表すモデル"""
     __tablename__ = "messages"
+    # ID を再利用しない (AUTOINCREMENT)。分割保存 (database.sharding) ではプロジェクトごとの ID の範囲から採番する
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = Column(Integer, primary_key=True, index=True)
-    thread_id = Column(Integer, ForeignKey("threads.id"), nullable=False)
+    thread_id = Column(Integer, ForeignKey("threads.id"), nullable=False, index=True)
     role = Column(String, nullable=False) # 'user' or 'assistant'
     content = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # 内容やスレッドを変更した日時 (比較回答の採用・分岐先への引き継ぎなど。増分エクスポートで変更行を範囲検索するため)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, index=True)
+    # アシスタントの応答の生成に使ったモデルと使用量・レイテンシ (ユーザーのメッセージや記録前の応答では NULL)
+    model_name = Column(String, nullable=True)
+    prompt_tokens = Column(Integer, nullable=True)
+    output_tokens = Column(Integer, nullable=True)
+    total_tokens = Column(Integer, nullable=True)
+    time_to_first_token_ms = Column(Float, nullable=True)
+    latency_ms = Column(Float, nullable=True)
 
     thread = relationship("Thread", back_populates="messages")
 
+class Tombstone(Base):
+    """削除されたプロジェクト・スレッドの記録 (増分エクスポート用)"""
+    __tablename__ = "tombstones"
+
+    id = Column(Integer, primary_key=True, index=True)
+    entity_type = Column(String, nullable=False) # 'project' or 'thread'
+    entity_id = Column(Integer, nullable=False)
+    project_id = Column(Integer, nullable=True) # スレッドの場合は所属プロジェクト ID
+    deleted_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class ExportWatermark(Base):
+    """増分エクスポートの出力先ごとの到達点 (ウォーターマーク)"""
+    __tablename__ = "export_watermarks"
+
+    target = Column(String, primary_key=True)
+    last_message_id = Column(Integer, nullable=False, default=0)
+    last_message_created_at = Column(DateTime, nullable=True)
+    last_tombstone_id = Column(Integer, nullable=False, default=0)
+    last_synced_at = Column(DateTime, nullable=True) # 読み出したメッセージ・スレッド・プロジェクトの updated_at の最大値
+    # 到達点の直前 (EXPORT_OVERLAP_SECONDS) に出力した行のキー (JSON)。読み直した重なりの分を二重に出力しないため
+    overlap_keys = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class ImportCheckpoint(Base):
+    """JSONL の一括インポート (database.bulk) の進捗。取り込んだ行と同じトランザクションで更新するため、どこで止まっても再開できる"""
+    __tablename__ = "import_checkpoints"
+
+    path = Column(String, primary_key=True) # 取り込むファイルの絶対パス
+    state = Column(Text, nullable=False) # ファイル内の位置・ID のオフセット・プロジェクトの対応などの JSON
+
+class ModelComparisonAnswer(Base):
+    """モデル比較モードで、同じプロンプトに対する1モデル分の回答と計測値"""
+    __tablename__ = "model_comparison_answers"
+
+    id = Column(Integer, primary_key=True, index=True)
+    comparison_id = Column(String, nullable=False, index=True) # 同じプロンプトの回答をまとめる ID
+    thread_id = Column(Integer, ForeignKey("threads.id", ondelete="CASCADE"), nullable=False, index=True)
+    user_message_id = Column(Integer, ForeignKey("messages.id", ondelete="CASCADE"), nullable=True)
+    assistant_message_id = Column(Integer, ForeignKey("messages.id", ondelete="SET NULL"), nullable=True) # 採用された回答を保存したメッセージ
+    model_name = Column(String, nullable=False)
+    content = Column(Text, nullable=False, default="")
+    error = Column(Text, nullable=True)
+    time_to_first_token_ms = Column(Float, nullable=True)
+    latency_ms = Column(Float, nullable=True)
+    prompt_tokens = Column(Integer, nullable=True)
+    output_tokens = Column(Integer, nullable=True)
+    total_tokens = Column(Integer, nullable=True)
+    adopted = Column(Boolean, nullable=False, default=False) # スレッドの応答として採用されているか
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class UsageRollup(Base):
+    """
+    日・プロジェクト・スレッド・モデルごとのトークン使用量とレイテンシの集計 (応答を保存するたびに加算する)。
+    スレッドやプロジェクトを削除しても使用量は残すため、外部キーは付けていない。
+    """
+    __tablename__ = "usage_rollups"
+    __table_args__ = (UniqueConstraint("day", "project_id", "thread_id", "model_name", name="uq_usage_rollups_key"),)
+
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False, index=True) # メッセージの作成日 (UTC)
+    project_id = Column(Integer, nullable=False, index=True)
+    thread_id = Column(Integer, nullable=False)
+    model_name = Column(String, nullable=False)
+    message_count = Column(Integer, nullable=False, default=0)
+    timed_message_count = Column(Integer, nullable=False, default=0) # レイテンシを計測できたメッセージ数 (平均の分母)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    output_tokens = Column(Integer, nullable=False, default=0)
+    total_tokens = Column(Integer, nullable=False, default=0)
+    time_to_first_token_ms_sum = Column(Float, nullable=False, default=0.0)
+    latency_ms_sum = Column(Float, nullable=False, default=0.0)
+
+class Attachment(Base):
+    """
+    添付ファイル。内容は SHA-256 のハッシュをキーに utils.blob_store に1つだけ保存し、
+    メッセージからは message_attachments で参照する (同じファイルを何度添付しても1行)。
+    """
+    __tablename__ = "attachments"
+    # ID を再利用しない (AUTOINCREMENT)。分割保存 (database.sharding) ではプロジェクトごとの ID の範囲から採番する
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(String, nullable=False, unique=True)
+    size_bytes = Column(Integer, nullable=False)
+    mime_type = Column(String, nullable=False)
+    filename = Column(String, nullable=False) # 最初に添付されたときのファイル名
+    ref_count = Column(Integer, nullable=False, default=0) # 参照しているメッセージ数 (message_attachments のトリガーで更新)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.datetime.utcnow) # 最後に保存・添付された日時 (未参照のファイルを消すまでの猶予の起点)
+    # Gemini の Files API にアップロード済みのファイル (期限内なら再アップロードせずに再利用する)
+    gemini_file_name = Column(String, nullable=True)
+    gemini_file_uri = Column(String, nullable=True)
+    gemini_file_expires_at = Column(DateTime, nullable=True)
+
+class MessageAttachment(Base):
+    """メッセージと添付ファイルの対応 (メッセージが削除されると行も削除され、attachments.ref_count が減る)"""
+    __tablename__ = "message_attachments"
+
+    message_id = Column(Integer, ForeignKey("messages.id", ondelete="CASCADE"), primary_key=True)
+    attachment_id = Column(Integer, ForeignKey("attachments.id"), primary_key=True, index=True)
+    position = Column(Integer, nullable=False, default=0) # メッセージ内での順番
+
+class ArchivedAttachment(Base):
+    """
+    コールドアーカイブに移したメッセージの添付ファイルの参照 (message_attachments の行をスレッドごと移したもの)。
+    アーカイブ中も attachments.ref_count に数えるため、添付ファイルは未参照として削除されない。
+    """
+    __tablename__ = "archived_attachments"
+
+    message_id = Column(Integer, primary_key=True) # アーカイブにあるメッセージの ID
+    attachment_id = Column(Integer, ForeignKey("attachments.id"), primary_key=True, index=True)
+    thread_id = Column(Integer, ForeignKey("threads.id", ondelete="CASCADE"), nullable=False, index=True)
+    position = Column(Integer, nullable=False, default=0)
+
+class ThreadLease(Base):
+    """
+    表示中・生成中のスレッドの印 (utils.thread_sweeper が定期的に更新する)。
+    別のプロセスで実行するアーカイブ (python -m database.archive) は、expires_at を過ぎていない印のあるスレッドを移さない。
+    """
+    __tablename__ = "thread_leases"
+
+    thread_id = Column(Integer, ForeignKey("threads.id", ondelete="CASCADE"), primary_key=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
 # FTS5 テーブルは SQLAlchemy で直接モデル化せず、
 # アプリケーションコード内で直接 SQL を実行して作成・利用します。 
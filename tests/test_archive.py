@@ -0,0 +1,177 @@
+import unittest
+import sys
+import os
+import datetime
+import tempfile
+import shutil
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from database import crud
+from database.database import init_db
+from database.archive import (archive_stale_threads, restore_thread, search_archived_messages, prune_archive,
+                              archive_inactive_threads, archive_path_for, dispose_archive, lease_threads)
+from models.models import Project, Thread, Message, Attachment, ModelComparisonAnswer, UsageRollup, ThreadLease
+from utils.blob_store import BlobStore
+
+class TestColdArchive(unittest.TestCase):
+    """database.archive (使われていないスレッドのコールドアーカイブ) のテストケース"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.work_dir, "test.db")
+        self.engine = create_engine(f"sqlite:///{self.db_path}", connect_args={"check_same_thread": False})
+        init_db(bind=self.engine)
+        self.Session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        self.db = self.Session()
+        self.project = Project(name="Archive", system_prompt="prompt")
+        self.db.add(self.project)
+        self.db.commit()
+        self.now = datetime.datetime.utcnow()
+
+    def tearDown(self):
+        self.db.close()
+        dispose_archive(self.db_path)
+        self.engine.dispose()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def add_thread(self, contents: list[str], age_days: float, **fields) -> int:
+        updated_at = self.now - datetime.timedelta(days=age_days)
+        thread = Thread(project_id=self.project.id, name=f"chat {age_days}", updated_at=updated_at, **fields)
+        self.db.add(thread)
+        self.db.flush()
+        self.db.add_all([Message(thread_id=thread.id, role="user", content=content,
+                                 created_at=updated_at - datetime.timedelta(minutes=len(contents) - i))
+                         for i, content in enumerate(contents)])
+        self.db.commit()
+        return thread.id
+
+    def archive(self, days: float = 30) -> int:
+        return archive_stale_threads(self.db, self.now - datetime.timedelta(days=days))
+
+    def message_ids(self, thread_id: int) -> list[int]:
+        return [m.id for m in crud.get_thread_history(self.db, thread_id)]
+
+    def test_archive_and_restore_keeps_messages_and_ids(self):
+        old = self.add_thread(["古い質問", "古い回答"], age_days=60)
+        recent = self.add_thread(["最近の質問"], age_days=1)
+        original_ids = self.message_ids(old)
+        old_updated_at = self.db.get(Thread, old).updated_at
+
+        self.assertEqual(self.archive(), 1)
+        self.db.expire_all()
+        thread = self.db.get(Thread, old)
+        # メッセージの無いスタブとして残り、一覧の並び順 (updated_at) は変わらない
+        self.assertIsNotNone(thread.archived_at)
+        self.assertEqual(thread.updated_at, old_updated_at)
+        self.assertEqual(self.message_ids(old), [])
+        self.assertEqual(len(self.message_ids(recent)), 1)
+        self.assertIsNotNone(next(t for t in crud.list_threads(self.db, self.project.id) if t.id == old).archived_at)
+        self.assertTrue(os.path.exists(archive_path_for(self.db_path)))
+        # 通常の検索はアーカイブを対象にしない
+        self.assertEqual(crud.search_messages(self.db, "古い"), [])
+        self.assertEqual(self.archive(), 0) # アーカイブ済みのスレッドは再び移さない
+
+        self.assertTrue(restore_thread(self.db, old))
+        self.db.expire_all()
+        self.assertEqual(self.message_ids(old), original_ids)
+        self.assertIsNone(self.db.get(Thread, old).archived_at)
+        self.assertEqual(len(crud.search_messages(self.db, "古い")), 2)
+        self.assertFalse(restore_thread(self.db, old))
+        self.assertEqual(self.archive(), 0) # 開いたスレッドは使われたものとして扱う
+
+    def test_search_includes_archived_messages_only_on_request(self):
+        first = self.add_thread(["needle one", "other"], age_days=90)
+        second = self.add_thread(["needle two"], age_days=60)
+        self.add_thread(["needle hot"], age_days=1)
+        self.assertEqual(self.archive(), 2)
+
+        self.assertEqual([hit.content for hit in crud.search_messages(self.db, "needle")], ["needle hot"])
+        hits = crud.search_messages(self.db, "NEEDLE", include_archived=True)
+        self.assertEqual([hit.content for hit in hits], ["needle hot", "needle two", "needle one"])
+        self.assertEqual((hits[1].thread_id, hits[1].project_name), (second, "Archive"))
+        self.assertEqual([hit.content for hit in search_archived_messages(self.db, "needle", limit=1)], ["needle two"])
+        self.assertEqual([hit.content for hit in crud.search_messages(self.db, "needle", limit=2, include_archived=True)],
+                         ["needle hot", "needle two"])
+        self.assertEqual(search_archived_messages(self.db, "needle one missing"), [])
+        # 削除したスレッドはアーカイブに残っていても検索しない
+        crud.delete_thread(self.db, first)
+        self.assertEqual([hit.content for hit in search_archived_messages(self.db, "needle")], ["needle two"])
+
+    def test_skips_fork_parents_and_excluded_threads(self):
+        parent = self.add_thread(["q", "a"], age_days=60)
+        branch_id = self.message_ids(parent)[-1]
+        self.add_thread([], age_days=60, parent_thread_id=parent, branch_message_id=branch_id)
+        excluded = self.add_thread(["open"], age_days=60)
+        self.assertEqual(archive_stale_threads(self.db, self.now - datetime.timedelta(days=30),
+                                               exclude_thread_ids={excluded}), 0)
+        self.db.expire_all()
+        self.assertIsNone(self.db.get(Thread, parent).archived_at)
+
+    def test_attachments_comparisons_and_usage_survive_archiving(self):
+        store = BlobStore(os.path.join(self.work_dir, "attachments"))
+        attachment = crud.store_attachment(self.db, store, b"archived file", "a.txt", "text/plain")
+        thread_id = self.add_thread([], age_days=60)
+        thread = self.db.get(Thread, thread_id)
+        question = crud.add_message(self.db, thread, "user", "添付の質問", attachment_ids=[attachment.id])
+        answer = crud.add_message(self.db, thread, "assistant", "回答", model_name="gemini-2.0-flash", usage={"total_tokens": 5})
+        self.db.add(ModelComparisonAnswer(comparison_id="c1", thread_id=thread_id, user_message_id=question.id,
+                                          assistant_message_id=answer.id, model_name="gemini-2.0-flash",
+                                          content="回答", adopted=True))
+        thread.updated_at = self.now - datetime.timedelta(days=60)
+        self.db.commit()
+
+        self.assertEqual(self.archive(), 1)
+        self.db.expire_all()
+        # アーカイブ中も参照として数え、未参照の添付ファイルとして削除しない
+        self.assertEqual(self.db.get(Attachment, attachment.id).ref_count, 1)
+        self.assertEqual(crud.collect_unreferenced_attachments(self.db, store, self.now + datetime.timedelta(days=1)), 0)
+        self.assertTrue(store.exists(attachment.sha256))
+        self.assertEqual(self.db.query(ModelComparisonAnswer).count(), 0)
+        # 空チャットの掃除はアーカイブしたスレッドを消さず、使用量の集計も作り直しで消えない
+        self.assertEqual(crud.delete_stale_empty_threads(self.db, self.now + datetime.timedelta(days=1)), 0)
+        self.assertEqual(crud.delete_empty_threads_in_project(self.db, self.project.id), 0)
+        crud.rebuild_usage_rollups(self.db)
+        self.assertEqual(self.db.query(UsageRollup).one().total_tokens, 5)
+
+        self.assertTrue(restore_thread(self.db, thread_id))
+        self.db.expire_all()
+        self.assertEqual(self.db.get(Attachment, attachment.id).ref_count, 1)
+        self.assertEqual([a.id for a in crud.get_attachments_by_message(self.db, [question.id])[question.id]], [attachment.id])
+        self.assertEqual(crud.get_latest_comparison(self.db, thread_id)[0].assistant_message_id, answer.id)
+
+        # アーカイブ中に削除したスレッドの参照は解放される
+        self.assertEqual(self.archive(days=-1), 1)
+        self.assertTrue(crud.delete_thread(self.db, thread_id))
+        self.db.expire_all()
+        self.assertEqual(self.db.get(Attachment, attachment.id).ref_count, 0)
+
+    def test_archive_inactive_threads_batches_and_prunes(self):
+        thread_ids = [self.add_thread([f"message {i}"], age_days=60) for i in range(5)]
+        self.assertEqual(archive_inactive_threads(self.Session, days=30, batch_size=2), {"archived": 5, "pruned": 0})
+        crud.delete_thread(self.db, thread_ids[0])
+        self.assertEqual(prune_archive(self.db), 1)
+        self.assertEqual(len(search_archived_messages(self.db, "message")), 4)
+
+    def test_leased_threads_are_not_archived(self):
+        """別のプロセスが表示中・生成中の印を付けたスレッドは移さず、期限が切れたら移す"""
+        opened, generating, idle = [self.add_thread([f"message {i}"], age_days=60) for i in range(3)]
+        self.assertEqual(lease_threads(self.db, {opened, generating, 999}, seconds=60), 2)
+        self.assertEqual(archive_inactive_threads(self.Session, days=30), {"archived": 1, "pruned": 0})
+        self.db.expire_all()
+        self.assertEqual([t.id for t in self.db.query(Thread).filter(Thread.archived_at.isnot(None))], [idle])
+
+        # 更新しなかった印は期限切れとして消え、次の実行で移される
+        self.assertEqual(lease_threads(self.db, {opened}, seconds=-1), 1)
+        self.assertEqual(lease_threads(self.db, set(), seconds=60), 0)
+        self.assertEqual([lease.thread_id for lease in self.db.query(ThreadLease)], [generating])
+        self.assertEqual(archive_inactive_threads(self.Session, days=30)["archived"], 1)
+        self.db.expire_all()
+        self.assertIsNotNone(self.db.get(Thread, opened).archived_at)
+
+if __name__ == '__main__':
+    unittest.main()
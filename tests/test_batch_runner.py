@@ -0,0 +1,166 @@
+import unittest
+import sys
+import os
+import csv
+import json
+import tempfile
+import shutil
+import threading
+import time
+from unittest import mock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from utils.batch_runner import BatchRunner, read_prompts, resolve_project_id, default_state_path
+from database.database import init_db
+from models.models import Project, Thread, Message
+
+class FakeBatchClient:
+    """プロンプトごとに決まった応答を返し、同時実行数を記録するクライアント"""
+
+    def __init__(self, failing_prompts: tuple = (), delay: float = 0.0):
+        self.failing_prompts = failing_prompts
+        self.delay = delay
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def generate_content_stream(self, model_name, history, system_prompt=None, usage=None, **scheduling):
+        prompt = history[-1].parts[0].text
+        with self._lock:
+            self.calls.append((prompt, system_prompt))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(self.delay)
+            if prompt in self.failing_prompts:
+                raise RuntimeError("quota exceeded")
+            yield f"{prompt} への回答"
+            if usage is not None:
+                usage.update(prompt_tokens=3, output_tokens=5, total_tokens=8)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+class TestBatchRunner(unittest.TestCase):
+    """utils.batch_runner のテストケース"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.work_dir, 'test.db')}",
+                                    connect_args={"check_same_thread": False})
+        init_db(bind=self.engine)
+        self.Session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        db = self.Session()
+        project = Project(name="Batch Project", system_prompt="batch prompt")
+        db.add(project)
+        db.commit()
+        self.project_id = project.id
+        db.close()
+        # テスト中はマークダウンファイルを書き出さない
+        patcher = mock.patch("utils.batch_runner.enqueue_message_to_markdown")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def write_jsonl(self, prompts: list[str]) -> str:
+        path = os.path.join(self.work_dir, "prompts.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            for i, prompt in enumerate(prompts):
+                f.write(json.dumps({"id": f"p{i}", "prompt": prompt}, ensure_ascii=False) + "\n")
+        return path
+
+    def run_batch(self, client: FakeBatchClient, path: str, concurrency: int = 2) -> dict:
+        runner = BatchRunner(self.project_id, "test-model", concurrency=concurrency,
+                             session_factory=self.Session, client_factory=lambda: client)
+        return runner.run(path)
+
+    def threads(self) -> dict[str, list[tuple[str, str]]]:
+        db = self.Session()
+        try:
+            result = {}
+            for thread in db.query(Thread).order_by(Thread.id):
+                messages = db.query(Message).filter(Message.thread_id == thread.id).order_by(Message.id)
+                result[thread.name] = [(m.role, m.content) for m in messages]
+            return result
+        finally:
+            db.close()
+
+    def test_read_prompts_jsonl_and_csv(self):
+        """JSONL と CSV の両方を読み込み、空のプロンプトは飛ばす"""
+        jsonl_path = os.path.join(self.work_dir, "prompts.jsonl")
+        with open(jsonl_path, "w", encoding="utf-8") as f:
+            f.write('{"prompt": "質問A", "id": "a"}\n\n{"prompt": " "}\n{"prompt": "質問B", "name": "B"}\n')
+        self.assertEqual(list(read_prompts(jsonl_path)), [
+            {"key": "a", "prompt": "質問A", "name": None},
+            {"key": "line:4", "prompt": "質問B", "name": "B"},
+        ])
+
+        csv_path = os.path.join(self.work_dir, "prompts.csv")
+        with open(csv_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["id", "prompt"])
+            writer.writerow(["x", "複数行の\n質問"])
+            writer.writerow(["", "質問C"])
+        self.assertEqual([(p["key"], p["prompt"]) for p in read_prompts(csv_path)],
+                         [("x", "複数行の\n質問"), ("line:4", "質問C")])
+
+    def test_run_saves_threads_and_summary(self):
+        """プロンプトごとにスレッドを作り、システムプロンプト付きで実行して統計を返す"""
+        client = FakeBatchClient(failing_prompts=("質問2",), delay=0.05)
+        summary = self.run_batch(client, self.write_jsonl(["質問1", "質問2", "質問3", "質問4"]))
+
+        self.assertEqual((summary["total"], summary["succeeded"], summary["failed"]), (4, 3, 1))
+        self.assertEqual(summary["errors"], {"quota exceeded": 1})
+        self.assertEqual(summary["tokens"]["total_tokens"], 24)
+        self.assertGreaterEqual(summary["latency_ms"]["p50"], 50)
+        self.assertEqual(client.max_running, 2) # 同時実行数は concurrency まで
+        self.assertTrue(all(system_prompt == "batch prompt" for _, system_prompt in client.calls))
+
+        threads = self.threads()
+        self.assertEqual(threads["質問1"], [("user", "質問1"), ("assistant", "質問1 への回答")])
+        self.assertEqual(threads["質問2"], [("user", "質問2")]) # 失敗したプロンプトは質問だけ残る
+
+    def test_resume_skips_done_and_retries_failed(self):
+        """再実行では完了済みをスキップし、失敗・中断したプロンプトだけをスレッドを作り直して実行する"""
+        path = self.write_jsonl(["質問1", "質問2", "質問3"])
+        self.run_batch(FakeBatchClient(failing_prompts=("質問2",)), path)
+
+        # 質問3 の実行中にプロセスが止まった状態を再現する (finished が書かれていない)
+        state_path = default_state_path(path)
+        with open(state_path, encoding="utf-8") as f:
+            lines = [line for line in f if not ('"finished"' in line and '"p2"' in line)]
+        with open(state_path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+            f.write('{"event": "finished", "key": "p0", "sta') # 書き込み途中の行は無視される
+
+        client = FakeBatchClient()
+        summary = self.run_batch(client, path)
+        self.assertEqual(sorted(prompt for prompt, _ in client.calls), ["質問2", "質問3"])
+        self.assertEqual((summary["run_prompts"], summary["resumed_skipped"]), (2, 1))
+        self.assertEqual((summary["total"], summary["failed"]), (3, 0))
+
+        threads = self.threads()
+        self.assertEqual(len(threads), 3) # 前回のスレッドは削除されて作り直される
+        self.assertEqual(threads["質問2"], [("user", "質問2"), ("assistant", "質問2 への回答")])
+        # 途中で切れた行の後の記録も読み込める
+        self.assertEqual(self.run_batch(FakeBatchClient(), path)["resumed_skipped"], 3)
+
+    def test_resolve_project_id(self):
+        """プロジェクトは名前でも ID でも指定できる"""
+        db = self.Session()
+        self.assertEqual(resolve_project_id(db, "Batch Project"), self.project_id)
+        self.assertEqual(resolve_project_id(db, str(self.project_id)), self.project_id)
+        self.assertIsNone(resolve_project_id(db, "missing"))
+        db.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+import sys
+import os
+import io
+import tempfile
+import shutil
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from utils.blob_store import BlobStore
+
+class TestBlobStore(unittest.TestCase):
+    """utils.blob_store.BlobStore (内容アドレス方式の添付ファイルの保存先) のテストケース"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.store = BlobStore(os.path.join(self.work_dir, "attachments"))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def test_same_content_is_stored_once(self):
+        digest, size = self.store.put(b"%PDF-1.7 hello")
+        self.assertEqual(size, 14)
+        # ファイルオブジェクトから少しずつ読み込んでも同じハッシュになる
+        self.assertEqual(self.store.put(io.BytesIO(b"%PDF-1.7 hello")), (digest, 14))
+        self.assertEqual(self.store.path(digest), os.path.join(self.store.root, digest[:2], digest))
+        stored = [name for _, _, files in os.walk(self.store.root) for name in files]
+        self.assertEqual(stored, [digest]) # 一時ファイルは残らない
+
+    def test_mapped_read_and_seek(self):
+        digest, _ = self.store.put(b"0123456789")
+        with self.store.open(digest) as blob:
+            self.assertEqual(blob.read(3), b"012")
+            blob.seek(-2, io.SEEK_END)
+            self.assertEqual(blob.read(), b"89")
+            self.assertEqual(blob.tell(), 10)
+            blob.seek(4)
+            self.assertEqual(blob.read(), b"456789")
+        self.assertTrue(blob.closed)
+
+        empty, size = self.store.put(b"")
+        self.assertEqual(size, 0)
+        with self.store.open(empty) as blob:
+            self.assertEqual(blob.read(), b"")
+
+    def test_delete(self):
+        digest, _ = self.store.put(b"data")
+        self.assertTrue(self.store.delete(digest))
+        self.assertFalse(self.store.exists(digest))
+        self.assertFalse(self.store.delete(digest))
+
+if __name__ == '__main__':
+    unittest.main()
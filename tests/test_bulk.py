@@ -0,0 +1,236 @@
+import unittest
+import sys
+import os
+import json
+import datetime
+import tempfile
+import shutil
+from unittest import mock
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from database import crud
+from database.bulk import export_jsonl, import_jsonl
+from database.archive import archive_stale_threads, dispose_archive
+from database.database import init_db
+from models.models import Project, Thread, Message
+
+def create_test_engine(path: str):
+    """テーブルと FTS を持つテスト用 DB を作成する"""
+    engine = create_engine(f"sqlite:///{path}")
+    init_db(bind=engine)
+    return engine
+
+def fts_match(engine, term: str) -> set[int]:
+    with engine.connect() as connection:
+        rows = connection.execute(text("SELECT rowid FROM message_fts WHERE message_fts MATCH :term"), {"term": term})
+        return {row[0] for row in rows}
+
+class TestBulkJsonl(unittest.TestCase):
+    """database.bulk の JSONL エクスポート/インポートのテストケース"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.source = create_test_engine(os.path.join(self.work_dir, "source.db"))
+        self.target = create_test_engine(os.path.join(self.work_dir, "target.db"))
+        self.jsonl_path = os.path.join(self.work_dir, "history.jsonl")
+
+        db = sessionmaker(bind=self.source)()
+        project = Project(name="Bulk Project", system_prompt="prompt")
+        db.add(project)
+        db.commit()
+        threads = [Thread(project_id=project.id, name=f"Thread {i}") for i in range(3)]
+        db.add_all(threads)
+        db.commit()
+        for thread in threads:
+            db.add_all([
+                Message(thread_id=thread.id, role="user", content=f"bulkword question {thread.id}"),
+                Message(thread_id=thread.id, role="assistant", content=f"answer {thread.id}",
+                        model_name="flash", prompt_tokens=3, output_tokens=4, total_tokens=7, latency_ms=100.0),
+            ])
+        db.commit()
+        db.close()
+
+    def tearDown(self):
+        dispose_archive(os.path.join(self.work_dir, "source.db"))
+        self.source.dispose()
+        self.target.dispose()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def count(self, engine, table: str) -> int:
+        with engine.connect() as connection:
+            return connection.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+
+    def test_round_trip_into_empty_database(self):
+        """空の DB への取り込みでは ID が保たれ、FTS インデックスも作られる"""
+        exported = export_jsonl(self.jsonl_path, bind=self.source)
+        self.assertEqual(exported, {"projects": 1, "threads": 3, "messages": 6})
+
+        counts = import_jsonl(self.jsonl_path, bind=self.target, batch_size=2)
+        self.assertEqual(counts["messages"], 6)
+        self.assertEqual(self.count(self.target, "messages"), 6)
+        self.assertEqual(len(fts_match(self.target, "bulkword")), 3)
+        # 使用量も引き継がれ、集計 (usage_rollups) に加算される
+        with self.target.connect() as connection:
+            self.assertEqual(connection.execute(text("SELECT SUM(message_count), SUM(total_tokens) FROM usage_rollups")).one(),
+                             (3, 21))
+
+        # インポート後はトリガーが元に戻り、通常の INSERT も索引付けされる
+        with self.target.connect() as connection:
+            connection.execute(text("INSERT INTO messages (thread_id, role, content) VALUES (1, 'user', 'afterimport')"))
+            connection.commit()
+        self.assertEqual(len(fts_match(self.target, "afterimport")), 1)
+
+    def test_import_remaps_ids_and_merges_projects(self):
+        """既存データがある DB では ID が振り直され、同名プロジェクトに合流する"""
+        export_jsonl(self.jsonl_path, bind=self.source)
+        import_jsonl(self.jsonl_path, bind=self.target)
+
+        # 同じ内容をもう一度取り込む (ID は全て衝突する)
+        self.assertEqual(import_jsonl(self.jsonl_path, bind=self.target)["merged_projects"], 0) # 取り込み済み
+        counts = import_jsonl(self.jsonl_path, bind=self.target, restart=True)
+        self.assertEqual(counts["merged_projects"], 1)
+        self.assertEqual(self.count(self.target, "projects"), 1)
+        self.assertEqual(self.count(self.target, "threads"), 6)
+        self.assertEqual(self.count(self.target, "messages"), 12)
+        self.assertEqual(len(fts_match(self.target, "bulkword")), 6)
+
+    def test_forks_keep_shared_history_after_import(self):
+        """分岐したスレッドは分岐元より後に出力され、ID を振り直しても共有する履歴が保たれる"""
+        db = sessionmaker(bind=self.source)()
+        thread = db.query(Thread).order_by(Thread.id).first()
+        question, answer = db.query(Message).filter(Message.thread_id == thread.id).order_by(Message.id).all()
+        early = crud.fork_thread(db, thread.id, question.id)
+        late = crud.fork_thread(db, thread.id, answer.id)
+        crud.add_message(db, early, "user", "early follow-up")
+        # 分岐元を削除すると、ID の大きい late が early の分岐元になる
+        crud.delete_thread(db, thread.id)
+        expected = {fork.id: [m.content for m in crud.get_thread_history(db, fork.id)] for fork in (early, late)}
+        question_content = question.content
+        db.close()
+
+        export_jsonl(self.jsonl_path, bind=self.source)
+        import_jsonl(self.jsonl_path, bind=self.target)
+        counts = import_jsonl(self.jsonl_path, bind=self.target, batch_size=1, restart=True) # ID を振り直して取り込む
+        self.assertEqual(counts["threads"], 4)
+
+        db = sessionmaker(bind=self.target)()
+        thread_offset = db.query(Thread.id).order_by(Thread.id.desc()).first()[0] - late.id
+        for thread_id, contents in expected.items():
+            for imported_id in (thread_id, thread_id + thread_offset):
+                self.assertEqual([m.content for m in crud.get_thread_history(db, imported_id)], contents)
+        self.assertEqual(expected[early.id], [question_content, "early follow-up"])
+        db.close()
+
+    def test_archived_threads_keep_their_messages(self):
+        """アーカイブ中のスレッドのメッセージもアーカイブから出力し、取り込んだスレッドは空にならない"""
+        db = sessionmaker(bind=self.source)()
+        archived_id = db.query(Thread.id).order_by(Thread.id).first()[0]
+        expected = [m.content for m in crud.get_thread_history(db, archived_id)]
+        hot_ids = {thread_id for (thread_id,) in db.query(Thread.id).filter(Thread.id != archived_id)}
+        self.assertEqual(archive_stale_threads(db, datetime.datetime.utcnow() + datetime.timedelta(days=1),
+                                               exclude_thread_ids=hot_ids), 1)
+        db.close()
+
+        self.assertEqual(export_jsonl(self.jsonl_path, bind=self.source)["messages"], 6)
+        with open(self.jsonl_path, encoding="utf-8") as f:
+            threads = [record for record in map(json.loads, f) if record["type"] == "thread"]
+        self.assertEqual([record["id"] for record in threads if record["archived_at"]], [archived_id])
+
+        import_jsonl(self.jsonl_path, bind=self.target)
+        db = sessionmaker(bind=self.target)()
+        self.assertEqual([m.content for m in crud.get_thread_history(db, archived_id)], expected)
+        self.assertIsNone(db.get(Thread, archived_id).archived_at)
+        self.assertEqual(crud.delete_stale_empty_threads(db, datetime.datetime.utcnow() + datetime.timedelta(days=1)), 0)
+        db.close()
+
+    def test_import_resumes_after_failure(self):
+        """途中で失敗しても、再実行するとコミット済みの位置から再開する"""
+        export_jsonl(self.jsonl_path, bind=self.source)
+        with open(self.jsonl_path, encoding="utf-8") as f:
+            lines = f.readlines()
+        with open(self.jsonl_path, "w", encoding="utf-8") as f:
+            f.writelines(lines[:-1])
+            f.write('{"type": "message", BROKEN\n')
+
+        with self.assertRaises(json.JSONDecodeError):
+            import_jsonl(self.jsonl_path, bind=self.target, batch_size=2)
+        imported_before = self.count(self.target, "messages")
+        self.assertGreater(imported_before, 0)
+        self.assertLess(imported_before, 6)
+
+        # 壊れた行を直して再実行
+        with open(self.jsonl_path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        counts = import_jsonl(self.jsonl_path, bind=self.target, batch_size=2)
+        self.assertEqual(counts["messages"], 6)
+        self.assertEqual(self.count(self.target, "messages"), 6)
+        self.assertEqual(len(fts_match(self.target, "bulkword")), 3)
+
+    def test_import_killed_without_cleanup_is_repaired_and_resumed(self):
+        """強制終了でトリガーが戻らなくても、次の起動で索引が直り、記録した位置から二重に取り込まずに再開する"""
+        export_jsonl(self.jsonl_path, bind=self.source)
+        with open(self.jsonl_path, encoding="utf-8") as f:
+            lines = f.readlines()
+        with open(self.jsonl_path, "w", encoding="utf-8") as f:
+            f.writelines(lines[:-1])
+            f.write('{"type": "message", BROKEN\n')
+        # finally のトリガーの復元まで実行されずに終了したことにする
+        with mock.patch("database.bulk._restore_fts"):
+            with self.assertRaises(json.JSONDecodeError):
+                import_jsonl(self.jsonl_path, bind=self.target, batch_size=2)
+        self.target.dispose()
+
+        # アプリの再起動でトリガーが戻り、取り込み済みのメッセージも検索できる
+        self.target = create_test_engine(os.path.join(self.work_dir, "target.db"))
+        with self.target.connect() as connection:
+            imported = connection.execute(text("SELECT COUNT(*) FROM messages WHERE content LIKE 'bulkword%'")).scalar()
+            self.assertEqual(connection.execute(text(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name = 'message_ai'")).scalar(), 1)
+        self.assertGreater(imported, 0)
+        self.assertEqual(len(fts_match(self.target, "bulkword")), imported)
+
+        with open(self.jsonl_path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        self.assertEqual(import_jsonl(self.jsonl_path, bind=self.target, batch_size=2)["messages"], 6)
+        self.assertEqual(self.count(self.target, "messages"), 6)
+        self.assertEqual(len(fts_match(self.target, "bulkword")), 3)
+        with self.target.begin() as connection:
+            connection.execute(text("INSERT INTO message_fts (message_fts) VALUES ('integrity-check')"))
+        db = sessionmaker(bind=self.target)()
+        self.assertTrue(crud.delete_thread(db, db.query(Thread.id).order_by(Thread.id.desc()).first()[0]))
+        db.close()
+
+    def test_export_includes_sharded_projects(self):
+        """分割保存が有効な場合はカタログに続けてプロジェクトの DB も出力し、取り込みはカタログへは行わない"""
+        from database.sharding import ShardRouter
+        router = ShardRouter(self.source, shard_dir=os.path.join(self.work_dir, "shards"))
+        try:
+            shard_project = router.create_project("Shard Project", "prompt")
+            db = router.session_for_project(shard_project.id)
+            try:
+                thread = crud.create_thread(db, shard_project.id, name="Shard Thread")
+                crud.add_message(db, thread, "user", "bulkword shard")
+                db.commit()
+            finally:
+                db.close()
+
+            with mock.patch("database.sharding.get_shard_router", return_value=router), \
+                 mock.patch("database.database.engine", self.source):
+                self.assertEqual(export_jsonl(self.jsonl_path, project_id=shard_project.id),
+                                 {"projects": 1, "threads": 1, "messages": 1})
+                self.assertEqual(export_jsonl(self.jsonl_path), {"projects": 2, "threads": 4, "messages": 7})
+                with self.assertRaises(RuntimeError):
+                    import_jsonl(self.jsonl_path)
+            import_jsonl(self.jsonl_path, bind=self.target)
+            self.assertEqual(self.count(self.target, "threads"), 4)
+            self.assertEqual(len(fts_match(self.target, "bulkword")), 4)
+        finally:
+            router.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,10 @@ import unittest
 import sys
 import os
 import logging
+import datetime
+import tempfile
+import shutil
+from types import SimpleNamespace
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 
@@ -10,9 +14,11 @@ project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_root)
 
 # テスト対象のモジュールとモデル
+from database import crud
 from database.crud import search_messages
-from models.models import Base, Project, Thread, Message
-from database.database import init_db # FTS作成ロジックを再利用するためインポート
+from models.models import Base, Project, Thread, Message, Attachment
+from utils.blob_store import BlobStore
+from database.database import init_db, assert_max_queries # FTS作成ロジックを再利用するためインポート
 
 # ロガー設定
 logging.basicConfig(level=logging.INFO)
@@ -63,13 +69,14 @@ class TestCrudSearchMessages(unittest.TestCase):
             # トリガー: DELETE
             connection.execute(text("""
             CREATE TRIGGER message_ad AFTER DELETE ON messages BEGIN
-                DELETE FROM message_fts WHERE rowid=old.id;
+                INSERT INTO message_fts (message_fts, rowid, content) VALUES ('delete', old.id, old.content);
             END;
             """))
             # トリガー: UPDATE
             connection.execute(text("""
             CREATE TRIGGER message_au AFTER UPDATE ON messages BEGIN
-                UPDATE message_fts SET content=new.content WHERE rowid=old.id;
+                INSERT INTO message_fts (message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content);
             END;
             """))
             connection.commit()
@@ -210,5 +217,301 @@ class TestCrudSearchMessages(unittest.TestCase):
     #     self.assertEqual(len(results), 3, "Should find messages containing 'test' ignoring symbols") 
         # ↑ このテストはトークナイザーの挙動次第なので、一旦コメントアウト
 
+class TestCrudQueryCounts(unittest.TestCase):
+    """CRUD 関数ごとの SQL 文の数の上限 (クエリの増加に気付くため)"""
+
+    def setUp(self):
+        self.engine = create_engine("sqlite:///:memory:")
+        init_db(bind=self.engine)
+        self.db = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)()
+        self.project = Project(name="Query Project", system_prompt="prompt")
+        self.db.add(self.project)
+        self.db.commit()
+        self.threads = [Thread(project_id=self.project.id, name=f"Thread {i}") for i in range(6)]
+        self.db.add_all(self.threads)
+        self.db.commit()
+        for thread in self.threads[:3]:
+            self.db.add_all([Message(thread_id=thread.id, role="user", content=f"hello {i}") for i in range(4)])
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        self.engine.dispose()
+
+    def test_search_is_a_single_statement(self):
+        with assert_max_queries(1):
+            self.assertEqual(len(search_messages(self.db, "hello")), 12)
+
+    def test_thread_operations(self):
+        with assert_max_queries(3):
+            self.assertTrue(crud.update_thread_name(self.db, self.threads[0].id, "renamed"))
+        with assert_max_queries(5):
+            self.assertIsNotNone(crud.create_thread(self.db, self.project.id))
+        with assert_max_queries(9): # 分岐先の有無の確認を含む
+            self.assertTrue(crud.delete_thread(self.db, self.threads[0].id))
+
+    def test_delete_empty_threads_does_not_grow_with_thread_count(self):
+        with assert_max_queries(4):
+            self.assertEqual(crud.delete_empty_threads_in_project(self.db, self.project.id), 3)
+
+    def test_update_project(self):
+        with assert_max_queries(4):
+            self.assertTrue(crud.update_project(self.db, self.project.id, "Renamed", "new prompt"))
+
+    def test_read_models_are_plain_records_from_one_statement(self):
+        project_id, thread_id = self.project.id, self.threads[0].id
+        self.db.expunge_all() # 一覧がセッションの ID マップを経由しないことを確認する
+        with assert_max_queries(1):
+            projects = crud.list_projects(self.db)
+        self.assertEqual(projects, [crud.ProjectRow(project_id, "Query Project", "prompt",
+                                                    projects[0].created_at, projects[0].updated_at)])
+        with assert_max_queries(1):
+            threads = crud.list_threads(self.db, project_id, offset=1, limit=2)
+        self.assertEqual(len(threads), 2)
+        self.assertIsInstance(threads[0], crud.ThreadRow)
+        with assert_max_queries(1):
+            history = crud.get_thread_history(self.db, thread_id)
+        self.assertEqual([(m.role, m.content) for m in history], [("user", f"hello {i}") for i in range(4)])
+        self.assertIsInstance(history[0], crud.MessageRow)
+        self.assertEqual(len(self.db.identity_map), 0)
+
+    def test_search_hits_include_thread_and_project_names(self):
+        hits = search_messages(self.db, "hello 2")
+        self.assertEqual({(hit.thread_name, hit.project_id, hit.project_name) for hit in hits},
+                         {(f"Thread {i}", self.project.id, "Query Project") for i in range(3)})
+
+    def test_limit_exceeded_lists_statements(self):
+        with self.assertRaises(AssertionError) as raised:
+            with assert_max_queries(0, operation="search"):
+                search_messages(self.db, "hello")
+        self.assertIn("SELECT", str(raised.exception))
+
+class TestCrudForkThread(unittest.TestCase):
+    """スレッドの分岐 (履歴をコピーせずに共有する) のテストケース"""
+
+    def setUp(self):
+        self.engine = create_engine("sqlite:///:memory:")
+        init_db(bind=self.engine)
+        self.db = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)()
+        self.project = Project(name="Fork Project", system_prompt="prompt")
+        self.db.add(self.project)
+        self.db.commit()
+        self.thread = Thread(project_id=self.project.id, name="main")
+        self.db.add(self.thread)
+        self.db.commit()
+        self.messages = [crud.add_message(self.db, self.thread, role, f"main {i}")
+                         for i, role in enumerate(["user", "assistant"] * 3)]
+
+    def tearDown(self):
+        self.db.close()
+        self.engine.dispose()
+
+    def contents(self, thread_id: int) -> list[str]:
+        return [message.content for message in crud.get_thread_history(self.db, thread_id)]
+
+    def test_fork_shares_prefix_without_copying(self):
+        with assert_max_queries(5):
+            fork = crud.fork_thread(self.db, self.thread.id, self.messages[1].id)
+        self.assertEqual((fork.parent_thread_id, fork.branch_message_id), (self.thread.id, self.messages[1].id))
+        self.assertEqual(fork.name, "main (分岐)")
+        self.assertEqual(self.db.query(Message).count(), 6)
+
+        crud.add_message(self.db, fork, "user", "fork 2")
+        self.assertEqual(self.contents(fork.id), ["main 0", "main 1", "fork 2"])
+        # 分岐元の履歴は変わらない
+        self.assertEqual(self.contents(self.thread.id), [f"main {i}" for i in range(6)])
+        # ページング
+        self.assertEqual([m.content for m in crud.get_thread_history(self.db, fork.id, after_id=self.messages[0].id, limit=1)],
+                         ["main 1"])
+
+    def test_history_is_a_single_statement_across_generations(self):
+        fork = crud.fork_thread(self.db, self.thread.id, self.messages[3].id)
+        fork_message = crud.add_message(self.db, fork, "user", "fork 4")
+        # 分岐先のさらに分岐 (祖先のメッセージを分岐点にすると、そのメッセージのスレッドから直接分岐する)
+        grandchild = crud.fork_thread(self.db, fork.id, fork_message.id, name="grandchild")
+        shortcut = crud.fork_thread(self.db, fork.id, self.messages[0].id)
+        self.assertEqual(shortcut.parent_thread_id, self.thread.id)
+        crud.add_message(self.db, grandchild, "assistant", "grandchild 5")
+        grandchild_id = grandchild.id
+
+        with assert_max_queries(1):
+            history = crud.get_thread_history(self.db, grandchild_id)
+        self.assertEqual([m.content for m in history], ["main 0", "main 1", "main 2", "main 3", "fork 4", "grandchild 5"])
+        self.assertEqual(self.contents(shortcut.id), ["main 0"])
+
+    def test_fork_rejects_messages_outside_the_history(self):
+        fork = crud.fork_thread(self.db, self.thread.id, self.messages[1].id)
+        # 分岐点より後の分岐元のメッセージは分岐先の履歴に含まれない
+        self.assertIsNone(crud.fork_thread(self.db, fork.id, self.messages[4].id))
+        self.assertIsNone(crud.fork_thread(self.db, self.thread.id, 9999))
+
+    def test_deleting_parent_hands_shared_messages_to_forks(self):
+        early = crud.fork_thread(self.db, self.thread.id, self.messages[1].id)
+        late = crud.fork_thread(self.db, self.thread.id, self.messages[3].id)
+        crud.add_message(self.db, early, "user", "early")
+        crud.add_message(self.db, late, "user", "late")
+
+        self.assertTrue(crud.delete_thread(self.db, self.thread.id))
+        self.db.expire_all()
+        self.assertEqual(self.contents(late.id), ["main 0", "main 1", "main 2", "main 3", "late"])
+        self.assertEqual(self.contents(early.id), ["main 0", "main 1", "early"])
+        self.assertEqual(self.db.get(Thread, early.id).parent_thread_id, late.id)
+        self.assertEqual(self.db.query(Message).count(), 6) # 分岐点より後の main 4, main 5 だけが削除される
+
+    def test_empty_fork_is_not_swept_and_project_delete_succeeds(self):
+        fork = crud.fork_thread(self.db, self.thread.id, self.messages[1].id)
+        crud.fork_thread(self.db, fork.id, self.messages[0].id)
+        self.assertEqual(crud.delete_empty_threads_in_project(self.db, self.project.id), 0)
+        self.assertTrue(crud.delete_all_threads_in_project(self.db, self.project.id))
+        self.assertEqual(self.db.query(Thread).count(), 0)
+
+class TestCrudUsage(unittest.TestCase):
+    """アシスタントのメッセージごとの使用量の記録と集計 (usage_rollups) のテストケース"""
+
+    def setUp(self):
+        self.engine = create_engine("sqlite:///:memory:")
+        init_db(bind=self.engine)
+        self.db = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)()
+        self.projects = [Project(name=f"Usage {i}", system_prompt="prompt") for i in range(2)]
+        self.db.add_all(self.projects)
+        self.db.commit()
+        self.threads = [Thread(project_id=project.id, name="chat") for project in self.projects]
+        self.db.add_all(self.threads)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        self.engine.dispose()
+
+    def add_answer(self, thread, model_name, prompt_tokens, output_tokens, latency_ms=None):
+        usage = {"prompt_tokens": prompt_tokens, "output_tokens": output_tokens,
+                 "total_tokens": prompt_tokens + output_tokens}
+        if latency_ms is not None:
+            usage.update(time_to_first_token_ms=latency_ms / 2, latency_ms=latency_ms)
+        crud.add_message(self.db, thread, "user", "question")
+        return crud.add_message(self.db, thread, "assistant", "answer", model_name=model_name, usage=usage)
+
+    def test_add_message_records_usage_on_the_message(self):
+        message = self.add_answer(self.threads[0], "flash", 10, 20, latency_ms=300.0)
+        self.db.expire_all()
+        stored = self.db.get(Message, message.id)
+        self.assertEqual((stored.model_name, stored.prompt_tokens, stored.output_tokens, stored.total_tokens),
+                         ("flash", 10, 20, 30))
+        self.assertEqual((stored.time_to_first_token_ms, stored.latency_ms), (150.0, 300.0))
+
+    def test_summary_groups_by_project_and_model(self):
+        self.add_answer(self.threads[0], "flash", 10, 20, latency_ms=100.0)
+        self.add_answer(self.threads[0], "flash", 5, 5, latency_ms=300.0)
+        self.add_answer(self.threads[0], "pro", 1, 2)
+        self.add_answer(self.threads[1], "flash", 7, 8, latency_ms=50.0)
+
+        rows = crud.get_usage_summary(self.db, group_by=["project", "model"])
+        summary = {(row["project_id"], row["model"]): row for row in rows}
+        flash = summary[(self.projects[0].id, "flash")]
+        self.assertEqual((flash["messages"], flash["prompt_tokens"], flash["output_tokens"], flash["total_tokens"]),
+                         (2, 15, 25, 40))
+        self.assertEqual((flash["avg_latency_ms"], flash["avg_time_to_first_token_ms"]), (200.0, 100.0))
+        self.assertEqual(flash["project_name"], "Usage 0")
+        # レイテンシを計測していない応答は平均に含めない
+        self.assertIsNone(summary[(self.projects[0].id, "pro")]["avg_latency_ms"])
+        self.assertEqual(len(rows), 3)
+
+        totals = crud.get_usage_summary(self.db, group_by=[], project_id=self.projects[1].id)
+        self.assertEqual([(row["messages"], row["total_tokens"]) for row in totals], [(1, 15)])
+
+    def test_summary_filters_by_day(self):
+        self.add_answer(self.threads[0], "flash", 1, 1)
+        today = datetime.datetime.utcnow().date()
+        self.assertEqual(len(crud.get_usage_summary(self.db, ["day"], start_day=today, end_day=today)), 1)
+        self.assertEqual(crud.get_usage_summary(self.db, ["day"], start_day=today + datetime.timedelta(days=1)), [])
+
+    def test_unknown_group_is_rejected(self):
+        with self.assertRaises(ValueError):
+            crud.get_usage_summary(self.db, ["user"])
+
+    def test_recording_twice_counts_once_and_rebuild_matches(self):
+        message = self.add_answer(self.threads[0], "flash", 10, 20, latency_ms=100.0)
+        crud.record_message_usage(self.db, message, self.projects[0].id, "flash", {"total_tokens": 999})
+        self.db.commit()
+        before = crud.get_usage_summary(self.db, ["thread", "model", "day"])
+        self.assertEqual(before[0]["total_tokens"], 30)
+
+        self.assertEqual(crud.rebuild_usage_rollups(self.db), 1)
+        self.assertEqual(crud.get_usage_summary(self.db, ["thread", "model", "day"]), before)
+
+class TestCrudAttachments(unittest.TestCase):
+    """添付ファイル (内容アドレスの保存と参照数) のテストケース"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.store = BlobStore(os.path.join(self.work_dir, "attachments"))
+        self.engine = create_engine("sqlite:///:memory:")
+        init_db(bind=self.engine)
+        self.db = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)()
+        self.projects = [Project(name=f"Attach {i}", system_prompt="prompt") for i in range(2)]
+        self.db.add_all(self.projects)
+        self.db.commit()
+        self.threads = [Thread(project_id=project.id, name="chat") for project in self.projects]
+        self.db.add_all(self.threads)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        self.engine.dispose()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def ref_count(self, attachment_id: int) -> int:
+        return self.db.execute(text("SELECT ref_count FROM attachments WHERE id = :id"), {"id": attachment_id}).scalar()
+
+    def test_same_file_is_shared_across_projects(self):
+        first = crud.store_attachment(self.db, self.store, b"%PDF same", "a.pdf", "application/pdf")
+        second = crud.store_attachment(self.db, self.store, b"%PDF same", "b.pdf", "application/pdf")
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(second.filename, "a.pdf")
+        self.assertEqual(self.db.query(Attachment).count(), 1)
+
+        messages = [crud.add_message(self.db, thread, "user", "見て", attachment_ids=[first.id, first.id])
+                    for thread in self.threads]
+        self.assertEqual(self.ref_count(first.id), 2) # 重複した ID は1つにまとめる
+        message_ids = [message.id for message in messages]
+        with assert_max_queries(1):
+            attachments = crud.get_attachments_by_message(self.db, message_ids)
+        self.assertEqual({message_id: [a.filename for a in items] for message_id, items in attachments.items()},
+                         {message_id: ["a.pdf"] for message_id in message_ids})
+
+        # スレッド・プロジェクトを削除すると参照が外れる
+        crud.delete_thread(self.db, self.threads[0].id)
+        self.assertEqual(self.ref_count(first.id), 1)
+        crud.delete_project(self.db, self.projects[1].id)
+        self.assertEqual(self.ref_count(first.id), 0)
+
+    def test_unreferenced_attachments_are_collected_after_grace(self):
+        orphan = crud.store_attachment(self.db, self.store, b"orphan", "orphan.txt", "text/plain")
+        used = crud.store_attachment(self.db, self.store, b"used", "used.txt", "text/plain")
+        crud.add_message(self.db, self.threads[0], "user", "見て", attachment_ids=[used.id])
+        orphan_digest = orphan.sha256
+
+        # 保存したばかりのファイルは、メッセージの送信前でも削除しない
+        self.assertEqual(crud.collect_unreferenced_attachments(self.db, self.store, orphan.created_at), 0)
+        later = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        self.assertEqual(crud.collect_unreferenced_attachments(self.db, self.store, later), 1)
+        self.assertEqual([a.filename for a in self.db.query(Attachment).all()], ["used.txt"])
+        self.assertFalse(self.store.exists(orphan_digest))
+        self.assertTrue(self.store.exists(used.sha256))
+
+        # 削除後に同じ内容を保存し直すと、ファイルも作り直される
+        again = crud.store_attachment(self.db, self.store, b"orphan", "orphan.txt", "text/plain")
+        self.assertTrue(self.store.exists(again.sha256))
+
+    def test_record_gemini_file_stores_naive_utc_expiry(self):
+        attachment = crud.store_attachment(self.db, self.store, b"big", "big.pdf", "application/pdf")
+        expires = datetime.datetime(2030, 1, 1, 9, 0, tzinfo=datetime.timezone(datetime.timedelta(hours=9)))
+        crud.record_gemini_file(self.db, attachment, SimpleNamespace(name="files/abc", uri="https://example/files/abc",
+                                                                     expiration_time=expires))
+        self.db.expire_all()
+        stored = self.db.get(Attachment, attachment.id)
+        self.assertEqual((stored.gemini_file_name, stored.gemini_file_expires_at),
+                         ("files/abc", datetime.datetime(2030, 1, 1, 0, 0)))
+
 if __name__ == '__main__':
     unittest.main() 
@@ -0,0 +1,193 @@
+import unittest
+import sys
+import os
+import csv
+import datetime
+import tempfile
+import shutil
+import logging
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from unittest import mock
+from utils.csv_export import export_incremental, export_incremental_all
+from database.crud import delete_thread, delete_project, update_thread_name
+from models.models import Base, Project, Thread, Message, ExportWatermark
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+TEST_DATABASE_URL = "sqlite:///:memory:"
+
+def read_export(output_dir: str, kind: str) -> list[dict]:
+    """出力ディレクトリ内の指定種類の CSV を全て読み込んで行のリストを返す"""
+    rows = []
+    for file_name in sorted(os.listdir(output_dir)):
+        if file_name.endswith(f"_{kind}.csv"):
+            with open(os.path.join(output_dir, file_name), encoding="utf-8-sig", newline="") as f:
+                rows.extend(csv.DictReader(f))
+    return rows
+
+class TestIncrementalExport(unittest.TestCase):
+    """csv_export.export_incremental 関数のテストケース"""
+
+    def setUp(self):
+        self.engine = create_engine(TEST_DATABASE_URL)
+        Base.metadata.create_all(bind=self.engine)
+        self.db = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)()
+        self.output_dir = tempfile.mkdtemp()
+
+        self.project = Project(name="Export Project", system_prompt="prompt")
+        self.db.add(self.project)
+        self.db.commit()
+        self.thread = Thread(project_id=self.project.id, name="Thread A")
+        self.db.add(self.thread)
+        self.db.commit()
+        self.db.add_all([
+            Message(thread_id=self.thread.id, role="user", content="最初の質問"),
+            Message(thread_id=self.thread.id, role="assistant", content="first answer"),
+        ])
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        Base.metadata.drop_all(bind=self.engine)
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+    def test_first_run_exports_everything(self):
+        """初回実行では既存の全データが出力される"""
+        counts = export_incremental(self.db, "nightly", self.output_dir)
+        self.assertEqual(counts["messages"], 2)
+        self.assertEqual(counts["threads"], 1)
+        self.assertEqual(counts["projects"], 1)
+        self.assertEqual(counts["tombstones"], 0)
+        self.assertEqual(len(read_export(self.output_dir, "messages")), 2)
+
+    def test_second_run_exports_only_new_rows(self):
+        """2回目以降は新しいメッセージだけが新しいファイルとして追記される"""
+        export_incremental(self.db, "nightly", self.output_dir)
+        self.db.add(Message(thread_id=self.thread.id, role="user", content="追加の質問"))
+        self.db.commit()
+
+        counts = export_incremental(self.db, "nightly", self.output_dir)
+        self.assertEqual(counts["messages"], 1)
+        self.assertEqual(counts["projects"], 0)
+        rows = read_export(self.output_dir, "messages")
+        self.assertEqual([row["message_content"] for row in rows], ["最初の質問", "first answer", "追加の質問"])
+
+        # 変更が無ければファイルは作られない
+        files_before = set(os.listdir(self.output_dir))
+        counts = export_incremental(self.db, "nightly", self.output_dir)
+        self.assertEqual(sum(counts.values()), 0)
+        self.assertEqual(set(os.listdir(self.output_dir)), files_before)
+
+    def test_message_updated_after_export_is_exported_again(self):
+        """生成途中に出力した応答は、完了して内容が確定した後の実行でもう一度出力される"""
+        answer = Message(thread_id=self.thread.id, role="assistant", content="")
+        self.db.add(answer)
+        self.db.commit()
+        counts = export_incremental(self.db, "nightly", self.output_dir)
+        self.assertEqual(counts["messages"], 3)
+
+        answer.content = "生成が完了した応答"
+        self.db.commit()
+        counts = export_incremental(self.db, "nightly", self.output_dir)
+        self.assertEqual(counts["messages"], 1)
+        latest = read_export(self.output_dir, "messages")[-1]
+        self.assertEqual((int(latest["message_id"]), latest["message_content"]), (answer.id, "生成が完了した応答"))
+        self.assertEqual(export_incremental(self.db, "nightly", self.output_dir)["messages"], 0)
+
+    def test_messages_handed_over_to_fork_are_exported_with_new_thread(self):
+        """分岐元を削除して分岐先に引き継いだメッセージは、新しい thread_id で出力し直される"""
+        first_message_id = self.db.query(Message.id).filter(Message.thread_id == self.thread.id).order_by(Message.id).first()[0]
+        fork = Thread(project_id=self.project.id, name="Fork", parent_thread_id=self.thread.id,
+                      branch_message_id=first_message_id)
+        self.db.add(fork)
+        self.db.commit()
+        fork_id = fork.id
+        export_incremental(self.db, "nightly", self.output_dir)
+
+        self.assertTrue(delete_thread(self.db, self.thread.id))
+        counts = export_incremental(self.db, "nightly", self.output_dir)
+        self.assertEqual(counts["messages"], 1)
+        latest = read_export(self.output_dir, "messages")[-1]
+        self.assertEqual((int(latest["message_id"]), int(latest["thread_id"])), (first_message_id, fork_id))
+
+    def test_row_committed_after_export_with_earlier_timestamp_is_not_lost(self):
+        """前回の実行より前に updated_at が付き、実行後にコミットされた行も次回出力され、出力済みの行は繰り返さない"""
+        export_incremental(self.db, "nightly", self.output_dir)
+        synced_at = self.db.query(ExportWatermark.last_synced_at).filter(ExportWatermark.target == "nightly").scalar()
+
+        late = Thread(project_id=self.project.id, name="Late Thread",
+                      updated_at=synced_at - datetime.timedelta(seconds=1))
+        self.db.add(late)
+        self.db.commit()
+        counts = export_incremental(self.db, "nightly", self.output_dir)
+        self.assertEqual((counts["threads"], counts["projects"], counts["messages"]), (1, 0, 0))
+        self.assertEqual(read_export(self.output_dir, "threads")[-1]["thread_name"], "Late Thread")
+        self.assertEqual(export_incremental(self.db, "nightly", self.output_dir)["threads"], 0)
+
+    def test_watermarks_are_per_target(self):
+        """ウォーターマークは出力先ごとに独立している"""
+        export_incremental(self.db, "nightly", self.output_dir)
+        other_dir = os.path.join(self.output_dir, "other")
+        counts = export_incremental(self.db, "other", other_dir)
+        self.assertEqual(counts["messages"], 2)
+
+    def test_renamed_thread_is_exported_as_changed(self):
+        """名前を変更したスレッドは変更行として出力される"""
+        export_incremental(self.db, "nightly", self.output_dir)
+        self.assertTrue(update_thread_name(self.db, self.thread.id, "Renamed"))
+
+        counts = export_incremental(self.db, "nightly", self.output_dir)
+        self.assertEqual(counts["threads"], 1)
+        self.assertEqual(read_export(self.output_dir, "threads")[-1]["thread_name"], "Renamed")
+
+    def test_deletes_are_exported_as_tombstones(self):
+        """delete_thread / delete_project による削除は tombstone として出力される"""
+        other_thread = Thread(project_id=self.project.id, name="Thread B")
+        self.db.add(other_thread)
+        self.db.commit()
+        other_thread_id = other_thread.id
+        export_incremental(self.db, "nightly", self.output_dir)
+
+        self.assertTrue(delete_thread(self.db, other_thread_id))
+        self.assertTrue(delete_project(self.db, self.project.id))
+
+        counts = export_incremental(self.db, "nightly", self.output_dir)
+        self.assertEqual(counts["tombstones"], 3)
+        tombstones = {(row["entity_type"], int(row["entity_id"])) for row in read_export(self.output_dir, "tombstones")}
+        self.assertIn(("thread", other_thread_id), tombstones)
+        self.assertIn(("thread", self.thread.id), tombstones)
+        self.assertIn(("project", self.project.id), tombstones)
+
+    def test_export_all_includes_sharded_projects(self):
+        """分割保存が有効な場合は、各プロジェクトの DB もウォーターマークを分けて出力する"""
+        from database import crud
+        from database.sharding import ShardRouter
+        router = ShardRouter(self.engine, shard_dir=os.path.join(self.output_dir, "shards"))
+        try:
+            shard_project = router.create_project("Shard Project", "prompt")
+            shard_db = router.session_for_project(shard_project.id)
+            try:
+                crud.add_message(shard_db, crud.create_thread(shard_db, shard_project.id, name="Shard"), "user", "shard")
+                shard_db.commit()
+            finally:
+                shard_db.close()
+            shard_dir = os.path.join(self.output_dir, f"project_{shard_project.id}")
+
+            with mock.patch("database.sharding.get_shard_router", return_value=router), \
+                 mock.patch("database.database.SessionLocal", sessionmaker(bind=self.engine)):
+                counts = export_incremental_all("nightly", self.output_dir)
+                self.assertEqual(counts["messages"], 3)
+                self.assertEqual([row["message_content"] for row in read_export(shard_dir, "messages")], ["shard"])
+                self.assertEqual(export_incremental_all("nightly", self.output_dir)["messages"], 0)
+        finally:
+            router.close()
+
+if __name__ == '__main__':
+    unittest.main()
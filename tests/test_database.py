@@ -0,0 +1,345 @@
+import unittest
+import sys
+import os
+import tempfile
+import shutil
+from sqlalchemy import create_engine, text, event
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from unittest import mock
+from database.database import init_db, SCHEMA_VERSION, QueryTracker, statement_shape
+
+class TestInitDb(unittest.TestCase):
+    """database.init_db 関数のテストケース"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.database_url = f"sqlite:///{os.path.join(self.work_dir, 'test.db')}"
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def user_version(self, engine) -> int:
+        with engine.connect() as connection:
+            return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+    def test_new_database_is_created_at_current_version(self):
+        """新規 DB ではテーブルと FTS が作成され、スキーマバージョンが記録される"""
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        self.assertEqual(self.user_version(engine), SCHEMA_VERSION)
+        with engine.connect() as connection:
+            names = {row[0] for row in connection.execute(text("SELECT name FROM sqlite_master"))}
+        self.assertTrue({"projects", "threads", "messages", "message_fts", "message_ai"} <= names)
+        engine.dispose()
+
+    def test_current_database_skips_ddl(self):
+        """バージョンが最新の DB では DDL を実行しない"""
+        init_db(bind=create_engine(self.database_url))
+
+        engine = create_engine(self.database_url)
+        statements = []
+        event.listen(engine, "before_cursor_execute",
+                     lambda conn, cursor, statement, *args: statements.append(statement))
+        init_db(bind=engine)
+        self.assertEqual(len(statements), 1) # バージョンと FTS のトリガーの確認だけ
+
+        # 同じプロセス・同じ Engine での2回目以降は DB に接続しない
+        statements.clear()
+        init_db(bind=engine)
+        self.assertEqual(statements, [])
+        engine.dispose()
+
+    def test_unversioned_existing_database_is_upgraded(self):
+        """バージョン管理前に作られた既存 DB (user_version = 0) も最新に更新される"""
+        engine = create_engine(self.database_url)
+        with engine.connect() as connection:
+            connection.execute(text("CREATE TABLE projects (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL UNIQUE, "
+                                    "system_prompt TEXT NOT NULL, created_at DATETIME, updated_at DATETIME)"))
+            connection.commit()
+        init_db(bind=engine)
+        self.assertEqual(self.user_version(engine), SCHEMA_VERSION)
+        with engine.connect() as connection:
+            tables = {row[0] for row in connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))}
+        self.assertIn("tombstones", tables)
+        engine.dispose()
+
+    def search(self, engine, term: str) -> list[int]:
+        with engine.connect() as connection:
+            return [row[0] for row in connection.execute(
+                text("SELECT rowid FROM message_fts WHERE message_fts MATCH :term ORDER BY rowid"), {"term": term})]
+
+    def add_message(self, engine, content: str) -> None:
+        with engine.begin() as connection:
+            connection.execute(text("INSERT OR IGNORE INTO projects (id, name, system_prompt) VALUES (1, 'p', '')"))
+            connection.execute(text("INSERT OR IGNORE INTO threads (id, project_id, name) VALUES (1, 1, 't')"))
+            connection.execute(text("INSERT INTO messages (thread_id, role, content) VALUES (1, 'assistant', :content)"),
+                               {"content": content})
+
+    def test_fts_follows_message_update_and_delete(self):
+        """メッセージの更新・削除が FTS 索引に反映され、索引が壊れない"""
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        self.add_message(engine, "")
+        self.add_message(engine, "keep this")
+        # 生成中の応答と同じく、同じメッセージを何度も更新する
+        for content in ["partial", "partial answer", "final answer"]:
+            with engine.begin() as connection:
+                connection.execute(text("UPDATE messages SET content = :content WHERE id = 1"), {"content": content})
+        self.assertEqual(self.search(engine, "final"), [1])
+        self.assertEqual(self.search(engine, "partial"), [])
+
+        with engine.begin() as connection:
+            connection.execute(text("DELETE FROM messages WHERE id = 1"))
+            connection.execute(text("INSERT INTO message_fts (message_fts) VALUES ('integrity-check')"))
+        self.assertEqual(self.search(engine, "answer"), [])
+        self.assertEqual(self.search(engine, "keep"), [2])
+        engine.dispose()
+
+    def test_missing_insert_trigger_is_restored_on_start(self):
+        """一括インポートが外したまま止まった FTS のトリガーは、次の起動で戻して索引を作り直す"""
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        self.add_message(engine, "before crash")
+        with engine.begin() as connection:
+            connection.execute(text("DROP TRIGGER message_ai"))
+        self.add_message(engine, "unindexed answer")
+        engine.dispose()
+
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        self.add_message(engine, "after restart")
+        self.assertEqual(self.search(engine, "unindexed"), [2])
+        self.assertEqual(self.search(engine, "restart"), [3])
+        with engine.begin() as connection:
+            connection.execute(text("DELETE FROM messages WHERE id = 2"))
+            connection.execute(text("INSERT INTO message_fts (message_fts) VALUES ('integrity-check')"))
+        engine.dispose()
+
+    def test_version_2_database_gets_fixed_fts_triggers(self):
+        """バージョン 2 の DB は FTS のトリガーが作り直され、索引が再構築される"""
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        self.add_message(engine, "old answer")
+        with engine.begin() as connection:
+            connection.execute(text("DROP TRIGGER message_au"))
+            connection.execute(text("CREATE TRIGGER message_au AFTER UPDATE ON messages BEGIN "
+                                    "UPDATE message_fts SET content=new.content WHERE rowid=old.id; END;"))
+            connection.exec_driver_sql("PRAGMA user_version = 2")
+        engine.dispose()
+
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        self.assertEqual(self.user_version(engine), SCHEMA_VERSION)
+        with engine.begin() as connection:
+            connection.execute(text("UPDATE messages SET content = 'new answer' WHERE id = 1"))
+        self.assertEqual(self.search(engine, "new"), [1])
+        self.assertEqual(self.search(engine, "old"), [])
+        engine.dispose()
+
+    def test_version_4_database_gets_thread_branch_columns(self):
+        """バージョン 4 の DB の threads に分岐の列とインデックスが追加される"""
+        engine = create_engine(self.database_url)
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE projects (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL UNIQUE, "
+                                    "system_prompt TEXT NOT NULL, created_at DATETIME, updated_at DATETIME)"))
+            connection.execute(text("CREATE TABLE threads (id INTEGER PRIMARY KEY, project_id INTEGER NOT NULL, "
+                                    "name VARCHAR NOT NULL, created_at DATETIME, updated_at DATETIME)"))
+            connection.exec_driver_sql("PRAGMA user_version = 4")
+        init_db(bind=engine)
+        with engine.connect() as connection:
+            columns = {row[1] for row in connection.exec_driver_sql("PRAGMA table_info(threads)")}
+            indexes = {row[1] for row in connection.exec_driver_sql("PRAGMA index_list(threads)")}
+        self.assertTrue({"parent_thread_id", "branch_message_id"} <= columns)
+        self.assertIn("ix_threads_parent_thread_id", indexes)
+        engine.dispose()
+
+    def test_version_7_database_gets_archive_columns(self):
+        """バージョン 7 の DB の threads にアーカイブの列が追加され、archived_attachments が作成される"""
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        with engine.begin() as connection:
+            connection.execute(text("DROP INDEX ix_threads_archived_at"))
+            connection.execute(text("ALTER TABLE threads DROP COLUMN archived_at"))
+            connection.execute(text("DROP TABLE archived_attachments"))
+            connection.exec_driver_sql("PRAGMA user_version = 7")
+        engine.dispose()
+
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        with engine.connect() as connection:
+            columns = {row[1] for row in connection.exec_driver_sql("PRAGMA table_info(threads)")}
+            indexes = {row[1] for row in connection.exec_driver_sql("PRAGMA index_list(threads)")}
+            tables = {row[0] for row in connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        self.assertIn("archived_at", columns)
+        self.assertIn("ix_threads_archived_at", indexes)
+        self.assertIn("archived_attachments", tables)
+        engine.dispose()
+
+    def test_version_8_database_gets_message_updated_column(self):
+        """バージョン 8 の DB の messages に変更日時の列が追加され、既存のメッセージは作成日時で埋められる"""
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        self.add_message(engine, "old answer")
+        with engine.begin() as connection:
+            connection.execute(text("DROP INDEX ix_messages_updated_at"))
+            connection.execute(text("ALTER TABLE messages DROP COLUMN updated_at"))
+            connection.execute(text("UPDATE messages SET created_at = '2025-01-01 00:00:00.000000'"))
+            connection.exec_driver_sql("PRAGMA user_version = 8")
+        engine.dispose()
+
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        with engine.connect() as connection:
+            indexes = {row[1] for row in connection.exec_driver_sql("PRAGMA index_list(messages)")}
+            created_at, updated_at = connection.execute(text("SELECT created_at, updated_at FROM messages")).one()
+        self.assertIn("ix_messages_updated_at", indexes)
+        self.assertEqual(updated_at, "2025-01-01 00:00:00.000000")
+        self.assertEqual(self.search(engine, "old"), [1])
+        engine.dispose()
+
+    def test_version_10_database_gets_autoincrement_tables(self):
+        """AUTOINCREMENT の無い threads・messages は作り直され、削除した最大の ID が再利用されない"""
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        self.add_message(engine, "first answer")
+        self.add_message(engine, "second answer")
+        with engine.begin() as connection:
+            # AUTOINCREMENT を指定する前に作られた DB にする
+            connection.exec_driver_sql("PRAGMA writable_schema = ON")
+            connection.execute(text("UPDATE sqlite_master SET sql = replace(sql, 'AUTOINCREMENT', '') "
+                                    "WHERE type = 'table' AND name IN ('threads', 'messages')"))
+            connection.exec_driver_sql("PRAGMA writable_schema = OFF")
+            connection.execute(text("DELETE FROM sqlite_sequence"))
+            connection.exec_driver_sql("PRAGMA user_version = 10")
+        engine.dispose()
+
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        with engine.begin() as connection:
+            sql = dict(connection.execute(text("SELECT name, sql FROM sqlite_master WHERE type = 'table'")).all())
+            connection.execute(text("DELETE FROM messages WHERE id = 2"))
+        self.assertIn("AUTOINCREMENT", sql["messages"])
+        self.assertIn("AUTOINCREMENT", sql["threads"])
+        self.add_message(engine, "third answer")
+        with engine.connect() as connection:
+            ids = [row[0] for row in connection.execute(text("SELECT id FROM messages ORDER BY id"))]
+            indexes = {row[1] for row in connection.exec_driver_sql("PRAGMA index_list(messages)")}
+        self.assertEqual(ids, [1, 3])
+        self.assertTrue({"ix_messages_thread_id", "ix_messages_updated_at"} <= indexes)
+        self.assertEqual(self.search(engine, "answer"), [1, 3])
+        engine.dispose()
+
+    def test_version_12_database_rolls_up_unadopted_comparison_answers(self):
+        """採用されなかった比較回答の使用量が、その回答のモデルで usage_rollups に加算される"""
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        self.add_message(engine, "adopted answer")
+        with engine.begin() as connection:
+            connection.execute(text(
+                "INSERT INTO model_comparison_answers (comparison_id, thread_id, assistant_message_id, model_name, content, "
+                "total_tokens, latency_ms, adopted, created_at) VALUES "
+                "('c1', 1, 1, 'flash', 'adopted answer', 5, 10.0, 1, '2025-01-01 00:00:00'), "
+                "('c1', 1, 1, 'pro', 'other answer', 7, 20.0, 0, '2025-01-01 00:00:00'), "
+                "('c1', 1, 1, 'lite', '', NULL, 1.0, 0, '2025-01-01 00:00:00')"))
+            connection.exec_driver_sql("PRAGMA user_version = 12")
+        engine.dispose()
+
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        with engine.connect() as connection:
+            rows = connection.execute(text(
+                "SELECT model_name, message_count, total_tokens, latency_ms_sum FROM usage_rollups")).all()
+        self.assertEqual(rows, [("pro", 1, 7, 20.0)])
+        engine.dispose()
+
+    def test_version_13_database_gets_content_only_update_trigger(self):
+        """FTS の更新トリガーが content の更新時だけ発火するものに作り直され、export_watermarks に列が追加される"""
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        with engine.begin() as connection:
+            connection.execute(text("DROP TRIGGER message_au"))
+            connection.execute(text("CREATE TRIGGER message_au AFTER UPDATE ON messages BEGIN "
+                                    "INSERT INTO message_fts (message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+                                    "INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content); END"))
+            connection.execute(text("ALTER TABLE export_watermarks DROP COLUMN overlap_keys"))
+            connection.exec_driver_sql("PRAGMA user_version = 13")
+        engine.dispose()
+
+        engine = create_engine(self.database_url)
+        init_db(bind=engine)
+        self.add_message(engine, "indexed answer")
+        with engine.begin() as connection:
+            sql = connection.execute(text("SELECT sql FROM sqlite_master WHERE name = 'message_au'")).scalar()
+            columns = {row[1] for row in connection.exec_driver_sql("PRAGMA table_info(export_watermarks)")}
+            connection.execute(text("UPDATE messages SET updated_at = '2025-01-01 00:00:00', total_tokens = 3"))
+            connection.execute(text("UPDATE messages SET content = 'changed answer'"))
+        self.assertIn("UPDATE OF content", sql)
+        self.assertIn("overlap_keys", columns)
+        self.assertEqual(self.search(engine, "indexed"), [])
+        self.assertEqual(self.search(engine, "changed"), [1])
+        engine.dispose()
+
+class TestQueryTracker(unittest.TestCase):
+    """database.database.QueryTracker (SQL の計測) のテストケース"""
+
+    def setUp(self):
+        self.engine = create_engine("sqlite:///:memory:")
+        init_db(bind=self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def run_selects(self, count: int) -> None:
+        with self.engine.connect() as connection:
+            for i in range(count):
+                connection.execute(text("SELECT id FROM projects WHERE id = :id"), {"id": i}).fetchall()
+
+    def test_statement_shape_ignores_literals_and_in_list_length(self):
+        self.assertEqual(statement_shape("SELECT * FROM t WHERE id IN (?, ?, ?) LIMIT 10"),
+                         statement_shape("SELECT *\n FROM t WHERE id IN (?, ?)  LIMIT 20"))
+
+    def test_nested_trackers_count_statements(self):
+        """入れ子の操作では、内側の文は外側にも数えられる"""
+        with QueryTracker("request") as outer:
+            self.run_selects(2)
+            with QueryTracker("crud") as inner:
+                self.run_selects(3)
+        self.run_selects(1) # 操作の外の文は数えない
+        self.assertEqual((outer.count, inner.count), (5, 3))
+        self.assertGreater(outer.total_ms, 0)
+
+    def test_repeated_select_is_reported_as_n_plus_one(self):
+        """同じ形の SELECT を繰り返すと、一番外側の操作が N+1 の疑いとして警告する"""
+        with self.assertLogs("database.sql", level="WARNING") as captured:
+            with QueryTracker("search") as tracker:
+                self.run_selects(12)
+        self.assertEqual(list(tracker.likely_n_plus_one().values()), [12])
+        self.assertIn("N+1", captured.output[0])
+        self.assertEqual(tracker.likely_n_plus_one(threshold=13), {})
+
+    def test_slow_query_is_logged_with_parameters_and_plan(self):
+        """遅いクエリは実行計画付きで記録され、パラメータの値は本文のログと同じく抽出したときだけ出る"""
+        with mock.patch("database.database.SQL_SLOW_QUERY_MS", 0.000001), \
+                mock.patch("utils.logging_setup.LOG_CONTENT_SAMPLE_RATE", 0.0):
+            with self.assertLogs("database.sql", level="WARNING") as captured:
+                with QueryTracker("lookup") as tracker:
+                    self.run_selects(1)
+        slow = tracker.slow_queries[0]
+        self.assertEqual(slow["operation"], "lookup")
+        self.assertEqual(slow["parameters"], "(int)")
+        self.assertIn("projects", slow["plan"])
+        self.assertIn("遅いクエリ", captured.output[0])
+
+        with mock.patch("database.database.SQL_SLOW_QUERY_MS", 0.000001), \
+                mock.patch("utils.logging_setup.LOG_CONTENT_SAMPLE_RATE", 1.0):
+            with self.assertLogs("database.sql", level="WARNING"):
+                with QueryTracker("lookup") as tracker:
+                    self.run_selects(1)
+        self.assertEqual(tracker.slow_queries[0]["parameters"], "(0,)")
+
+if __name__ == '__main__':
+    unittest.main()
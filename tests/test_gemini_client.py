@@ -8,6 +8,12 @@ sys.path.insert(0, project_root)
 from api.gemini_client import GeminiClient # GeminiClient をインポート
 from google.genai import types # types をインポート
 import traceback # traceback をインポート
+import datetime
+import tempfile
+import shutil
+from types import SimpleNamespace
+from unittest import mock
+from utils.blob_store import BlobStore
 
 class TestGeminiClient(unittest.TestCase):
     """GeminiClient クラスのテストケース"""
@@ -100,5 +106,65 @@ class TestGeminiClient(unittest.TestCase):
             # テスト中に例外が発生したらフェイルさせる
             self.fail(f"generate_content_stream failed with exception: {e}\n{traceback.format_exc()}")
 
+class FakeFiles:
+    """genai.Client.files の代わりにアップロードを記録する"""
+
+    def __init__(self):
+        self.uploads = []
+
+    def upload(self, file, config):
+        self.uploads.append((file.read(), config.display_name))
+        return types.File(name="files/abc", uri="https://example/files/abc", mime_type=config.mime_type,
+                          state=types.FileState.ACTIVE,
+                          expiration_time=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=48))
+
+class TestGeminiClientAttachments(unittest.TestCase):
+    """添付ファイルの Part への変換のテストケース (API キー不要)"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.store = BlobStore(self.work_dir)
+        self.files = FakeFiles()
+        self.client = GeminiClient(client=SimpleNamespace(files=self.files))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def attachment(self, data: bytes, attachment_id: int = 1, **fields):
+        digest, size = self.store.put(data)
+        values = dict(id=attachment_id, sha256=digest, size_bytes=size, mime_type="application/pdf", filename="doc.pdf",
+                      gemini_file_uri=None, gemini_file_expires_at=None)
+        values.update(fields)
+        return SimpleNamespace(**values)
+
+    def test_small_file_is_inlined(self):
+        part, uploaded = self.client.attachment_part(self.attachment(b"%PDF small"), self.store)
+        self.assertIsNone(uploaded)
+        self.assertEqual(part.inline_data.data, b"%PDF small")
+        self.assertEqual(self.files.uploads, [])
+
+    def test_large_file_is_uploaded_once_and_reused_while_valid(self):
+        attachment = self.attachment(b"%PDF large")
+        recorded = []
+        with mock.patch("api.gemini_client.ATTACHMENT_INLINE_MAX_BYTES", 4):
+            parts = self.client.attachment_parts({1: [attachment], 2: [attachment]}, self.store,
+                                                 on_upload=lambda a, f: recorded.append(f.name))
+        self.assertEqual(self.files.uploads, [(b"%PDF large", "doc.pdf")]) # 同じ添付ファイルは1回だけアップロードする
+        self.assertEqual(recorded, ["files/abc"])
+        self.assertEqual(parts[1][0].file_data.file_uri, "https://example/files/abc")
+        self.assertIs(parts[1][0], parts[2][0])
+
+        # 有効期限まで余裕のある URI は再アップロードしない。期限が近いものはアップロードし直す
+        valid = self.attachment(b"%PDF large", gemini_file_uri="https://example/files/old",
+                                gemini_file_expires_at=datetime.datetime.utcnow() + datetime.timedelta(hours=10))
+        part, uploaded = self.client.attachment_part(valid, self.store)
+        self.assertEqual((part.file_data.file_uri, uploaded), ("https://example/files/old", None))
+        expiring = self.attachment(b"%PDF large", gemini_file_uri="https://example/files/old",
+                                   gemini_file_expires_at=datetime.datetime.utcnow() + datetime.timedelta(minutes=5))
+        with mock.patch("api.gemini_client.ATTACHMENT_INLINE_MAX_BYTES", 4):
+            _, uploaded = self.client.attachment_part(expiring, self.store)
+        self.assertEqual(uploaded.name, "files/abc")
+        self.assertEqual(len(self.files.uploads), 2)
+
 if __name__ == '__main__':
     unittest.main()
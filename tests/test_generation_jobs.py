@@ -0,0 +1,337 @@
+import unittest
+import sys
+import os
+import tempfile
+import shutil
+import threading
+import time
+import datetime
+from unittest import mock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from google.genai import types
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from utils.generation_jobs import GenerationJobRunner, DONE, ERROR, CANCELLED
+from utils.request_scheduler import FairScheduler, INTERACTIVE
+from models.models import Base, Project, Thread, Message, ModelComparisonAnswer, Attachment
+from database.crud import adopt_comparison_answer, get_latest_comparison, get_usage_summary, rebuild_usage_rollups
+
+class FakeClient:
+    """GeminiClient の代わりに決まった応答を返すクライアント"""
+
+    def __init__(self, chunks=("こんにちは", "、世界"), barrier: threading.Barrier | None = None,
+                 error: Exception | None = None, gate: threading.Event | None = None,
+                 delays: dict | None = None, failing_models: tuple = ()):
+        self.chunks = chunks
+        self.delays = delays or {}
+        self.failing_models = failing_models
+        self.barrier = barrier
+        self.error = error
+        self.gate = gate
+        self.history_lengths = []
+        self.histories = []
+        self.scheduling = []
+
+    def generate_content_stream(self, model_name, history, system_prompt=None, usage=None, cancel_event=None, **scheduling):
+        self.history_lengths.append(len(history))
+        self.histories.append(history)
+        self.scheduling.append(scheduling)
+        time.sleep(self.delays.get(model_name, 0))
+        if model_name in self.failing_models:
+            raise RuntimeError(f"{model_name} is unavailable")
+        if self.barrier is not None:
+            self.barrier.wait(timeout=5) # 2つのジョブが同時に実行されていなければタイムアウトする
+        if self.error is not None:
+            raise self.error
+        for chunk in self.chunks:
+            if self.gate is not None:
+                self.gate.wait(timeout=5)
+            yield chunk
+        if usage is not None:
+            usage.update(prompt_tokens=len(history), output_tokens=len(self.chunks), total_tokens=len(history) + len(self.chunks))
+
+    def attachment_parts(self, attachments, store, on_upload=None):
+        return {key: [types.Part(text=f"[{a.filename}]") for a in items] for key, items in attachments.items()}
+
+class GenerationJobTestCase(unittest.TestCase):
+    """テスト用の DB とランナーを用意する基底クラス"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.work_dir, 'test.db')}",
+                                    connect_args={"check_same_thread": False})
+        Base.metadata.create_all(bind=self.engine)
+        self.Session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        db = self.Session()
+        project = Project(name="Job Project", system_prompt="prompt")
+        db.add(project)
+        db.commit()
+        self.threads = [Thread(project_id=project.id, name="新規チャット") for _ in range(2)]
+        db.add_all(self.threads)
+        db.commit()
+        self.thread_ids = [thread.id for thread in self.threads]
+        db.close()
+        # テスト中はマークダウンファイルを書き出さない
+        patcher = mock.patch("utils.generation_jobs.enqueue_message_to_markdown")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def make_runner(self, client: FakeClient, workers: int = 2) -> GenerationJobRunner:
+        runner = GenerationJobRunner(max_workers=workers, session_factory=self.Session,
+                                     client_factory=lambda: client)
+        self.addCleanup(runner.shutdown)
+        return runner
+
+    def messages(self, thread_id: int) -> list[tuple[str, str]]:
+        db = self.Session()
+        try:
+            rows = db.query(Message).filter(Message.thread_id == thread_id).order_by(Message.id).all()
+            return [(m.role, m.content) for m in rows]
+        finally:
+            db.close()
+
+class TestGenerationJobRunner(GenerationJobTestCase):
+    """utils.generation_jobs.GenerationJobRunner のテストケース"""
+
+    def test_job_saves_messages_and_names_thread(self):
+        """ジョブは応答を DB に保存し、最初のやり取りでチャット名を設定する"""
+        client = FakeClient()
+        runner = self.make_runner(client)
+        job = runner.submit(self.thread_ids[0], "最初の質問", "test-model", user="session-a")
+        self.assertTrue(job.wait(5))
+        self.assertEqual(job.status, DONE)
+        # API の実行枠はプロジェクトとユーザーごとに割り当てる
+        self.assertEqual(client.scheduling, [{"project_id": self.threads[0].project_id, "user": "session-a"}])
+        self.assertEqual(self.messages(self.thread_ids[0]), [("user", "最初の質問"), ("assistant", "こんにちは、世界")])
+        db = self.Session()
+        self.assertEqual(db.get(Thread, self.thread_ids[0]).name, "最初の質問")
+        db.close()
+        self.assertEqual(runner.jobs_for_thread(self.thread_ids[0]), [])
+
+    def test_job_stops_when_archived_thread_cannot_be_restored(self):
+        """アーカイブから戻せないチャットでは、履歴の無いまま生成せずにエラーで終わる"""
+        db = self.Session()
+        db.get(Thread, self.thread_ids[0]).archived_at = datetime.datetime.utcnow()
+        db.commit()
+        db.close()
+        client = FakeClient()
+        with mock.patch("database.archive.restore_thread", return_value=False):
+            job = self.make_runner(client).submit(self.thread_ids[0], "質問", "test-model")
+            self.assertTrue(job.wait(5))
+        self.assertEqual((job.status, job.error), (ERROR, "チャットをアーカイブから戻せませんでした。"))
+        self.assertEqual(client.histories, [])
+        self.assertEqual(self.messages(self.thread_ids[0]), [])
+
+    def test_jobs_in_same_thread_run_in_order(self):
+        """同じチャットのジョブは順番に実行され、前の応答が履歴に含まれる"""
+        client = FakeClient()
+        runner = self.make_runner(client)
+        first = runner.submit(self.thread_ids[0], "質問1", "test-model")
+        second = runner.submit(self.thread_ids[0], "質問2", "test-model")
+        self.assertTrue(second.wait(5))
+        self.assertEqual((first.status, second.status), (DONE, DONE))
+        self.assertEqual(client.history_lengths, [1, 3])
+        self.assertEqual([role for role, _ in self.messages(self.thread_ids[0])], ["user", "assistant", "user", "assistant"])
+
+    def test_jobs_in_different_threads_run_concurrently(self):
+        """異なるチャットのジョブは同時に実行される"""
+        runner = self.make_runner(FakeClient(barrier=threading.Barrier(2)))
+        jobs = [runner.submit(thread_id, "質問", "test-model") for thread_id in self.thread_ids]
+        for job in jobs:
+            self.assertTrue(job.wait(10))
+            self.assertEqual(job.status, DONE)
+
+    def test_partial_response_is_visible_only_in_the_job_while_running(self):
+        """生成途中の応答はジョブの状態からだけ読み取れ、完了するまで DB には保存されない"""
+        gate = threading.Event()
+        runner = self.make_runner(FakeClient(chunks=("途中", "まで"), gate=gate))
+        job = runner.submit(self.thread_ids[0], "質問", "test-model")
+        for _ in range(100):
+            if job.snapshot()["status"] == "running" and self.messages(self.thread_ids[0]):
+                break
+            threading.Event().wait(0.05)
+        self.assertEqual(runner.active_thread_ids(), {self.thread_ids[0]})
+        self.assertEqual(self.messages(self.thread_ids[0]), [("user", "質問")])
+        self.assertIsNone(job.snapshot()["assistant_message_id"])
+        gate.set()
+        self.assertTrue(job.wait(5))
+        self.assertEqual(job.snapshot()["text"], "途中まで")
+        self.assertEqual(self.messages(self.thread_ids[0]), [("user", "質問"), ("assistant", "途中まで")])
+        self.assertIsNotNone(job.snapshot()["assistant_message_id"])
+
+    def test_job_records_phase_timings_when_enabled(self):
+        """PERF_TIMING が有効なら、ジョブは履歴の読み込みから書き出しまでのフェーズの時間を記録する"""
+        with mock.patch("utils.perf_timing.PERF_TIMING", True):
+            runner = self.make_runner(FakeClient())
+            job = runner.submit(self.thread_ids[0], "質問", "test-model")
+            self.assertTrue(job.wait(5))
+        self.assertEqual(set(job.timings.phases), {"queue_wait", "history_load", "history_conversion",
+                                                   "time_to_first_token", "streaming", "markdown_export"})
+
+    def test_attachments_are_sent_with_their_message(self):
+        """添付ファイルはユーザーメッセージに関連付けて保存し、以降の履歴でも同じメッセージの Part として送る"""
+        db = self.Session()
+        attachment = Attachment(sha256="0" * 64, size_bytes=3, mime_type="application/pdf", filename="doc.pdf")
+        db.add(attachment)
+        db.commit()
+        attachment_id = attachment.id
+        db.close()
+        client = FakeClient()
+        runner = self.make_runner(client)
+        self.assertTrue(runner.submit(self.thread_ids[0], "要約して", "test-model", [attachment_id]).wait(5))
+        self.assertTrue(runner.submit(self.thread_ids[0], "続けて", "test-model").wait(5))
+        first, second = client.histories
+        self.assertEqual([part.text for part in first[-1].parts], ["[doc.pdf]", "要約して"])
+        self.assertEqual([part.text for part in second[0].parts], ["[doc.pdf]", "要約して"])
+        self.assertEqual([part.text for part in second[-1].parts], ["続けて"])
+
+    def test_api_error_marks_job_failed(self):
+        """API エラーでは空の応答を残さず、エラーとして終了する"""
+        runner = self.make_runner(FakeClient(error=RuntimeError("quota exceeded")))
+        job = runner.submit(self.thread_ids[0], "質問", "test-model")
+        self.assertTrue(job.wait(5))
+        self.assertEqual(job.status, ERROR)
+        self.assertIn("quota exceeded", job.error)
+        self.assertEqual(self.messages(self.thread_ids[0]), [("user", "質問")])
+
+    def test_cancel_keeps_partial_response(self):
+        """生成中に中止すると、それまでの応答を保存して終了する"""
+        gate = threading.Event()
+        runner = self.make_runner(FakeClient(chunks=("前半", "後半"), gate=gate))
+        job = runner.submit(self.thread_ids[0], "質問", "test-model")
+        self.assertTrue(runner.cancel(job.job_id))
+        gate.set()
+        self.assertTrue(job.wait(5))
+        self.assertEqual(job.status, CANCELLED)
+        # キャンセルが実行前に届いた場合はメッセージ自体が保存されない
+        self.assertIn(self.messages(self.thread_ids[0]), ([], [("user", "質問"), ("assistant", "前半")]))
+
+    def test_cancel_while_waiting_for_api_slot_frees_the_worker(self):
+        """API の実行枠を待っている間に中止すると、順番を待たずにワーカーを空けて終了する"""
+        scheduler = FairScheduler(capacity=1, project_max_concurrency=0, project_limits={}, project_weights={})
+
+        class ScheduledClient(FakeClient):
+            def generate_content_stream(self, model_name, history, system_prompt=None, usage=None, cancel_event=None, **scheduling):
+                with scheduler.slot(scheduling["project_id"], scheduling["user"], cancel_event=cancel_event):
+                    yield from super().generate_content_stream(model_name, history, system_prompt, usage, **scheduling)
+
+        runner = self.make_runner(ScheduledClient(), workers=1)
+        with scheduler.slot("other", None): # 実行枠を塞いでおく
+            job = runner.submit(self.thread_ids[0], "質問", "test-model")
+            for _ in range(100):
+                if scheduler.metrics()["queued"][INTERACTIVE]:
+                    break
+                time.sleep(0.05)
+            self.assertTrue(runner.cancel(job.job_id))
+            self.assertTrue(job.wait(5))
+            self.assertEqual(job.status, CANCELLED)
+            self.assertEqual(scheduler.metrics()["queued"][INTERACTIVE], 0)
+        self.assertEqual(self.messages(self.thread_ids[0]), [("user", "質問")])
+        # 空いたワーカーで次のジョブを実行できる
+        self.assertTrue(runner.submit(self.thread_ids[1], "次の質問", "test-model").wait(5))
+
+class TestModelComparison(GenerationJobTestCase):
+    """比較ジョブ (GenerationJobRunner.submit_comparison) のテストケース"""
+
+    def test_comparison_runs_models_in_parallel_and_records_metrics(self):
+        """全モデルに同時に送られ、全体の時間は最も遅いモデルに近い"""
+        client = FakeClient(delays={"flash": 0.3, "pro": 0.4})
+        runner = self.make_runner(client)
+        started = time.perf_counter()
+        job = runner.submit_comparison(self.thread_ids[0], "比較して", ["flash", "pro"])
+        self.assertTrue(job.wait(5))
+        elapsed = time.perf_counter() - started
+        self.assertEqual(job.status, DONE)
+        self.assertLess(elapsed, 0.65) # 直列なら 0.7 秒以上かかる
+
+        db = self.Session()
+        answers = get_latest_comparison(db, self.thread_ids[0])
+        self.assertEqual([a.model_name for a in answers], ["flash", "pro"])
+        self.assertEqual([a.adopted for a in answers], [True, False])
+        for answer in answers:
+            self.assertEqual(answer.content, "こんにちは、世界")
+            self.assertGreaterEqual(answer.time_to_first_token_ms, 250)
+            self.assertGreaterEqual(answer.latency_ms, answer.time_to_first_token_ms)
+            self.assertEqual(answer.output_tokens, 2)
+        db.close()
+        # スレッドには採用された1件の応答だけが保存される
+        self.assertEqual(self.messages(self.thread_ids[0]), [("user", "比較して"), ("assistant", "こんにちは、世界")])
+
+    def test_failed_model_falls_back_and_answer_can_be_adopted(self):
+        """先頭のモデルが失敗した場合は次のモデルを採用し、後から別の回答に切り替えられる"""
+        client = FakeClient(failing_models=("flash",), chunks=("pro の回答",))
+        runner = self.make_runner(client)
+        job = runner.submit_comparison(self.thread_ids[0], "質問", ["flash", "pro"])
+        self.assertTrue(job.wait(5))
+        self.assertEqual(job.status, DONE)
+
+        db = self.Session()
+        flash, pro = get_latest_comparison(db, self.thread_ids[0])
+        self.assertIn("unavailable", flash.error)
+        self.assertTrue(pro.adopted)
+        self.assertFalse(adopt_comparison_answer(db, flash.id)) # 空の回答は採用できない
+
+        # 別の回答を採用すると応答メッセージの内容が置き換わる
+        pro.content = "修正した回答"
+        db.commit()
+        self.assertTrue(adopt_comparison_answer(db, pro.id))
+        db.close()
+        self.assertEqual(self.messages(self.thread_ids[0])[-1], ("assistant", "修正した回答"))
+
+    def test_every_answer_is_rolled_up_and_adopting_moves_usage(self):
+        """採用しなかった回答の使用量もそのモデルで集計し、採用を切り替えると応答の使用量と集計も入れ替わる"""
+        class PricedClient(FakeClient):
+            def generate_content_stream(self, model_name, history, system_prompt=None, usage=None, cancel_event=None, **scheduling):
+                yield from super().generate_content_stream(model_name, history, system_prompt, usage, **scheduling)
+                if model_name == "pro": # モデルごとにトークン数を変える
+                    usage["total_tokens"] += 100
+
+        runner = self.make_runner(PricedClient())
+        job = runner.submit_comparison(self.thread_ids[0], "比較して", ["flash", "pro"])
+        self.assertTrue(job.wait(5))
+
+        def usage_by_model(db) -> dict:
+            return {row["model"]: (row["messages"], row["total_tokens"]) for row in get_usage_summary(db, group_by=["model"])}
+
+        db = self.Session()
+        flash, pro = get_latest_comparison(db, self.thread_ids[0])
+        expected = {"flash": (1, flash.total_tokens), "pro": (1, pro.total_tokens)}
+        self.assertEqual(pro.total_tokens - flash.total_tokens, 100)
+        self.assertEqual(usage_by_model(db), expected)
+
+        self.assertTrue(adopt_comparison_answer(db, pro.id))
+        message = db.get(Message, pro.assistant_message_id)
+        self.assertEqual((message.model_name, message.total_tokens, message.latency_ms),
+                         ("pro", pro.total_tokens, pro.latency_ms))
+        self.assertEqual(usage_by_model(db), expected)
+        self.assertTrue(adopt_comparison_answer(db, pro.id)) # 同じ回答を採用し直しても二重に数えない
+        self.assertEqual(usage_by_model(db), expected)
+        self.assertTrue(adopt_comparison_answer(db, flash.id))
+        self.assertEqual(db.get(Message, flash.assistant_message_id).model_name, "flash")
+        self.assertEqual(usage_by_model(db), expected)
+        # 集計を作り直しても同じになる
+        rebuild_usage_rollups(db)
+        self.assertEqual(usage_by_model(db), expected)
+        db.close()
+
+    def test_all_models_failing_marks_job_failed(self):
+        """全てのモデルが失敗した場合はエラーとして終了し、応答は保存されない"""
+        runner = self.make_runner(FakeClient(failing_models=("flash", "pro")))
+        job = runner.submit_comparison(self.thread_ids[0], "質問", ["flash", "pro"])
+        self.assertTrue(job.wait(5))
+        self.assertEqual(job.status, ERROR)
+        self.assertEqual(self.messages(self.thread_ids[0]), [("user", "質問")])
+        db = self.Session()
+        self.assertEqual(db.query(ModelComparisonAnswer).count(), 2)
+        db.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+import sys
+import os
+import logging
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from utils.logging_setup import parse_log_levels, TruncatedText, should_log_content
+
+class TestLoggingSetup(unittest.TestCase):
+    """utils.logging_setup のテストケース"""
+
+    def test_parse_log_levels(self):
+        """ロガーごとのレベル指定を解釈し、不正な項目は無視する"""
+        levels = parse_log_levels("app=debug, database=WARNING,broken,httpx=NOPE,")
+        self.assertEqual(levels, {"app": logging.DEBUG, "database": logging.WARNING})
+
+    def test_truncated_text(self):
+        """長い本文は str() されたときにだけ切り詰められる"""
+        self.assertEqual(str(TruncatedText("short", max_chars=10)), "short")
+        truncated = str(TruncatedText("x" * 30, max_chars=10))
+        self.assertTrue(truncated.startswith("x" * 10 + "..."))
+        self.assertIn("30", truncated)
+        self.assertEqual(str(TruncatedText(["a", "b"], max_chars=100)), "['a', 'b']")
+
+    def test_should_log_content_bounds(self):
+        """サンプリング率 0 は常に False、1 は常に True"""
+        self.assertFalse(any(should_log_content(0.0) for _ in range(100)))
+        self.assertTrue(all(should_log_content(1.0) for _ in range(100)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+import sys
+import os
+import tempfile
+import shutil
+import time
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from utils.markdown_export import MarkdownWriter, get_markdown_file_path
+
+class TestMarkdownWriter(unittest.TestCase):
+    """markdown_export.MarkdownWriter クラスのテストケース"""
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+
+    def read(self, project_name: str, thread_id: int, thread_name: str) -> str:
+        path = get_markdown_file_path(project_name, thread_id, thread_name, self.base_dir)
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+
+    def test_close_drains_queued_messages_in_order(self):
+        """close() でキューに残ったメッセージが順番通りに書き出される"""
+        # 時間・サイズでは書き出されない設定にして、close 時の書き出しだけを確認
+        writer = MarkdownWriter(base_dir=self.base_dir, flush_bytes=10**9, flush_interval=3600).start()
+        writer.submit("Project/A", 1, "Thread: one", "user", "質問です")
+        writer.submit("Project/A", 1, "Thread: one", "assistant", "回答です")
+        writer.close()
+
+        content = self.read("Project/A", 1, "Thread: one")
+        self.assertIn("**[User]**", content)
+        self.assertLess(content.index("質問です"), content.index("回答です"))
+
+    def test_flushes_when_buffer_exceeds_size(self):
+        """バッファが flush_bytes を超えると close を待たずに書き出される"""
+        writer = MarkdownWriter(base_dir=self.base_dir, flush_bytes=1, flush_interval=3600).start()
+        writer.submit("P", 2, "T", "user", "hello")
+        path = get_markdown_file_path("P", 2, "T", self.base_dir)
+        for _ in range(100):
+            if os.path.exists(path) and "hello" in open(path, encoding="utf-8").read():
+                break
+            time.sleep(0.05)
+        self.assertIn("hello", self.read("P", 2, "T"))
+        writer.close()
+
+    def test_lru_pool_limits_open_handles(self):
+        """開いたままのファイルハンドルは max_open_files 個までに制限される"""
+        writer = MarkdownWriter(base_dir=self.base_dir, max_open_files=2)
+        for thread_id in range(5):
+            writer.submit("P", thread_id, "T", "user", f"message {thread_id}")
+            writer._drain_queue()
+            writer._flush()
+            self.assertLessEqual(len(writer._handles), 2)
+        writer.close()
+        for thread_id in range(5):
+            self.assertIn(f"message {thread_id}", self.read("P", thread_id, "T"))
+
+    def test_submit_after_close_is_rejected(self):
+        """close 後の submit は False を返す"""
+        writer = MarkdownWriter(base_dir=self.base_dir).start()
+        writer.close()
+        self.assertFalse(writer.submit("P", 1, "T", "user", "late"))
+
+if __name__ == '__main__':
+    unittest.main()
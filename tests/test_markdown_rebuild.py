@@ -0,0 +1,171 @@
+import unittest
+import sys
+import os
+import tempfile
+import shutil
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from unittest import mock
+from utils.markdown_rebuild import rebuild_markdown_archive
+from utils.markdown_export import MarkdownWriter, get_markdown_file_path, enqueue_thread_history_to_markdown
+from database.crud import fork_thread, get_thread_history
+from models.models import Base, Project, Thread, Message
+
+class TestRebuildMarkdownArchive(unittest.TestCase):
+    """markdown_rebuild.rebuild_markdown_archive 関数のテストケース"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.base_dir = os.path.join(self.work_dir, "markdown")
+        self.database_url = f"sqlite:///{os.path.join(self.work_dir, 'test.db')}"
+        self.engine = create_engine(self.database_url)
+        Base.metadata.create_all(bind=self.engine)
+        self.db = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)()
+
+        self.project = Project(name="Rebuild Project", system_prompt="prompt")
+        self.other_project = Project(name="Other Project", system_prompt="prompt")
+        self.db.add_all([self.project, self.other_project])
+        self.db.commit()
+        self.threads = [Thread(project_id=self.project.id, name=f"Thread {i}") for i in range(5)]
+        self.other_thread = Thread(project_id=self.other_project.id, name="Other Thread")
+        self.db.add_all(self.threads + [self.other_thread])
+        self.db.commit()
+        for thread in self.threads + [self.other_thread]:
+            self.db.add_all([
+                Message(thread_id=thread.id, role="user", content=f"質問 {thread.id}"),
+                Message(thread_id=thread.id, role="assistant", content=f"回答 {thread.id}"),
+            ])
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        self.engine.dispose()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def path_for(self, project: Project, thread: Thread) -> str:
+        return get_markdown_file_path(project.name, thread.id, thread.name, self.base_dir)
+
+    def test_rebuild_writes_all_threads_in_parallel(self):
+        """全スレッドのファイルが生成され、内容が時系列順になる"""
+        stats = rebuild_markdown_archive(self.database_url, self.base_dir, workers=2)
+        self.assertEqual(stats["threads"], 6)
+        self.assertEqual(stats["written"], 6)
+        with open(self.path_for(self.project, self.threads[0]), encoding="utf-8") as f:
+            content = f.read()
+        self.assertLess(content.index("**[User]**"), content.index("**[Assistant]**"))
+        self.assertIn(f"回答 {self.threads[0].id}", content)
+
+    def test_unchanged_files_are_skipped(self):
+        """内容が変わっていないファイルは2回目の再生成で書き込まれない"""
+        rebuild_markdown_archive(self.database_url, self.base_dir, workers=1)
+        self.db.add(Message(thread_id=self.threads[1].id, role="user", content="追加"))
+        self.db.commit()
+
+        stats = rebuild_markdown_archive(self.database_url, self.base_dir, workers=1)
+        self.assertEqual(stats["written"], 1)
+        self.assertEqual(stats["skipped"], 5)
+
+    def test_renamed_thread_replaces_stale_file(self):
+        """スレッド名を変更すると古いファイル名のファイルが削除される"""
+        rebuild_markdown_archive(self.database_url, self.base_dir, workers=1)
+        old_path = self.path_for(self.project, self.threads[2])
+        self.threads[2].name = "Renamed Thread"
+        self.db.commit()
+
+        stats = rebuild_markdown_archive(self.database_url, self.base_dir, workers=1)
+        self.assertEqual(stats["removed"], 1)
+        self.assertFalse(os.path.exists(old_path))
+        self.assertTrue(os.path.exists(self.path_for(self.project, self.threads[2])))
+
+    def test_rebuild_single_project(self):
+        """project_id を指定するとそのプロジェクトのスレッドだけが再生成される"""
+        stats = rebuild_markdown_archive(self.database_url, self.base_dir, project_id=self.other_project.id, workers=1)
+        self.assertEqual(stats["threads"], 1)
+        self.assertTrue(os.path.exists(self.path_for(self.other_project, self.other_thread)))
+        self.assertFalse(os.path.exists(self.path_for(self.project, self.threads[0])))
+
+    def test_prune_keeps_sharded_threads(self):
+        """分割保存が有効な場合、プロジェクトの DB のスレッドも再生成し、--prune で孤立扱いしない"""
+        from database.database import init_db
+        from database.sharding import ShardRouter
+        init_db(bind=self.engine)
+        router = ShardRouter(self.engine, shard_dir=os.path.join(self.work_dir, "shards"))
+        try:
+            shard_project = router.create_project("Shard Project", "prompt")
+            shard_db = router.session_for_project(shard_project.id)
+            try:
+                shard_thread = Thread(project_id=shard_project.id, name="Shard Thread")
+                shard_db.add(shard_thread)
+                shard_db.flush()
+                shard_db.add(Message(thread_id=shard_thread.id, role="user", content="分割保存の質問"))
+                shard_db.commit()
+                shard_path = get_markdown_file_path(shard_project.name, shard_thread.id, shard_thread.name, self.base_dir)
+            finally:
+                shard_db.close()
+            orphan_path = get_markdown_file_path(self.project.name, 999, "Deleted", self.base_dir)
+            os.makedirs(os.path.dirname(orphan_path), exist_ok=True)
+            open(orphan_path, "w").close()
+
+            with mock.patch("database.sharding.get_shard_router", return_value=router), \
+                 mock.patch("database.database.DATABASE_URL", self.database_url):
+                stats = rebuild_markdown_archive(base_dir=self.base_dir, workers=1, prune=True)
+                self.assertEqual((stats["threads"], stats["removed"]), (7, 1))
+                self.assertTrue(os.path.exists(shard_path))
+                self.assertTrue(os.path.exists(self.path_for(self.project, self.threads[0])))
+                self.assertFalse(os.path.exists(orphan_path))
+
+                stats = rebuild_markdown_archive(base_dir=self.base_dir, workers=1, prune=True)
+                self.assertEqual((stats["skipped"], stats["removed"]), (7, 0))
+                self.assertTrue(os.path.exists(shard_path))
+        finally:
+            router.close()
+
+    def read(self, project: Project, thread: Thread) -> str:
+        with open(self.path_for(project, thread), encoding="utf-8") as f:
+            return f.read()
+
+    def test_forked_thread_includes_inherited_history(self):
+        """分岐したスレッドのファイルは分岐点までの分岐元のメッセージで始まり、分岐時に書き出す内容と一致する"""
+        parent = self.threads[0]
+        first_message_id = get_thread_history(self.db, parent.id)[0].id
+        fork = fork_thread(self.db, parent.id, first_message_id, name="Fork")
+        writer = MarkdownWriter(base_dir=self.base_dir)
+        with mock.patch("utils.markdown_export.get_markdown_writer", return_value=writer):
+            enqueue_thread_history_to_markdown(self.project.name, fork.id, fork.name, get_thread_history(self.db, fork.id))
+        writer.close()
+        live = self.read(self.project, fork)
+        self.assertIn(f"質問 {parent.id}", live)
+        self.assertNotIn(f"回答 {parent.id}", live)
+
+        os.remove(self.path_for(self.project, fork))
+        rebuild_markdown_archive(self.database_url, self.base_dir, workers=2)
+        self.assertEqual(self.read(self.project, fork), live)
+
+    def test_writer_reopens_file_replaced_by_rebuild(self):
+        """再生成でファイルが置き換え・削除されても、ライターが開いたままのハンドルに書いた内容は失われない"""
+        thread = self.threads[0]
+        writer = MarkdownWriter(base_dir=self.base_dir)
+        writer.submit(self.project.name, thread.id, thread.name, "user", "再生成前の追記")
+        writer._drain_queue()
+        writer._flush()
+
+        rebuild_markdown_archive(self.database_url, self.base_dir, workers=1)
+        writer.submit(self.project.name, thread.id, thread.name, "assistant", "再生成後の追記")
+        writer._drain_queue()
+        writer._flush()
+        content = self.read(self.project, thread)
+        self.assertIn(f"回答 {thread.id}", content)
+        self.assertIn("再生成後の追記", content)
+
+        os.remove(self.path_for(self.project, thread)) # prune などで削除された場合は作り直す
+        writer.submit(self.project.name, thread.id, thread.name, "user", "削除後の追記")
+        writer.close()
+        self.assertIn("削除後の追記", self.read(self.project, thread))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import sys
+import os
+import time
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from utils.perf_timing import PhaseTimer, parse_records, summarize, format_phases, percentile
+
+class TestPhaseTimer(unittest.TestCase):
+    """utils.perf_timing のテストケース"""
+
+    def test_disabled_timer_records_nothing(self):
+        """無効のときはフェーズを記録せず、ログも出さない"""
+        timer = PhaseTimer("rerun", enabled=False)
+        with timer.phase("init_db"):
+            pass
+        timer.add("streaming", 10.0)
+        self.assertEqual(timer.phases, {})
+        with self.assertNoLogs("perf"):
+            timer.emit()
+
+    def test_phases_are_accumulated_and_emitted_as_json(self):
+        """同じ名前のフェーズは加算され、JSON のログとして出力される"""
+        timer = PhaseTimer("rerun", enabled=True, thread_id=3)
+        with timer.phase("sidebar_queries"):
+            time.sleep(0.01)
+        with timer.phase("sidebar_queries"):
+            time.sleep(0.01)
+        timer.add("history_load", 5.0)
+        self.assertGreaterEqual(timer.phases["sidebar_queries"], 20.0)
+        self.assertIn("| history_load | 5.0 |", format_phases(timer.to_dict()))
+
+        with self.assertLogs("perf", level="INFO") as captured:
+            timer.emit()
+        records = parse_records([f"2025-01-01 00:00:00,000 - perf - INFO - {line.split(':', 2)[2]}"
+                                 for line in captured.output])
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["kind"], "rerun")
+        self.assertEqual(records[0]["thread_id"], 3)
+        self.assertEqual(records[0]["phases"]["history_load"], 5.0)
+
+    def test_summarize_percentiles(self):
+        """種類・フェーズごとにパーセンタイルを集計する"""
+        records = [{"kind": "rerun", "total_ms": float(i), "phases": {"init_db": float(i)}} for i in range(1, 101)]
+        records.append({"kind": "generation", "total_ms": 500.0, "phases": {"time_to_first_token": 400.0}})
+        summary = summarize(records + parse_records(["not a record", "perf_timing {broken"]))
+        self.assertEqual(summary["rerun"]["init_db"]["count"], 100)
+        self.assertEqual(summary["rerun"]["init_db"]["p50_ms"], 51.0)
+        self.assertEqual(summary["rerun"]["total"]["p95_ms"], 96.0)
+        self.assertEqual(summary["generation"]["time_to_first_token"]["max_ms"], 400.0)
+
+    def test_percentile_of_empty_values_returns_default(self):
+        self.assertEqual(percentile([3.0, 1.0, 2.0], 0.5), 2.0)
+        self.assertIsNone(percentile([], 0.5))
+        self.assertEqual(percentile([], 0.95, default=0.0), 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
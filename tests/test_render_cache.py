@@ -0,0 +1,78 @@
+import unittest
+import sys
+import os
+import datetime
+from types import SimpleNamespace
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from utils.render_cache import MessageRenderCache
+
+def make_messages(count: int, start: int = 1) -> list:
+    base = datetime.datetime(2025, 1, 1)
+    return [
+        SimpleNamespace(id=i, role="user" if i % 2 else "assistant", content=f"message {i}",
+                        created_at=base + datetime.timedelta(minutes=i))
+        for i in range(start, start + count)
+    ]
+
+class TestMessageRenderCache(unittest.TestCase):
+    """utils.render_cache.MessageRenderCache のテストケース"""
+
+    def test_prepare_history_splits_blocks_and_recent(self):
+        """直近 recent 件を含まない完全なブロックだけがまとめられる"""
+        cache = MessageRenderCache()
+        messages = make_messages(25)
+        blocks, recent = cache.prepare_history(messages, recent=5, block_size=10)
+        self.assertEqual(len(blocks), 2)
+        self.assertEqual([m.id for m in recent], list(range(21, 26)))
+        self.assertIn("message 1\n", blocks[0])
+        self.assertIn("message 20\n", blocks[1])
+
+        # 件数が少なければ全て個別に表示する
+        blocks, recent = cache.prepare_history(make_messages(12), recent=5, block_size=10)
+        self.assertEqual(blocks, [])
+        self.assertEqual(len(recent), 12)
+
+    def test_appending_messages_reuses_existing_blocks(self):
+        """メッセージを追加しても既存のブロックはキャッシュから返され、内容も変わらない"""
+        cache = MessageRenderCache()
+        messages = make_messages(30)
+        first_blocks, _ = cache.prepare_history(messages, recent=5, block_size=10)
+        misses = cache.misses
+
+        messages += make_messages(2, start=31)
+        blocks, recent = cache.prepare_history(messages, recent=5, block_size=10)
+        self.assertEqual(blocks[:2], first_blocks)
+        self.assertEqual(cache.misses, misses) # 新しいブロックはまだできない
+        self.assertEqual([m.id for m in recent], list(range(21, 33)))
+
+    def test_edited_message_rebuilds_its_block(self):
+        """本文が変わったメッセージを含むブロックだけが作り直される"""
+        cache = MessageRenderCache()
+        messages = make_messages(25)
+        cache.prepare_history(messages, recent=5, block_size=10)
+
+        messages[12].content = "edited content"
+        blocks, _ = cache.prepare_history(messages, recent=5, block_size=10)
+        self.assertIn("edited content", blocks[1])
+        self.assertNotIn("message 13\n", blocks[1])
+
+    def test_unclosed_code_fence_is_closed(self):
+        """閉じられていないコードブロックは、後続のメッセージを巻き込まないよう閉じられる"""
+        cache = MessageRenderCache()
+        messages = make_messages(4)
+        messages[0].content = "```python\nprint('open')"
+        blocks, _ = cache.prepare_history(messages, recent=0, block_size=2)
+        self.assertEqual(blocks[0].count("```"), 2)
+
+    def test_lru_eviction(self):
+        """max_entries を超えると古いエントリから削除される"""
+        cache = MessageRenderCache(max_entries=3)
+        cache.prepare_history(make_messages(10), recent=0, block_size=1)
+        self.assertEqual(len(cache._entries), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+import sys
+import os
+import asyncio
+import threading
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from utils.request_scheduler import FairScheduler, INTERACTIVE, BATCH, SlotCancelled, _parse_mapping
+
+class TestFairScheduler(unittest.TestCase):
+    """utils.request_scheduler.FairScheduler (API 呼び出しの優先度と公平な割り当て) のテストケース"""
+
+    def make(self, capacity=1, **kwargs) -> FairScheduler:
+        return FairScheduler(capacity=capacity, project_max_concurrency=kwargs.pop("project_max_concurrency", 0),
+                             project_limits=kwargs.pop("project_limits", {}),
+                             project_weights=kwargs.pop("project_weights", {}))
+
+    def grant_order(self, scheduler: FairScheduler, requests: list[tuple]) -> list[tuple]:
+        """実行枠を1つ占有した状態で requests を登録し、1件ずつ解放しながら開始された順を返す"""
+        blocker = scheduler._enqueue("blocker", None, INTERACTIVE)
+        tickets = [scheduler._enqueue(*request) for request in requests]
+        order = []
+        running = blocker
+        for _ in tickets:
+            scheduler._release(running)
+            running = next(ticket for ticket in tickets if ticket.granted and not ticket.released)
+            order.append((running.project_id, running.user, running.priority))
+        scheduler._release(running)
+        return order
+
+    def test_interactive_requests_go_before_batch(self):
+        order = self.grant_order(self.make(), [(1, "batch", BATCH), (1, "batch", BATCH), (2, "alice", INTERACTIVE)])
+        self.assertEqual([priority for _, _, priority in order], [INTERACTIVE, BATCH, BATCH])
+
+    def test_projects_share_capacity_by_weight(self):
+        # 大量に投入したプロジェクトがあっても、他のプロジェクトを交互に開始する
+        order = self.grant_order(self.make(), [(1, "u", INTERACTIVE)] * 4 + [(2, "u", INTERACTIVE)] * 2)
+        self.assertEqual([project for project, _, _ in order], [1, 2, 1, 2, 1, 1])
+        # 重み 2 のプロジェクトは2倍の頻度で開始する
+        order = self.grant_order(self.make(project_weights={1: 2.0}),
+                                 [(1, "u", INTERACTIVE)] * 4 + [(2, "u", INTERACTIVE)] * 2)
+        self.assertEqual([project for project, _, _ in order], [1, 2, 1, 1, 2, 1])
+
+    def test_users_in_a_project_take_turns(self):
+        order = self.grant_order(self.make(), [(1, "alice", INTERACTIVE)] * 3 + [(1, "bob", INTERACTIVE)])
+        self.assertEqual([user for _, user, _ in order], ["alice", "bob", "alice", "alice"])
+
+    def test_project_limit_lets_other_projects_run(self):
+        scheduler = self.make(capacity=3, project_limits={1: 1})
+        tickets = [scheduler._enqueue(1, "u", INTERACTIVE) for _ in range(2)] + [scheduler._enqueue(2, "u", INTERACTIVE)]
+        self.assertEqual([ticket.granted for ticket in tickets], [True, False, True])
+        metrics = scheduler.metrics()
+        self.assertEqual(metrics["projects"][1], {"running": 1, "queued": 1, "limit": 1})
+        self.assertEqual((metrics["running"], metrics["queued"][INTERACTIVE]), (2, 1))
+        scheduler._release(tickets[0])
+        self.assertTrue(tickets[1].granted)
+
+    def test_idle_project_does_not_bank_credit(self):
+        scheduler = self.make()
+        # プロジェクト 1 だけが使っていた間の使用量は、後から来たプロジェクト 2 の優先にはならない
+        self.grant_order(scheduler, [(1, "u", INTERACTIVE)] * 5)
+        order = self.grant_order(scheduler, [(2, "u", INTERACTIVE)] * 3 + [(1, "u", INTERACTIVE)] * 2)
+        self.assertEqual([project for project, _, _ in order], [2, 1, 2, 1, 2])
+        self.assertEqual(scheduler.metrics()["projects"], {})
+
+    def test_slot_records_wait_metrics(self):
+        scheduler = self.make(capacity=2)
+        with scheduler.slot(1, "alice"):
+            with scheduler.slot(2, "bob", BATCH):
+                self.assertEqual(scheduler.metrics()["running"], 2)
+        metrics = scheduler.metrics()
+        self.assertEqual(metrics["running"], 0)
+        self.assertEqual(metrics["granted"], {INTERACTIVE: 1, BATCH: 1})
+        self.assertEqual(metrics["wait_ms"][BATCH]["count"], 1)
+        with self.assertRaises(ValueError):
+            with scheduler.slot(1, "alice", "urgent"):
+                pass
+
+    def test_async_slot_waits_and_cancelled_waiters_leave_the_queue(self):
+        scheduler = self.make()
+
+        async def main():
+            order = []
+            async def request(name, hold):
+                async with scheduler.slot_async(1, name):
+                    order.append(name)
+                    await hold.wait()
+            first_hold, second_hold = asyncio.Event(), asyncio.Event()
+            first = asyncio.create_task(request("first", first_hold))
+            await asyncio.sleep(0.01)
+            cancelled = asyncio.create_task(request("cancelled", asyncio.Event()))
+            second = asyncio.create_task(request("second", second_hold))
+            await asyncio.sleep(0.01)
+            self.assertEqual(scheduler.metrics()["queued"][INTERACTIVE], 2)
+            cancelled.cancel()
+            await asyncio.sleep(0.01)
+            first_hold.set()
+            second_hold.set()
+            await asyncio.gather(first, second)
+            return order
+
+        self.assertEqual(asyncio.run(main()), ["first", "second"])
+        self.assertEqual(scheduler.metrics()["running"], 0)
+
+    def test_parse_mapping(self):
+        self.assertEqual(_parse_mapping("1:2, 5:0.5,", float), {1: 2.0, 5: 0.5})
+        self.assertEqual(_parse_mapping("", int), {})
+
+    def test_cancelled_slot_wait_leaves_the_queue(self):
+        scheduler = self.make()
+        cancel_event = threading.Event()
+        with scheduler.slot(1, "alice"):
+            threading.Timer(0.05, cancel_event.set).start()
+            with self.assertRaises(SlotCancelled):
+                with scheduler.slot(2, "bob", cancel_event=cancel_event):
+                    self.fail("実行枠は空いていない")
+            self.assertEqual(scheduler.metrics()["queued"][INTERACTIVE], 0)
+        with scheduler.slot(2, "bob", cancel_event=cancel_event): # 空いていれば中止済みでも取得できる
+            self.assertEqual(scheduler.metrics()["running"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
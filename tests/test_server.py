@@ -0,0 +1,229 @@
+import unittest
+import sys
+import os
+import json
+import datetime
+import tempfile
+import shutil
+from types import SimpleNamespace
+from unittest import mock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from starlette.testclient import TestClient
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from api.server import create_app
+from api.gemini_client import GeminiClient
+from utils.blob_store import BlobStore
+from database.sharding import ShardRouter, SHARD_ID_SPAN
+from database.archive import archive_stale_threads, dispose_archive
+
+class FakeAsyncClient:
+    """GeminiClient の代わりに決まった応答を非同期でストリーミングするクライアント"""
+
+    def __init__(self, chunks=("こんにちは", "、世界"), error: Exception | None = None):
+        self.chunks = chunks
+        self.error = error
+        self.histories = []
+
+    async def generate_content_stream_async(self, model_name, history, system_prompt=None, usage=None, **scheduling):
+        self.histories.append(history)
+        for chunk in self.chunks:
+            yield chunk
+        if self.error is not None:
+            raise self.error
+        if usage is not None:
+            usage.update(prompt_tokens=len(history), output_tokens=len(self.chunks), total_tokens=len(history) + len(self.chunks))
+
+    def attachment_parts(self, attachments, store, on_upload=None):
+        # 小さいファイルはリクエストに直接含めるため、Files API は使われない
+        return GeminiClient(client=SimpleNamespace()).attachment_parts(attachments, store, on_upload)
+
+def parse_sse(text: str) -> list[tuple[str, dict]]:
+    events = []
+    for block in text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+class TestApiServer(unittest.TestCase):
+    """api.server の HTTP/SSE エンドポイントのテストケース"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.work_dir, 'test.db')}",
+                                    connect_args={"check_same_thread": False})
+        self.fake = FakeAsyncClient()
+        # テスト中はマークダウンファイルを書き出さない
+        for name in ("enqueue_message_to_markdown", "enqueue_thread_history_to_markdown"):
+            patcher = mock.patch(f"api.server.{name}")
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.blob_store = BlobStore(os.path.join(self.work_dir, "attachments"))
+        self.client = TestClient(create_app(engine=self.engine, client_factory=lambda: self.fake, blob_store=self.blob_store))
+        self.client.__enter__()
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+        self.engine.dispose()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def create_thread(self) -> int:
+        project = self.client.post("/projects", json={"name": "API Project", "system_prompt": "prompt"}).json()
+        return self.client.post(f"/projects/{project['id']}/threads").json()["id"]
+
+    def test_project_and_thread_crud(self):
+        """プロジェクトとスレッドの作成・取得・更新・削除"""
+        response = self.client.post("/projects", json={"name": "API Project", "system_prompt": "prompt"})
+        self.assertEqual(response.status_code, 201)
+        project_id = response.json()["id"]
+        self.assertEqual(self.client.post("/projects", json={"name": "API Project", "system_prompt": ""}).status_code, 409)
+
+        response = self.client.patch(f"/projects/{project_id}", json={"system_prompt": "new prompt"})
+        self.assertEqual(response.json()["system_prompt"], "new prompt")
+        self.assertEqual(response.json()["name"], "API Project")
+
+        thread = self.client.post(f"/projects/{project_id}/threads", json={"name": "Thread A"}).json()
+        self.assertEqual(self.client.patch(f"/threads/{thread['id']}", json={"name": "Renamed"}).json()["name"], "Renamed")
+        self.assertEqual([t["name"] for t in self.client.get(f"/projects/{project_id}/threads").json()], ["Renamed"])
+        self.assertEqual(self.client.delete(f"/projects/{project_id}/threads/empty").json(), {"deleted": 1})
+
+        self.assertEqual(self.client.delete(f"/projects/{project_id}").status_code, 204)
+        self.assertEqual(self.client.get(f"/projects/{project_id}").status_code, 404)
+        self.assertEqual(self.client.get("/projects").json(), [])
+
+    def test_chat_streams_events_and_saves_messages(self):
+        """チャットは SSE で応答を返し、両方のメッセージを保存する"""
+        thread_id = self.create_thread()
+        response = self.client.post(f"/threads/{thread_id}/chat", json={"prompt": "最初の質問"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
+
+        events = parse_sse(response.text)
+        self.assertEqual([name for name, _ in events], ["message", "delta", "delta", "done"])
+        self.assertEqual(events[-1][1]["message"]["content"], "こんにちは、世界")
+        self.assertEqual(events[-1][1]["usage"]["output_tokens"], 2)
+
+        messages = self.client.get(f"/threads/{thread_id}/messages").json()
+        self.assertEqual([(m["role"], m["content"]) for m in messages],
+                         [("user", "最初の質問"), ("assistant", "こんにちは、世界")])
+        self.assertEqual(self.client.get(f"/threads/{thread_id}").json()["name"], "最初の質問")
+        # after_id で続きだけを取得できる
+        self.assertEqual(len(self.client.get(f"/threads/{thread_id}/messages", params={"after_id": messages[0]["id"]}).json()), 1)
+
+        # 2回目は前のやり取りが履歴に含まれる
+        self.client.post(f"/threads/{thread_id}/chat", json={"prompt": "次の質問"})
+        self.assertEqual(len(self.fake.histories[-1]), 3)
+
+        # 応答ごとの使用量がモデル・日付ごとに集計される
+        usage = self.client.get("/usage", params={"group_by": "model,day"}).json()
+        self.assertEqual(len(usage), 1)
+        self.assertEqual((usage[0]["messages"], usage[0]["output_tokens"]), (2, 4))
+        self.assertEqual(self.client.get("/usage", params={"group_by": "user"}).status_code, 400)
+
+    def test_fork_continues_from_shared_history(self):
+        """分岐したスレッドは分岐点までの履歴を共有し、その続きで応答を生成する"""
+        thread_id = self.create_thread()
+        self.client.post(f"/threads/{thread_id}/chat", json={"prompt": "最初の質問"})
+        self.client.post(f"/threads/{thread_id}/chat", json={"prompt": "次の質問"})
+        first_answer = self.client.get(f"/threads/{thread_id}/messages").json()[1]
+
+        response = self.client.post(f"/threads/{thread_id}/fork", json={"message_id": first_answer["id"]})
+        self.assertEqual(response.status_code, 201)
+        fork = response.json()
+        self.assertEqual((fork["parent_thread_id"], fork["branch_message_id"]), (thread_id, first_answer["id"]))
+
+        self.client.post(f"/threads/{fork['id']}/chat", json={"prompt": "別の質問"})
+        self.assertEqual(len(self.fake.histories[-1]), 3) # 分岐点までの2件 + 新しい質問
+        contents = [m["content"] for m in self.client.get(f"/threads/{fork['id']}/messages").json()]
+        self.assertEqual(contents, ["最初の質問", "こんにちは、世界", "別の質問", "こんにちは、世界"])
+        self.assertEqual(self.client.post(f"/threads/{fork['id']}/fork", json={"message_id": 9999}).status_code, 404)
+
+    def test_chat_error_keeps_partial_response(self):
+        """生成中のエラーは error イベントで返し、途中までの応答は保存する"""
+        self.fake.error = RuntimeError("quota exceeded")
+        thread_id = self.create_thread()
+        events = parse_sse(self.client.post(f"/threads/{thread_id}/chat", json={"prompt": "質問"}).text)
+        self.assertEqual(events[-1][0], "error")
+        self.assertIn("quota exceeded", events[-1][1]["detail"])
+        self.assertEqual(len(self.client.get(f"/threads/{thread_id}/messages").json()), 2)
+
+    def test_attachments_are_deduplicated_and_sent_with_history(self):
+        """同じ内容の添付ファイルは同じ ID になり、添付したメッセージの Part として毎回送られる"""
+        upload = lambda name: self.client.post("/attachments", params={"filename": name}, content=b"%PDF-1.7 doc",
+                                               headers={"Content-Type": "application/pdf"})
+        response = upload("doc.pdf")
+        self.assertEqual(response.status_code, 201)
+        attachment = response.json()
+        self.assertEqual(upload("copy.pdf").json()["id"], attachment["id"])
+        self.assertEqual((attachment["size_bytes"], attachment["mime_type"]), (12, "application/pdf"))
+        content = self.client.get(f"/attachments/{attachment['id']}/content")
+        self.assertEqual((content.content, content.headers["etag"]), (b"%PDF-1.7 doc", f'"{attachment["sha256"]}"'))
+
+        thread_id = self.create_thread()
+        self.client.post(f"/threads/{thread_id}/chat", json={"prompt": "要約して", "attachment_ids": [attachment["id"]]})
+        self.client.post(f"/threads/{thread_id}/chat", json={"prompt": "続けて"})
+        first_turn = self.fake.histories[-1][0]
+        self.assertEqual(first_turn.parts[0].inline_data.data, b"%PDF-1.7 doc")
+        self.assertEqual(first_turn.parts[1].text, "要約して")
+
+        self.assertEqual(self.client.post(f"/threads/{thread_id}/chat",
+                                          json={"prompt": "x", "attachment_ids": [999]}).status_code, 400)
+        self.assertEqual(self.client.post("/attachments", content=b"x").status_code, 400)
+        self.assertEqual(self.client.get("/attachments/999").status_code, 404)
+
+    def test_validation_errors(self):
+        """存在しないスレッドや不正な入力はエラーを返す"""
+        self.assertEqual(self.client.post("/threads/999/chat", json={"prompt": "x"}).status_code, 404)
+        thread_id = self.create_thread()
+        self.assertEqual(self.client.post(f"/threads/{thread_id}/chat", json={"prompt": " "}).status_code, 400)
+        self.assertEqual(self.client.post(f"/threads/{thread_id}/chat", json={"prompt": "x", "priority": "urgent"}).status_code, 400)
+        self.assertIn("queued", self.client.get("/scheduler").json())
+        self.assertEqual(self.client.post("/projects", content="not json").status_code, 400)
+        self.assertEqual(self.client.get(f"/threads/{thread_id}/messages", params={"limit": "x"}).status_code, 400)
+
+    def test_archived_thread_is_restored_when_opened(self):
+        """アーカイブしたスレッドは検索では archived=1 のときだけヒットし、メッセージを読むとアーカイブから戻る"""
+        thread_id = self.create_thread()
+        self.client.post(f"/threads/{thread_id}/chat", json={"prompt": "古い質問"})
+        self.addCleanup(dispose_archive, os.path.join(self.work_dir, "test.db"))
+        db = Session(self.engine)
+        try:
+            self.assertEqual(archive_stale_threads(db, datetime.datetime.utcnow() + datetime.timedelta(days=1)), 1)
+        finally:
+            db.close()
+        self.assertIsNotNone(self.client.get(f"/threads/{thread_id}").json()["archived_at"])
+        self.assertEqual(self.client.get("/search", params={"q": "古い"}).json(), [])
+        self.assertEqual(len(self.client.get("/search", params={"q": "古い", "archived": "1"}).json()), 1)
+
+        messages = self.client.get(f"/threads/{thread_id}/messages").json()
+        self.assertEqual([m["content"] for m in messages], ["古い質問", "こんにちは、世界"])
+        self.assertIsNone(self.client.get(f"/threads/{thread_id}").json()["archived_at"])
+        self.assertEqual(len(self.client.get("/search", params={"q": "古い"}).json()), 1)
+
+    def test_sharded_storage(self):
+        """分割保存ではプロジェクトごとの DB に保存し、ID から DB を選ぶ"""
+        router = ShardRouter(self.engine, shard_dir=os.path.join(self.work_dir, "shards"))
+        self.addCleanup(router.close)
+        with TestClient(create_app(engine=self.engine, client_factory=lambda: self.fake,
+                                   blob_store=self.blob_store, shards=router)) as client:
+            project = client.post("/projects", json={"name": "Sharded", "system_prompt": ""}).json()
+            thread_id = client.post(f"/projects/{project['id']}/threads").json()["id"]
+            self.assertEqual(thread_id, project["id"] * SHARD_ID_SPAN + 1)
+            client.post(f"/threads/{thread_id}/chat", json={"prompt": "分割の質問"})
+            self.assertEqual(len(client.get(f"/threads/{thread_id}/messages").json()), 2)
+            self.assertEqual([hit["content"] for hit in client.get("/search", params={"q": "分割"}).json()], ["分割の質問"])
+            self.assertEqual(len(client.get("/usage", params={"group_by": "project"}).json()), 1)
+            self.assertEqual(client.get("/usage", params={"group_by": "model"}).status_code, 400)
+            self.assertEqual(client.get(f"/threads/{999 * SHARD_ID_SPAN + 1}").status_code, 404)
+            self.assertEqual(client.post("/attachments", params={"filename": "a.txt"}, content=b"x",
+                                         headers={"Content-Type": "text/plain"}).status_code, 400)
+            self.assertTrue(os.path.exists(router.shard_path(project["id"])))
+            self.assertEqual(client.delete(f"/projects/{project['id']}").status_code, 204)
+            self.assertFalse(os.path.exists(router.shard_path(project["id"])))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import unittest
+import sys
+import os
+import datetime
+import tempfile
+import shutil
+from sqlalchemy import create_engine
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from database import crud
+from database.database import init_db
+from database.sharding import ShardRouter, SHARD_ID_SPAN, project_id_for_record
+from database.archive import archive_stale_threads, archive_path_for
+from models.models import Project, Thread, Attachment
+
+class TestShardRouter(unittest.TestCase):
+    """database.sharding.ShardRouter (プロジェクトごとの DB への分割保存) のテストケース"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.catalog = create_engine(f"sqlite:///{os.path.join(self.work_dir, 'catalog.db')}",
+                                     connect_args={"check_same_thread": False})
+        init_db(bind=self.catalog)
+        self.router = ShardRouter(self.catalog, shard_dir=os.path.join(self.work_dir, "shards"), max_open=1)
+        self.projects = [self.router.create_project(f"Shard {i}", f"prompt {i}") for i in range(2)]
+
+    def tearDown(self):
+        self.router.close()
+        self.catalog.dispose()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def add_thread(self, project, contents: list[str], created_at: datetime.datetime | None = None) -> int:
+        db = self.router.session_for_project(project.id)
+        try:
+            thread = crud.create_thread(db, project.id, name=f"{project.name} chat")
+            for content in contents:
+                message = crud.add_message(db, thread, "user", content)
+                if created_at is not None:
+                    message.created_at = created_at
+            db.commit()
+            return thread.id
+        finally:
+            db.close()
+
+    def test_ids_are_allocated_from_the_project_range(self):
+        thread_ids = [self.add_thread(project, ["hello"]) for project in self.projects]
+        self.assertEqual(thread_ids, [project.id * SHARD_ID_SPAN + 1 for project in self.projects])
+        self.assertEqual([project_id_for_record(thread_id) for thread_id in thread_ids], [p.id for p in self.projects])
+        # ID からプロジェクトの DB を選び、他のプロジェクトのスレッドは見えない
+        db = self.router.session_for_record(thread_ids[1])
+        try:
+            self.assertEqual([m.content for m in crud.get_thread_history(db, thread_ids[1])], ["hello"])
+            self.assertEqual(db.query(Thread).count(), 1)
+            self.assertEqual(db.get(Project, self.projects[1].id).system_prompt, "prompt 1")
+        finally:
+            db.close()
+        # カタログにはプロジェクトの一覧だけがある
+        catalog = self.router.CatalogSession()
+        try:
+            self.assertEqual((catalog.query(Project).count(), catalog.query(Thread).count()), (2, 0))
+        finally:
+            catalog.close()
+
+    def test_unknown_project_raises_lookup_error(self):
+        with self.assertRaises(LookupError):
+            self.router.session_for_project(999)
+        with self.assertRaises(LookupError):
+            self.router.session_for_record(999 * SHARD_ID_SPAN + 1)
+        self.assertFalse(os.path.exists(self.router.shard_path(999)))
+
+    def test_search_fans_out_and_merges_newest_first(self):
+        started = datetime.datetime(2025, 1, 1)
+        self.add_thread(self.projects[0], ["needle old"], created_at=started)
+        self.add_thread(self.projects[1], ["needle new"], created_at=started + datetime.timedelta(days=2))
+        self.add_thread(self.projects[0], ["needle middle", "other"], created_at=started + datetime.timedelta(days=1))
+        hits = self.router.search_messages("needle")
+        self.assertEqual([hit.content for hit in hits], ["needle new", "needle middle", "needle old"])
+        self.assertEqual([hit.project_name for hit in hits], ["Shard 1", "Shard 0", "Shard 0"])
+        self.assertEqual([hit.content for hit in self.router.search_messages("needle", limit=2)],
+                         ["needle new", "needle middle"])
+
+    def test_update_and_delete_project(self):
+        thread_id = self.add_thread(self.projects[0], ["hello"])
+        self.assertTrue(self.router.update_project(self.projects[0].id, "Renamed", "new prompt"))
+        db = self.router.session_for_record(thread_id)
+        try:
+            self.assertEqual(db.get(Thread, thread_id).project.system_prompt, "new prompt")
+            # アーカイブはプロジェクトの DB ごとに作られる
+            self.assertEqual(archive_stale_threads(db, datetime.datetime.utcnow() + datetime.timedelta(days=1)), 1)
+        finally:
+            db.close()
+
+        path = self.router.shard_path(self.projects[0].id)
+        self.assertTrue(os.path.exists(archive_path_for(path)))
+        self.assertTrue(self.router.delete_project(self.projects[0].id))
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(archive_path_for(path)))
+        self.assertEqual(self.router.project_ids(), [self.projects[1].id])
+        with self.assertRaises(LookupError):
+            self.router.session_for_record(thread_id)
+        self.assertEqual(self.router.search_messages("hello"), [])
+
+    def test_engine_with_open_session_is_not_evicted(self):
+        """max_open を超えても、セッションが開いている Engine は閉じずに使い回し、DB の初期化をやり直さない"""
+        first, second = self.projects
+        prepared = []
+        original_prepare = self.router._prepare
+        def counting_prepare(engine, project):
+            prepared.append(project["id"])
+            original_prepare(engine, project)
+        self.router._prepare = counting_prepare
+
+        held = self.router.session_for_project(first.id)
+        engine = held.get_bind()
+        prepared.clear()
+        try:
+            for _ in range(3): # 2つのプロジェクトを交互に使う
+                db = self.router.session_for_project(second.id)
+                try:
+                    self.assertEqual(db.get(Project, second.id).name, "Shard 1")
+                finally:
+                    db.close()
+                self.assertIs(self.router.engine_for(first.id), engine)
+                self.assertEqual(held.get(Project, first.id).name, "Shard 0")
+        finally:
+            held.close()
+        # 上限を超えたもう一方だけが毎回開き直される
+        self.assertEqual(prepared, [second.id] * 3)
+        # 最後のセッションが閉じられたら上限まで閉じる
+        self.assertEqual(list(self.router._engines), [first.id])
+
+    def test_blob_in_use_checks_every_project(self):
+        db = self.router.session_for_project(self.projects[1].id)
+        try:
+            db.add(Attachment(sha256="a" * 64, size_bytes=1, mime_type="text/plain", filename="a.txt"))
+            db.commit()
+        finally:
+            db.close()
+        self.assertTrue(self.router.blob_in_use("a" * 64))
+        self.assertFalse(self.router.blob_in_use("b" * 64))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+import unittest
+import sys
+import os
+import asyncio
+import time
+import threading
+from types import SimpleNamespace
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from google.genai import types
+from api import gemini_client
+from api.gemini_client import GeminiClient
+from utils.single_flight import SingleFlight, AsyncSingleFlight, request_key
+
+class GatedStream:
+    """gate が開くたびに1チャンクずつ返す上流のストリーム"""
+
+    def __init__(self, chunks=("A", "B", "C"), error: Exception | None = None):
+        self.chunks = chunks
+        self.error = error
+        self.gates = [threading.Event() for _ in chunks]
+        self.calls = 0
+        self.closed = threading.Event()
+
+    def open(self, usage: dict, stop_event: threading.Event):
+        self.calls += 1
+        try:
+            for gate, chunk in zip(self.gates, self.chunks):
+                gate.wait(timeout=5)
+                yield chunk
+            if self.error is not None:
+                raise self.error
+            usage.update(prompt_tokens=10, output_tokens=len(self.chunks), total_tokens=10 + len(self.chunks))
+        finally:
+            self.closed.set()
+
+    def release(self, count: int = None):
+        for gate in self.gates[:count]:
+            gate.set()
+
+class TestSingleFlight(unittest.TestCase):
+    """utils.single_flight.SingleFlight (同じリクエストのストリームの共有) のテストケース"""
+
+    def test_concurrent_and_late_subscribers_share_one_upstream(self):
+        flights = SingleFlight()
+        upstream = GatedStream()
+        owner_usage, follower_usage = {}, {}
+        owner = flights.stream("key", upstream.open, owner_usage)
+        upstream.release(1)
+        self.assertEqual(next(owner), "A")
+        # 1チャンク目が届いた後に加わった購読者にも、先頭から再送する
+        follower = flights.stream("key", upstream.open, follower_usage)
+        self.assertEqual(next(follower), "A")
+        upstream.release()
+        self.assertEqual(list(owner), ["B", "C"])
+        self.assertEqual(list(follower), ["B", "C"])
+        self.assertEqual(upstream.calls, 1)
+        self.assertEqual((flights.started, flights.joined, flights.in_flight()), (1, 1, 0))
+        # トークン数は上流の終了時に購読中の最初の購読者にだけ記録する
+        self.assertEqual(owner_usage["total_tokens"], 13)
+        self.assertNotIn("total_tokens", follower_usage)
+        self.assertIn("latency_ms", follower_usage)
+
+        # 完了後の同じリクエストは新しく実行する
+        again = GatedStream()
+        again.release()
+        self.assertEqual(list(flights.stream("key", again.open)), ["A", "B", "C"])
+        self.assertEqual(again.calls, 1)
+
+    def test_tokens_go_to_a_remaining_subscriber_when_the_owner_leaves(self):
+        flights = SingleFlight()
+        upstream = GatedStream()
+        owner_usage, follower_usage = {}, {}
+        owner = flights.stream("key", upstream.open, owner_usage)
+        follower = flights.stream("key", upstream.open, follower_usage)
+        upstream.release(1)
+        self.assertEqual(next(owner), "A")
+        self.assertEqual(next(follower), "A")
+        owner.close() # 上流のリクエストを送った購読者が中止しても、残った購読者が全体の使用量を受け取る
+        upstream.release()
+        self.assertEqual(list(follower), ["B", "C"])
+        self.assertNotIn("total_tokens", owner_usage)
+        self.assertEqual(follower_usage["total_tokens"], 13)
+
+    def test_different_requests_are_not_shared(self):
+        flights = SingleFlight()
+        first, second = GatedStream(), GatedStream(chunks=("X",))
+        first.release()
+        second.release()
+        self.assertEqual(list(flights.stream(request_key("flash", "prompt", ["hi"]), first.open)), ["A", "B", "C"])
+        self.assertEqual(list(flights.stream(request_key("pro", "prompt", ["hi"]), second.open)), ["X"])
+        self.assertNotEqual(request_key("flash", None, [types.Content(role="user", parts=[types.Part(text="a")])]),
+                            request_key("flash", None, [types.Content(role="user", parts=[types.Part(text="b")])]))
+
+    def test_error_is_raised_to_every_subscriber(self):
+        flights = SingleFlight()
+        upstream = GatedStream(chunks=("A", "B"), error=RuntimeError("quota exceeded"))
+        streams = [flights.stream("key", upstream.open) for _ in range(2)]
+        upstream.release(1)
+        for stream in streams:
+            self.assertEqual(next(stream), "A")
+        upstream.release()
+        for stream in streams:
+            self.assertEqual(next(stream), "B")
+            with self.assertRaisesRegex(RuntimeError, "quota exceeded"):
+                next(stream)
+        self.assertEqual(upstream.calls, 1)
+
+    def test_upstream_stops_when_every_subscriber_leaves(self):
+        flights = SingleFlight()
+        upstream = GatedStream()
+        streams = [flights.stream("key", upstream.open) for _ in range(2)]
+        upstream.release(1)
+        for stream in streams:
+            self.assertEqual(next(stream), "A")
+        streams[0].close()
+        self.assertEqual(flights.in_flight(), 1) # まだ購読者がいる
+        streams[1].close()
+        self.assertEqual(flights.in_flight(), 0)
+        upstream.release()
+        self.assertTrue(upstream.closed.wait(5))
+
+class TestAsyncSingleFlight(unittest.TestCase):
+    """utils.single_flight.AsyncSingleFlight のテストケース"""
+
+    def test_concurrent_subscribers_share_one_upstream(self):
+        flights = AsyncSingleFlight()
+        calls = []
+
+        async def upstream(usage):
+            calls.append(1)
+            for chunk in ("A", "B"):
+                await asyncio.sleep(0.01)
+                yield chunk
+            usage["total_tokens"] = 5
+
+        async def collect(usage):
+            return [chunk async for chunk in flights.stream("key", upstream, usage)]
+
+        async def main():
+            usages = [{}, {}, {}]
+            results = await asyncio.gather(*(collect(usage) for usage in usages))
+            return results, usages
+
+        results, usages = asyncio.run(main())
+        self.assertEqual(results, [["A", "B"]] * 3)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([usage.get("total_tokens") for usage in usages], [5, None, None])
+        self.assertEqual(flights.in_flight(), 0)
+
+    def test_tokens_go_to_a_remaining_subscriber_when_the_owner_leaves(self):
+        flights = AsyncSingleFlight()
+        release = None
+
+        async def upstream(usage):
+            yield "A"
+            await release.wait()
+            yield "B"
+            usage["total_tokens"] = 5
+
+        async def main():
+            nonlocal release
+            release = asyncio.Event()
+            owner_usage, follower_usage = {}, {}
+            owner = flights.stream("key", upstream, owner_usage)
+            follower = flights.stream("key", upstream, follower_usage)
+            self.assertEqual(await owner.__anext__(), "A")
+            self.assertEqual(await follower.__anext__(), "A")
+            await owner.aclose()
+            release.set()
+            self.assertEqual([chunk async for chunk in follower], ["B"])
+            return owner_usage, follower_usage
+
+        owner_usage, follower_usage = asyncio.run(main())
+        self.assertNotIn("total_tokens", owner_usage)
+        self.assertEqual(follower_usage["total_tokens"], 5)
+
+class TestGeminiClientSingleFlight(unittest.TestCase):
+    """GeminiClient.generate_content_stream が同じリクエストの API 呼び出しをまとめることのテストケース"""
+
+    def test_identical_concurrent_requests_call_api_once(self):
+        gate = threading.Event()
+        calls = []
+
+        def generate_content_stream(model, contents, config):
+            calls.append(model)
+            gate.wait(timeout=5)
+            yield SimpleNamespace(text="こんにちは", usage_metadata=None)
+
+        client = GeminiClient(client=SimpleNamespace(models=SimpleNamespace(generate_content_stream=generate_content_stream)))
+        history = [types.Content(role="user", parts=[types.Part(text="同じ質問")])]
+        results = []
+        joined_before = gemini_client._stream_flights.joined
+        threads = [threading.Thread(target=lambda: results.append(list(client.generate_content_stream("flash", history, "prompt"))))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        # 3つとも同じストリームを購読してから応答を返す
+        deadline = time.monotonic() + 5
+        while gemini_client._stream_flights.joined - joined_before < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        gate.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, [["こんにちは"]] * 3)
+        self.assertEqual(calls, ["flash"])
+
+if __name__ == '__main__':
+    unittest.main()
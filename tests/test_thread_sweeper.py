@@ -0,0 +1,136 @@
+import unittest
+import sys
+import os
+import datetime
+import tempfile
+import shutil
+from unittest import mock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# プロジェクトルートを Python パスに追加 (test_crud.py と同様)
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from database import crud
+from database.database import init_db
+from models.models import Project, Thread, Message, Tombstone, Attachment, ThreadLease
+from utils.thread_sweeper import EmptyThreadSweeper
+from utils.blob_store import BlobStore
+
+class TestEmptyThreadSweeper(unittest.TestCase):
+    """utils.thread_sweeper.EmptyThreadSweeper (空チャットのバックグラウンド削除) のテストケース"""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        # 掃除のスレッドからも同じ DB を読むため、ファイルの DB を使う
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.work_dir, 'test.db')}",
+                                    connect_args={"check_same_thread": False})
+        init_db(bind=self.engine)
+        self.Session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        self.db = self.Session()
+        self.projects = [Project(name=f"Sweep {i}", system_prompt="prompt") for i in range(2)]
+        self.db.add_all(self.projects)
+        self.db.commit()
+        self.busy: set[int] = set()
+
+    def tearDown(self):
+        self.db.close()
+        self.engine.dispose()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def add_thread(self, project, age_seconds: float, messages: int = 0, **fields) -> int:
+        created_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=age_seconds)
+        thread = Thread(project_id=project.id, name="chat", created_at=created_at, **fields)
+        self.db.add(thread)
+        self.db.flush()
+        self.db.add_all([Message(thread_id=thread.id, role="user", content="hello") for _ in range(messages)])
+        self.db.commit()
+        return thread.id
+
+    def sweeper(self, **kwargs) -> EmptyThreadSweeper:
+        return EmptyThreadSweeper(session_factory=self.Session, interval=0, grace_seconds=60,
+                                  busy_thread_ids=lambda: self.busy, **kwargs)
+
+    def remaining(self) -> set[int]:
+        self.db.expire_all()
+        return {thread_id for (thread_id,) in self.db.query(Thread.id).all()}
+
+    def test_deletes_stale_empty_threads_across_projects_in_batches(self):
+        stale = [self.add_thread(project, age_seconds=120) for project in self.projects for _ in range(3)]
+        with_messages = self.add_thread(self.projects[0], age_seconds=120, messages=1)
+        recent = self.add_thread(self.projects[1], age_seconds=1)
+
+        with mock.patch("database.crud.delete_stale_empty_threads", wraps=crud.delete_stale_empty_threads) as batches:
+            self.assertEqual(self.sweeper(batch_size=2).sweep_once(), 6)
+        self.assertEqual(batches.call_count, 4) # 2件ずつ3回 + 残りが無いことの確認
+        self.assertEqual(self.remaining(), {with_messages, recent})
+        tombstones = {(t.entity_id, t.project_id) for t in self.db.query(Tombstone).all()}
+        self.assertEqual(len(tombstones), 6)
+        self.assertIn((stale[-1], self.projects[1].id), tombstones)
+
+    def test_protected_busy_and_forked_threads_are_kept(self):
+        parent = self.add_thread(self.projects[0], age_seconds=120, messages=1)
+        branch_message_id = self.db.query(Message.id).filter(Message.thread_id == parent).scalar()
+        fork = self.add_thread(self.projects[0], age_seconds=120, parent_thread_id=parent, branch_message_id=branch_message_id)
+        shown = self.add_thread(self.projects[0], age_seconds=120)
+        generating = self.add_thread(self.projects[1], age_seconds=120)
+        closed = self.add_thread(self.projects[1], age_seconds=120)
+
+        sweeper = self.sweeper()
+        sweeper.protect("session-a", shown)
+        sweeper.protect("session-b", closed)
+        sweeper.protect("session-b", None) # 別のチャットに移動した
+        self.busy.add(generating)
+        self.assertEqual(sweeper.sweep_once(), 1)
+        self.assertEqual(self.remaining(), {parent, fork, shown, generating})
+        # 別のプロセスのアーカイブにも表示中・生成中のチャットが分かるよう印を付ける
+        self.assertEqual({lease.thread_id for lease in self.db.query(ThreadLease)}, {shown, generating})
+
+    def test_protection_expires_after_session_ttl(self):
+        thread_id = self.add_thread(self.projects[0], age_seconds=120)
+        sweeper = self.sweeper(session_ttl=10)
+        with mock.patch("utils.thread_sweeper.time.monotonic", return_value=1000.0):
+            sweeper.protect("session-a", thread_id)
+        with mock.patch("utils.thread_sweeper.time.monotonic", return_value=1005.0):
+            self.assertEqual(sweeper.protected_thread_ids(), {thread_id})
+        with mock.patch("utils.thread_sweeper.time.monotonic", return_value=1011.0):
+            self.assertEqual(sweeper.protected_thread_ids(), set())
+
+    def test_collects_attachments_of_deleted_chats(self):
+        store = BlobStore(os.path.join(self.work_dir, "attachments"))
+        thread_id = self.add_thread(self.projects[0], age_seconds=120)
+        kept = self.add_thread(self.projects[0], age_seconds=120)
+        thread = self.db.get(Thread, thread_id)
+        attachment = crud.store_attachment(self.db, store, b"%PDF old", "old.pdf", "application/pdf")
+        crud.add_message(self.db, thread, "user", "見て", attachment_ids=[attachment.id])
+        crud.add_message(self.db, self.db.get(Thread, kept), "user", "見て", attachment_ids=[attachment.id])
+        digest = attachment.sha256
+        # 猶予期間より前に最後に使われたことにする
+        self.db.query(Attachment).update({"last_used_at": datetime.datetime.utcnow() - datetime.timedelta(seconds=120)})
+        self.db.commit()
+
+        sweeper = self.sweeper(blob_store=store)
+        crud.delete_thread(self.db, thread_id)
+        sweeper.sweep_once()
+        self.assertTrue(store.exists(digest)) # まだ別のチャットから参照されている
+        crud.delete_thread(self.db, kept)
+        sweeper.sweep_once()
+        self.assertFalse(store.exists(digest))
+        self.assertEqual(self.db.query(Attachment).count(), 0)
+
+    def test_background_thread_sweeps_periodically(self):
+        self.add_thread(self.projects[0], age_seconds=120)
+        sweeper = EmptyThreadSweeper(session_factory=self.Session, interval=0.01, grace_seconds=60,
+                                     busy_thread_ids=set).start()
+        try:
+            for _ in range(200):
+                if not self.remaining():
+                    break
+                sweeper._stop.wait(0.01)
+        finally:
+            sweeper.close(timeout=5)
+        self.assertEqual(self.remaining(), set())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,279 @@
+"""
+プロンプトのファイル (JSONL / CSV) をプロジェクトのシステムプロンプトでまとめて実行するバッチ処理。
+
+プロンプトごとにプロジェクトの下へ新しいスレッドを作り、応答を通常のメッセージとして保存します。
+進捗はチェックポイント (JSONL) に1件ずつ追記するため、途中で止まっても同じコマンドで続きから再開できます。
+
+    python main.py batch prompts.jsonl --project "My Project" --concurrency 8
+
+プロンプトファイルの形式:
+    JSONL: 1行1オブジェクト {"prompt": "...", "id": "任意の一意な ID", "name": "任意のスレッド名"}
+    CSV:   ヘッダー行に prompt 列 (id / name 列は任意)
+"""
+import os
+import csv
+import json
+import time
+import logging
+import datetime
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Iterator
+
+from utils.markdown_export import enqueue_message_to_markdown
+from utils.perf_timing import percentile
+from utils.request_scheduler import BATCH
+
+log = logging.getLogger(__name__)
+
+# 同時に実行するプロンプト数 (環境変数で上書き可能)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+# チェックポイントのイベント
+STARTED = "started"
+FINISHED = "finished"
+
+def _default_session_factory(project_id: int):
+    # 分割保存 (DB_SHARDING) の場合はプロジェクトの DB を開く
+    from database.sharding import open_session
+    return open_session(project_id=project_id)
+
+def _default_client_factory():
+    from api.gemini_client import GeminiClient
+    return GeminiClient()
+
+def default_state_path(prompts_path: str) -> str:
+    """チェックポイントのファイルパス (プロンプトファイルの隣に作成)"""
+    return prompts_path + ".batch-state.jsonl"
+
+def default_summary_path(prompts_path: str) -> str:
+    """集計結果のファイルパス"""
+    return prompts_path + ".batch-summary.json"
+
+def read_prompts(path: str) -> Iterator[dict]:
+    """
+    プロンプトファイルを1件ずつ読み込みます。拡張子が .csv なら CSV、それ以外は JSONL として扱います。
+
+    Yields:
+        {"key": 再開時に使う一意なキー, "prompt": プロンプト, "name": スレッド名 (None なら先頭60文字)}
+    """
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            reader = csv.DictReader(f)
+            if "prompt" not in (reader.fieldnames or []):
+                raise ValueError(f"CSV に prompt 列がありません: {path}")
+            rows = ((reader.line_num, row) for row in reader)
+        else:
+            rows = ((line_number, json.loads(line)) for line_number, line in enumerate(f, 1) if line.strip())
+
+        for line_number, row in rows:
+            prompt = (row.get("prompt") or "").strip()
+            if not prompt:
+                log.warning(f"プロンプトが空の行をスキップします ({path}:{line_number})")
+                continue
+            key = str(row.get("id") or f"line:{line_number}")
+            yield {"key": key, "prompt": prompt, "name": row.get("name") or None}
+
+class BatchCheckpoint:
+    """
+    バッチの進捗を記録する追記専用の JSONL ファイル。
+
+    プロンプトごとに、スレッドを作った時点で started、応答を保存した (または失敗した) 時点で finished を追記します。
+    書き込みは1行ずつなので、プロセスが途中で止まっても失われるのは実行中だったプロンプトだけです。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.started: dict[str, dict] = {} # key -> 最後の started
+        self.finished: dict[str, dict] = {} # key -> 最後の finished
+        complete = self._load()
+        self._file = open(path, "a", encoding="utf-8")
+        if not complete:
+            self._file.write("\n") # 途中で切れた行の後ろに続けて書かない
+
+    def _load(self) -> bool:
+        """記録を読み込みます。最後の行が改行で終わっていない場合は False。"""
+        line = "\n"
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # 書き込み途中で止まった最後の行
+                    target = self.started if entry.get("event") == STARTED else self.finished
+                    target[entry["key"]] = entry
+        except FileNotFoundError:
+            pass
+        return line.endswith("\n")
+
+    def is_done(self, key: str) -> bool:
+        return self.finished.get(key, {}).get("status") == "done"
+
+    def stale_thread_id(self, key: str) -> int | None:
+        """前回の実行で失敗・中断したプロンプトのスレッド ID (再実行の前に削除する)"""
+        if self.is_done(key):
+            return None
+        entry = self.finished.get(key) or self.started.get(key)
+        return entry.get("thread_id") if entry else None
+
+    def record(self, event: str, entry: dict) -> None:
+        entry = {"event": event, **entry}
+        with self._lock:
+            (self.started if event == STARTED else self.finished)[entry["key"]] = entry
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+def summarize(results: list[dict]) -> dict:
+    """finished の記録からレイテンシとエラーの統計を作ります。"""
+    succeeded = [r for r in results if r["status"] == "done"]
+    failed = [r for r in results if r["status"] != "done"]
+    latencies = [r["latency_ms"] for r in succeeded]
+    ttfts = [r["time_to_first_token_ms"] for r in succeeded if r.get("time_to_first_token_ms") is not None]
+    errors: dict[str, int] = {}
+    for r in failed:
+        errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return {
+        "total": len(results),
+        "succeeded": len(succeeded),
+        "failed": len(failed),
+        "latency_ms": {"p50": percentile(latencies, 0.5), "p95": percentile(latencies, 0.95),
+                       "max": max(latencies) if latencies else None},
+        "time_to_first_token_ms": {"p50": percentile(ttfts, 0.5), "p95": percentile(ttfts, 0.95)},
+        "tokens": {name: sum(r.get(name) or 0 for r in succeeded)
+                   for name in ("prompt_tokens", "output_tokens", "total_tokens")},
+        # 多い順に上位10件
+        "errors": dict(sorted(errors.items(), key=lambda item: -item[1])[:10]),
+    }
+
+class BatchRunner:
+    """
+    プロンプトファイルを最大 concurrency 件ずつ同時に実行するランナー。
+    Gemini のクライアントは1つを全ワーカーで共有します。
+    """
+
+    def __init__(self,
+                 project_id: int,
+                 model_name: str,
+                 concurrency: int = BATCH_CONCURRENCY,
+                 session_factory: Callable | None = None,
+                 client_factory: Callable = _default_client_factory):
+        self.project_id = project_id
+        self.model_name = model_name
+        self.concurrency = max(1, concurrency)
+        self.session_factory = session_factory or functools.partial(_default_session_factory, project_id)
+        self.client_factory = client_factory
+        self._client = None
+
+    def run(self, prompts_path: str, state_path: str | None = None) -> dict:
+        """
+        プロンプトファイルを実行し、集計結果を返します。
+        チェックポイントで完了済みのプロンプトはスキップし、失敗・中断したものはスレッドを作り直して再実行します。
+        """
+        from models.models import Project
+
+        db = self.session_factory()
+        try:
+            project = db.get(Project, self.project_id)
+            if project is None:
+                raise ValueError(f"プロジェクトが見つかりません (ID: {self.project_id})")
+            project_name, system_prompt = project.name, project.system_prompt
+        finally:
+            db.close()
+
+        self._client = self.client_factory()
+        checkpoint = BatchCheckpoint(state_path or default_state_path(prompts_path))
+        started_at = time.perf_counter()
+        skipped = submitted = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch") as executor:
+                in_flight = set()
+                for item in read_prompts(prompts_path):
+                    if checkpoint.is_done(item["key"]):
+                        skipped += 1
+                        continue
+                    # 投入数を concurrency に抑え、大きなファイルでもプロンプトを全て読み込まない
+                    if len(in_flight) >= self.concurrency:
+                        _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    in_flight.add(executor.submit(self._run_prompt, item, project_name, system_prompt, checkpoint))
+                    submitted += 1
+                wait(in_flight)
+        finally:
+            checkpoint.close()
+
+        summary = summarize(list(checkpoint.finished.values()))
+        summary.update({
+            "project_id": self.project_id,
+            "model": self.model_name,
+            "prompts_file": prompts_path,
+            "run_prompts": submitted,
+            "resumed_skipped": skipped,
+            "wall_seconds": round(time.perf_counter() - started_at, 3),
+            "finished_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        })
+        log.info(f"バッチが終了しました: 実行 {submitted} 件, スキップ {skipped} 件, "
+                 f"成功 {summary['succeeded']} / {summary['total']} 件")
+        return summary
+
+    def _run_prompt(self, item: dict, project_name: str, system_prompt: str, checkpoint: BatchCheckpoint) -> None:
+        from api.gemini_client import messages_to_contents
+        from database import crud
+
+        key, prompt = item["key"], item["prompt"]
+        result = {"key": key, "thread_id": None}
+        started = time.perf_counter()
+        db = self.session_factory()
+        try:
+            stale_thread_id = checkpoint.stale_thread_id(key)
+            if stale_thread_id is not None:
+                crud.delete_thread(db, stale_thread_id) # 前回の途中までの結果は残さない
+
+            thread = crud.create_thread(db, self.project_id, name=item["name"] or prompt[:60])
+            result["thread_id"] = thread.id
+            checkpoint.record(STARTED, dict(result))
+            crud.add_message(db, thread, "user", prompt)
+            enqueue_message_to_markdown(project_name, thread.id, thread.name, "user", prompt)
+
+            usage: dict = {}
+            chunks: list[str] = []
+            time_to_first_token = None
+            for chunk in self._client.generate_content_stream(
+                    model_name=self.model_name, history=messages_to_contents([], prompt),
+                    system_prompt=system_prompt, usage=usage,
+                    project_id=self.project_id, user="batch", priority=BATCH):
+                if not chunk:
+                    continue
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - started
+                chunks.append(chunk)
+            text = "".join(chunks)
+            if not text:
+                raise RuntimeError("応答が空でした。")
+
+            crud.add_message(db, thread, "assistant", text, model_name=self.model_name, usage=usage)
+            enqueue_message_to_markdown(project_name, thread.id, thread.name, "assistant", text)
+            # usage のレイテンシは API 呼び出しのみ。結果にはプロンプトの処理全体 (DB 書き込みを含む) の時間を記録する
+            result.update(usage)
+            result.update(status="done", time_to_first_token_ms=round(time_to_first_token * 1000, 1))
+        except Exception as e:
+            db.rollback()
+            log.error(f"バッチのプロンプトが失敗しました (key={key}): {e}", exc_info=True)
+            result.update(status="error", error=str(e))
+        finally:
+            db.close()
+        result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        checkpoint.record(FINISHED, result)
+
+def resolve_project_id(db, project: str) -> int | None:
+    """プロジェクト名または ID の文字列からプロジェクト ID を求めます。"""
+    from models.models import Project
+
+    found = db.query(Project).filter(Project.name == project).first()
+    if found is None and project.isdigit():
+        found = db.get(Project, int(project))
+    return found.id if found is not None else None
@@ -0,0 +1,135 @@
+import io
+import os
+import mmap
+import hashlib
+import logging
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+# 添付ファイルの保存先 (環境変数で上書き可能)
+ATTACHMENT_DIR = os.getenv("ATTACHMENT_DIR", "attachments")
+
+_COPY_CHUNK_SIZE = 1024 * 1024 # ファイルから読み込むときの1回の読み込みサイズ
+
+class MappedBlob(io.RawIOBase):
+    """
+    保存済みのファイルをメモリマップで読み取る、読み取り専用のファイルオブジェクト。
+    read() / seek() に対応しているため、そのまま Gemini の Files API へのアップロードなどに渡せます。
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self.size = os.fstat(self._file.fileno()).st_size
+        # 長さ 0 のファイルはマップできない
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        count = max(0, min(len(buffer), self.size - self._position))
+        if count:
+            buffer[:count] = self._map[self._position:self._position + count]
+            self._position += count
+        return count
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self.size}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        if not self.closed:
+            if self._map is not None:
+                self._map.close()
+            self._file.close()
+        super().close()
+
+class BlobStore:
+    """
+    添付ファイルの内容を SHA-256 のハッシュをファイル名にしてディスクに保存します (内容アドレス方式)。
+
+    同じ内容は何度保存しても1つのファイルになるため、同じ PDF を複数のチャット・プロジェクトに添付しても
+    ディスクも DB も増えません。どのメッセージから参照されているかは DB (message_attachments) で管理し、
+    参照されなくなったファイルは crud.collect_unreferenced_attachments で削除します。
+    """
+
+    def __init__(self, root: str = ATTACHMENT_DIR):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        """ハッシュに対応するファイルのパス (1ディレクトリのファイル数を抑えるため先頭2文字で分ける)"""
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def put(self, data) -> tuple[str, int]:
+        """
+        内容を保存します。同じ内容が保存済みの場合は書き込みません。
+
+        Args:
+            data: bytes などのバッファ、またはバイナリモードのファイルオブジェクト (少しずつ読み込みながら保存する)。
+
+        Returns:
+            (SHA-256 の16進数文字列, バイト数)。
+        """
+        tmp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        # 一時ファイルに書きながらハッシュを計算し、最後に名前を変えて確定する (読み取り中の不完全なファイルを見せない)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                chunks = iter(lambda: data.read(_COPY_CHUNK_SIZE), b"") if hasattr(data, "read") else [data]
+                for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            hex_digest = digest.hexdigest()
+            final_path = self.path(hex_digest)
+            if os.path.exists(final_path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.replace(tmp_path, final_path)
+                log.info(f"添付ファイルを保存しました: {hex_digest} ({size} bytes)")
+            return hex_digest, size
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def open(self, digest: str) -> MappedBlob:
+        """保存済みの内容をメモリマップで開きます (with 文で閉じる)。"""
+        return MappedBlob(self.path(digest))
+
+    def delete(self, digest: str) -> bool:
+        """ファイルを削除します。無かった場合は False。"""
+        try:
+            os.remove(self.path(digest))
+            return True
+        except FileNotFoundError:
+            return False
+
+# プロセス全体で共有する保存先
+_store: BlobStore | None = None
+_store_lock = threading.Lock()
+
+def get_blob_store() -> BlobStore:
+    """共有の BlobStore を返します。"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = BlobStore()
+        return _store
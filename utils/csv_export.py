@@ -1,8 +1,41 @@
-import pandas as pd
+from __future__ import annotations
+from typing import TYPE_CHECKING
 from sqlalchemy.orm import Session
 from sqlalchemy.sql import text # text をインポート
-from models.models import Project, Thread, Message
+from sqlalchemy import select, func, or_, and_
+from models.models import Project, Thread, Message, Tombstone, ExportWatermark
 import logging
+import csv
+import json
+import datetime
+import os
+
+log = logging.getLogger(__name__)
+
+# 増分エクスポートで前回の到達点より前を読み直す秒数 (updated_at を付けてからコミットするまでの間に
+# 前回のエクスポートが走った行を取りこぼさないため。読み直した行のうち出力済みのものは出力しない)
+EXPORT_OVERLAP_SECONDS = float(os.getenv("EXPORT_OVERLAP_SECONDS", "300"))
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# pandas は読み込みが重いため、DataFrame を使う関数の中で初めて読み込む
+# (増分エクスポートは pandas を使わない)
+
+# 増分エクスポートで出力する各ファイルの列定義
+INCREMENTAL_MESSAGE_COLUMNS = [
+    "project_id", "thread_id", "message_id", "message_role", "message_content", "message_created_at",
+    "message_updated_at",
+]
+INCREMENTAL_THREAD_COLUMNS = [
+    "thread_id", "project_id", "thread_name", "thread_created_at", "thread_updated_at",
+]
+INCREMENTAL_PROJECT_COLUMNS = [
+    "project_id", "project_name", "project_system_prompt", "project_created_at", "project_updated_at",
+]
+INCREMENTAL_TOMBSTONE_COLUMNS = [
+    "tombstone_id", "entity_type", "entity_id", "project_id", "deleted_at",
+]
 
 def get_all_data_as_dataframe(db: Session) -> pd.DataFrame:
     """
@@ -16,6 +49,7 @@ def get_all_data_as_dataframe(db: Session) -> pd.DataFrame:
         結合されたデータを含む Pandas DataFrame。
         エラーが発生した場合は空の DataFrame。
     """
+    import pandas as pd
     try:
         # JOIN を使って効率的に全データを取得するクエリを作成
         # SELECT句でカラム名を指定し、ラベル付けする
@@ -40,11 +74,11 @@ def get_all_data_as_dataframe(db: Session) -> pd.DataFrame:
 
         # Pandas DataFrame に読み込む (Session の bind を使用)
         df = pd.read_sql(stmt, db.bind)
-        logging.info(f"{len(df)} 件のメッセージを含むデータをエクスポート用に取得しました。")
+        log.info(f"{len(df)} 件のメッセージを含むデータをエクスポート用に取得しました。")
         return df
 
     except Exception as e:
-        logging.error(f"全データ取得中にエラーが発生しました: {e}", exc_info=True)
+        log.error(f"全データ取得中にエラーが発生しました: {e}", exc_info=True)
         return pd.DataFrame() # エラー時は空の DataFrame を返す
 
 def generate_csv_data(df: pd.DataFrame) -> bytes | None:
@@ -67,5 +101,193 @@ def generate_csv_data(df: pd.DataFrame) -> bytes | None:
         csv_bytes = csv_string.encode('utf-8-sig')
         return csv_bytes
     except Exception as e:
-        logging.error(f"CSV データ生成中にエラーが発生しました: {e}", exc_info=True)
-        return None 
+        log.error(f"CSV データ生成中にエラーが発生しました: {e}", exc_info=True)
+        return None
+
+def _write_csv_rows(output_dir: str, file_name: str, columns: list[str], rows) -> int:
+    """
+    行のイテラブルを CSV ファイルとして書き出します。行が無い場合はファイルを作りません。
+    一時ファイルに書いてから rename するため、途中で失敗しても不完全なファイルは残りません。
+
+    Returns:
+        書き出した行数。
+    """
+    file_path = os.path.join(output_dir, file_name)
+    tmp_path = file_path + ".tmp"
+    count = 0
+    with open(tmp_path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    if count == 0:
+        os.remove(tmp_path)
+        return 0
+    os.replace(tmp_path, file_path)
+    return count
+
+def export_incremental(db: Session, target: str, output_dir: str) -> dict[str, int]:
+    """
+    前回のエクスポート以降に追加・変更・削除されたデータだけを CSV に書き出します。
+
+    出力先 (target) ごとにウォーターマーク (最後に出力した message.id と created_at、
+    tombstone の ID、読み出したメッセージ・スレッド・プロジェクトの updated_at の最大値) を記録し、
+    次回はその続きだけを主キー/インデックスの範囲検索で取得します。
+    そのため実行時間はデータベース全体ではなく変更量に比例します。
+    updated_at は行をコミットする前に付くため、到達点の EXPORT_OVERLAP_SECONDS 秒前から読み直し、
+    前回同じ ID と updated_at で出力した行は除きます (前回の実行中にコミットされた行を取りこぼさない)。
+
+    出力は実行ごとに新しいファイルとして追記されます (既存ファイルは上書きしません)。
+        {実行時刻}_messages.csv   : 新規・変更 (生成途中の応答の確定、比較回答の採用、分岐先への引き継ぎなど) されたメッセージ
+                                    (同じ message_id の行は message_updated_at が新しいもので上書きしてください)
+        {実行時刻}_threads.csv    : 新規・変更 (名前変更など) されたスレッド
+        {実行時刻}_projects.csv   : 新規・変更されたプロジェクト
+        {実行時刻}_tombstones.csv : 削除されたスレッド・プロジェクト
+    ファイル書き出し後にウォーターマークを更新するため、途中で失敗した場合は
+    次回同じ行が再度出力されます (少なくとも1回の配信)。
+
+    Args:
+        db: SQLAlchemy セッションオブジェクト。
+        target: エクスポート先を識別する名前 (ウォーターマークのキー)。
+        output_dir: CSV ファイルを書き出すディレクトリ。
+
+    Returns:
+        種類ごとの出力行数 ({"messages": n, "threads": n, "projects": n, "tombstones": n})。
+        エラーが発生した場合は空の dict。
+    """
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        watermark = db.query(ExportWatermark).filter(ExportWatermark.target == target).first()
+        if watermark is None:
+            watermark = ExportWatermark(target=target, last_message_id=0, last_tombstone_id=0)
+            db.add(watermark)
+
+        last_message_id = watermark.last_message_id or 0
+        last_tombstone_id = watermark.last_tombstone_id or 0
+        overlap = datetime.timedelta(seconds=EXPORT_OVERLAP_SECONDS)
+        # updated_at はコミットより前に付くため、前回の到達点より少し前から読み直す
+        since = watermark.last_synced_at - overlap if watermark.last_synced_at else datetime.datetime.min
+        exported_keys = {kind: set(keys) for kind, keys in json.loads(watermark.overlap_keys or "{}").items()}
+
+        # 新規メッセージの上限を先に確定し、実行中に追加されたメッセージは次回に回す
+        synced_at = datetime.datetime.utcnow()
+        max_message_id = db.query(func.max(Message.id)).scalar() or 0
+        max_tombstone_id = db.query(func.max(Tombstone.id)).scalar() or 0
+
+        stamp = synced_at.strftime("%Y%m%dT%H%M%S%f")
+        counts = {}
+        # 読み出した行の updated_at の最大値 (次回の到達点) と、重なりの範囲に入りうる行のキー
+        read_updated_at = [watermark.last_synced_at] if watermark.last_synced_at else []
+        read_keys: dict[str, dict[str, datetime.datetime]] = {}
+
+        def unexported(kind: str, rows, id_index: int):
+            """前回までに同じ内容 (ID と updated_at) で出力した行を除きながら、読み出した updated_at を記録する"""
+            seen = read_keys.setdefault(kind, {})
+            for row in rows:
+                updated_at = row[-1]
+                key = f"{row[id_index]}:{updated_at.isoformat() if updated_at else ''}"
+                if updated_at is not None:
+                    read_updated_at.append(updated_at)
+                    seen[key] = updated_at
+                if key not in exported_keys.get(kind, ()):
+                    yield row
+
+        message_rows = db.execute(
+            select(Thread.project_id, Message.thread_id, Message.id, Message.role, Message.content, Message.created_at,
+                   Message.updated_at)
+            .join(Thread, Thread.id == Message.thread_id)
+            .where(Message.id <= max_message_id,
+                   or_(Message.id > last_message_id,
+                       # 出力済みのメッセージも、前回以降に変更されたものは出力し直す
+                       Message.updated_at > since))
+            .order_by(Message.id)
+        )
+        counts["messages"] = _write_csv_rows(
+            output_dir, f"{stamp}_messages.csv", INCREMENTAL_MESSAGE_COLUMNS, unexported("messages", message_rows, 2)
+        )
+
+        thread_rows = db.execute(
+            select(Thread.id, Thread.project_id, Thread.name, Thread.created_at, Thread.updated_at)
+            .where(Thread.updated_at > since)
+            .order_by(Thread.updated_at, Thread.id)
+        )
+        counts["threads"] = _write_csv_rows(
+            output_dir, f"{stamp}_threads.csv", INCREMENTAL_THREAD_COLUMNS, unexported("threads", thread_rows, 0)
+        )
+
+        project_rows = db.execute(
+            select(Project.id, Project.name, Project.system_prompt, Project.created_at, Project.updated_at)
+            .where(Project.updated_at > since)
+            .order_by(Project.updated_at, Project.id)
+        )
+        counts["projects"] = _write_csv_rows(
+            output_dir, f"{stamp}_projects.csv", INCREMENTAL_PROJECT_COLUMNS, unexported("projects", project_rows, 0)
+        )
+
+        tombstone_rows = db.execute(
+            select(Tombstone.id, Tombstone.entity_type, Tombstone.entity_id, Tombstone.project_id, Tombstone.deleted_at)
+            .where(Tombstone.id > last_tombstone_id, Tombstone.id <= max_tombstone_id)
+            .order_by(Tombstone.id)
+        )
+        counts["tombstones"] = _write_csv_rows(
+            output_dir, f"{stamp}_tombstones.csv", INCREMENTAL_TOMBSTONE_COLUMNS, tombstone_rows
+        )
+
+        # すべてのファイルを書き終えてからウォーターマークを進める。
+        # 時刻の到達点は実行時刻ではなく、実際に読み出した updated_at の最大値にする
+        if max_message_id > last_message_id:
+            watermark.last_message_id = max_message_id
+            watermark.last_message_created_at = db.query(Message.created_at).filter(Message.id == max_message_id).scalar()
+        watermark.last_tombstone_id = max(max_tombstone_id, last_tombstone_id)
+        watermark.last_synced_at = max(read_updated_at, default=None)
+        if watermark.last_synced_at is not None:
+            next_since = watermark.last_synced_at - overlap
+            watermark.overlap_keys = json.dumps({
+                kind: sorted(key for key, updated_at in keys.items() if updated_at > next_since)
+                for kind, keys in read_keys.items()
+            })
+        db.commit()
+
+        log.info(f"増分エクスポート '{target}' を実行しました: {counts}")
+        return counts
+
+    except Exception as e:
+        db.rollback()
+        log.error(f"増分エクスポート '{target}' 中にエラーが発生しました: {e}", exc_info=True)
+        return {}
+
+def export_incremental_all(target: str, output_dir: str) -> dict[str, int]:
+    """
+    アプリの DB 全体に export_incremental を実行します。
+
+    分割保存 (DB_SHARDING) が有効な場合は、カタログ (有効にする前のデータ) を output_dir に、
+    各プロジェクトの DB を output_dir/project_{ID} に書き出します。ウォーターマークは DB ごとに記録されます。
+
+    Returns:
+        全 DB の種類ごとの出力行数の合計。いずれかの DB でエラーが発生した場合は空の dict。
+    """
+    from database.database import SessionLocal
+    from database.sharding import get_shard_router
+
+    def export(db: Session, directory: str) -> dict[str, int]:
+        try:
+            return export_incremental(db, target, directory)
+        finally:
+            db.close()
+
+    results = [export(SessionLocal(), output_dir)]
+    router = get_shard_router()
+    for project_id in router.project_ids() if router is not None else []:
+        try:
+            db = router.session_for_project(project_id)
+        except LookupError: # 実行中に削除されたプロジェクト
+            continue
+        results.append(export(db, os.path.join(output_dir, f"project_{project_id}")))
+    if not all(results):
+        return {}
+    totals: dict[str, int] = {}
+    for counts in results:
+        for kind, count in counts.items():
+            totals[kind] = totals.get(kind, 0) + count
+    return totals
@@ -0,0 +1,544 @@
+import os
+import time
+import uuid
+import logging
+import datetime
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from utils.logging_setup import TruncatedText, should_log_content
+from utils.markdown_export import enqueue_message_to_markdown
+from utils.perf_timing import PhaseTimer
+from utils.request_scheduler import SlotCancelled
+
+log = logging.getLogger(__name__)
+
+# バックグラウンド生成の設定 (環境変数で上書き可能)
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "4")) # 同時に生成できるチャット数
+GENERATION_KEEP_FINISHED = int(os.getenv("GENERATION_KEEP_FINISHED", "100")) # 完了後も状態を保持するジョブ数
+
+# ジョブの状態
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+ERROR = "error"
+CANCELLED = "cancelled"
+
+class GenerationJob:
+    """
+    1回の応答生成 (スレッドへのプロンプト送信) を表すジョブ。
+    状態と生成途中のテキストは書き込みスレッドが更新し、Streamlit の再実行からは snapshot() で読み取ります。
+    """
+
+    def __init__(self, thread_id: int, prompt: str, model_name: str, attachment_ids: list[int] | None = None,
+                 user: str | None = None):
+        self.job_id = uuid.uuid4().hex
+        self.thread_id = thread_id
+        self.prompt = prompt
+        self.model_name = model_name
+        self.attachment_ids = list(attachment_ids or []) # ユーザーメッセージに添付するファイル (crud.store_attachment で保存済み)
+        self.user = user # 送信したユーザー (セッション)。API の実行枠をユーザーの間で公平に割り当てるために使う
+        self.status = QUEUED
+        self.text = "" # 生成途中の応答
+        self.error: str | None = None
+        self.user_message_id: int | None = None
+        self.assistant_message_id: int | None = None # 完了した応答を保存したメッセージ (生成中は None)
+        self.created_at = datetime.datetime.utcnow()
+        self.finished_at: datetime.datetime | None = None
+        # フェーズごとの所要時間 (PERF_TIMING=1 のときだけ記録。登録時から計測するので順番待ちの時間も含む)
+        self.timings = PhaseTimer("generation", thread_id=thread_id, model=model_name)
+        self._cancel_event = threading.Event() # cancel() で set する (API の実行枠の待ちも中止する)
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def _cancel_requested(self) -> bool:
+        return self._cancel_event.is_set()
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in (QUEUED, RUNNING)
+
+    def snapshot(self) -> dict:
+        """現在の状態のコピーを返します (表示用)。"""
+        with self._lock:
+            return {
+                "job_id": self.job_id,
+                "thread_id": self.thread_id,
+                "prompt": self.prompt,
+                "model_name": self.model_name,
+                "status": self.status,
+                "text": self.text,
+                "error": self.error,
+                "user_message_id": self.user_message_id,
+                "assistant_message_id": self.assistant_message_id,
+            }
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """ジョブが終わるまで待ちます。終わった場合は True。"""
+        return self._done.wait(timeout)
+
+    def _append(self, chunk: str) -> None:
+        with self._lock:
+            self.text += chunk
+
+    def _finish(self, status: str, error: str | None = None) -> None:
+        with self._lock:
+            self.status = status
+            self.error = error
+            self.finished_at = datetime.datetime.utcnow()
+        self._done.set()
+
+class ModelAnswer:
+    """比較モードでの1モデル分の回答と計測値"""
+    __slots__ = ("model_name", "text", "status", "error", "time_to_first_token_ms", "latency_ms", "usage")
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.text = ""
+        self.status = RUNNING
+        self.error: str | None = None
+        self.time_to_first_token_ms: float | None = None
+        self.latency_ms: float | None = None
+        self.usage: dict = {}
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class ComparisonJob(GenerationJob):
+    """同じプロンプトを複数のモデルに同時に送るジョブ (モデル比較モード)"""
+
+    def __init__(self, thread_id: int, prompt: str, model_names: list[str], attachment_ids: list[int] | None = None,
+                 user: str | None = None):
+        super().__init__(thread_id, prompt, model_names[0], attachment_ids, user)
+        self.model_names = list(dict.fromkeys(model_names)) # 重複を除き、順序は保つ
+        self.answers = {model_name: ModelAnswer(model_name) for model_name in self.model_names}
+
+    def snapshot(self) -> dict:
+        state = super().snapshot()
+        with self._lock:
+            state["answers"] = [self.answers[model_name].to_dict() for model_name in self.model_names]
+        return state
+
+def _default_session_factory(thread_id: int):
+    # 分割保存 (DB_SHARDING) の場合はスレッドの ID からプロジェクトの DB を選ぶ
+    from database.sharding import open_session
+    return open_session(record_id=thread_id)
+
+def _default_blob_store():
+    from utils.blob_store import get_blob_store
+    return get_blob_store()
+
+def _default_client_factory():
+    # google.genai は重いので、初めてジョブを実行するときに読み込む
+    from api.gemini_client import GeminiClient
+    return GeminiClient()
+
+class GenerationJobRunner:
+    """
+    Gemini の応答生成を Streamlit のスクリプト実行とは別のスレッドプールで行うランナー。
+
+    Streamlit はチャットやプロジェクトを切り替えるとスクリプトを中断して再実行するため、
+    スクリプト内でストリーミングすると応答が失われます。ランナーのジョブはスクリプトとは独立して動き、
+    生成途中の応答をジョブに保持するので、どの再実行からでも進捗を読み取って表示を再開できます。
+    応答は完了 (または中止) した時点で DB に保存され、それまで検索やエクスポートからは見えません。
+
+    - 異なるスレッドのジョブは最大 max_workers 個まで同時に実行されます。
+    - 同じスレッドのジョブは投入順に1つずつ実行されます (前の応答を履歴に含めるため)。
+    """
+
+    def __init__(self,
+                 max_workers: int = GENERATION_WORKERS,
+                 session_factory: Callable | None = None,
+                 client_factory: Callable = _default_client_factory,
+                 keep_finished: int = GENERATION_KEEP_FINISHED,
+                 blob_store_factory: Callable = _default_blob_store):
+        self.session_factory = session_factory # 省略時はジョブのスレッドの DB (_default_session_factory)
+        self.client_factory = client_factory
+        self.blob_store_factory = blob_store_factory # 添付ファイルの保存先 (utils.blob_store.BlobStore)
+        self.keep_finished = keep_finished
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="generation")
+        self._lock = threading.Lock()
+        self._jobs: OrderedDict[str, GenerationJob] = OrderedDict() # job_id -> ジョブ (投入順)
+        self._pending: dict[int, deque] = {} # thread_id -> 実行待ちのジョブ
+        self._draining: set[int] = set() # ジョブを実行中のスレッド ID
+
+    def submit(self, thread_id: int, prompt: str, model_name: str, attachment_ids: list[int] | None = None,
+               user: str | None = None) -> GenerationJob:
+        """
+        プロンプトをジョブとして登録し、すぐに戻ります。
+        ユーザーメッセージの保存もジョブの中で行います (同じスレッドの前の応答の後に並べるため)。
+        """
+        return self._enqueue(GenerationJob(thread_id, prompt, model_name, attachment_ids, user))
+
+    def _enqueue(self, job: GenerationJob) -> GenerationJob:
+        thread_id = job.thread_id
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._pending.setdefault(thread_id, deque()).append(job)
+            start_drain = thread_id not in self._draining
+            if start_drain:
+                self._draining.add(thread_id)
+        if start_drain:
+            self._executor.submit(self._drain_thread, thread_id)
+        log.info("生成ジョブを登録しました: job=%s, thread=%s, model=%s", job.job_id, thread_id, job.model_name)
+        return job
+
+    def submit_comparison(self, thread_id: int, prompt: str, model_names: list[str],
+                          attachment_ids: list[int] | None = None, user: str | None = None) -> "ComparisonJob":
+        """
+        同じプロンプトを model_names の全モデルに送る比較ジョブを登録し、すぐに戻ります。
+        通常のジョブと同じく、同じスレッドのジョブの後に順番に実行されます。
+        """
+        if not model_names:
+            raise ValueError("比較するモデルを1つ以上指定してください。")
+        return self._enqueue(ComparisonJob(thread_id, prompt, model_names, attachment_ids, user))
+
+    def cancel(self, job_id: str) -> bool:
+        """ジョブを中止します。生成中の場合はそれまでの応答を保存して終了します。"""
+        job = self.get_job(job_id)
+        if job is None or not job.is_active:
+            return False
+        job._cancel_event.set()
+        return True
+
+    def get_job(self, job_id: str) -> GenerationJob | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs_for_thread(self, thread_id: int, active_only: bool = True) -> list[GenerationJob]:
+        """スレッドのジョブを投入順に返します。"""
+        with self._lock:
+            return [job for job in self._jobs.values()
+                    if job.thread_id == thread_id and (job.is_active or not active_only)]
+
+    def active_thread_ids(self) -> set[int]:
+        """生成中または実行待ちのジョブがあるスレッド ID。"""
+        with self._lock:
+            return {job.thread_id for job in self._jobs.values() if job.is_active}
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+    def _drain_thread(self, thread_id: int) -> None:
+        """1つのスレッドの実行待ちジョブを順番に実行します (ワーカースレッドで実行)。"""
+        while True:
+            with self._lock:
+                pending = self._pending.get(thread_id)
+                if not pending:
+                    self._pending.pop(thread_id, None)
+                    self._draining.discard(thread_id)
+                    return
+                job = pending.popleft()
+            try:
+                if isinstance(job, ComparisonJob):
+                    self._run_comparison(job)
+                else:
+                    self._run_job(job)
+            except Exception as e:
+                # _run_job 内で処理されなかった想定外のエラー
+                log.error(f"生成ジョブの実行中に予期しないエラーが発生しました (job={job.job_id}): {e}", exc_info=True)
+                job._finish(ERROR, str(e))
+            self._prune_finished()
+
+    def _prune_finished(self) -> None:
+        with self._lock:
+            finished = [job_id for job_id, job in self._jobs.items() if not job.is_active]
+            for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+                del self._jobs[job_id]
+
+    def _prepare_turn(self, db, job: GenerationJob):
+        """
+        スレッドと履歴を読み込み、ユーザーメッセージを (添付ファイルとともに) 保存します。
+
+        Returns:
+            (スレッド, プロジェクト, API 用の履歴, 最初のやり取りかどうか)。
+            スレッドが無い・アーカイブから戻せない場合は、ジョブをエラーで終了して None。
+        """
+        from api.gemini_client import messages_to_contents
+        from models.models import Project, Thread, Message
+        from database.crud import get_thread_history, get_attachments_by_message, link_attachments, record_gemini_file
+
+        thread = db.query(Thread).filter(Thread.id == job.thread_id).first()
+        if thread is None:
+            job._finish(ERROR, "チャットが見つかりません。")
+            return None
+        if thread.archived_at is not None: # 実行待ちの間に別のプロセスがアーカイブに移した
+            from database.archive import restore_thread
+            if not restore_thread(db, thread.id): # 履歴の無いまま生成しない
+                job._finish(ERROR, "チャットをアーカイブから戻せませんでした。")
+                return None
+        project = db.query(Project).filter(Project.id == thread.project_id).first()
+
+        with job.timings.phase("history_load"):
+            history = get_thread_history(db, thread.id) # 分岐元から共有しているメッセージを含む
+
+        user_message = Message(thread_id=thread.id, role="user", content=job.prompt)
+        db.add(user_message)
+        db.flush()
+        link_attachments(db, user_message, job.attachment_ids)
+        thread.updated_at = datetime.datetime.utcnow()
+        db.commit()
+        job.user_message_id = user_message.id
+        with job.timings.phase("markdown_export"):
+            enqueue_message_to_markdown(project.name, thread.id, thread.name, "user", job.prompt)
+
+        # 添付ファイルは同じ内容を1回だけ読み込み、Files API のアップロード済みのファイルは期限内なら再利用する
+        attachments = get_attachments_by_message(db, [m.id for m in history] + [user_message.id])
+        parts = {}
+        if attachments:
+            with job.timings.phase("attachments"):
+                parts = self.client_factory().attachment_parts(
+                    attachments, self.blob_store_factory(),
+                    on_upload=lambda attachment, uploaded: record_gemini_file(db, attachment, uploaded))
+        with job.timings.phase("history_conversion"):
+            history_for_api = messages_to_contents(history, job.prompt, parts, parts.get(user_message.id))
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Job: %s, Thread ID: %s, Model: %s, history items: %d, attachments: %d",
+                      job.job_id, thread.id, job.model_name, len(history_for_api), sum(map(len, attachments.values())))
+            if should_log_content():
+                log.debug("System Prompt: %s", TruncatedText(project.system_prompt))
+        return thread, project, history_for_api, not history
+
+    def _auto_name_thread(self, db, thread, prompt: str) -> None:
+        """最初のやり取りの後、ユーザー入力の先頭60文字をチャット名にします。"""
+        from database.crud import update_thread_name
+
+        new_thread_name = prompt[:60]
+        if new_thread_name:
+            log.info(f"最初のやり取りを検出。チャット ID {thread.id} の名前を自動設定: '{new_thread_name}'")
+            if not update_thread_name(db, thread.id, new_thread_name):
+                log.warning("チャット名の自動設定に失敗しました。")
+
+    def _open_session(self, job: GenerationJob):
+        if self.session_factory is None:
+            return _default_session_factory(job.thread_id)
+        return self.session_factory()
+
+    def _run_job(self, job: GenerationJob) -> None:
+        if job._cancel_requested:
+            job._finish(CANCELLED)
+            return
+
+        with job._lock:
+            job.status = RUNNING
+        job.timings.add("queue_wait", job.timings.elapsed_ms())
+
+        from models.models import Message
+        from database.crud import record_message_usage
+        db = self._open_session(job)
+        try:
+            # 1. 履歴を読み込み、ユーザーメッセージを保存
+            turn = self._prepare_turn(db, job)
+            if turn is None:
+                return
+            thread, project, history_for_api, is_first_exchange = turn
+
+            # 2. Gemini API をストリーミングで呼び出す
+            # 生成途中の応答はジョブ (job.text) にだけ保持し、DB には完了後に1回で書き込む
+            # (検索やエクスポートが書きかけの応答を完成した応答として読まないように)
+            status, error = DONE, None
+            stream_started = time.perf_counter()
+            first_token_at = None
+            usage: dict = {} # トークン数とレイテンシ (クライアントが書き込む)
+            try:
+                client = self.client_factory()
+                stream = client.generate_content_stream(
+                    model_name=job.model_name,
+                    history=history_for_api,
+                    system_prompt=project.system_prompt,
+                    usage=usage,
+                    project_id=project.id,
+                    user=job.user,
+                    cancel_event=job._cancel_event, # 実行枠を待っている間に中止されたら、ワーカーをすぐに空ける
+                )
+                for chunk in stream:
+                    if not chunk:
+                        continue
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    job._append(chunk)
+                    if job._cancel_requested:
+                        break
+                if job._cancel_requested:
+                    status = CANCELLED
+            except SlotCancelled:
+                status = CANCELLED
+            except Exception as e:
+                log.error(f"Gemini API の呼び出し中にエラーが発生しました (job={job.job_id}): {e}", exc_info=True)
+                status, error = ERROR, f"Gemini API の呼び出し中にエラーが発生しました: {e}"
+            stream_finished = time.perf_counter()
+            if first_token_at is None: # 応答が無かった場合は全体を最初のトークン待ちとする
+                first_token_at = stream_finished
+            job.timings.add("time_to_first_token", (first_token_at - stream_started) * 1000)
+            job.timings.add("streaming", (stream_finished - first_token_at) * 1000)
+
+            # 3. 最終的な応答を保存 (何も生成されなかった場合は保存しない)
+            if job.text:
+                assistant_message = Message(thread_id=thread.id, role="assistant", content=job.text)
+                db.add(assistant_message)
+                thread.updated_at = datetime.datetime.utcnow()
+                db.flush()
+                record_message_usage(db, assistant_message, project.id, job.model_name, usage)
+                db.commit()
+                with job._lock:
+                    job.assistant_message_id = assistant_message.id
+                with job.timings.phase("markdown_export"):
+                    enqueue_message_to_markdown(project.name, thread.id, thread.name, "assistant", job.text)
+
+            # --- チャット名の自動設定 (最初のやり取り後) ---
+            if is_first_exchange and status == DONE:
+                self._auto_name_thread(db, thread, job.prompt)
+
+            job._finish(status, error)
+            job.timings.emit()
+            log.info("生成ジョブが終了しました: job=%s, thread=%s, status=%s, chars=%d",
+                     job.job_id, job.thread_id, status, len(job.text))
+        except Exception as e:
+            db.rollback()
+            # 生成中にチャットが削除された場合など
+            log.error(f"生成ジョブの DB 更新中にエラーが発生しました (job={job.job_id}): {e}", exc_info=True)
+            job._finish(ERROR, f"応答の保存中にエラーが発生しました: {e}")
+        finally:
+            db.close()
+
+    def _stream_answer(self, job: "ComparisonJob", answer: "ModelAnswer", history_for_api: list, project) -> None:
+        """比較モードで1モデル分の応答をストリーミングし、初回トークンまでの時間・全体の時間・使用量を記録します。"""
+        started = time.perf_counter()
+        usage: dict = {}
+        try:
+            client = self.client_factory()
+            stream = client.generate_content_stream(
+                model_name=answer.model_name,
+                history=history_for_api,
+                system_prompt=project.system_prompt,
+                usage=usage,
+                project_id=project.id,
+                user=job.user,
+                cancel_event=job._cancel_event,
+            )
+            for chunk in stream:
+                if not chunk:
+                    continue
+                with job._lock:
+                    if answer.time_to_first_token_ms is None:
+                        answer.time_to_first_token_ms = (time.perf_counter() - started) * 1000
+                    answer.text += chunk
+                if job._cancel_requested:
+                    break
+            answer.status = CANCELLED if job._cancel_requested else DONE
+        except SlotCancelled:
+            answer.status = CANCELLED
+        except Exception as e:
+            log.error(f"Gemini API の呼び出し中にエラーが発生しました (job={job.job_id}, model={answer.model_name}): {e}", exc_info=True)
+            answer.status, answer.error = ERROR, f"Gemini API の呼び出し中にエラーが発生しました: {e}"
+        finally:
+            with job._lock:
+                answer.latency_ms = (time.perf_counter() - started) * 1000
+                answer.usage = usage
+
+    def _run_comparison(self, job: "ComparisonJob") -> None:
+        """
+        同じ履歴とプロンプトを複数のモデルに同時に送り、全ての回答と計測値を保存します。
+        モデルごとに別スレッドでストリーミングするため、全体の時間は最も遅いモデルとほぼ同じになります。
+        最初に指定したモデル (失敗した場合は次に成功したモデル) の回答をスレッドの応答として採用します。
+        """
+        if job._cancel_requested:
+            job._finish(CANCELLED)
+            return
+
+        with job._lock:
+            job.status = RUNNING
+        job.timings.add("queue_wait", job.timings.elapsed_ms())
+
+        from models.models import Message, ModelComparisonAnswer
+        from database.crud import record_message_usage, record_comparison_usage
+        db = self._open_session(job)
+        try:
+            turn = self._prepare_turn(db, job)
+            if turn is None:
+                return
+            thread, project, history_for_api, is_first_exchange = turn
+
+            # ジョブ自体がワーカーを1つ使っているため、モデルごとのストリームは専用のスレッドで実行する
+            answers = [job.answers[model_name] for model_name in job.model_names]
+            with job.timings.phase("streaming"), \
+                    ThreadPoolExecutor(max_workers=len(answers), thread_name_prefix="compare") as pool:
+                for future in [pool.submit(self._stream_answer, job, answer, history_for_api, project)
+                               for answer in answers]:
+                    future.result()
+
+            # 最初に成功したモデルの回答をスレッドの応答として保存する
+            adopted = next((answer for answer in answers if answer.text), None)
+            assistant_message = None
+            if adopted is not None:
+                assistant_message = Message(thread_id=thread.id, role="assistant", content=adopted.text)
+                db.add(assistant_message)
+                thread.updated_at = datetime.datetime.utcnow()
+                db.flush()
+                record_message_usage(db, assistant_message, project.id, adopted.model_name,
+                                     {**adopted.usage, "time_to_first_token_ms": adopted.time_to_first_token_ms,
+                                      "latency_ms": adopted.latency_ms})
+                job.assistant_message_id = assistant_message.id
+                job.text = adopted.text
+
+            rows = [
+                ModelComparisonAnswer(
+                    comparison_id=job.job_id,
+                    thread_id=thread.id,
+                    user_message_id=job.user_message_id,
+                    assistant_message_id=assistant_message.id if assistant_message else None,
+                    model_name=answer.model_name,
+                    content=answer.text,
+                    error=answer.error,
+                    time_to_first_token_ms=answer.time_to_first_token_ms,
+                    latency_ms=answer.latency_ms,
+                    prompt_tokens=answer.usage.get("prompt_tokens"),
+                    output_tokens=answer.usage.get("output_tokens"),
+                    total_tokens=answer.usage.get("total_tokens"),
+                    adopted=answer is adopted,
+                )
+                for answer in answers
+            ]
+            db.add_all(rows)
+            # 採用しなかった回答のトークンも課金されているため、それぞれのモデルで集計する
+            for row in rows:
+                record_comparison_usage(db, row, project.id)
+            db.commit()
+
+            if adopted is not None:
+                with job.timings.phase("markdown_export"):
+                    enqueue_message_to_markdown(project.name, thread.id, thread.name, "assistant", adopted.text)
+                if is_first_exchange:
+                    self._auto_name_thread(db, thread, job.prompt)
+
+            if job._cancel_requested:
+                job._finish(CANCELLED)
+            elif adopted is None:
+                job._finish(ERROR, "\n".join(answer.error or f"{answer.model_name}: 応答がありません。" for answer in answers))
+            else:
+                job._finish(DONE)
+            job.timings.emit()
+            log.info("比較ジョブが終了しました: job=%s, thread=%s, %s", job.job_id, job.thread_id,
+                     ", ".join(f"{a.model_name}={a.status} ({a.latency_ms or 0:.0f} ms)" for a in answers))
+        except Exception as e:
+            db.rollback()
+            log.error(f"比較ジョブの DB 更新中にエラーが発生しました (job={job.job_id}): {e}", exc_info=True)
+            job._finish(ERROR, f"応答の保存中にエラーが発生しました: {e}")
+        finally:
+            db.close()
+
+# プロセス全体で共有するランナー (Streamlit の全セッション・全再実行で共有する)
+_runner: GenerationJobRunner | None = None
+_runner_lock = threading.Lock()
+
+def get_generation_runner() -> GenerationJobRunner:
+    """共有の GenerationJobRunner を返します。"""
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = GenerationJobRunner()
+        return _runner
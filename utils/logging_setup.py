@@ -0,0 +1,105 @@
+import os
+import atexit
+import queue
+import random
+import logging
+import logging.handlers
+import threading
+
+# 環境変数によるログ設定
+#   LOG_LEVEL                : ルートロガーのレベル (デフォルト INFO)
+#   LOG_LEVELS               : サブシステムごとのレベル。"ロガー名=レベル" をカンマ区切りで指定
+#                              例: LOG_LEVELS="app=DEBUG,database=WARNING,httpx=WARNING"
+#   LOG_CONTENT_MAX_CHARS    : プロンプトや履歴などの本文をログに出すときの最大文字数 (デフォルト 500)
+#   LOG_CONTENT_SAMPLE_RATE  : 本文をログに出す割合 (0.0〜1.0、デフォルト 0.1)
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_CONTENT_MAX_CHARS = int(os.getenv("LOG_CONTENT_MAX_CHARS", "500"))
+LOG_CONTENT_SAMPLE_RATE = float(os.getenv("LOG_CONTENT_SAMPLE_RATE", "0.1"))
+
+class _DeferredFormatQueueHandler(logging.handlers.QueueHandler):
+    """
+    メッセージの整形 (msg % args) もリスナースレッドに任せる QueueHandler。
+    標準の QueueHandler は呼び出し元のスレッドで整形してからキューに積むため、
+    例外のトレースバックだけを呼び出し元で文字列化し、それ以外はそのまま積みます。
+    そのため args には後から変更されない値 (文字列・数値・TruncatedText など) を渡してください。
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+_listener: logging.handlers.QueueListener | None = None
+_setup_lock = threading.Lock()
+
+def parse_log_levels(spec: str) -> dict[str, int]:
+    """
+    "app=DEBUG,database=WARNING" 形式の文字列をロガー名 -> レベルの dict に変換します。
+    不正な項目は無視します。
+    """
+    levels = {}
+    for item in spec.split(","):
+        name, _, level_name = item.partition("=")
+        level = logging.getLevelName(level_name.strip().upper())
+        if name.strip() and isinstance(level, int):
+            levels[name.strip()] = level
+    return levels
+
+def setup_logging() -> None:
+    """
+    アプリ全体のログ設定を行います (何度呼んでも設定は1回だけ)。
+
+    ロガーはキューに積むだけの QueueHandler を使い、フォーマットと出力は
+    バックグラウンドスレッドの QueueListener が行います。これにより、チャット処理中の
+    ログ出力がコンソールやファイルへの I/O を待たないようにしています。
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+        log_queue: queue.Queue = queue.Queue(-1)
+        queue_handler = _DeferredFormatQueueHandler(log_queue)
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        root.setLevel(logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper()))
+
+        for name, level in parse_log_levels(os.getenv("LOG_LEVELS", "")).items():
+            logging.getLogger(name).setLevel(level)
+
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop) # 終了時にキューに残ったログを書き出す
+
+class TruncatedText:
+    """
+    ログのメッセージ引数として渡す、長さ制限付きの遅延文字列。
+    実際にログが出力されるときにだけ str() され、max_chars を超える部分は省略されます。
+
+    例: log.debug("System Prompt: %s", TruncatedText(prompt))
+    """
+    __slots__ = ("value", "max_chars")
+
+    def __init__(self, value, max_chars: int | None = None):
+        self.value = value
+        self.max_chars = LOG_CONTENT_MAX_CHARS if max_chars is None else max_chars
+
+    def __str__(self) -> str:
+        text = self.value if isinstance(self.value, str) else repr(self.value)
+        if len(text) <= self.max_chars:
+            return text
+        return f"{text[:self.max_chars]}... (全 {len(text)} 文字)"
+
+    __repr__ = __str__
+
+def should_log_content(rate: float | None = None) -> bool:
+    """プロンプトや履歴の本文をログに出すかどうかを LOG_CONTENT_SAMPLE_RATE の割合で決めます。"""
+    rate = LOG_CONTENT_SAMPLE_RATE if rate is None else rate
+    return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
@@ -1,19 +1,60 @@
 import os
 import datetime
 import logging
+import queue
+import threading
+import time
+import atexit
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
 
 # 環境変数からマークダウン保存ディレクトリを取得、なければデフォルト値
 MARKDOWN_BASE_DIR = os.getenv("MARKDOWN_SAVE_DIR", "markdown_files")
 
+# バックグラウンド書き込みの設定 (環境変数で上書き可能)
+MARKDOWN_MAX_OPEN_FILES = int(os.getenv("MARKDOWN_MAX_OPEN_FILES", "32")) # 開いたままにするファイル数の上限
+MARKDOWN_FLUSH_BYTES = int(os.getenv("MARKDOWN_FLUSH_BYTES", str(64 * 1024))) # この量たまったら書き出す
+MARKDOWN_FLUSH_INTERVAL = float(os.getenv("MARKDOWN_FLUSH_INTERVAL", "1.0")) # 最後の書き出しからの最大待ち秒数
+
 def sanitize_filename(name: str) -> str:
     """ファイル名として安全でない文字を置換します。"""
     # 例: スラッシュ、コロンなどをアンダースコアに置換
     # 必要に応じて他の文字も追加
     return name.replace("/", "_").replace(":", "_").replace("\\", "_")
 
+def get_markdown_file_path(project_name: str, thread_id: int, thread_name: str, base_dir: str | None = None) -> str:
+    """
+    スレッドに対応するマークダウンファイルのパスを返します (ディレクトリは作成しません)。
+
+    Args:
+        project_name: プロジェクト名 (ディレクトリ名に使用)。
+        thread_id: スレッドID。
+        thread_name: スレッド名（ファイル名に使用）。
+        base_dir: 保存先のルートディレクトリ。省略時は MARKDOWN_BASE_DIR。
+
+    Returns:
+        "{base_dir}/{プロジェクト名}/{スレッド名} ({ID}).md" 形式のパス。
+    """
+    project_dir = os.path.join(base_dir or MARKDOWN_BASE_DIR, sanitize_filename(project_name))
+    file_name = f"{sanitize_filename(thread_name)} ({thread_id}).md"
+    return os.path.join(project_dir, file_name)
+
+def format_markdown_message(role: str, content: str, timestamp: datetime.datetime) -> str:
+    """1件のメッセージをマークダウンファイルに追記する形式に整形します。"""
+    # DBロール('user'/'assistant')をそのまま使う
+    return f"**[{role.capitalize()}]** ({timestamp.strftime('%Y-%m-%d %H:%M:%S')}):\n\n{content}\n\n---\n\n"
+
+def to_local_time(created_at) -> datetime.datetime:
+    """DB の UTC 日時 (文字列または datetime) を、リアルタイム書き出しと同じローカル時刻に変換します。"""
+    if isinstance(created_at, str):
+        created_at = datetime.datetime.fromisoformat(created_at)
+    return created_at.replace(tzinfo=datetime.timezone.utc).astimezone().replace(tzinfo=None)
+
 def export_message_to_markdown(project_name: str, thread_id: int, thread_name: str, role: str, content: str):
     """
     指定されたメッセージをスレッドに対応するマークダウンファイルに追記します。
+    呼び出し元でファイル I/O を待つため、チャット処理中は enqueue_message_to_markdown を使用してください。
 
     Args:
         project_name: プロジェクト名。
@@ -24,27 +65,233 @@ def export_message_to_markdown(project_name: str, thread_id: int, thread_name: s
     """
     try:
         # プロジェクト名のディレクトリパスを作成 (なければ作成)
-        project_dir = os.path.join(MARKDOWN_BASE_DIR, sanitize_filename(project_name))
-        os.makedirs(project_dir, exist_ok=True)
-
-        # スレッド名とIDでファイル名を生成 (サニタイズ)
         # 例: "スレッド名 (ID).md"
-        file_name = f"{sanitize_filename(thread_name)} ({thread_id}).md"
-        file_path = os.path.join(project_dir, file_name)
-
-        # タイムスタンプを取得
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        file_path = get_markdown_file_path(project_name, thread_id, thread_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
         # 追記するテキストをフォーマット
-        # DBロール('user'/'assistant')をそのまま使う
-        formatted_message = f"**[{role.capitalize()}]** ({timestamp}):\n\n{content}\n\n---\n\n"
+        formatted_message = format_markdown_message(role, content, datetime.datetime.now())
 
         # ファイルに追記モードで書き込み
         with open(file_path, "a", encoding="utf-8") as f:
             f.write(formatted_message)
-        
+
         # logging.debug(f"メッセージをマークダウンファイルにエクスポートしました: {file_path}")
 
     except Exception as e:
         # エラー発生時はログに出力（Streamlit画面には出さない方が良いかも）
-        logging.error(f"マークダウンファイルへのエクスポート中にエラーが発生しました: {e}", exc_info=True) 
+        log.error(f"マークダウンファイルへのエクスポート中にエラーが発生しました: {e}", exc_info=True)
+
+class MarkdownWriter:
+    """
+    マークダウンファイルへの追記をバックグラウンドスレッドでまとめて行うライター。
+
+    submit() はキューに積むだけで即座に戻るため、チャット処理はファイル I/O を待ちません。
+    書き込みスレッドは追記内容をファイルごとにまとめ、バッファ量 (flush_bytes) か
+    経過時間 (flush_interval) のどちらかが上限に達したら書き出します。
+    開いたファイルハンドルは LRU で最大 max_open_files 個まで保持し、
+    同じスレッドへの連続した追記で open/close を繰り返さないようにします。
+    保持中のファイルが置き換え・削除された場合 (markdown_rebuild など) は、書き出し前に開き直します。
+    """
+
+    _STOP = object() # 終了を知らせる番兵
+
+    def __init__(self,
+                 base_dir: str | None = None,
+                 max_open_files: int = MARKDOWN_MAX_OPEN_FILES,
+                 flush_bytes: int = MARKDOWN_FLUSH_BYTES,
+                 flush_interval: float = MARKDOWN_FLUSH_INTERVAL):
+        self.base_dir = base_dir or MARKDOWN_BASE_DIR
+        self.max_open_files = max(1, max_open_files)
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+
+        self._queue: queue.Queue = queue.Queue()
+        self._handles: OrderedDict = OrderedDict() # path -> ファイルオブジェクト (LRU 順)
+        self._buffers: dict[str, list[str]] = {} # path -> 未書き出しのテキスト
+        self._buffered_bytes = 0
+        self._known_dirs: set[str] = set() # 作成済みディレクトリ (makedirs を繰り返さない)
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._closed = False
+
+    def start(self) -> "MarkdownWriter":
+        """書き込みスレッドを開始します (開始済みなら何もしません)。"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="markdown-writer", daemon=True)
+                self._thread.start()
+        return self
+
+    def submit(self, project_name: str, thread_id: int, thread_name: str, role: str, content: str,
+               timestamp: datetime.datetime | None = None) -> bool:
+        """
+        メッセージの追記をキューに積みます。ファイル I/O は行いません。
+        タイムスタンプ (ローカル時刻) を省略した場合は呼び出し時点のものが使われます。
+
+        Returns:
+            キューに積めた場合は True、ライターが既に閉じられている場合は False。
+        """
+        if self._closed:
+            log.warning("MarkdownWriter は既に閉じられています。メッセージを書き込めません。")
+            return False
+        self._queue.put((project_name, thread_id, thread_name, role, content, timestamp or datetime.datetime.now()))
+        return True
+
+    def close(self, timeout: float | None = None) -> None:
+        """キューに残ったメッセージを全て書き出してからスレッドを終了し、ファイルを閉じます。"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(self._STOP)
+            thread.join(timeout)
+        else:
+            # start() されていない場合は呼び出し元のスレッドで書き出す
+            self._drain_queue()
+            self._flush()
+            self._close_handles()
+
+    def _run(self) -> None:
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is self._STOP:
+                self._drain_queue()
+                self._flush()
+                self._close_handles()
+                return
+            if item is not None:
+                self._buffer(item)
+
+            if self._buffered_bytes >= self.flush_bytes or time.monotonic() - last_flush >= self.flush_interval:
+                self._flush()
+                last_flush = time.monotonic()
+
+    def _drain_queue(self) -> None:
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not self._STOP:
+                self._buffer(item)
+
+    def _buffer(self, item: tuple) -> None:
+        project_name, thread_id, thread_name, role, content, timestamp = item
+        file_path = get_markdown_file_path(project_name, thread_id, thread_name, self.base_dir)
+        text = format_markdown_message(role, content, timestamp)
+        self._buffers.setdefault(file_path, []).append(text)
+        self._buffered_bytes += len(text)
+
+    def _flush(self) -> None:
+        """ファイルごとにまとめたテキストを1回の write で書き出します。"""
+        buffers, self._buffers = self._buffers, {}
+        self._buffered_bytes = 0
+        for file_path, chunks in buffers.items():
+            try:
+                handle = self._get_handle(file_path)
+                handle.write("".join(chunks))
+                handle.flush()
+            except Exception as e:
+                log.error(f"マークダウンファイルへの書き込み中にエラーが発生しました ({file_path}): {e}", exc_info=True)
+                self._discard_handle(file_path)
+
+    def _get_handle(self, file_path: str):
+        handle = self._handles.get(file_path)
+        if handle is not None:
+            if self._is_same_file(handle, file_path):
+                self._handles.move_to_end(file_path)
+                return handle
+            # 開いている間にファイルが置き換え・削除された (削除済みの inode に書くと内容が失われる)
+            self._discard_handle(file_path)
+
+        directory = os.path.dirname(file_path)
+        if directory not in self._known_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._known_dirs.add(directory)
+        handle = open(file_path, "a", encoding="utf-8")
+        self._handles[file_path] = handle
+        # 上限を超えたら最も古く使われたハンドルを閉じる
+        while len(self._handles) > self.max_open_files:
+            _, oldest = self._handles.popitem(last=False)
+            oldest.close()
+        return handle
+
+    @staticmethod
+    def _is_same_file(handle, file_path: str) -> bool:
+        """ハンドルが今 file_path にあるファイルを指しているか (inode で比較)"""
+        try:
+            opened, current = os.fstat(handle.fileno()), os.stat(file_path)
+        except OSError:
+            return False
+        return (opened.st_dev, opened.st_ino) == (current.st_dev, current.st_ino)
+
+    def _discard_handle(self, file_path: str) -> None:
+        handle = self._handles.pop(file_path, None)
+        if handle is not None:
+            try:
+                handle.close()
+            except Exception:
+                pass
+        # ディレクトリが削除された可能性もあるので次回は作り直す
+        self._known_dirs.discard(os.path.dirname(file_path))
+
+    def _close_handles(self) -> None:
+        while self._handles:
+            _, handle = self._handles.popitem()
+            try:
+                handle.close()
+            except Exception as e:
+                log.error(f"マークダウンファイルのクローズ中にエラーが発生しました: {e}", exc_info=True)
+
+# プロセス全体で共有するライター
+_writer: MarkdownWriter | None = None
+_writer_lock = threading.Lock()
+
+def get_markdown_writer() -> MarkdownWriter:
+    """共有の MarkdownWriter を返します。初回呼び出し時に開始し、プロセス終了時に残りを書き出します。"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = MarkdownWriter().start()
+            atexit.register(_writer.close)
+        return _writer
+
+def enqueue_message_to_markdown(project_name: str, thread_id: int, thread_name: str, role: str, content: str):
+    """
+    export_message_to_markdown のノンブロッキング版。
+    メッセージを共有ライターのキューに積み、ファイルへの追記はバックグラウンドで行います。
+
+    Args:
+        project_name: プロジェクト名。
+        thread_id: スレッドID。
+        thread_name: スレッド名（ファイル名に使用）。
+        role: メッセージの役割 ('user' or 'assistant')。
+        content: メッセージの内容。
+    """
+    get_markdown_writer().submit(project_name, thread_id, thread_name, role, content)
+
+def enqueue_thread_history_to_markdown(project_name: str, thread_id: int, thread_name: str, messages) -> None:
+    """
+    分岐したスレッドのファイルを、分岐元から引き継いだ履歴で始めます。
+    markdown_rebuild が書き出すファイル (分岐元のメッセージを含む) と同じ内容になるように、
+    各メッセージの作成日時をタイムスタンプに使います。
+
+    Args:
+        project_name: プロジェクト名。
+        thread_id: 分岐したスレッドの ID。
+        thread_name: スレッド名（ファイル名に使用）。
+        messages: crud.get_thread_history の結果 (role / content / created_at を持つ行)。
+    """
+    writer = get_markdown_writer()
+    for message in messages:
+        writer.submit(project_name, thread_id, thread_name, message.role, message.content,
+                      timestamp=to_local_time(message.created_at))
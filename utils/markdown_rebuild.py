@@ -0,0 +1,302 @@
+"""
+データベースからマークダウンアーカイブ (MARKDOWN_SAVE_DIR) を一括で再生成するコマンド。
+
+スレッド名の変更やリストア後に、不足しているファイルや古いファイル名を修復します。
+
+    python -m utils.markdown_rebuild                    # 全プロジェクトを再生成
+    python -m utils.markdown_rebuild --project-id 3     # 1プロジェクトのみ
+    python -m utils.markdown_rebuild --workers 8 --prune
+"""
+import os
+import re
+import json
+import hashlib
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import create_engine, text
+
+from utils.markdown_export import MARKDOWN_BASE_DIR, get_markdown_file_path, format_markdown_message, to_local_time
+
+log = logging.getLogger(__name__)
+
+# 前回の再生成で書き出したファイルのパスと内容のハッシュを、スレッド ID ごとに保存するファイル (base_dir 直下)
+MANIFEST_FILE_NAME = ".rebuild_manifest.json"
+
+# "{スレッド名} ({ID}).md" からスレッド ID を取り出す
+_THREAD_FILE_PATTERN = re.compile(r"^.* \((\d+)\)\.md$")
+
+# 1ワーカーが1回のクエリで読み出すスレッド ID 範囲内の全メッセージ (スレッド順・時系列順)。
+# 分岐したスレッドは crud.get_thread_history と同じく、分岐元から共有しているメッセージ (分岐点まで) を先頭に含める
+_PARTITION_QUERY = """
+    WITH RECURSIVE lineage(root_id, thread_id, cutoff, depth) AS (
+        SELECT t.id, t.id, NULL, 0
+        FROM threads t
+        WHERE t.id BETWEEN :first_id AND :last_id {project_filter}
+        UNION ALL
+        SELECT l.root_id, t.parent_thread_id, t.branch_message_id, l.depth + 1
+        FROM lineage l
+        JOIN threads t ON t.id = l.thread_id
+        WHERE t.parent_thread_id IS NOT NULL
+    )
+    SELECT p.name, r.id, r.name, m.role, m.content, m.created_at
+    FROM lineage l
+    JOIN threads r ON r.id = l.root_id
+    JOIN projects p ON p.id = r.project_id
+    JOIN messages m ON m.thread_id = l.thread_id AND (l.cutoff IS NULL OR m.id <= l.cutoff)
+    ORDER BY r.id, l.depth DESC, m.created_at, m.id
+"""
+
+def _content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def _write_if_changed(file_path: str, rel_path: str, content: str, previous: dict | None,
+                      created_dirs: set[str]) -> tuple[bool, dict]:
+    """
+    前回と同じパス・同じ内容のハッシュで、ファイルも前回書いたまま (サイズと mtime が一致) なら
+    書き込みを省略します。
+
+    Returns:
+        (書き込んだかどうか, マニフェストに保存するエントリ)
+    """
+    digest = _content_hash(content)
+    if previous and previous.get("path") == rel_path and previous.get("sha256") == digest:
+        try:
+            stat = os.stat(file_path)
+            if stat.st_size == previous.get("size") and stat.st_mtime_ns == previous.get("mtime_ns"):
+                return False, previous
+        except FileNotFoundError:
+            pass
+
+    directory = os.path.dirname(file_path)
+    if directory not in created_dirs:
+        os.makedirs(directory, exist_ok=True)
+        created_dirs.add(directory)
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, file_path)
+    stat = os.stat(file_path)
+    return True, {"path": rel_path, "sha256": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def _rebuild_partition(database_url: str, base_dir: str, first_id: int, last_id: int,
+                       project_id: int | None, manifest: dict[str, dict]) -> dict:
+    """
+    ワーカープロセスで実行: スレッド ID が first_id〜last_id の範囲のファイルを再生成します。
+    メッセージは1本の順序付きクエリでストリーミングし、スレッドが切り替わるたびに書き出します。
+    manifest にはこの範囲のスレッドのエントリ (スレッド ID の文字列 -> 前回の書き込み情報) だけを渡します。
+    """
+    engine = create_engine(database_url)
+    written, skipped = 0, 0
+    entries: dict[str, dict] = {}
+    expected: dict[int, str] = {} # thread_id -> 正しいファイルパス
+    created_dirs: set[str] = set()
+
+    def flush(thread_key, parts):
+        nonlocal written, skipped
+        project_name, thread_id, thread_name = thread_key
+        file_path = get_markdown_file_path(project_name, thread_id, thread_name, base_dir)
+        rel_path = os.path.relpath(file_path, base_dir)
+        changed, entry = _write_if_changed(file_path, rel_path, "".join(parts), manifest.get(str(thread_id)), created_dirs)
+        entries[str(thread_id)] = entry
+        expected[thread_id] = file_path
+        if changed:
+            written += 1
+        else:
+            skipped += 1
+
+    query = _PARTITION_QUERY.format(project_filter="AND t.project_id = :project_id" if project_id is not None else "")
+    params = {"first_id": first_id, "last_id": last_id, "project_id": project_id}
+    try:
+        with engine.connect() as connection:
+            result = connection.execution_options(yield_per=1000).execute(text(query), params)
+            current_key, parts = None, []
+            for project_name, thread_id, thread_name, role, content, created_at in result:
+                key = (project_name, thread_id, thread_name)
+                if key != current_key:
+                    if current_key is not None:
+                        flush(current_key, parts)
+                    current_key, parts = key, []
+                parts.append(format_markdown_message(role, content, to_local_time(created_at)))
+            if current_key is not None:
+                flush(current_key, parts)
+    finally:
+        engine.dispose()
+
+    return {"written": written, "skipped": skipped, "entries": entries, "expected": expected}
+
+def _partition_thread_ids(thread_ids: list[int], partitions: int) -> list[tuple[int, int]]:
+    """ソート済みのスレッド ID を、件数がほぼ均等な連続範囲 (first_id, last_id) に分割します。"""
+    if not thread_ids:
+        return []
+    partitions = max(1, min(partitions, len(thread_ids)))
+    size = -(-len(thread_ids) // partitions) # 切り上げ
+    return [
+        (thread_ids[i], thread_ids[min(i + size, len(thread_ids)) - 1])
+        for i in range(0, len(thread_ids), size)
+    ]
+
+def _load_manifest(base_dir: str) -> dict[str, dict]:
+    try:
+        with open(os.path.join(base_dir, MANIFEST_FILE_NAME), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _save_manifest(base_dir: str, manifest: dict[str, dict]) -> None:
+    os.makedirs(base_dir, exist_ok=True)
+    path = os.path.join(base_dir, MANIFEST_FILE_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+def _remove_stale_files(base_dir: str, expected: dict[int, str], existing_thread_ids: set[int] | None) -> list[str]:
+    """
+    古いファイルを削除します。
+    - 再生成したスレッドのうち、現在の名前と異なるファイル名のもの (スレッド名・プロジェクト名の変更)
+    - existing_thread_ids が指定された場合、DB に存在しないスレッドのファイル (prune)
+    """
+    removed = []
+    if not os.path.isdir(base_dir):
+        return removed
+    expected_paths = {os.path.normpath(path) for path in expected.values()}
+    for project_entry in os.scandir(base_dir):
+        if not project_entry.is_dir():
+            continue
+        for file_entry in os.scandir(project_entry.path):
+            match = _THREAD_FILE_PATTERN.match(file_entry.name)
+            if not match or not file_entry.is_file():
+                continue
+            thread_id = int(match.group(1))
+            path = os.path.normpath(file_entry.path)
+            is_renamed = thread_id in expected and path not in expected_paths
+            is_orphan = existing_thread_ids is not None and thread_id not in existing_thread_ids
+            if is_renamed or is_orphan:
+                os.remove(file_entry.path)
+                removed.append(file_entry.path)
+    return removed
+
+def _database_urls(database_url: str | None, project_id: int | None) -> list[str]:
+    """
+    スレッドを読み出す DB の URL。分割保存が有効な場合は、カタログ (有効にする前のスレッド) と
+    プロジェクトごとの DB をすべて読むため、--prune がプロジェクトの DB のスレッドを孤立扱いしません。
+    """
+    if database_url is not None:
+        return [database_url]
+    from database.database import DATABASE_URL
+    from database.sharding import get_shard_router
+    router = get_shard_router()
+    if router is None:
+        return [DATABASE_URL]
+    project_ids = router.project_ids()
+    if project_id is not None:
+        project_ids = [shard_id for shard_id in project_ids if shard_id == project_id]
+    return [DATABASE_URL] + [f"sqlite:///{router.shard_path(shard_id)}" for shard_id in project_ids]
+
+def rebuild_markdown_archive(database_url: str | None = None,
+                             base_dir: str | None = None,
+                             project_id: int | None = None,
+                             workers: int | None = None,
+                             prune: bool = False) -> dict[str, int]:
+    """
+    データベースの内容からマークダウンアーカイブを再生成します。
+
+    スレッドを ID 範囲で分割し、プロセスプールの各ワーカーが1本のストリーミングクエリで
+    担当範囲を読み出してファイルを並列に書き出します。前回の再生成時と内容のハッシュが
+    同じファイルは書き込みを省略します。
+
+    Args:
+        database_url: 読み出すデータベースの URL。省略時はアプリと同じ DB
+            (分割保存 (DB_SHARDING) が有効な場合はカタログと全プロジェクトの DB)。
+        base_dir: マークダウンの保存先。省略時は MARKDOWN_BASE_DIR。
+        project_id: 指定した場合はそのプロジェクトのみ再生成します。
+        workers: ワーカープロセス数。省略時は CPU 数。1 の場合はプロセスを起動しません。
+        prune: True の場合、DB に存在しないスレッドのファイルも削除します (全体の再生成時のみ)。
+
+    Returns:
+        {"threads": 対象スレッド数, "written": 書き込み数, "skipped": 変更なし数, "removed": 削除数}
+    """
+    base_dir = base_dir or MARKDOWN_BASE_DIR
+    workers = workers or os.cpu_count() or 1
+
+    # 読み出す DB ごとのスレッド ID (分割保存ではカタログと各プロジェクトの DB)
+    sources = []
+    for source_url in _database_urls(database_url, project_id):
+        engine = create_engine(source_url)
+        try:
+            with engine.connect() as connection:
+                if project_id is None:
+                    rows = connection.execute(text("SELECT id FROM threads ORDER BY id"))
+                else:
+                    rows = connection.execute(
+                        text("SELECT id FROM threads WHERE project_id = :project_id ORDER BY id"),
+                        {"project_id": project_id},
+                    )
+                sources.append((source_url, [row[0] for row in rows]))
+        finally:
+            engine.dispose()
+    thread_ids = [thread_id for _, source_ids in sources for thread_id in source_ids]
+
+    manifest = _load_manifest(base_dir)
+    # スレッド数が均等になるよう DB ごとに ID 範囲を分け、1ワーカー1クエリで読み出す
+    tasks = [(source_url, first_id, last_id)
+             for source_url, source_ids in sources
+             for first_id, last_id in _partition_thread_ids(source_ids, workers)]
+    log.info(f"マークダウンアーカイブを再生成します: {len(thread_ids)} スレッド, {len(tasks)} パーティション, {workers} ワーカー")
+
+    def manifest_slice(first_id: int, last_id: int) -> dict[str, dict]:
+        return {key: entry for key, entry in manifest.items() if first_id <= int(key) <= last_id}
+
+    results = []
+    if workers == 1 or len(tasks) <= 1:
+        for source_url, first_id, last_id in tasks:
+            results.append(_rebuild_partition(
+                source_url, base_dir, first_id, last_id, project_id, manifest_slice(first_id, last_id)
+            ))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_rebuild_partition, source_url, base_dir, first_id, last_id, project_id,
+                                manifest_slice(first_id, last_id))
+                for source_url, first_id, last_id in tasks
+            ]
+            results = [future.result() for future in futures]
+
+    stats = {"threads": len(thread_ids), "written": 0, "skipped": 0, "removed": 0}
+    expected: dict[int, str] = {}
+    for result in results:
+        stats["written"] += result["written"]
+        stats["skipped"] += result["skipped"]
+        manifest.update(result["entries"])
+        expected.update(result["expected"])
+
+    existing_thread_ids = set(thread_ids) if prune and project_id is None else None
+    removed = _remove_stale_files(base_dir, expected, existing_thread_ids)
+    if existing_thread_ids is not None:
+        manifest = {key: entry for key, entry in manifest.items() if int(key) in existing_thread_ids}
+    stats["removed"] = len(removed)
+
+    _save_manifest(base_dir, manifest)
+    log.info(f"マークダウンアーカイブの再生成が完了しました: {stats}")
+    return stats
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    from utils.logging_setup import setup_logging
+    setup_logging()
+
+    parser = argparse.ArgumentParser(description="データベースからマークダウンアーカイブを再生成します。")
+    parser.add_argument("--project-id", type=int, default=None, help="このプロジェクトのみ再生成する")
+    parser.add_argument("--workers", type=int, default=None, help="ワーカープロセス数 (デフォルト: CPU 数)")
+    parser.add_argument("--base-dir", default=os.getenv("MARKDOWN_SAVE_DIR", MARKDOWN_BASE_DIR), help="保存先ディレクトリ")
+    parser.add_argument("--prune", action="store_true", help="DB に存在しないスレッドのファイルを削除する")
+    args = parser.parse_args()
+
+    print(rebuild_markdown_archive(
+        base_dir=args.base_dir,
+        project_id=args.project_id,
+        workers=args.workers,
+        prune=args.prune,
+    ))
@@ -0,0 +1,144 @@
+"""
+再実行 (rerun) と応答生成の処理時間をフェーズごとに計測します (環境変数 PERF_TIMING=1 で有効)。
+
+「遅い」と言われたときに、DB・Gemini のストリーム・Streamlit の描画のどれが原因かを切り分けるためのものです。
+計測結果は app.py のデバッグパネルに表示され、ロガー "perf" に1行の JSON として出力されます。
+ログからパーセンタイルを集計するには:
+
+    python -m utils.perf_timing app.log
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+from contextlib import contextmanager, nullcontext
+
+# 計測の有効/無効 (無効の場合、phase() は何もしないコンテキストマネージャを返す)
+PERF_TIMING = os.getenv("PERF_TIMING", "").lower() in ("1", "true", "yes", "on")
+
+perf_log = logging.getLogger("perf")
+
+# ログの1行から JSON 部分を取り出す (LOG_FORMAT の前置きは無視する)
+_RECORD_PATTERN = re.compile(r"perf_timing (\{.*\})\s*$")
+
+class PhaseTimer:
+    """
+    処理のフェーズごとの所要時間 (ミリ秒) を記録します。
+
+    例:
+        timer = PhaseTimer("rerun")
+        with timer.phase("init_db"):
+            init_db()
+        timer.emit()
+    """
+
+    def __init__(self, kind: str, enabled: bool | None = None, **context):
+        self.kind = kind # "rerun" / "generation" など (集計の単位)
+        self.enabled = PERF_TIMING if enabled is None else enabled
+        self.context = context # スレッド ID などの付加情報 (ログに含める)
+        self.phases: dict[str, float] = {}
+        self._started = time.perf_counter()
+
+    def phase(self, name: str):
+        """with 文で囲んだ処理の時間を name として記録します (同じ名前は加算)。"""
+        if not self.enabled:
+            return nullcontext()
+        return self._measure(name)
+
+    @contextmanager
+    def _measure(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - started) * 1000)
+
+    def add(self, name: str, elapsed_ms: float) -> None:
+        """計測済みの時間 (ミリ秒) を記録します。"""
+        if self.enabled:
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed_ms
+
+    def elapsed_ms(self) -> float:
+        """作成してからの経過時間 (ミリ秒)"""
+        return (time.perf_counter() - self._started) * 1000
+
+    def to_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            **self.context,
+            "total_ms": round(self.elapsed_ms(), 2),
+            "phases": {name: round(value, 2) for name, value in self.phases.items()},
+        }
+
+    def emit(self) -> None:
+        """計測結果をロガー "perf" に JSON として出力します。"""
+        if self.enabled:
+            perf_log.info("perf_timing %s", json.dumps(self.to_dict(), ensure_ascii=False))
+
+def parse_records(lines) -> list[dict]:
+    """ログの行から PhaseTimer.emit() の出力を読み取ります。"""
+    records = []
+    for line in lines:
+        match = _RECORD_PATTERN.search(line)
+        if match:
+            try:
+                records.append(json.loads(match.group(1)))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+def percentile(values: list[float], q: float, default: float | None = None) -> float | None:
+    """
+    values の q 分位点 (0.0〜1.0、最近傍順位法) を返します。values が空の場合は default を返します。
+    計測結果の集計 (summarize)、スケジューラーの待ち時間、ベンチマーク・一括実行の集計で共通に使います。
+    """
+    if not values:
+        return default
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def summarize(records: list[dict]) -> dict[str, dict[str, dict]]:
+    """
+    計測結果を種類・フェーズごとに集計します。
+
+    Returns:
+        種類 -> フェーズ ("total" を含む) -> {"count", "p50_ms", "p95_ms", "p99_ms", "max_ms"}。
+    """
+    samples: dict[str, dict[str, list[float]]] = {}
+    for record in records:
+        phases = samples.setdefault(record.get("kind", "unknown"), {})
+        phases.setdefault("total", []).append(record.get("total_ms", 0.0))
+        for name, value in record.get("phases", {}).items():
+            phases.setdefault(name, []).append(value)
+    return {
+        kind: {
+            name: {"count": len(values), "p50_ms": percentile(values, 0.5), "p95_ms": percentile(values, 0.95),
+                   "p99_ms": percentile(values, 0.99), "max_ms": max(values)}
+            for name, values in phases.items()
+        }
+        for kind, phases in samples.items()
+    }
+
+def format_phases(timer_dict: dict) -> str:
+    """to_dict() の結果をデバッグパネル用のマークダウンの表にします。"""
+    total = timer_dict["total_ms"] or 1.0
+    rows = ["| フェーズ | 時間 (ms) | 割合 |", "|---|---:|---:|"]
+    for name, value in timer_dict["phases"].items():
+        rows.append(f"| {name} | {value:.1f} | {value / total:.0%} |")
+    rows.append(f"| **合計** | **{timer_dict['total_ms']:.1f}** | |")
+    return "\n".join(rows)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], encoding="utf-8") as f:
+            parsed = parse_records(f)
+    else:
+        parsed = parse_records(sys.stdin)
+    for kind, phases in summarize(parsed).items():
+        print(f"--- {kind} ---")
+        print(f"{'phase':<20} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+        for name, stats in phases.items():
+            print(f"{name:<20} {stats['count']:>6} {stats['p50_ms']:9.1f} {stats['p95_ms']:9.1f} "
+                  f"{stats['p99_ms']:9.1f} {stats['max_ms']:9.1f}")
@@ -0,0 +1,134 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+
+from utils.markdown_export import format_markdown_message
+
+# チャット履歴表示の設定 (環境変数で上書き可能)
+RENDER_RECENT_MESSAGES = int(os.getenv("RENDER_RECENT_MESSAGES", "30")) # 吹き出し (st.chat_message) で個別に表示する直近の件数
+RENDER_BLOCK_SIZE = int(os.getenv("RENDER_BLOCK_SIZE", "50")) # 古いメッセージを何件ずつ1つの要素にまとめるか
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "20000")) # キャッシュに保持する最大エントリ数
+
+def content_hash(content: str) -> str:
+    """メッセージ本文のハッシュ (キャッシュキー用)"""
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=8).hexdigest()
+
+def _close_code_fences(content: str) -> str:
+    """閉じられていないコードブロックを閉じます (まとめて表示したときに後続のメッセージを巻き込まないため)。"""
+    fence_count = sum(1 for line in content.splitlines() if line.lstrip().startswith("```"))
+    return content + "\n```" if fence_count % 2 else content
+
+class MessageRenderCache:
+    """
+    チャット履歴の表示用マークダウンを、メッセージ ID と本文のハッシュをキーにキャッシュします。
+
+    Streamlit は再実行のたびに全メッセージの要素を作り直すため、メッセージ数に比例して遅くなります。
+    そこで直近 recent 件以外の古いメッセージを block_size 件ずつ1つのマークダウンにまとめ、
+    まとめた結果もキャッシュします。ブロックの区切りはスレッドの先頭から固定なので、
+    メッセージが追加されても既存のブロックの内容は変わらず、新しいメッセージだけが整形されます。
+    本文が変わったメッセージはハッシュが変わるため、そのメッセージを含むブロックだけ作り直されます。
+    """
+
+    def __init__(self, max_entries: int = RENDER_CACHE_SIZE):
+        self.max_entries = max(1, max_entries)
+        self._entries: OrderedDict = OrderedDict() # キー -> 整形済みマークダウン (LRU 順)
+        self._lock = threading.Lock() # Streamlit はセッションごとに別スレッドで実行される
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return value
+
+    def _put(self, key, value: str) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def render_message(self, message, key: tuple) -> str:
+        """1件のメッセージを履歴ブロック用のマークダウンに整形します (キャッシュがあれば再利用)。"""
+        cached = self._get(key)
+        if cached is None:
+            cached = format_markdown_message(message.role, _close_code_fences(message.content), message.created_at)
+            self._put(key, cached)
+        return cached
+
+    def render_block(self, messages: list, keys: list[tuple]) -> str:
+        """複数のメッセージを1つのマークダウンにまとめます (キャッシュがあれば再利用)。"""
+        block_key = ("block", tuple(keys))
+        cached = self._get(block_key)
+        if cached is None:
+            cached = "".join(self.render_message(message, key) for message, key in zip(messages, keys))
+            self._put(block_key, cached)
+        return cached
+
+    def prepare_history(self, messages: list,
+                        recent: int = RENDER_RECENT_MESSAGES,
+                        block_size: int = RENDER_BLOCK_SIZE) -> tuple[list[str], list]:
+        """
+        履歴を「まとめて表示するブロック」と「個別に表示するメッセージ」に分けます。
+
+        Args:
+            messages: 作成日時順のメッセージ (id, role, content, created_at を持つオブジェクト)。
+            recent: 個別に表示する直近のメッセージ数の下限。
+            block_size: 1ブロックにまとめるメッセージ数。
+
+        Returns:
+            (ブロックのマークダウンのリスト, 個別に表示するメッセージのリスト)。
+            ブロックには先頭から block_size 件ずつ区切ったうち、直近 recent 件を含まないものが入ります。
+        """
+        block_size = max(1, block_size)
+        block_count = max(0, len(messages) - max(0, recent)) // block_size
+        consolidated = block_count * block_size
+
+        blocks = []
+        for start in range(0, consolidated, block_size):
+            chunk = messages[start:start + block_size]
+            keys = [(message.id, content_hash(message.content)) for message in chunk]
+            blocks.append(self.render_block(chunk, keys))
+        return blocks, messages[consolidated:]
+
+# プロセス全体で共有するキャッシュ (同じスレッドを開いている全セッションで再利用する)
+_cache: MessageRenderCache | None = None
+_cache_lock = threading.Lock()
+
+def get_render_cache() -> MessageRenderCache:
+    """共有の MessageRenderCache を返します。"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = MessageRenderCache()
+        return _cache
+
+def render_chat_history(messages: list, cache: MessageRenderCache | None = None, timer=None,
+                        attachments: dict | None = None) -> None:
+    """
+    チャット履歴を表示します。
+    古いメッセージはキャッシュ済みのブロックとしてまとめて表示し、直近のメッセージだけを吹き出しで表示します。
+    timer (utils.perf_timing.PhaseTimer) を渡すと、整形 (history_conversion) と描画 (history_render) の時間を記録します。
+    attachments (メッセージ ID -> 添付ファイルのリスト) を渡すと、直近のメッセージに添付ファイル名を表示します。
+    """
+    import streamlit as st
+
+    with timer.phase("history_conversion") if timer is not None else nullcontext():
+        blocks, recent_messages = (cache or get_render_cache()).prepare_history(messages)
+    with timer.phase("history_render") if timer is not None else nullcontext():
+        if blocks:
+            with st.expander(f"以前のメッセージ ({len(messages) - len(recent_messages)} 件)", expanded=True):
+                for block in blocks:
+                    st.markdown(block)
+        for msg in recent_messages:
+            with st.chat_message(msg.role):
+                st.markdown(msg.content) # マークダウンとして表示
+                if attachments and attachments.get(msg.id):
+                    st.caption("📎 " + ", ".join(attachment.filename for attachment in attachments[msg.id]))
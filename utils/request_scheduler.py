@@ -0,0 +1,257 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextlib
+import itertools
+from collections import Counter, deque
+
+from utils.perf_timing import percentile
+
+log = logging.getLogger(__name__)
+
+# 優先度クラス (先にあるほど優先。上位のクラスに実行待ちがある間、下位のクラスは開始されない)
+INTERACTIVE = "interactive" # 画面や API からのチャット
+BATCH = "batch" # プロンプトの一括実行
+PRIORITY_CLASSES = (INTERACTIVE, BATCH)
+
+def _parse_mapping(value: str, cast) -> dict[int, object]:
+    """"1:2,5:0.5" 形式の環境変数を {プロジェクト ID: 値} にします。"""
+    mapping = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        project_id, _, setting = item.partition(":")
+        mapping[int(project_id)] = cast(setting)
+    return mapping
+
+# API 呼び出しのスケジューリングの設定 (環境変数で上書き可能)
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")) # 同時に実行する API のストリーミングの最大数 (プロセスごと)
+SCHEDULER_PROJECT_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_PROJECT_MAX_CONCURRENCY", "0")) # 1プロジェクトの同時実行数の上限。0 で無制限
+SCHEDULER_PROJECT_LIMITS = _parse_mapping(os.getenv("SCHEDULER_PROJECT_LIMITS", ""), int) # プロジェクトごとの上限 ("ID:上限,...")
+SCHEDULER_PROJECT_WEIGHTS = _parse_mapping(os.getenv("SCHEDULER_PROJECT_WEIGHTS", ""), float) # プロジェクトごとの重み ("ID:重み,..."。既定は 1)
+SCHEDULER_WAIT_SAMPLES = 1000 # 待ち時間の集計に使う直近の件数 (優先度クラスごと)
+SCHEDULER_CANCEL_POLL_SECONDS = 0.1 # 実行枠を待っている間に中止されたかを確認する間隔 (秒)
+
+class SlotCancelled(Exception):
+    """実行枠を待っている間にリクエストが中止された (cancel_event が set された)"""
+
+class _Ticket:
+    """実行待ち・実行中の1件のリクエスト"""
+
+    def __init__(self, seq: int, project_id, user, priority: str):
+        self.seq = seq
+        self.project_id = project_id
+        self.user = user
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.released = False
+        self.event = threading.Event() # 同期版の待ち合わせ
+        self.future: asyncio.Future | None = None # 非同期版の待ち合わせ
+
+class FairScheduler:
+    """
+    Gemini API の呼び出しの開始順を決めるスケジューラー。全てのセッションで1つの API の割り当て (同時実行数) を共有します。
+
+    - 優先度クラス: 対話 (INTERACTIVE) のリクエストが待っている間は、一括実行 (BATCH) のリクエストを開始しません。
+    - 重み付き公平キューイング: 同じクラスの中では、これまでに開始したリクエスト数を重みで割った値 (仮想的な使用量) が
+      最も少ないプロジェクトから開始し、プロジェクトの中ではユーザーの間で同じように順番を回します。
+      しばらく使っていなかったプロジェクトは、実行中のプロジェクトの最小の使用量から始めます (使わなかった分を溜め込まない)。
+    - プロジェクトごとの同時実行数の上限: 上限に達したプロジェクトのリクエストは、他のプロジェクトを先に開始します。
+
+    このスケジューラーはプロセスの中で共有します。別のプロセス (一括実行のコマンド、API サーバーのワーカー) とは共有しません。
+    """
+
+    def __init__(self,
+                 capacity: int = GEMINI_MAX_CONCURRENCY,
+                 project_max_concurrency: int = SCHEDULER_PROJECT_MAX_CONCURRENCY,
+                 project_limits: dict | None = None,
+                 project_weights: dict | None = None):
+        self.capacity = max(1, capacity)
+        self.project_max_concurrency = project_max_concurrency
+        self.project_limits = dict(SCHEDULER_PROJECT_LIMITS if project_limits is None else project_limits)
+        self.project_weights = dict(SCHEDULER_PROJECT_WEIGHTS if project_weights is None else project_weights)
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        # 優先度クラス -> プロジェクト -> ユーザー -> 実行待ちのリクエスト (到着順)
+        self._waiting: dict[str, dict] = {priority: {} for priority in PRIORITY_CLASSES}
+        self._running = 0
+        self._running_by_project: Counter = Counter()
+        self._running_by_user: Counter = Counter()
+        self._project_service: dict = {} # プロジェクト -> 仮想的な使用量 (実行待ち・実行中のプロジェクトのみ)
+        self._user_service: dict = {} # (プロジェクト, ユーザー) -> 開始したリクエスト数 (同上)
+        self._waits: dict[str, deque] = {priority: deque(maxlen=SCHEDULER_WAIT_SAMPLES) for priority in PRIORITY_CLASSES}
+        self._granted: Counter = Counter()
+
+    # --- 取得と解放 ---
+    @contextlib.contextmanager
+    def slot(self, project_id=None, user=None, priority: str = INTERACTIVE,
+             cancel_event: threading.Event | None = None):
+        """
+        実行枠を取得するまで待ち、with 文を抜けると解放します。
+        cancel_event を指定した場合、待っている間に set されると実行待ちから外して SlotCancelled を送出します
+        (生成ジョブのワーカーなど、待っている間もスレッドを占有する呼び出し元が中止できるように)。
+        """
+        ticket = self._enqueue(project_id, user, priority)
+        try:
+            if cancel_event is None:
+                ticket.event.wait()
+            else:
+                while not ticket.event.wait(SCHEDULER_CANCEL_POLL_SECONDS):
+                    if cancel_event.is_set():
+                        raise SlotCancelled(f"実行枠を待っている間に中止されました (project={project_id}, user={user})")
+            yield
+        finally:
+            self._release(ticket)
+
+    @contextlib.asynccontextmanager
+    async def slot_async(self, project_id=None, user=None, priority: str = INTERACTIVE):
+        """slot の非同期版 (イベントループを止めずに待つ)。"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        ticket = self._enqueue(project_id, user, priority, future=future)
+        try:
+            await future
+            yield
+        finally:
+            self._release(ticket)
+
+    def _enqueue(self, project_id, user, priority: str, future: asyncio.Future | None = None) -> _Ticket:
+        if priority not in self._waiting:
+            raise ValueError(f"不明な優先度クラスです: {priority} (指定できるのは {', '.join(PRIORITY_CLASSES)})")
+        with self._lock:
+            ticket = _Ticket(next(self._seq), project_id, user, priority)
+            ticket.future = future
+            flow = (project_id, user)
+            # 使っていなかったプロジェクト・ユーザーは、動いているものの最小の使用量から始める
+            if project_id not in self._project_service:
+                self._project_service[project_id] = min(self._project_service.values(), default=0.0)
+            if flow not in self._user_service:
+                self._user_service[flow] = min((service for (other, _), service in self._user_service.items()
+                                                if other == project_id), default=0.0)
+            self._waiting[priority].setdefault(project_id, {}).setdefault(user, deque()).append(ticket)
+            self._dispatch()
+        return ticket
+
+    def _release(self, ticket: _Ticket) -> None:
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted:
+                self._running -= 1
+                self._running_by_project[ticket.project_id] -= 1
+                self._running_by_user[(ticket.project_id, ticket.user)] -= 1
+            else:
+                # 待っている間に中止・切断された
+                users = self._waiting[ticket.priority].get(ticket.project_id, {})
+                queue = users.get(ticket.user)
+                if queue is not None and ticket in queue:
+                    queue.remove(ticket)
+                    self._drop_empty(ticket.priority, ticket.project_id, ticket.user)
+            self._forget_idle(ticket.project_id, ticket.user)
+            self._dispatch()
+
+    # --- 順番の決定 (ロックを取った状態で呼ぶ) ---
+    def project_limit(self, project_id) -> int:
+        """プロジェクトの同時実行数の上限 (0 は無制限)。"""
+        return self.project_limits.get(project_id, self.project_max_concurrency)
+
+    def _has_room(self, project_id) -> bool:
+        limit = self.project_limit(project_id)
+        return limit <= 0 or self._running_by_project[project_id] < limit
+
+    def _next_ticket(self) -> _Ticket | None:
+        for priority in PRIORITY_CLASSES:
+            projects = self._waiting[priority]
+            candidates = [project_id for project_id in projects if self._has_room(project_id)]
+            if not candidates:
+                continue
+            project_id = min(candidates, key=lambda p: (self._project_service[p],
+                                                        min(queue[0].seq for queue in projects[p].values())))
+            users = projects[project_id]
+            user = min(users, key=lambda u: (self._user_service[(project_id, u)], users[u][0].seq))
+            ticket = users[user].popleft()
+            self._drop_empty(priority, project_id, user)
+            return ticket
+        return None
+
+    def _dispatch(self) -> None:
+        while self._running < self.capacity:
+            ticket = self._next_ticket()
+            if ticket is None:
+                return
+            ticket.granted = True
+            self._running += 1
+            self._running_by_project[ticket.project_id] += 1
+            self._running_by_user[(ticket.project_id, ticket.user)] += 1
+            self._project_service[ticket.project_id] += 1.0 / self.project_weights.get(ticket.project_id, 1.0)
+            self._user_service[(ticket.project_id, ticket.user)] += 1.0
+            self._waits[ticket.priority].append((time.monotonic() - ticket.enqueued_at) * 1000)
+            self._granted[ticket.priority] += 1
+            if ticket.future is not None:
+                loop = ticket.future.get_loop()
+                loop.call_soon_threadsafe(lambda future=ticket.future: future.done() or future.set_result(None))
+            else:
+                ticket.event.set()
+
+    def _drop_empty(self, priority: str, project_id, user) -> None:
+        users = self._waiting[priority][project_id]
+        if not users[user]:
+            del users[user]
+        if not users:
+            del self._waiting[priority][project_id]
+
+    def _forget_idle(self, project_id, user) -> None:
+        """実行待ち・実行中のリクエストが無くなったプロジェクト・ユーザーの使用量を消す (次は最小の使用量から始める)"""
+        waiting = [self._waiting[priority].get(project_id, {}) for priority in PRIORITY_CLASSES]
+        if not self._running_by_user[(project_id, user)] and not any(user in users for users in waiting):
+            self._user_service.pop((project_id, user), None)
+            del self._running_by_user[(project_id, user)]
+        if not self._running_by_project[project_id] and not any(waiting):
+            self._project_service.pop(project_id, None)
+            del self._running_by_project[project_id]
+
+    # --- 計測 ---
+    def metrics(self) -> dict:
+        """
+        キューの深さと待ち時間を返します (割り当ての大きさの見積もり用)。
+
+        Returns:
+            {"capacity", "running", "queued": {クラス: 件数}, "granted": {クラス: 開始した件数},
+             "wait_ms": {クラス: {"count", "p50_ms", "p95_ms", "max_ms"} (直近 SCHEDULER_WAIT_SAMPLES 件)},
+             "projects": {プロジェクト: {"running", "queued", "limit"}}}
+        """
+        with self._lock:
+            queued = {priority: sum(len(queue) for users in projects.values() for queue in users.values())
+                      for priority, projects in self._waiting.items()}
+            projects: dict = {}
+            for project_id in set(self._running_by_project) | {p for ps in self._waiting.values() for p in ps}:
+                projects[project_id] = {
+                    "running": self._running_by_project[project_id],
+                    "queued": sum(len(queue) for ps in self._waiting.values() for queue in ps.get(project_id, {}).values()),
+                    "limit": self.project_limit(project_id),
+                }
+            waits = {priority: list(samples) for priority, samples in self._waits.items()}
+            return {
+                "capacity": self.capacity,
+                "running": self._running,
+                "queued": queued,
+                "granted": {priority: self._granted[priority] for priority in PRIORITY_CLASSES},
+                "wait_ms": {priority: {"count": len(values), "p50_ms": percentile(values, 0.5),
+                                       "p95_ms": percentile(values, 0.95), "max_ms": max(values)}
+                            for priority, values in waits.items() if values},
+                "projects": projects,
+            }
+
+# プロセス全体で共有するスケジューラー
+_scheduler: FairScheduler | None = None
+_scheduler_lock = threading.Lock()
+
+def get_request_scheduler() -> FairScheduler:
+    """共有の FairScheduler を返します。"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = FairScheduler()
+        return _scheduler
@@ -0,0 +1,256 @@
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Callable, Iterator, AsyncIterator, Generator, AsyncGenerator
+
+log = logging.getLogger(__name__)
+
+_CANCEL_POLL_SECONDS = 0.1 # 購読者がチャンクを待っている間に中止されたかを確認する間隔 (秒)
+
+def request_key(*parts) -> str:
+    """
+    リクエストの内容 (モデル名・システムプロンプト・履歴など JSON に変換できる値) から、同一判定用のキーを作ります。
+    pydantic のモデル (google.genai.types.Content など) は JSON 形式の dict に変換してから比較します。
+    """
+    def to_json(value):
+        if hasattr(value, "model_dump"):
+            return value.model_dump(mode="json", exclude_none=True)
+        raise TypeError(f"{type(value).__name__} はキーに使えません")
+    payload = json.dumps(parts, default=to_json, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class _Flight:
+    """実行中の1本の上流ストリーム。届いたチャンクは途中から加わった購読者に再送するため全て保持する。"""
+
+    def __init__(self):
+        self.chunks: list[str] = []
+        self.usage: dict = {} # 上流のストリームが書き込むトークン数とレイテンシ
+        self.error: BaseException | None = None
+        self.finished = False
+        self.abandoned = threading.Event() # 購読者が全員いなくなった (上流を止める。実行枠の待ちも中止する)
+        self.subscribers = 0
+        self.recipients: list[dict] = [] # 購読中の購読者の usage (加わった順)。上流の終了時に先頭にトークン数を書き込む
+        self.changed: asyncio.Event | None = None # 非同期版: チャンクの追加・完了で set する (チャンクごとに作り直す)
+        self.task: asyncio.Task | None = None # 非同期版: 上流のストリームを読み込むタスク
+
+    def attach(self, usage: dict | None) -> None:
+        self.subscribers += 1
+        if usage is not None:
+            self.recipients.append(usage)
+
+    def detach(self, usage: dict | None) -> None:
+        self.subscribers -= 1
+        # 中身が同じ dict を取り違えないよう、同一性で比較する
+        self.recipients = [recipient for recipient in self.recipients if recipient is not usage]
+
+    def hand_over_tokens(self) -> None:
+        """
+        上流のストリームが終わった時点で購読中の購読者のうち、最初に加わったものの usage にだけトークン数を書き込みます
+        (1回分の料金を複数のメッセージで重複して集計せず、途中で抜けた購読者の分として失われないようにするため)。
+        """
+        if self.recipients:
+            self.recipients[0].update({key: value for key, value in self.usage.items() if key.endswith("_tokens")})
+
+def _record_subscriber_usage(usage: dict | None, joined: float, first_chunk_at: float | None) -> None:
+    """購読者の usage に時間を書き込みます。時間は購読者ごとに、加わった時点から計測します (トークン数は _Flight.hand_over_tokens)。"""
+    if usage is None:
+        return
+    if first_chunk_at is not None:
+        usage["time_to_first_token_ms"] = round((first_chunk_at - joined) * 1000, 1)
+    usage["latency_ms"] = round((time.perf_counter() - joined) * 1000, 1)
+
+class SingleFlight:
+    """
+    同じ内容のストリーミングリクエストが同時に実行されている場合に、上流のストリームを1本にまとめます。
+
+    ダブルクリックやタブの再読み込み、共有プロジェクトで同じ質問が同時に送られた場合でも、API の呼び出し (と料金) は1回です。
+    上流のストリームは専用のスレッドで読み込み、届いたチャンクを全ての購読者に配ります。
+    途中から加わった購読者には、それまでのチャンクを先に再送します。
+    購読者が全員いなくなった (中止・切断) 場合は、上流のストリームも止めます。
+    完了したストリームは保持しないため、完了後の同じリクエストは新しく実行されます。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock) # チャンクの追加・完了を購読者に知らせる
+        self._flights: dict[str, _Flight] = {}
+        self.started = 0 # 上流のストリームを開始した回数
+        self.joined = 0 # 実行中のストリームに相乗りした回数
+
+    def in_flight(self) -> int:
+        """実行中の上流のストリームの数。"""
+        with self._lock:
+            return len(self._flights)
+
+    def stream(self, key: str, open_stream: Callable[[dict, threading.Event], Iterator[str]],
+               usage: dict | None = None, cancel_event: threading.Event | None = None) -> Generator[str, None, None]:
+        """
+        key が同じ実行中のストリームがあれば相乗りし、無ければ open_stream(usage, stop_event) で上流のストリームを開始します。
+
+        Args:
+            key: リクエストの同一判定のキー (request_key)。
+            open_stream: 上流のストリームを開く関数。引数の dict にトークン数などを書き込むこと。
+                         stop_event は購読者が全員いなくなると set されます (実行枠の待ちなどを中止するため)。
+            usage: 指定した場合、時間と (上流の終了時に購読中の最初の購読者であれば) トークン数を書き込みます。
+            cancel_event: 指定した場合、最初のチャンクなどを待っている間に set されると購読をやめて戻ります。
+
+        Yields:
+            上流のストリームのチャンク (先頭から全て)。
+
+        Raises:
+            上流のストリームで発生した例外。
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.started += 1
+                threading.Thread(target=self._pump, args=(key, flight, open_stream),
+                                 name="single-flight-stream", daemon=True).start()
+            else:
+                self.joined += 1
+                log.info(f"実行中の同じリクエストの応答を共有します (key={key[:12]}, 購読者={flight.subscribers + 1})")
+            flight.attach(usage)
+        joined = time.perf_counter()
+        first_chunk_at = None
+        position = 0
+        try:
+            while True:
+                with self._changed:
+                    ready = self._changed.wait_for(lambda: position < len(flight.chunks) or flight.finished,
+                                                   timeout=None if cancel_event is None else _CANCEL_POLL_SECONDS)
+                    new_chunks = flight.chunks[position:]
+                    finished = flight.finished
+                if not ready:
+                    if cancel_event.is_set():
+                        return
+                    continue
+                for chunk in new_chunks:
+                    if first_chunk_at is None:
+                        first_chunk_at = time.perf_counter()
+                    yield chunk
+                position += len(new_chunks)
+                if finished and position >= len(flight.chunks):
+                    break
+            if flight.error is not None:
+                raise flight.error
+        finally:
+            with self._lock:
+                flight.detach(usage)
+                if flight.subscribers == 0 and not flight.finished:
+                    # 後から来た同じリクエストは、止めている途中のストリームに加わらずに新しく開始する
+                    flight.abandoned.set()
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+            _record_subscriber_usage(usage, joined, first_chunk_at)
+
+    def _pump(self, key: str, flight: _Flight, open_stream: Callable[[dict, threading.Event], Iterator[str]]) -> None:
+        """上流のストリームを読み込み、チャンクを購読者に配る (専用のスレッドで実行)"""
+        upstream = None
+        try:
+            if flight.abandoned.is_set(): # リクエストを送る前に購読者が全員いなくなった
+                return
+            upstream = open_stream(flight.usage, flight.abandoned)
+            for chunk in upstream:
+                if flight.abandoned.is_set():
+                    break
+                with self._changed:
+                    flight.chunks.append(chunk)
+                    self._changed.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            if hasattr(upstream, "close"):
+                upstream.close() # 途中で止めた場合に接続を閉じる
+            with self._changed:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                if not flight.abandoned.is_set():
+                    flight.hand_over_tokens()
+                flight.finished = True
+                self._changed.notify_all()
+
+class AsyncSingleFlight:
+    """
+    SingleFlight の非同期版 (API サーバー用)。上流のストリームはイベントループのタスクで読み込みます。
+    イベントループごとに独立しています (ワーカープロセスの間では共有しません)。
+    """
+
+    def __init__(self):
+        self._flights: dict[tuple[int, str], _Flight] = {}
+        self.started = 0
+        self.joined = 0
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    async def stream(self, key: str, open_stream: Callable[[dict], AsyncIterator[str]],
+                     usage: dict | None = None) -> AsyncGenerator[str, None]:
+        """
+        SingleFlight.stream の非同期版。open_stream(usage) は非同期イテレーターを返します
+        (購読者が全員いなくなった場合は上流を読み込むタスクを中止するため、stop_event は渡しません)。
+        """
+        loop = asyncio.get_running_loop()
+        flight_key = (id(loop), key)
+        flight = self._flights.get(flight_key)
+        if flight is None:
+            flight = self._flights[flight_key] = _Flight()
+            flight.changed = asyncio.Event()
+            flight.task = loop.create_task(self._pump(flight_key, flight, open_stream))
+            self.started += 1
+        else:
+            self.joined += 1
+            log.info(f"実行中の同じリクエストの応答を共有します (key={key[:12]}, 購読者={flight.subscribers + 1})")
+        flight.attach(usage)
+        joined = time.perf_counter()
+        first_chunk_at = None
+        position = 0
+        try:
+            while True:
+                if position >= len(flight.chunks) and not flight.finished:
+                    await flight.changed.wait()
+                    continue
+                new_chunks = flight.chunks[position:]
+                for chunk in new_chunks:
+                    if first_chunk_at is None:
+                        first_chunk_at = time.perf_counter()
+                    yield chunk
+                position += len(new_chunks)
+                if flight.finished and position >= len(flight.chunks):
+                    break
+            if flight.error is not None:
+                raise flight.error
+        finally:
+            flight.detach(usage)
+            if flight.subscribers == 0 and not flight.finished:
+                flight.abandoned.set()
+                if self._flights.get(flight_key) is flight:
+                    del self._flights[flight_key]
+                flight.task.cancel() # 購読者がいなくなったら上流のストリームを止める
+            _record_subscriber_usage(usage, joined, first_chunk_at)
+
+    async def _pump(self, flight_key: tuple[int, str], flight: _Flight,
+                    open_stream: Callable[[dict], AsyncIterator[str]]) -> None:
+        """上流のストリームを読み込み、チャンクを購読者に配る"""
+        try:
+            if flight.abandoned.is_set():
+                return
+            async for chunk in open_stream(flight.usage):
+                flight.chunks.append(chunk)
+                # 待っている購読者を起こし、次のチャンク用に作り直す
+                changed, flight.changed = flight.changed, asyncio.Event()
+                changed.set()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            flight.error = e
+        finally:
+            if self._flights.get(flight_key) is flight:
+                del self._flights[flight_key]
+            if not flight.abandoned.is_set():
+                flight.hand_over_tokens()
+            flight.finished = True
+            flight.changed.set()
@@ -0,0 +1,174 @@
+import os
+import time
+import atexit
+import logging
+import datetime
+import threading
+import functools
+from typing import Callable
+
+log = logging.getLogger(__name__)
+
+# 空チャットの掃除の設定 (環境変数で上書き可能)
+EMPTY_THREAD_SWEEP_INTERVAL = float(os.getenv("EMPTY_THREAD_SWEEP_INTERVAL", "300")) # 掃除の間隔 (秒)。0 以下で無効
+EMPTY_THREAD_GRACE_SECONDS = float(os.getenv("EMPTY_THREAD_GRACE_SECONDS", "3600")) # 作成からこの秒数が経つまでは削除しない
+EMPTY_THREAD_SWEEP_BATCH = int(os.getenv("EMPTY_THREAD_SWEEP_BATCH", "200")) # 1トランザクションで削除する最大件数
+EMPTY_THREAD_SESSION_TTL = float(os.getenv("EMPTY_THREAD_SESSION_TTL", str(24 * 3600))) # 表示中のチャットの保護を解除するまでの秒数 (閉じたセッション用)
+THREAD_LEASE_SECONDS = float(os.getenv("THREAD_LEASE_SECONDS", "900")) # 表示中・生成中のチャットをアーカイブから除ける印の有効期間 (掃除の間隔より長くする)
+
+def _default_session_factory():
+    from database.database import SessionLocal
+    return SessionLocal()
+
+def _default_busy_thread_ids() -> set[int]:
+    # 実行待ちのジョブはまだユーザーメッセージを保存していないため、空に見える
+    from utils.generation_jobs import get_generation_runner
+    return get_generation_runner().active_thread_ids()
+
+class EmptyThreadSweeper:
+    """
+    メッセージが1件も無いチャットを、バックグラウンドスレッドで定期的に少しずつ削除します。
+
+    「新規チャット」のたびにプロジェクト全体を走査して削除すると、新しいチャットが表示されるまでの時間が延びるため、
+    削除はこのクラスにまとめています。次のチャットは削除しません:
+    - 作成から grace_seconds 秒が経っていないチャット
+    - いずれかのセッションが表示中のチャット (protect() で登録)
+    - 応答を生成中・実行待ちのチャット
+
+    掃除のたびに、表示中・生成中のチャットに lease_seconds 秒間有効な印 (thread_leases) を付け、
+    別のプロセスで実行するアーカイブ (python -m database.archive) に移されないようにします。
+
+    blob_store を渡すと、どのメッセージからも参照されなくなって grace_seconds 秒が経った添付ファイルも削除します。
+    shards (database.sharding.ShardRouter) を渡すと、session_factory の代わりに全プロジェクトの DB を順に掃除します。
+    """
+
+    def __init__(self,
+                 session_factory: Callable = _default_session_factory,
+                 interval: float = EMPTY_THREAD_SWEEP_INTERVAL,
+                 grace_seconds: float = EMPTY_THREAD_GRACE_SECONDS,
+                 batch_size: int = EMPTY_THREAD_SWEEP_BATCH,
+                 session_ttl: float = EMPTY_THREAD_SESSION_TTL,
+                 busy_thread_ids: Callable[[], set[int]] = _default_busy_thread_ids,
+                 blob_store=None,
+                 shards=None,
+                 lease_seconds: float = THREAD_LEASE_SECONDS):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.grace_seconds = grace_seconds
+        self.batch_size = max(1, batch_size)
+        self.session_ttl = session_ttl
+        self.busy_thread_ids = busy_thread_ids
+        self.blob_store = blob_store
+        self.shards = shards
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._protected: dict[str, tuple[int, float]] = {} # セッションのキー -> (表示中のチャット ID, 最後に登録した時刻)
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> "EmptyThreadSweeper":
+        """掃除のスレッドを開始します (開始済み・無効の場合は何もしません)。"""
+        with self._lock:
+            if self._thread is None and self.interval > 0:
+                self._thread = threading.Thread(target=self._run, name="empty-thread-sweeper", daemon=True)
+                self._thread.start()
+        return self
+
+    def protect(self, session_key: str, thread_id: int | None) -> None:
+        """セッションが表示中のチャットを登録します (再実行ごとに呼ぶ。None で登録を解除)。"""
+        with self._lock:
+            if thread_id is None:
+                self._protected.pop(session_key, None)
+            else:
+                self._protected[session_key] = (thread_id, time.monotonic())
+
+    def protected_thread_ids(self) -> set[int]:
+        """削除しないチャットの ID (表示中・生成中)。"""
+        now = time.monotonic()
+        with self._lock:
+            for session_key, (_, seen_at) in list(self._protected.items()):
+                if now - seen_at > self.session_ttl:
+                    del self._protected[session_key]
+            protected = {thread_id for thread_id, _ in self._protected.values()}
+        return protected | set(self.busy_thread_ids())
+
+    def sweep_once(self) -> int:
+        """
+        猶予期間を過ぎた空チャットを batch_size 件ずつ、無くなるまで削除します。
+
+        Returns:
+            削除したチャットの数。
+        """
+        created_before = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.grace_seconds)
+        total = 0
+        for session_factory in self._session_factories():
+            if self._stop.is_set():
+                break
+            total += self._sweep_database(session_factory, created_before)
+        if total:
+            log.info(f"空のチャットを {total} 件削除しました。")
+        return total
+
+    def _session_factories(self) -> list[Callable]:
+        if self.shards is None:
+            return [self.session_factory]
+        return [functools.partial(self.shards.session_for_project, project_id) for project_id in self.shards.project_ids()]
+
+    def _sweep_database(self, session_factory: Callable, created_before: datetime.datetime) -> int:
+        from database.crud import delete_stale_empty_threads, collect_unreferenced_attachments
+        from database.archive import lease_threads
+
+        # 分割保存では同じ内容のファイルを別のプロジェクトの DB が参照していることがある
+        blob_store = self.blob_store
+        if blob_store is not None and self.shards is not None:
+            blob_store = self.shards.shared_blob_store(blob_store)
+        total = 0
+        try:
+            db = session_factory()
+        except LookupError: # 掃除の途中で削除されたプロジェクト
+            return 0
+        try:
+            lease_threads(db, self.protected_thread_ids(), self.lease_seconds)
+            while not self._stop.is_set():
+                # バッチごとに取り直す (掃除の途中で開かれたチャットも消さない)
+                deleted = delete_stale_empty_threads(db, created_before, self.batch_size, self.protected_thread_ids())
+                total += deleted
+                if deleted < self.batch_size:
+                    break
+            # チャットの削除で参照が無くなった添付ファイルも片付ける
+            while blob_store is not None and not self._stop.is_set():
+                if collect_unreferenced_attachments(db, blob_store, created_before, self.batch_size) < self.batch_size:
+                    break
+        finally:
+            db.close()
+        return total
+
+    def close(self, timeout: float | None = None) -> None:
+        """掃除のスレッドを終了します。"""
+        self._stop.set()
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep_once()
+            except Exception as e:
+                log.error(f"空チャットの掃除中にエラーが発生しました: {e}", exc_info=True)
+
+# プロセス全体で共有する掃除のスレッド
+_sweeper: EmptyThreadSweeper | None = None
+_sweeper_lock = threading.Lock()
+
+def get_empty_thread_sweeper() -> EmptyThreadSweeper:
+    """共有の EmptyThreadSweeper を返します (初回に掃除のスレッドを開始します)。"""
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is None:
+            from utils.blob_store import get_blob_store
+            from database.sharding import get_shard_router
+            _sweeper = EmptyThreadSweeper(blob_store=get_blob_store(), shards=get_shard_router()).start()
+            atexit.register(_sweeper.close, 1.0)
+        return _sweeper